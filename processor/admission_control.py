@@ -0,0 +1,93 @@
+# processor/admission_control.py - Admission limits for concurrent Pub/Sub pushes on one processor instance.
+# Cloud Run delivers up to `max_instance_request_concurrency` pushes to an instance at once; each one downloads a pcap
+# into the (RAM-backed) temp dir and produces intermediate files, so a burst of large captures can exhaust memory.
+# Before any work is done, a request must be admitted against two budgets:
+# - in-flight files (MAX_IN_FLIGHT_FILES),
+# - estimated temp bytes (MAX_TEMP_BYTES; the estimate depends on the processing mode, see processor_app.py).
+# A request that does not fit is rejected with a retryable status (429), so Pub/Sub redelivers it later with backoff
+# instead of the instance running out of memory. A single file larger than the byte budget is still admitted when
+# nothing else is in flight, otherwise it could never be processed.
+
+import logging
+import os
+import threading
+
+def detect_memory_limit_bytes():
+    """Container memory limit (cgroup v2, then v1), else physical memory. None if it cannot be determined."""
+    for limit_path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(limit_path) as f_limit:
+                limit_text = f_limit.read().strip()
+            if limit_text.isdigit() and int(limit_text) < 1 << 60: # v1 reports a huge number when unlimited
+                return int(limit_text)
+        except OSError:
+            continue
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def available_cpu_count():
+    """CPUs this process may run on (respects affinity / cpusets), at least 1."""
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return max(1, os.cpu_count() or 1)
+
+class AdmissionController:
+    """
+    Thread-safe in-flight file / temp byte budget. `try_admit` returns a ticket (the reserved byte count) or None;
+    every admitted ticket must be passed back to `release`.
+    """
+    def __init__(self, max_in_flight_files, max_temp_bytes):
+        self.max_in_flight_files = max_in_flight_files
+        self.max_temp_bytes = max_temp_bytes
+        self.in_flight_files = 0
+        self.in_flight_bytes = 0
+        self.admitted = 0
+        self.rejected = {} # reason -> count
+        self._lock = threading.Lock()
+
+    def try_admit(self, estimated_temp_bytes, source_name):
+        with self._lock:
+            if self.in_flight_files >= self.max_in_flight_files:
+                rejection_reason = "in_flight_files"
+            elif self.in_flight_files and self.in_flight_bytes + estimated_temp_bytes > self.max_temp_bytes:
+                rejection_reason = "temp_bytes"
+            else:
+                if estimated_temp_bytes > self.max_temp_bytes:
+                    logging.warning(f"{source_name} needs ~{estimated_temp_bytes} temp bytes, above MAX_TEMP_BYTES "
+                                    f"({self.max_temp_bytes}); admitted alone.")
+                self.in_flight_files += 1
+                self.in_flight_bytes += estimated_temp_bytes
+                self.admitted += 1
+                return estimated_temp_bytes
+            self.rejected[rejection_reason] = self.rejected.get(rejection_reason, 0) + 1
+            in_flight_files, in_flight_bytes = self.in_flight_files, self.in_flight_bytes
+        logging.warning(f"ADMISSION_REJECTED: {rejection_reason} FILE: {source_name} "
+                        f"(in flight: {in_flight_files} files, ~{in_flight_bytes} temp bytes)")
+        return None
+
+    def release(self, ticket):
+        with self._lock:
+            self.in_flight_files -= 1
+            self.in_flight_bytes -= ticket
+
+    def prometheus_lines(self):
+        with self._lock:
+            lines = ["# HELP pcap_processor_in_flight_files Files admitted and not yet finished (queue depth).",
+                     "# TYPE pcap_processor_in_flight_files gauge",
+                     f"pcap_processor_in_flight_files {self.in_flight_files}",
+                     "# HELP pcap_processor_in_flight_temp_bytes Estimated temp bytes reserved by in-flight files.",
+                     "# TYPE pcap_processor_in_flight_temp_bytes gauge",
+                     f"pcap_processor_in_flight_temp_bytes {self.in_flight_bytes}",
+                     "# HELP pcap_processor_admission_limit Configured admission limits.",
+                     "# TYPE pcap_processor_admission_limit gauge",
+                     f'pcap_processor_admission_limit{{resource="in_flight_files"}} {self.max_in_flight_files}',
+                     f'pcap_processor_admission_limit{{resource="temp_bytes"}} {self.max_temp_bytes}',
+                     "# HELP pcap_processor_admitted_total Requests admitted.", "# TYPE pcap_processor_admitted_total counter",
+                     f"pcap_processor_admitted_total {self.admitted}",
+                     "# HELP pcap_processor_rejected_total Requests rejected with 429, by exhausted budget.",
+                     "# TYPE pcap_processor_rejected_total counter"]
+            lines += [f'pcap_processor_rejected_total{{reason="{reason}"}} {count}' for reason, count in sorted(self.rejected.items())]
+        return lines
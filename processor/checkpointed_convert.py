@@ -0,0 +1,189 @@
+# processor/checkpointed_convert.py - Checkpointed, resumable conversion of large captures across Pub/Sub retries.
+# A capture too large to finish within one request (600 s timeout, instance recycled) used to restart from frame 1
+# on every redelivery and could fail forever. Here the conversion is committed in numbered parts:
+# 1. The pcap is cut into frame ranges of `part_packets` frames with editcap (`-r <first>-` drops the frames already
+#    committed by an earlier attempt, `-c` splits the rest) and the ranges are converted in the shared process pool.
+# 2. In frame order, each converted range is written as an output fragment (NDJSON lines, or a piece of the JSON
+#    array; gzip members when compressed), uploaded as `<prefix><job>/part-NNNNN`, and then the manifest
+#    `<prefix><job>/manifest.json` is rewritten with the next frame to convert and the counters so far.
+# 3. When all frames are committed, the parts (plus the closing bracket for JSON) are composed server-side into the
+#    final object (GCS compose takes at most 32 sources per call, so larger sets are composed in levels) and the
+#    part objects and the manifest are deleted.
+# A retry reads the manifest, skips the committed parts and resumes at `next_frame`, so its cost is proportional to
+# the remaining frames. Concatenated fragments are byte-identical to a single-pass output (gzip: multi-member stream).
+# The job key is `<object>@<generation>`, so a re-uploaded capture never resumes from another file's parts.
+# Parts and manifest live next to the output (compose requires one bucket) under CHECKPOINT_PREFIX.
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from google.api_core import exceptions as google_api_exceptions
+
+import json2udm_cloud
+import json_backends
+import parallel_convert
+import pcap_pipeline
+
+GCS_COMPOSE_MAX_SOURCES = 32
+
+def _job_prefix(checkpoint_prefix, job_key):
+    return f"{checkpoint_prefix}{job_key}/"
+
+def load_manifest(bucket, job_prefix):
+    """The committed manifest of a job, or None if the job has not committed anything yet."""
+    manifest_blob = bucket.get_blob(job_prefix + "manifest.json")
+    if manifest_blob is None:
+        return None
+    try:
+        return json.loads(manifest_blob.download_as_bytes())
+    except (google_api_exceptions.NotFound, ValueError):
+        return None
+
+def _new_manifest(source_name, output_format, compress, part_packets, input_format, flow_settings):
+    stats = json2udm_cloud.new_conversion_stats()
+    stats.update({"tshark_output_bytes": 0, "udm_output_bytes": 0, "chunks": 0})
+    return {"source": source_name, "output_format": output_format, "compress": compress, "part_packets": part_packets,
+            "input_format": input_format, "flow_settings": flow_settings, "next_frame": 1, "events_written": 0,
+            "parts": [], "stats": stats, "complete": False}
+
+def _settings_match(manifest, output_format, compress, part_packets, input_format, flow_settings):
+    """A manifest written with other output settings cannot be continued (the fragments would not fit together)."""
+    return (manifest.get("output_format"), manifest.get("compress"), manifest.get("part_packets"),
+            manifest.get("input_format"), manifest.get("flow_settings")) == (output_format, compress, part_packets,
+                                                                            input_format, flow_settings)
+
+def cut_remaining_frames(pcap_path, first_frame, work_dir):
+    """Copy of `pcap_path` without the frames before `first_frame` (editcap -r keeps the selected range)."""
+    remaining_path = os.path.join(work_dir, "remaining.pcap")
+    subprocess.run(["editcap", "-r", pcap_path, remaining_path, f"{first_frame}-"], capture_output=True, text=True, check=True)
+    return remaining_path
+
+def write_part_fragment(ndjson_part_path, fragment_path, output_format, compress, preceding_events, lead_separator=True):
+    """
+    Turns a converted range (NDJSON) into the fragment it contributes to the final object: the NDJSON itself, or
+    the JSON array piece continuing after `preceding_events` events (no closing bracket; with `lead_separator=False`
+    no "[" or "," before its first event either). Returns the event count.
+    """
+    with open(ndjson_part_path, "rb") as f_part, open(fragment_path, "wb") as f_fragment:
+        if output_format == "ndjson":
+            event_count = 0
+            out_stream = gzip.GzipFile(fileobj=f_fragment, mode="wb", mtime=0) if compress else f_fragment
+            for line in f_part:
+                out_stream.write(line)
+                event_count += 1
+            if compress:
+                out_stream.close()
+            return event_count
+        return json2udm_cloud.write_udm_events((json_backends.loads(line) for line in f_part), f_fragment, output_format, compress,
+                                               preceding_events=preceding_events, close_array=False, lead_separator=lead_separator)
+
+def convert_with_checkpoints(pcap_path, bucket, checkpoint_prefix, job_key, source_name, max_workers, part_packets,
+                             output_format="json", compress=False, input_format="json", flow_settings=None):
+    """
+    Converts `pcap_path` into committed parts under `<checkpoint_prefix><job_key>/` in `bucket`, resuming from the
+    job's manifest if an earlier attempt committed some. Returns the complete manifest (pass it to `finalize_parts`).
+    """
+    job_prefix = _job_prefix(checkpoint_prefix, job_key)
+    manifest = load_manifest(bucket, job_prefix)
+    if manifest is not None and not _settings_match(manifest, output_format, compress, part_packets, input_format, flow_settings):
+        logging.warning(f"Checkpoint manifest for {source_name} was written with other output settings; starting over.")
+        manifest = None
+    if manifest is None:
+        manifest = _new_manifest(source_name, output_format, compress, part_packets, input_format, flow_settings)
+    elif manifest["complete"]:
+        logging.info(f"All frames of {source_name} were committed by an earlier attempt; only composing.")
+        return manifest
+    else:
+        logging.info(f"CHECKPOINT_RESUMED: {len(manifest['parts'])} parts FRAME: {manifest['next_frame']} FILE: {source_name}")
+
+    work_dir = tempfile.mkdtemp(prefix="checkpoint-", dir=os.path.dirname(pcap_path) or None)
+    try:
+        first_frame = manifest["next_frame"]
+        remaining_path = cut_remaining_frames(pcap_path, first_frame, work_dir) if first_frame > 1 else pcap_path
+        chunk_paths = parallel_convert.split_capture(remaining_path, work_dir, part_packets)
+        ndjson_paths = [f"{chunk_path}.udm.ndjson" for chunk_path in chunk_paths]
+        logging.info(f"Converting {source_name} from frame {first_frame} in {len(chunk_paths)} parts of up to {part_packets} packets.")
+
+        chunk_futures = [parallel_convert.submit_conversion_job(max_workers, parallel_convert.convert_chunk, chunk_path,
+                                                                ndjson_path, source_name, input_format,
+                                                                first_frame - 1 + chunk_index * part_packets, flow_settings)
+                         for chunk_index, (chunk_path, ndjson_path) in enumerate(zip(chunk_paths, ndjson_paths))]
+        try:
+            for chunk_index, (chunk_future, chunk_path, ndjson_path) in enumerate(zip(chunk_futures, chunk_paths, ndjson_paths)): # Commit in frame order
+                chunk_stats = chunk_future.result()
+                os.remove(chunk_path)
+                part_index = len(manifest["parts"])
+                part_name = f"{job_prefix}part-{part_index:05d}"
+                fragment_path = ndjson_path + ".fragment"
+                part_events = write_part_fragment(ndjson_path, fragment_path, output_format, compress, manifest["events_written"])
+                bucket.blob(part_name).upload_from_filename(fragment_path)
+                part_bytes = os.path.getsize(fragment_path)
+                os.remove(ndjson_path)
+                os.remove(fragment_path)
+
+                chunk_stats["udm_output_bytes"] = part_bytes
+                chunk_stats["chunks"] = 1
+                json2udm_cloud.merge_conversion_stats(manifest["stats"], chunk_stats)
+                manifest["parts"].append({"object": part_name, "first_frame": manifest["next_frame"],
+                                          "frames": chunk_stats["packets_processed"], "events": part_events, "bytes": part_bytes})
+                manifest["next_frame"] = first_frame + (chunk_index + 1) * part_packets # editcap chunks are exactly part_packets long
+                manifest["events_written"] += part_events
+                # The commit point: a retry after this line skips the part
+                bucket.blob(job_prefix + "manifest.json").upload_from_string(json.dumps(manifest), content_type="application/json")
+        except BaseException:
+            for chunk_future in chunk_futures:
+                chunk_future.cancel()
+            raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    manifest["complete"] = True
+    bucket.blob(job_prefix + "manifest.json").upload_from_string(json.dumps(manifest), content_type="application/json")
+    pcap_pipeline.log_stage_summary(manifest["stats"], source_name)
+    return manifest
+
+def compose_objects(bucket, source_names, destination_blob, job_prefix):
+    """
+    Composes `source_names` (in order) into `destination_blob`, in levels of at most 32 sources per compose call.
+    Intermediate objects are written under `job_prefix` and cleaned up with the job.
+    """
+    level = 0
+    while len(source_names) > GCS_COMPOSE_MAX_SOURCES:
+        next_level_names = []
+        for group_index in range(0, len(source_names), GCS_COMPOSE_MAX_SOURCES):
+            intermediate_name = f"{job_prefix}compose-{level}-{group_index // GCS_COMPOSE_MAX_SOURCES:05d}"
+            bucket.blob(intermediate_name).compose([bucket.blob(name) for name in source_names[group_index:group_index + GCS_COMPOSE_MAX_SOURCES]])
+            next_level_names.append(intermediate_name)
+        source_names = next_level_names
+        level += 1
+    destination_blob.compose([bucket.blob(name) for name in source_names])
+
+def finalize_parts(bucket, manifest, checkpoint_prefix, job_key, output_blob):
+    """
+    Composes the committed parts into `output_blob` (same bucket; set its content type / metadata beforehand),
+    then deletes the job's parts and manifest. Returns the final object's size in bytes.
+    """
+    job_prefix = _job_prefix(checkpoint_prefix, job_key)
+    source_names = [part["object"] for part in manifest["parts"]]
+    if manifest["output_format"] == "json": # Closing bracket ("[]" if no events at all), as its own small object
+        tail_name = f"{job_prefix}tail"
+        with tempfile.TemporaryFile() as f_tail:
+            json2udm_cloud.write_udm_events((), f_tail, "json", manifest["compress"], preceding_events=manifest["events_written"])
+            f_tail.seek(0)
+            bucket.blob(tail_name).upload_from_file(f_tail)
+        source_names.append(tail_name)
+    compose_objects(bucket, source_names, output_blob, job_prefix)
+    output_size = output_blob.size or sum(part["bytes"] for part in manifest["parts"])
+
+    for leftover_blob in list(bucket.list_blobs(prefix=job_prefix)):
+        try:
+            leftover_blob.delete()
+        except google_api_exceptions.NotFound:
+            pass
+    logging.info(f"CHECKPOINT_PARTS_COMPOSED: {len(manifest['parts'])} FILE: {manifest['source']}")
+    return output_size
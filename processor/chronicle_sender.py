@@ -0,0 +1,363 @@
+# processor/chronicle_sender.py - Batched, concurrent delivery of converted UDM events to the Chronicle ingestion API.
+# Until now the UDM events only landed in the output bucket as one object per capture. With CHRONICLE_INGESTION=true
+# the processor also sends them to `udmevents:batchCreate` in a `send` stage after the output is written:
+# - Events are packed into request bodies of at most CHRONICLE_BATCH_MAX_BYTES and CHRONICLE_BATCH_MAX_EVENTS
+#   (the API rejects requests above 1 MB); the `{"event": ...}` wrapper of the mapper is removed.
+# - Batches are posted by CHRONICLE_SEND_WORKERS threads over ONE pooled HTTP session shared by the whole process.
+#   At most two batches per worker are pending, so memory stays flat for any capture size.
+# - 408 / 429 / 5xx answers and connection errors are retried with exponential backoff and full jitter; a
+#   `Retry-After` header (seconds or HTTP date) replaces the computed delay, and a wait longer than
+#   CHRONICLE_RETRY_MAX_BACKOFF_SECONDS ends the retries instead of blocking the request.
+# - A batch that still fails is spooled as its request body to `<spool>retry/<name>@<generation>/batch-NNNNNN.json`
+#   (create-only: a redelivery does not spool the same batch twice). After a file was sent without spooling, up to
+#   CHRONICLE_SPOOL_REPLAY_BATCHES spooled batches are posted again and deleted.
+# - A batch the API rejects for good (another 4xx) or one event above the size limit goes to `<spool>rejected/...`
+#   instead: it is kept for inspection and never replayed, so it cannot block the replay of the others.
+# The spool store is pluggable like the idempotency ledger: `GcsSpoolStore` (objects under a prefix) and
+# `LocalSpoolStore` (a directory). CHRONICLE_INGESTION_URL points the sender at a local stand-in of the API
+# (with CHRONICLE_AUTH=none), which is how test/benchmarks/chronicle_sender_check.py exercises it.
+
+import email.utils
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timezone
+
+from google.api_core import exceptions as google_api_exceptions
+
+import json_backends
+
+INGESTION_PATH = "/v2/udmevents:batchCreate"
+INGESTION_SCOPE = "https://www.googleapis.com/auth/malachite-ingestion"
+DEFAULT_BATCH_MAX_BYTES = 900 * 1024 # Request body limit of the API is 1 MB
+DEFAULT_BATCH_MAX_EVENTS = 1000
+RETRYABLE_STATUS_CODES = frozenset((408, 429, 500, 502, 503, 504))
+RETRY_BASE_SECONDS = 1.0 # First backoff ceiling; doubled per attempt up to the configured maximum
+
+def ingestion_url(region=""):
+    """batchCreate URL of the global endpoint, or of a regional one (e.g. "europe", "asia-southeast1")."""
+    host = f"{region}-malachiteingestion-pa.googleapis.com" if region else "malachiteingestion-pa.googleapis.com"
+    return f"https://{host}{INGESTION_PATH}"
+
+def retry_after_seconds(header_value):
+    """Seconds to wait from a `Retry-After` header (delta-seconds or HTTP date), or None if absent / unparseable."""
+    if not header_value:
+        return None
+    try:
+        return max(0.0, float(header_value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def iter_batches(udm_events, customer_id, max_bytes=DEFAULT_BATCH_MAX_BYTES, max_events=DEFAULT_BATCH_MAX_EVENTS):
+    """
+    Packs UDM events into batchCreate request bodies. Yields (body bytes, event count); a single event that does not
+    fit in `max_bytes` on its own is yielded alone, and the sender spools it instead of posting it.
+    """
+    body_prefix = b'{"customer_id":' + json.dumps(customer_id).encode("utf-8") + b',"events":['
+    body_overhead = len(body_prefix) + 2 # Plus the closing "]}"
+    pending_events = []
+    pending_bytes = body_overhead
+    for udm_event in udm_events:
+        event_bytes = json_backends.dumps_compact(udm_event.get("event", udm_event))
+        separator_bytes = 1 if pending_events else 0
+        if pending_events and (pending_bytes + separator_bytes + len(event_bytes) > max_bytes or len(pending_events) >= max_events):
+            yield body_prefix + b",".join(pending_events) + b"]}", len(pending_events)
+            pending_events.clear()
+            pending_bytes = body_overhead
+            separator_bytes = 0
+        pending_events.append(event_bytes)
+        pending_bytes += separator_bytes + len(event_bytes)
+    if pending_events:
+        yield body_prefix + b",".join(pending_events) + b"]}", len(pending_events)
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class GcsSpoolStore:
+    """Spooled request bodies as objects under a prefix of a GCS bucket."""
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, name, body):
+        """Stores `body` under `name` unless it already exists (same batch spooled by an earlier delivery)."""
+        try:
+            self.bucket.blob(self.prefix + name).upload_from_string(body, content_type="application/json", if_generation_match=0)
+        except google_api_exceptions.PreconditionFailed:
+            pass
+
+    def list_names(self, name_prefix, limit):
+        return [blob.name[len(self.prefix):] for blob in self.bucket.list_blobs(prefix=self.prefix + name_prefix, max_results=limit)]
+
+    def get(self, name):
+        try:
+            return self.bucket.blob(self.prefix + name).download_as_bytes()
+        except google_api_exceptions.NotFound:
+            return None # Replayed and deleted by another instance
+
+    def delete(self, name):
+        try:
+            self.bucket.blob(self.prefix + name).delete()
+        except google_api_exceptions.NotFound:
+            pass
+
+class LocalSpoolStore:
+    """Same interface on a local directory (local runs, tests)."""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name.replace("/", "%2F"))
+
+    def put(self, name, body):
+        try:
+            with open(self._path(name), "xb") as f_spool:
+                f_spool.write(body)
+        except FileExistsError:
+            pass
+
+    def list_names(self, name_prefix, limit):
+        names = sorted(file_name.replace("%2F", "/") for file_name in os.listdir(self.directory))
+        return [name for name in names if name.startswith(name_prefix)][:limit]
+
+    def get(self, name):
+        try:
+            with open(self._path(name), "rb") as f_spool:
+                return f_spool.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+def build_session(auth="default", key_file="", pool_size=4):
+    """
+    HTTP session for the ingestion API with a connection pool for `pool_size` concurrent requests. `auth` "default"
+    uses `key_file` (the Chronicle ingestion service account) or the ambient credentials; "none" is for a local stand-in.
+    """
+    import requests # Imported on first use, like the auth modules: the processor loads this module even when sending is off
+    from requests.adapters import HTTPAdapter
+    if auth == "none":
+        session = requests.Session()
+    else:
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from google.oauth2 import service_account
+        if key_file:
+            credentials = service_account.Credentials.from_service_account_file(key_file, scopes=[INGESTION_SCOPE])
+        else:
+            credentials, _ = google.auth.default(scopes=[INGESTION_SCOPE])
+        session = AuthorizedSession(credentials)
+    pooled_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", pooled_adapter)
+    session.mount("http://", pooled_adapter)
+    return session
+
+class ChronicleSender:
+    """
+    Sends UDM events to one ingestion endpoint. One instance per process: the session and the worker threads are
+    shared by all files sent concurrently.
+    """
+    def __init__(self, url, customer_id, session, spool_store=None, workers=4, batch_max_bytes=DEFAULT_BATCH_MAX_BYTES,
+                 batch_max_events=DEFAULT_BATCH_MAX_EVENTS, max_attempts=5, max_backoff_seconds=60.0, request_timeout_seconds=60.0):
+        self.url = url
+        self.customer_id = customer_id
+        self.session = session
+        self.spool_store = spool_store
+        self.workers = workers
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_max_events = batch_max_events
+        self.max_attempts = max_attempts
+        self.max_backoff_seconds = max_backoff_seconds
+        self.request_timeout_seconds = request_timeout_seconds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chronicle-send")
+        self._replay_lock = threading.Lock()
+
+    def post_batch(self, body):
+        """
+        Posts one request body, retrying transient failures. Returns (delivered, seconds, retries, last error, retryable):
+        `seconds` covers the retries and their waits, `retryable` is False when the API rejected the body for good.
+        """
+        import requests # Already loaded by build_session
+        started = time.monotonic()
+        last_error = None
+        for attempt in range(1, self.max_attempts + 1):
+            retry_after = None
+            try:
+                response = self.session.post(self.url, data=body, headers={"Content-Type": "application/json"},
+                                             timeout=self.request_timeout_seconds)
+            except requests.RequestException as e_request:
+                last_error = f"{type(e_request).__name__}: {e_request}"
+            else:
+                if response.status_code < 300:
+                    return True, time.monotonic() - started, attempt - 1, None, True
+                last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    # Bad request: the same body will not succeed later either (auth errors are worth retrying later)
+                    return False, time.monotonic() - started, attempt - 1, last_error, response.status_code in (401, 403)
+                retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+            if attempt == self.max_attempts:
+                break
+            if retry_after is not None and retry_after > self.max_backoff_seconds:
+                last_error += f" (Retry-After {retry_after:.0f}s exceeds the backoff limit)"
+                break
+            time.sleep(retry_after if retry_after is not None else
+                       random.uniform(0, min(self.max_backoff_seconds, RETRY_BASE_SECONDS * 2 ** (attempt - 1))))
+        return False, time.monotonic() - started, attempt - 1, last_error, True
+
+    def _send_batch(self, body):
+        if len(body) > self.batch_max_bytes:
+            return False, 0.0, 0, f"one event of {len(body)} bytes exceeds the batch limit", False
+        return self.post_batch(body)
+
+    def _spool(self, spool_key, batch_index, body, source_name, error, retryable):
+        if self.spool_store is None:
+            raise RuntimeError(f"Chronicle batch {batch_index} of {source_name} failed ({error}) and no spool is configured.")
+        spool_folder = "retry" if retryable else "rejected"
+        self.spool_store.put(f"{spool_folder}/{spool_key}/batch-{batch_index:06d}.json", body)
+        logging.warning(f"Chronicle batch {batch_index} of {source_name} spooled to {spool_folder}/: {error}")
+
+    def send_events(self, udm_events, source_name, spool_key):
+        """
+        Sends the events of one file; batches that cannot be delivered are spooled under `spool_key`.
+        Returns the file's send counters. Raises only if a batch can neither be delivered nor spooled.
+        """
+        stats = {"chronicle_events_sent": 0, "chronicle_batches_sent": 0, "chronicle_events_spooled": 0,
+                 "chronicle_batches_spooled": 0, "chronicle_batches_rejected": 0, "chronicle_retries": 0, "chronicle_request_bytes": 0}
+        batch_latencies = []
+        pending = {} # future -> (batch index, body, event count)
+        started = time.monotonic()
+
+        def collect(done_futures):
+            for future in done_futures:
+                batch_index, body, event_count = pending.pop(future)
+                delivered, seconds, retries, error, retryable = future.result()
+                stats["chronicle_retries"] += retries
+                if delivered:
+                    stats["chronicle_events_sent"] += event_count
+                    stats["chronicle_batches_sent"] += 1
+                    stats["chronicle_request_bytes"] += len(body)
+                    batch_latencies.append(seconds)
+                else:
+                    self._spool(spool_key, batch_index, body, source_name, error, retryable)
+                    stats["chronicle_events_spooled"] += event_count
+                    stats["chronicle_batches_spooled"] += 1
+                    stats["chronicle_batches_rejected"] += 0 if retryable else 1
+
+        try:
+            for batch_index, (body, event_count) in enumerate(iter_batches(udm_events, self.customer_id, self.batch_max_bytes,
+                                                                            self.batch_max_events)):
+                if len(pending) >= 2 * self.workers:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                pending[self.executor.submit(self._send_batch, body)] = (batch_index, body, event_count)
+            while pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        finally:
+            for future in pending:
+                future.cancel()
+
+        send_seconds = time.monotonic() - started
+        stats["chronicle_send_seconds"] = round(send_seconds, 3)
+        stats["chronicle_events_per_second"] = round(stats["chronicle_events_sent"] / send_seconds, 1) if send_seconds else 0.0
+        if batch_latencies:
+            batch_latencies.sort()
+            stats["chronicle_batch_latency_p50_seconds"] = round(_percentile(batch_latencies, 0.5), 3)
+            stats["chronicle_batch_latency_p95_seconds"] = round(_percentile(batch_latencies, 0.95), 3)
+            stats["chronicle_batch_latency_max_seconds"] = round(batch_latencies[-1], 3)
+        return stats
+
+    def replay_spool(self, limit):
+        """
+        Posts up to `limit` spooled batches of the retry folder again, deleting each one delivered. A batch now rejected
+        for good moves to the rejected folder; any other failure stops the replay. Returns the number delivered.
+        """
+        if self.spool_store is None or limit <= 0 or not self._replay_lock.acquire(blocking=False):
+            return 0 # Another request of this instance is already replaying
+        replayed = 0
+        try:
+            for name in self.spool_store.list_names("retry/", limit):
+                body = self.spool_store.get(name)
+                if body is None:
+                    continue
+                delivered, _, _, error, retryable = self.post_batch(body)
+                if not delivered:
+                    logging.warning(f"Replay of spooled Chronicle batch {name} failed: {error}")
+                    if retryable:
+                        break
+                    self.spool_store.put("rejected/" + name[len("retry/"):], body)
+                else:
+                    replayed += 1
+                self.spool_store.delete(name)
+        finally:
+            self._replay_lock.release()
+        return replayed
+
+def log_send_summary(stats, source_name):
+    """Logs the send counters in the `NAME: value FILE: name` format of the other metric lines."""
+    logging.info(f"CHRONICLE_EVENTS_SENT: {stats['chronicle_events_sent']} BATCHES: {stats['chronicle_batches_sent']} FILE: {source_name}")
+    logging.info(f"CHRONICLE_EVENTS_PER_SECOND: {stats['chronicle_events_per_second']} FILE: {source_name}")
+    if "chronicle_batch_latency_p50_seconds" in stats:
+        logging.info(f"CHRONICLE_BATCH_LATENCY_SECONDS: p50={stats['chronicle_batch_latency_p50_seconds']} "
+                     f"p95={stats['chronicle_batch_latency_p95_seconds']} max={stats['chronicle_batch_latency_max_seconds']} FILE: {source_name}")
+    if stats["chronicle_retries"]:
+        logging.warning(f"CHRONICLE_RETRIES: {stats['chronicle_retries']} FILE: {source_name}")
+    if stats["chronicle_batches_spooled"]:
+        logging.warning(f"CHRONICLE_EVENTS_SPOOLED: {stats['chronicle_events_spooled']} BATCHES: {stats['chronicle_batches_spooled']} "
+                        f"REJECTED: {stats['chronicle_batches_rejected']} FILE: {source_name}")
+
+_environment_sender = None
+_environment_sender_loaded = False
+
+def sender_from_environment(spool_bucket=None):
+    """
+    The process-wide `ChronicleSender` configured by the CHRONICLE_* variables, or None if CHRONICLE_INGESTION is off
+    or incomplete. Batches are spooled to CHRONICLE_SPOOL_DIR if set, else under CHRONICLE_SPOOL_PREFIX in `spool_bucket`.
+    """
+    global _environment_sender, _environment_sender_loaded
+    if _environment_sender_loaded:
+        return _environment_sender
+    _environment_sender_loaded = True
+
+    if os.environ.get("CHRONICLE_INGESTION", "false").strip().lower() not in ("1", "true", "yes"):
+        return None
+    customer_id = os.environ.get("CHRONICLE_CUSTOMER_ID", "").strip()
+    if not customer_id:
+        logging.critical("CRITICAL: CHRONICLE_INGESTION is on but CHRONICLE_CUSTOMER_ID is not set; events are not sent.")
+        return None
+    url = os.environ.get("CHRONICLE_INGESTION_URL", "").strip() or ingestion_url(os.environ.get("CHRONICLE_REGION", "").strip())
+    workers = int(os.environ.get("CHRONICLE_SEND_WORKERS", "4"))
+    spool_dir = os.environ.get("CHRONICLE_SPOOL_DIR", "").strip()
+    if spool_dir:
+        spool_store, spool_text = LocalSpoolStore(spool_dir), spool_dir
+    elif spool_bucket is not None:
+        spool_prefix = os.environ.get("CHRONICLE_SPOOL_PREFIX", "_chronicle_spool/")
+        spool_store, spool_text = GcsSpoolStore(spool_bucket, spool_prefix), f"gs://{spool_bucket.name}/{spool_prefix}"
+    else:
+        spool_store, spool_text = None, "none (failed batches fail the file)"
+    session = build_session(os.environ.get("CHRONICLE_AUTH", "default").strip().lower(),
+                            os.environ.get("CHRONICLE_KEY_FILE", "").strip(), workers)
+    _environment_sender = ChronicleSender(
+        url, customer_id, session, spool_store, workers,
+        batch_max_bytes=int(os.environ.get("CHRONICLE_BATCH_MAX_BYTES", str(DEFAULT_BATCH_MAX_BYTES))),
+        batch_max_events=int(os.environ.get("CHRONICLE_BATCH_MAX_EVENTS", str(DEFAULT_BATCH_MAX_EVENTS))),
+        max_attempts=int(os.environ.get("CHRONICLE_MAX_ATTEMPTS", "5")),
+        max_backoff_seconds=float(os.environ.get("CHRONICLE_RETRY_MAX_BACKOFF_SECONDS", "60")))
+    logging.info(f"Chronicle ingestion enabled: {url} ({workers} workers), spool: {spool_text}.")
+    return _environment_sender
@@ -0,0 +1,198 @@
+# processor/fanout.py - Fan-out of oversized captures across processor instances.
+# One instance converting a whole multi-GB pcap hits its memory and 600 s limits while the service could scale out.
+# Captures above FANOUT_MIN_PCAP_BYTES are handled in three steps, each a normal Pub/Sub push:
+# 1. Split (the original notification): editcap cuts the pcap into chunks of `chunk_packets` frames, uploaded to the
+#    incoming bucket as `<prefix><name>@<generation>/chunk-NNNNN.pcap`; one message per chunk is published to the
+#    processor's own topic, with the attributes content=pcap_chunk, chunk_index, chunk_count, chunk_packets and
+#    source_generation (the message data stays the original file name).
+# 2. Chunk (any instance): converts its chunk with frame numbers offset to the original capture, uploads the output
+#    fragment as `<prefix><job>/part-NNNNN` in the output bucket and then writes `done-NNNNN` with its counters.
+# 3. Merge: the chunk that finds all `done-*` markers takes the create-only `merge.lock` and composes the parts (plus
+#    the array punctuation for JSON) into the final UDM object, then deletes the job's chunks, parts and markers.
+#    A lock left by a crashed merger expires after MERGE_LOCK_SECONDS and is taken over by the redelivery.
+# Chunks are converted concurrently, so a JSON fragment cannot know whether events precede it (UDM_DROP_RULES or
+# sampling can empty any chunk, chunk 0 included). Fragments leave out the "[" or "," before their first event; each
+# done marker records the chunk's `events_written`, and the merge puts "[" before the first non-empty fragment, ","
+# before the later ones and "\n]" (or "[]") at the end, from the running count - the bytes of a one-pass conversion.
+# Gzip fragments and the punctuation objects are members of one gzip stream.
+
+import base64
+import gzip
+import io
+import json
+import logging
+import os
+import socket
+import time
+
+from google.api_core import exceptions as google_api_exceptions
+
+import checkpointed_convert
+import json2udm_cloud
+import parallel_convert
+import pcap_pipeline
+
+PUBSUB_API_ROOT = "https://pubsub.googleapis.com/v1"
+PUBSUB_PUBLISH_MAX_MESSAGES = 1000 # Per publish request
+MERGE_LOCK_SECONDS = 600 # The subscription's ack deadline: a merge still holding the lock after that is dead
+
+def chunk_object_name(prefix, job_key, chunk_index):
+    return f"{prefix}{job_key}/chunk-{chunk_index:05d}.pcap"
+
+def _job_object_name(prefix, job_key, kind, chunk_index):
+    return f"{prefix}{job_key}/{kind}-{chunk_index:05d}"
+
+def split_and_upload(pcap_path, incoming_bucket, prefix, job_key, chunk_packets, work_dir):
+    """
+    Splits the capture with editcap and uploads the chunks (create-only, so a redelivered split keeps the chunks
+    already there; editcap output is deterministic). Returns the number of chunks.
+    """
+    chunk_paths = parallel_convert.split_capture(pcap_path, work_dir, chunk_packets)
+    for chunk_index, chunk_path in enumerate(chunk_paths):
+        try:
+            incoming_bucket.blob(chunk_object_name(prefix, job_key, chunk_index)).upload_from_filename(
+                chunk_path, content_type="application/vnd.tcpdump.pcap", if_generation_match=0)
+        except google_api_exceptions.PreconditionFailed:
+            pass # Uploaded by an earlier attempt
+        os.remove(chunk_path)
+    return len(chunk_paths)
+
+def publish_chunk_messages(session, topic_path, source_name, source_generation, chunk_count, chunk_packets):
+    """Publishes one notification per chunk through the Pub/Sub REST API (raises on failure, so the split is retried)."""
+    encoded_name = base64.b64encode(source_name.encode("utf-8")).decode("ascii")
+    messages = [{"data": encoded_name, "attributes": {"content": "pcap_chunk", "chunk_index": str(chunk_index),
+                                                      "chunk_count": str(chunk_count), "chunk_packets": str(chunk_packets),
+                                                      "source_generation": str(source_generation)}}
+                for chunk_index in range(chunk_count)]
+    for batch_start in range(0, len(messages), PUBSUB_PUBLISH_MAX_MESSAGES):
+        response = session.post(f"{PUBSUB_API_ROOT}/{topic_path}:publish",
+                                json={"messages": messages[batch_start:batch_start + PUBSUB_PUBLISH_MAX_MESSAGES]}, timeout=60)
+        response.raise_for_status()
+
+def convert_and_commit_chunk(chunk_pcap_path, output_bucket, prefix, job_key, chunk_index, chunk_packets, source_name,
+                             max_workers, output_format="json", compress=False, input_format="json", flow_settings=None):
+    """
+    Converts one downloaded chunk in the process pool and commits it: the output fragment as `part-NNNNN`, then the
+    `done-NNNNN` marker holding its counters. A chunk already marked done (redelivery after a failed merge) is
+    not converted again. Returns the chunk's stats.
+    """
+    done_blob = output_bucket.get_blob(_job_object_name(prefix, job_key, "done", chunk_index))
+    if done_blob is not None:
+        logging.info(f"Chunk {chunk_index} of {source_name} was committed by an earlier attempt.")
+        return json.loads(done_blob.download_as_bytes())
+
+    ndjson_path = chunk_pcap_path + ".udm.ndjson"
+    fragment_path = ndjson_path + ".fragment"
+    chunk_stats = parallel_convert.submit_conversion_job(max_workers, parallel_convert.convert_chunk, chunk_pcap_path, ndjson_path,
+                                                         source_name, input_format, chunk_index * chunk_packets, flow_settings).result()
+    # The "[" or "," before the fragment's first event is added by the merge, which knows the events before it
+    chunk_stats["events_written"] = checkpointed_convert.write_part_fragment(ndjson_path, fragment_path, output_format, compress, 0,
+                                                                             lead_separator=False)
+    output_bucket.blob(_job_object_name(prefix, job_key, "part", chunk_index)).upload_from_filename(fragment_path)
+    chunk_stats["udm_output_bytes"] = os.path.getsize(fragment_path)
+    chunk_stats["pcap_input_bytes"] = os.path.getsize(chunk_pcap_path)
+    os.remove(ndjson_path)
+    os.remove(fragment_path)
+
+    try:
+        output_bucket.blob(_job_object_name(prefix, job_key, "done", chunk_index)).upload_from_string(
+            json.dumps(chunk_stats), content_type="application/json", if_generation_match=0)
+    except google_api_exceptions.PreconditionFailed:
+        pass # A concurrent delivery of the same chunk committed first; its part is identical
+    return chunk_stats
+
+def _acquire_merge_lock(output_bucket, lock_name):
+    """Create-only lock object; an expired one is taken over with a generation-matched write. Returns its blob or None."""
+    lock_record = json.dumps({"holder": f"{os.environ.get('K_REVISION', socket.gethostname())}/{os.getpid()}",
+                              "expires_at": time.time() + MERGE_LOCK_SECONDS})
+    lock_blob = output_bucket.blob(lock_name)
+    try:
+        lock_blob.upload_from_string(lock_record, content_type="application/json", if_generation_match=0)
+        return lock_blob
+    except google_api_exceptions.PreconditionFailed:
+        pass
+    current_lock = output_bucket.get_blob(lock_name)
+    if current_lock is None:
+        return None # Released in between: the holder's merge failed and its redelivery will retry
+    try:
+        if json.loads(current_lock.download_as_bytes()).get("expires_at", 0) > time.time():
+            return None
+        lock_blob.upload_from_string(lock_record, content_type="application/json", if_generation_match=current_lock.generation)
+    except (google_api_exceptions.PreconditionFailed, google_api_exceptions.NotFound, ValueError):
+        return None
+    logging.warning(f"Took over expired merge lock {lock_name}.")
+    return lock_blob
+
+def _upload_punctuation(output_bucket, object_name, punctuation, compress):
+    """Uploads "[" or "," as its own small object (a gzip member with `compress`) and returns its name."""
+    f_punctuation = io.BytesIO()
+    out_stream = gzip.GzipFile(fileobj=f_punctuation, mode="wb", mtime=0) if compress else f_punctuation
+    out_stream.write(punctuation)
+    if compress:
+        out_stream.close()
+    output_bucket.blob(object_name).upload_from_string(f_punctuation.getvalue())
+    return object_name
+
+def try_merge(incoming_bucket, output_bucket, prefix, job_key, chunk_count, output_blob, output_format, compress, source_name):
+    """
+    Composes the job's parts into `output_blob` (content type and metadata set by the caller) once every chunk is
+    done. Returns the summed stats of the merge, or None if chunks are still running or another chunk is merging.
+    Raises if the merge fails; the lock is released so the caller's redelivery can retry it.
+    """
+    job_prefix = f"{prefix}{job_key}/"
+    done_blobs = [blob for blob in output_bucket.list_blobs(prefix=job_prefix + "done-")]
+    if len(done_blobs) < chunk_count:
+        logging.info(f"FANOUT_CHUNKS_DONE: {len(done_blobs)}/{chunk_count} FILE: {source_name}")
+        return None
+    lock_blob = _acquire_merge_lock(output_bucket, job_prefix + "merge.lock")
+    if lock_blob is None:
+        logging.info(f"Merge of {source_name} is handled by another delivery.")
+        return None
+
+    try:
+        merged_stats = json2udm_cloud.new_conversion_stats()
+        merged_stats.update({"tshark_output_bytes": 0, "pcap_input_bytes": 0, "chunks": chunk_count})
+        chunk_events = {}
+        for done_blob in done_blobs:
+            chunk_stats = json.loads(done_blob.download_as_bytes())
+            chunk_stats.pop("udm_output_bytes", None) # Replaced by the composed object's size
+            chunk_events[done_blob.name] = chunk_stats.pop("events_written")
+            json2udm_cloud.merge_conversion_stats(merged_stats, chunk_stats)
+
+        source_names = []
+        events_written = 0
+        separator_name = None
+        for chunk_index in range(chunk_count):
+            part_events = chunk_events[_job_object_name(prefix, job_key, "done", chunk_index)]
+            if output_format == "json":
+                if not part_events:
+                    continue # Empty fragment
+                if not events_written:
+                    source_names.append(_upload_punctuation(output_bucket, job_prefix + "open", b"[", compress))
+                else:
+                    separator_name = separator_name or _upload_punctuation(output_bucket, job_prefix + "separator", b",", compress)
+                    source_names.append(separator_name)
+            source_names.append(_job_object_name(prefix, job_key, "part", chunk_index))
+            events_written += part_events
+        if output_format == "json": # Closing bracket ("[]" if no chunk has events)
+            f_tail = io.BytesIO()
+            json2udm_cloud.write_udm_events((), f_tail, "json", compress, preceding_events=events_written)
+            output_bucket.blob(job_prefix + "tail").upload_from_string(f_tail.getvalue())
+            source_names.append(job_prefix + "tail")
+        checkpointed_convert.compose_objects(output_bucket, source_names, output_blob, job_prefix)
+        merged_stats["udm_output_bytes"] = output_blob.size or 0
+    except BaseException:
+        try:
+            lock_blob.delete()
+        except google_api_exceptions.GoogleAPICallError:
+            pass # Expires on its own
+        raise
+
+    for leftover_blob in list(output_bucket.list_blobs(prefix=job_prefix)) + list(incoming_bucket.list_blobs(prefix=job_prefix)):
+        try:
+            leftover_blob.delete()
+        except google_api_exceptions.NotFound:
+            pass
+    pcap_pipeline.log_stage_summary(merged_stats, source_name)
+    logging.info(f"FANOUT_MERGED: {chunk_count} chunks FILE: {source_name}")
+    return merged_stats
@@ -0,0 +1,188 @@
+# processor/flow_aggregator.py - Optional flow aggregation: one UDM event per connection instead of one per packet.
+# `convert_single_packet_to_udm` emits a full event per frame, so a busy link repeats the same principal, target,
+# metadata and description millions of times. Here the per-packet events are folded into flows keyed on
+# (IP version, transport, principal ip/port, target ip/port); packets in the reverse direction join the same flow.
+# A flow keeps:
+# - first/last seen, packets and bytes per direction (UDM network.sent_* / received_*),
+# - the union of TCP flags,
+# - the DNS / HTTP / TLS attributes and `about` entities the mapper extracted (lists are capped).
+# Flows are emitted when idle longer than the idle timeout, when older than the active timeout (a new flow then
+# starts), when evicted because `max_flows` are open (least recently active first), and at the end of the capture.
+# Time is capture time (frame.time_epoch), so replaying an old pcap expires flows the same way as live traffic.
+# Events without an IP flow (ARP, malformed and error events) pass through unchanged.
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+DEFAULT_IDLE_TIMEOUT_SECONDS = 60
+DEFAULT_ACTIVE_TIMEOUT_SECONDS = 300
+DEFAULT_MAX_FLOWS = 20000 # Open flows held in memory (a few KB each)
+MAX_FLOW_LIST_VALUES = 32 # Cap for per-flow lists (DNS queries, answer TTLs, about entities)
+
+def _epoch_from_iso(event_timestamp):
+    """Fallback clock for packets without frame.time_epoch: the event's ISO timestamp."""
+    try:
+        return datetime.fromisoformat(event_timestamp.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+def _iso_from_epoch(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).isoformat(timespec="microseconds").replace("+00:00", "Z")
+
+def _append_capped(values, value):
+    if value not in values and len(values) < MAX_FLOW_LIST_VALUES:
+        values.append(value)
+
+class FlowAggregator:
+    """
+    Folds per-packet UDM events into flow events. `add` and `flush_all` return / yield the events ready to write;
+    counters (`flows_emitted`, `flows_<reason>`) go into the shared conversion `stats` dict.
+    """
+    def __init__(self, stats, idle_timeout_seconds=DEFAULT_IDLE_TIMEOUT_SECONDS,
+                 active_timeout_seconds=DEFAULT_ACTIVE_TIMEOUT_SECONDS, max_flows=DEFAULT_MAX_FLOWS):
+        self.stats = stats
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.active_timeout_seconds = active_timeout_seconds
+        self.max_flows = max(1, max_flows)
+        self.flows = OrderedDict() # flow key -> flow state, least recently active first
+        self.clock = None # Latest capture time seen
+        stats.setdefault("flows_emitted", 0)
+
+    def add(self, udm_event, packet_epoch=None, frame_len=None, frame_number=None, protocols=None):
+        """Accounts one per-packet event. Returns the list of events to emit now (expired flows or a pass-through)."""
+        payload = udm_event.get("event", {})
+        network = payload.get("network", {})
+        ip_version = network.get("ip_protocol_version")
+        if ip_version is None:
+            return [udm_event]
+
+        if packet_epoch is None:
+            packet_epoch = _epoch_from_iso(payload.get("metadata", {}).get("event_timestamp")) or self.clock or 0.0
+        if self.clock is None or packet_epoch > self.clock:
+            self.clock = packet_epoch
+        ready_events = self._expire_idle()
+
+        principal, target = payload.get("principal", {}), payload.get("target", {})
+        transport = network.get("transport_protocol")
+        flow_key = (ip_version, transport, principal.get("ip"), principal.get("port"), target.get("ip"), target.get("port"))
+        reverse_key = (ip_version, transport, target.get("ip"), target.get("port"), principal.get("ip"), principal.get("port"))
+        packet_key = flow_key
+        is_reply = flow_key not in self.flows and reverse_key in self.flows
+        if is_reply:
+            flow_key = reverse_key
+
+        flow = self.flows.get(flow_key)
+        if flow is not None and packet_epoch - flow["first_seen"] >= self.active_timeout_seconds:
+            ready_events.append(self._emit(self.flows.pop(flow_key), "active_timeout"))
+            # The new flow starts with this packet, so its principal is this packet's sender
+            flow, flow_key, is_reply = None, packet_key, False
+        if flow is None:
+            if len(self.flows) >= self.max_flows:
+                _, evicted_flow = self.flows.popitem(last=False)
+                ready_events.append(self._emit(evicted_flow, "evicted"))
+            flow = self._new_flow(payload, packet_epoch, frame_number)
+            self.flows[flow_key] = flow
+        else:
+            self.flows.move_to_end(flow_key)
+        self._update_flow(flow, payload, network, packet_epoch, frame_len, frame_number, protocols, is_reply)
+        return ready_events
+
+    def flush_all(self):
+        """Emits every open flow (end of capture)."""
+        while self.flows:
+            _, flow = self.flows.popitem(last=False)
+            yield self._emit(flow, "end_of_capture")
+
+    def _expire_idle(self):
+        expired_events = []
+        while self.flows:
+            oldest_flow = next(iter(self.flows.values()))
+            if self.clock - oldest_flow["last_seen"] < self.idle_timeout_seconds:
+                break
+            self.flows.popitem(last=False)
+            expired_events.append(self._emit(oldest_flow, "idle_timeout"))
+        return expired_events
+
+    def _new_flow(self, payload, packet_epoch, frame_number):
+        network = {key: value for key, value in payload.get("network", {}).items()
+                   if key not in ("application_protocol_data", "tcp_flags")}
+        return {"first_payload": payload, "network": network, "event_type": "NETWORK_CONNECTION", "protocols": "",
+                "first_seen": packet_epoch, "last_seen": packet_epoch, "first_frame": frame_number, "last_frame": frame_number,
+                "sent_packets": 0, "received_packets": 0, "sent_bytes": 0, "received_bytes": 0,
+                "tcp_flags": None, "http": {}, "dns": {}, "tls": {}, "about": []}
+
+    def _update_flow(self, flow, payload, network, packet_epoch, frame_len, frame_number, protocols, is_reply):
+        flow["last_seen"] = max(flow["last_seen"], packet_epoch)
+        flow["first_seen"] = min(flow["first_seen"], packet_epoch)
+        if frame_number is not None:
+            flow["last_frame"] = frame_number
+        direction = "received" if is_reply else "sent"
+        flow[f"{direction}_packets"] += 1
+        try:
+            flow[f"{direction}_bytes"] += int(frame_len)
+        except (TypeError, ValueError):
+            pass
+        if protocols and len(protocols) > len(flow["protocols"]):
+            flow["protocols"] = protocols # Deepest dissection seen, e.g. "...:tcp:tls" over "...:tcp"
+
+        event_type = payload.get("metadata", {}).get("event_type")
+        if flow["event_type"] == "NETWORK_CONNECTION" and event_type:
+            flow["event_type"] = event_type
+        tcp_flags = network.get("tcp_flags")
+        if tcp_flags is not None:
+            try:
+                flow["tcp_flags"] = (flow["tcp_flags"] or 0) | int(str(tcp_flags), 0)
+            except ValueError:
+                pass
+
+        app_layer_data = network.get("application_protocol_data", {})
+        for protocol in ("http", "tls"):
+            for attribute, value in app_layer_data.get(protocol, {}).items():
+                flow[protocol].setdefault(attribute, value) # First value wins (request line, first handshake)
+        dns_info = app_layer_data.get("dns")
+        if dns_info:
+            flow_dns = flow["dns"]
+            for query in dns_info.get("queries", ()):
+                _append_capped(flow_dns.setdefault("queries", []), query)
+            for answer_ttl in dns_info.get("answer_ttls", ()):
+                _append_capped(flow_dns.setdefault("answer_ttls", []), answer_ttl)
+            if dns_info.get("is_response"):
+                flow_dns["is_response"] = True
+            else:
+                flow_dns.setdefault("is_response", False)
+        for about_entity in payload.get("about", ()):
+            _append_capped(flow["about"], about_entity)
+
+    def _emit(self, flow, end_reason):
+        self.stats["flows_emitted"] += 1
+        self.stats[f"flows_{end_reason}"] = self.stats.get(f"flows_{end_reason}", 0) + 1
+        first_payload = flow["first_payload"]
+        total_packets = flow["sent_packets"] + flow["received_packets"]
+        frame_range = f"{flow['first_frame']}-{flow['last_frame']}" if flow["first_frame"] is not None else "N/A"
+
+        network = dict(flow["network"])
+        if flow["tcp_flags"] is not None:
+            network["tcp_flags"] = f"0x{flow['tcp_flags']:04x}"
+        network.update(sent_packets=flow["sent_packets"], received_packets=flow["received_packets"],
+                       sent_bytes=flow["sent_bytes"], received_bytes=flow["received_bytes"])
+        app_layer_data = {protocol: flow[protocol] for protocol in ("http", "dns", "tls") if flow[protocol]}
+        if app_layer_data:
+            network["application_protocol_data"] = app_layer_data
+
+        udm_payload = {"metadata": {"event_timestamp": _iso_from_epoch(flow["first_seen"]),
+                                    "product_name": "Wireshark TShark",
+                                    "vendor_name": "Wireshark",
+                                    "event_type": flow["event_type"],
+                                    "description": f"Network flow. Protocols: {flow['protocols'] or 'N/A'}. "
+                                                   f"Packets: {total_packets}. Frames: {frame_range}"}}
+        for section in ("principal", "target"):
+            if first_payload.get(section):
+                udm_payload[section] = first_payload[section]
+        udm_payload["network"] = network
+        if flow["about"]:
+            udm_payload["about"] = flow["about"]
+        additional = dict(first_payload.get("additional", {}))
+        additional.update(flow_first_seen=_iso_from_epoch(flow["first_seen"]), flow_last_seen=_iso_from_epoch(flow["last_seen"]),
+                          flow_duration_seconds=f"{flow['last_seen'] - flow['first_seen']:.6f}", flow_end_reason=end_reason)
+        udm_payload["additional"] = additional
+        return {"event": udm_payload}
@@ -0,0 +1,213 @@
+# processor/ip_enrichment.py - Optional IP / hostname enrichment of UDM events, cached per unique key.
+# The converter emits bare principal.ip / target.ip / about.hostname, so every consumer re-resolves the same
+# endpoints. When configured, each event is enriched before it is written with:
+# - geo and ASN data from one or more MaxMind DB files (GeoLite2/GeoIP2 City, Country or ASN; needs the optional
+#   `maxminddb` package) -> `<noun>.ip_geo_artifact` [{ip, location, network}],
+# - internal asset context from a CSV table (cidr,hostname,asset_id,category[,extra columns]), matched by longest
+#   prefix for IPs and by exact name for hostnames -> `<noun>.asset` (extra columns become asset.attribute.labels).
+# Lookups go through an LRU cache keyed on the address / hostname: a capture has thousands of packets but only
+# tens of distinct endpoints, so almost every lookup is a dict hit and the enrichment fragments are shared, not
+# rebuilt. The cache lives as long as the process (pool workers keep it across files); hits, misses and
+# evictions are counted in each file's conversion stats.
+# Configuration comes from the environment, so the script, the pool workers and the sniffer's edge conversion
+# pick it up the same way: ENRICH_MMDB_PATHS (comma-separated), ENRICH_ASSET_CIDRS, ENRICH_CACHE_ENTRIES.
+
+import csv
+import ipaddress
+import logging
+import os
+from collections import OrderedDict
+
+try:
+    import maxminddb # Optional: pip install maxminddb (pure Python, with an optional C extension)
+except ImportError:
+    maxminddb = None
+
+DEFAULT_CACHE_ENTRIES = 65536
+ASSET_TABLE_COLUMNS = ("hostname", "asset_id", "category") # Mapped to UDM asset fields; other columns become labels
+
+class CidrAssetIndex:
+    """
+    Longest-prefix match of IP addresses against a CIDR -> asset table: one dict per (IP version, prefix length),
+    probed from the longest prefix present down to the shortest (at most 33 / 129 probes, usually a handful).
+    Hostnames of the table are indexed as well, for `about.hostname` entries.
+    """
+    def __init__(self):
+        self.networks = {4: {}, 6: {}} # version -> {prefix length -> {network int >> host bits: asset}}
+        self.prefix_lengths = {4: (), 6: ()} # version -> prefix lengths present, longest first
+        self.hostnames = {}
+
+    def add(self, cidr, asset):
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        host_bits = network.max_prefixlen - network.prefixlen
+        self.networks[network.version].setdefault(network.prefixlen, {})[int(network.network_address) >> host_bits] = asset
+        self.prefix_lengths[network.version] = tuple(sorted(self.networks[network.version], reverse=True))
+        if asset.get("hostname"):
+            self.hostnames.setdefault(asset["hostname"].lower(), asset)
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        """Loads `cidr,hostname,asset_id,category,...` rows (header required); bad rows are skipped with a warning."""
+        index = cls()
+        with open(csv_path, newline="") as f_csv:
+            for row in csv.DictReader(f_csv):
+                cidr = (row.pop("cidr", None) or "").strip()
+                asset = {column: row.pop(column).strip() for column in ASSET_TABLE_COLUMNS if (row.get(column) or "").strip()}
+                labels = [{"key": key, "value": value.strip()} for key, value in row.items() if key and value and value.strip()]
+                if labels:
+                    asset["attribute"] = {"labels": labels}
+                try:
+                    index.add(cidr, asset)
+                except ValueError:
+                    logging.warning(f"Skipping asset table row with invalid CIDR '{cidr}' in {csv_path}.")
+        return index
+
+    def lookup_ip(self, address):
+        max_prefix = 32 if address.version == 4 else 128
+        address_int = int(address)
+        version_networks = self.networks[address.version]
+        for prefix_length in self.prefix_lengths[address.version]:
+            asset = version_networks[prefix_length].get(address_int >> (max_prefix - prefix_length))
+            if asset is not None:
+                return asset
+        return None
+
+    def lookup_hostname(self, hostname):
+        return self.hostnames.get(hostname.lower())
+
+def _geo_artifact(ip_text, record):
+    """Maps a MaxMind record (City/Country and/or ASN fields) to a UDM ip_geo_artifact entry, or None if empty."""
+    location = {}
+    country = record.get("country") or record.get("registered_country") or {}
+    if country.get("iso_code"):
+        location["country_or_region"] = country["iso_code"]
+    city_name = (record.get("city") or {}).get("names", {}).get("en")
+    if city_name:
+        location["city"] = city_name
+    subdivisions = record.get("subdivisions") or []
+    if subdivisions and subdivisions[0].get("names", {}).get("en"):
+        location["state"] = subdivisions[0]["names"]["en"]
+    coordinates = record.get("location") or {}
+    if coordinates.get("latitude") is not None and coordinates.get("longitude") is not None:
+        location["region_coordinates"] = {"latitude": coordinates["latitude"], "longitude": coordinates["longitude"]}
+    network = {}
+    if record.get("autonomous_system_number") is not None:
+        network["asn"] = str(record["autonomous_system_number"])
+    if record.get("autonomous_system_organization"):
+        network["organization_name"] = record["autonomous_system_organization"]
+    if not (location or network):
+        return None
+    artifact = {"ip": ip_text}
+    if location:
+        artifact["location"] = location
+    if network:
+        artifact["network"] = network
+    return artifact
+
+class IpEnricher:
+    """Resolves IPs and hostnames through MMDB readers and a `CidrAssetIndex`, behind one LRU cache."""
+    def __init__(self, mmdb_readers=(), asset_index=None, cache_entries=DEFAULT_CACHE_ENTRIES):
+        self.mmdb_readers = list(mmdb_readers)
+        self.asset_index = asset_index
+        self.cache_entries = max(1, cache_entries)
+        self.cache = OrderedDict() # (kind, value) -> enrichment fields dict or None, least recently used first
+
+    def _resolve_ip(self, ip_text):
+        try:
+            address = ipaddress.ip_address(ip_text)
+        except ValueError:
+            return None
+        fields = {}
+        record = {}
+        for reader in self.mmdb_readers: # City and ASN databases complement each other
+            try:
+                record.update(reader.get(ip_text) or {})
+            except ValueError:
+                pass
+        artifact = _geo_artifact(ip_text, record) if record else None
+        if artifact:
+            fields["ip_geo_artifact"] = [artifact]
+        asset = self.asset_index.lookup_ip(address) if self.asset_index else None
+        if asset:
+            fields["asset"] = asset
+        return fields or None
+
+    def _resolve_hostname(self, hostname):
+        asset = self.asset_index.lookup_hostname(hostname) if self.asset_index else None
+        return {"asset": asset} if asset else None
+
+    def lookup(self, kind, value, stats):
+        """Enrichment fields for an IP (`kind` "ip") or hostname, from the cache when possible."""
+        cache_key = (kind, value)
+        try:
+            fields = self.cache[cache_key]
+            self.cache.move_to_end(cache_key)
+            stats["enrichment_cache_hits"] += 1
+            return fields
+        except KeyError:
+            pass
+        stats["enrichment_cache_misses"] += 1
+        fields = self._resolve_ip(value) if kind == "ip" else self._resolve_hostname(value)
+        self.cache[cache_key] = fields
+        if len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+            stats["enrichment_cache_evictions"] += 1
+        return fields
+
+    def enrich_event(self, udm_event, stats):
+        payload = udm_event.get("event")
+        if not payload:
+            return udm_event
+        for section in ("principal", "target"):
+            noun = payload.get(section)
+            if noun and isinstance(noun.get("ip"), str):
+                fields = self.lookup("ip", noun["ip"], stats)
+                if fields:
+                    noun.update(fields) # Shared, read-only fragments: events are only serialized afterwards
+                    stats["enriched_endpoints"] += 1
+        for about_entity in payload.get("about", ()):
+            if isinstance(about_entity.get("hostname"), str):
+                fields = self.lookup("hostname", about_entity["hostname"], stats)
+                if fields:
+                    about_entity.update(fields)
+                    stats["enriched_endpoints"] += 1
+        return udm_event
+
+    def enrich_events(self, udm_events, stats):
+        for counter in ("enrichment_cache_hits", "enrichment_cache_misses", "enrichment_cache_evictions", "enriched_endpoints"):
+            stats.setdefault(counter, 0)
+        for udm_event in udm_events:
+            yield self.enrich_event(udm_event, stats)
+
+_environment_enricher = None
+_environment_enricher_loaded = False
+
+def enricher_from_environment():
+    """The process-wide `IpEnricher` configured by the ENRICH_* variables, or None if enrichment is off."""
+    global _environment_enricher, _environment_enricher_loaded
+    if _environment_enricher_loaded:
+        return _environment_enricher
+    _environment_enricher_loaded = True
+
+    mmdb_paths = [path.strip() for path in os.environ.get("ENRICH_MMDB_PATHS", "").split(",") if path.strip()]
+    asset_table_path = os.environ.get("ENRICH_ASSET_CIDRS", "").strip()
+    mmdb_readers = []
+    if mmdb_paths and maxminddb is None:
+        logging.warning("ENRICH_MMDB_PATHS is set but the `maxminddb` package is not installed; geo/ASN enrichment is disabled.")
+    elif mmdb_paths:
+        for mmdb_path in mmdb_paths:
+            try:
+                mmdb_readers.append(maxminddb.open_database(mmdb_path))
+            except (OSError, ValueError) as e:
+                logging.error(f"Cannot open MMDB file {mmdb_path}: {e}")
+    asset_index = None
+    if asset_table_path:
+        try:
+            asset_index = CidrAssetIndex.from_csv(asset_table_path)
+        except OSError as e:
+            logging.error(f"Cannot read asset table {asset_table_path}: {e}")
+    if mmdb_readers or asset_index:
+        _environment_enricher = IpEnricher(mmdb_readers, asset_index,
+                                           int(os.environ.get("ENRICH_CACHE_ENTRIES", str(DEFAULT_CACHE_ENTRIES))))
+        logging.info(f"IP enrichment enabled: {len(mmdb_readers)} MMDB file(s), asset table: {asset_table_path or 'none'}.")
+    return _environment_enricher
@@ -4,105 +4,318 @@
 # - Processes packets one by one, reducing peak memory usage.
 # - Ensures every input packet results in a UDM event, even if it's a minimal error event.
 # - Implemented a more robust timestamp conversion (`convert_timestamp_robust`) with fallbacks.
+#   It prefers `frame.time_epoch`, never calls strptime, and caches the parsed date/time per second.
 # - The UDM structure is now more aligned with Chronicle's expectations (metadata, principal, target, network sections clearly defined).
 # - Removed the `write_to_multiple_files` function. In a cloud environment, the plan is to stream/send these UDM events directly to Chronicle's API or stage them in GCS.
-
-import json
+# - Output is written as events are produced (no list of all events): either the original indented JSON array
+#   or compact newline-delimited JSON (NDJSON), optionally gzip-compressed, flushed in bounded buffers.
+# - `UDM_SOURCE_FIELDS` declares every TShark field the mapper reads. It drives a projected extraction
+#   (`tshark -T ek -e ...`) that skips serializing unused fields, with a matching input path (`--input-format ek`).
+# - The ijson backend and the per-document JSON codec (orjson or stdlib) are chosen in json_backends.py, fastest
+#   available first; the output bytes do not depend on the choice.
+# - Optional drop / keep rules and per-flow sampling (packet_filter.py) discard packets with a counted reason,
+#   reported as `UDM_PACKETS_DROPPED` next to `UDM_PACKETS_PROCESSED`.
+# - `iter_udm_output_events` streams a written output back, for the Chronicle ingestion sender (chronicle_sender.py).
+# - `convert_tshark_output_file` is the command line's file-to-file conversion as a function, so a process that
+#   already imported this module (a pre-warmed pool worker, see processor_app.py FAST_STARTUP) can run it.
+# - Failed packets go through packet_errors.py: bounded snippets, per-reason counters, rate-limited log lines and a
+#   small sample of the failing packets (written next to the output as `<output>.errors.json`).
+
+import argparse
+import gzip
 import sys
 import os
 import logging
+import time
 from datetime import datetime, timezone
 import ijson  # Added ijson for efficient streaming of large JSON files
 
+import flow_aggregator
+import ip_enrichment
+import json_backends
+import packet_errors
+import packet_filter
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def convert_timestamp_robust(timestamp_str):
+OUTPUT_FORMATS = ("json", "ndjson") # "json": indented array (original format), "ndjson": one compact event per line
+DEFAULT_WRITE_BUFFER_BYTES = 256 * 1024 # Serialized events are flushed to the output once this much is pending
+INPUT_FORMATS = ("json", "ek") # "json": full `tshark -T json` array, "ek": projected `tshark -T ek -e ...` lines
+
+# Every TShark field read by `convert_single_packet_to_udm` (or by the flow aggregation), with where it sits inside `_source.layers` of the
+# full `-T json` output. "*" marks a section holding one sub-dictionary per occurrence (e.g. DNS queries).
+# This is the single source of truth for the projected extraction: a new mapping needs a new entry here.
+UDM_SOURCE_FIELDS = (
+    ("frame.time_epoch", ("frame", "frame.time_epoch")),
+    ("frame.time_utc", ("frame", "frame.time_utc")),
+    ("frame.number", ("frame", "frame.number")),
+    ("frame.protocols", ("frame", "frame.protocols")),
+    ("frame.len", ("frame", "frame.len")),
+    ("eth.src", ("eth", "eth.src")),
+    ("eth.dst", ("eth", "eth.dst")),
+    ("ip.src", ("ip", "ip.src")),
+    ("ip.dst", ("ip", "ip.dst")),
+    ("ip.ttl", ("ip", "ip.ttl")),
+    ("ipv6.src", ("ipv6", "ipv6.src")),
+    ("ipv6.dst", ("ipv6", "ipv6.dst")),
+    ("tcp.srcport", ("tcp", "tcp.srcport")),
+    ("tcp.dstport", ("tcp", "tcp.dstport")),
+    ("tcp.flags", ("tcp", "tcp.flags")),
+    ("udp.srcport", ("udp", "udp.srcport")),
+    ("udp.dstport", ("udp", "udp.dstport")),
+    ("icmp.type", ("icmp", "icmp.type")),
+    ("icmp.code", ("icmp", "icmp.code")),
+    ("arp.opcode", ("arp", "arp.opcode")),
+    ("arp.src.hw_mac", ("arp", "arp.src.hw_mac")),
+    ("arp.src.proto_ipv4", ("arp", "arp.src.proto_ipv4")),
+    ("arp.dst.hw_mac", ("arp", "arp.dst.hw_mac")),
+    ("arp.dst.proto_ipv4", ("arp", "arp.dst.proto_ipv4")),
+    ("http.host", ("http", "http.host")),
+    ("http.file_data", ("http", "http.file_data")),
+    ("http.request.method", ("http", "http.request.method")),
+    ("http.request.full_uri", ("http", "http.request.full_uri")),
+    ("http.user_agent", ("http", "http.user_agent")),
+    ("http.response.code", ("http", "http.response.code")),
+    ("dns.qry.name", ("dns", "Queries", "*", "dns.qry.name")),
+    ("dns.qry.type", ("dns", "Queries", "*", "dns.qry.type")),
+    ("dns.resp.ttl", ("dns", "Answers", "*", "dns.resp.ttl")),
+    ("dns.flags.response", ("dns", "dns.flags_tree", "dns.flags.response")),
+    ("tls.record.version", ("tls", "tls.record", "tls.record.version")),
+    ("tls.handshake.version", ("tls", "tls.record", "tls.handshake", "tls.handshake.version")),
+    ("tls.handshake.extensions_server_name", ("tls", "tls.record", "tls.handshake", "tls.handshake.extensions_server_name")),
+)
+# Layers the mapper branches on. In projected input a layer can be present (per `frame.protocols`) without any
+# projected field, e.g. an HTTP continuation segment; it then gets a marker key so `if http:` still sees it.
+PROJECTED_LAYER_MARKER = "_projected"
+_MAPPED_LAYERS = frozenset(layer_path[0] for _, layer_path in UDM_SOURCE_FIELDS) - {"frame"}
+# ek output names fields with '_' instead of '.', e.g. "ip_src"; precomputed once for the per-packet lookup.
+_PROJECTION_PLAN = tuple((field_name, field_name.replace(".", "_"), layer_path) for field_name, layer_path in UDM_SOURCE_FIELDS)
+
+_MONTH_NUMBERS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+                  "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+TIMESTAMP_CACHE_MAX_ENTRIES = 4096 # Distinct seconds remembered; a capture file rarely spans more than a few minutes
+_second_prefix_cache = {} # "Nov 14, 2023 22:13:20" (or epoch "1700000000") -> "2023-11-14T22:13:20"
+
+def _current_time_iso():
+    return datetime.now(timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
+
+def _count_timestamp_fallback(stats, reason):
+    """Per-file counter instead of a warning per packet; summarized by `log_conversion_summary`."""
+    if stats is not None:
+        stats["timestamp_fallbacks"] = stats.get("timestamp_fallbacks", 0) + 1
+        stats["last_timestamp_fallback_reason"] = reason
+    else:
+        logging.debug(f"Timestamp fallback to current time: {reason}")
+
+def _remember_second_prefix(cache_key, iso_prefix):
+    if len(_second_prefix_cache) >= TIMESTAMP_CACHE_MAX_ENTRIES:
+        _second_prefix_cache.clear()
+    _second_prefix_cache[cache_key] = iso_prefix
+    return iso_prefix
+
+def _iso_prefix_from_text(second_text):
+    """
+    Parses the second-resolution part of a TShark text timestamp into "YYYY-MM-DDTHH:MM:SS" without strptime.
+    Accepts "Nov 14, 2023 22:13:20" (day may be space-padded) and ISO "2023-11-14T22:13:20" (Wireshark >= 4.2).
+    Returns None if the text is not a valid timestamp.
+    """
+    try:
+        if len(second_text) >= 19 and second_text[4] == "-" and second_text[10] in "T ":
+            dt_naive = datetime(int(second_text[0:4]), int(second_text[5:7]), int(second_text[8:10]),
+                                int(second_text[11:13]), int(second_text[14:16]), int(second_text[17:19]))
+        else:
+            month_text, day_text, year_text, clock_text = second_text.replace(",", " ").split()[:4]
+            hours_text, minutes_text, seconds_text = clock_text.split(":")
+            dt_naive = datetime(int(year_text), _MONTH_NUMBERS[month_text], int(day_text),
+                                int(hours_text), int(minutes_text), int(seconds_text))
+    except (ValueError, KeyError, IndexError):
+        return None
+    return dt_naive.strftime("%Y-%m-%dT%H:%M:%S")
+
+def _microseconds_text(fraction_text):
+    """Leading digits of the fractional part, truncated or zero-padded to 6 (None if there are none)."""
+    digit_count = 0
+    while digit_count < len(fraction_text) and fraction_text[digit_count].isdigit():
+        digit_count += 1
+    if digit_count == 0:
+        return None
+    return (fraction_text[:digit_count] + "00000")[:6]
+
+def convert_epoch_timestamp(epoch_str, stats=None):
+    """
+    Converts a `frame.time_epoch` value ("1700000000.123456789") to ISO 8601 UTC with microseconds.
+    The "YYYY-MM-DDTHH:MM:SS" prefix is computed once per second and cached; only the fraction is
+    handled per packet. Returns None if the value is unusable, so callers can try the text form.
+    """
+    if not isinstance(epoch_str, str):
+        epoch_str = str(epoch_str) # EK output may carry it as a JSON number
+    seconds_text, _, fraction_text = epoch_str.partition(".")
+    iso_prefix = _second_prefix_cache.get(seconds_text)
+    if iso_prefix is None:
+        try:
+            iso_prefix = _remember_second_prefix(seconds_text, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(int(seconds_text))))
+        except (ValueError, OverflowError, OSError):
+            return None
+    microseconds = _microseconds_text(fraction_text) if fraction_text else "000000"
+    if microseconds is None:
+        return None
+    return f"{iso_prefix}.{microseconds}Z"
+
+def convert_timestamp_robust(timestamp_str, stats=None):
     """
     Converts Wireshark timestamp string to ISO 8601 UTC format.
-    If conversion fails, logs a warning and uses the current processing time as a robust fallback.
+    If conversion fails, uses the current processing time as a robust fallback and counts it in
+    `stats["timestamp_fallbacks"]` (one summary line per file rather than a warning per packet).
     This ensures a timestamp is always present in the UDM event.
-    This is a significant improvement over the previous simple strptime, adding resilience.
+    Packets in the same second reuse the cached date/time prefix, so the per-packet cost is a
+    dictionary lookup plus the fractional part; strptime is never called.
     """
     if not timestamp_str:
-        logging.warning(f"Timestamp string is missing or empty. Using current time as fallback.")
-        return datetime.now(timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
-    try:
-        # Standard TShark format up to microseconds
-        dt_naive = datetime.strptime(timestamp_str[:26], "%b %d, %Y %H:%M:%S.%f")
-    except ValueError:
-        # Fallback for timestamps that might not have microseconds or have timezone names
-        try:
-            # Attempt to clean common timezone strings if present
-            cleaned_ts = timestamp_str.split(" UTC")[0]
-            cleaned_ts = cleaned_ts.split(" Central European Summer Time")[0].strip() # Example, can add more
-            dt_naive = datetime.strptime(cleaned_ts, "%b %d, %Y %H:%M:%S") # Try without microseconds
-        except ValueError as e_fallback:
-            logging.warning(f"Error converting timestamp '{timestamp_str}' with primary and fallback formats: {e_fallback}. Using current time.")
-            # If all fails, use current time to ensure UDM compliance for event_timestamp
-            return datetime.now(timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
-
-    dt_aware = dt_naive.replace(tzinfo=timezone.utc) # Assume UTC as per Wireshark's frame.time_utc
-    iso_timestamp = dt_aware.isoformat(timespec='microseconds').replace('+00:00', 'Z') # Ensure 'Z' for Zulu time
-    return iso_timestamp
-
-def get_nested_value(data_dict, key_path, default=None):
-    """
-    Safely retrieves a nested value from a dictionary using a dot-separated path.
-    This helper avoids multiple .get() calls and KeyError exceptions, making data extraction cleaner
-    than in the previous version where missing keys could lead to skipping packets or more verbose checks.
-    """
-    keys = key_path.split('.')
-    val = data_dict
-    try:
+        _count_timestamp_fallback(stats, "missing")
+        return _current_time_iso()
+
+    second_text, _, fraction_text = timestamp_str.partition(".")
+    if not fraction_text: # No sub-second part, e.g. "Nov 14, 2023 22:13:20 UTC"
+        second_text = " ".join(second_text.split()[:4]) if second_text[:1].isalpha() else second_text[:19]
+    iso_prefix = _second_prefix_cache.get(second_text)
+    if iso_prefix is None:
+        iso_prefix = _iso_prefix_from_text(second_text)
+        if iso_prefix is None:
+            _count_timestamp_fallback(stats, f"unparsed format: {timestamp_str[:64]}")
+            return _current_time_iso()
+        _remember_second_prefix(second_text, iso_prefix)
+
+    microseconds = _microseconds_text(fraction_text) if fraction_text else "000000"
+    if microseconds is None:
+        _count_timestamp_fallback(stats, f"unparsed fraction: {timestamp_str[:64]}")
+        return _current_time_iso()
+    return f"{iso_prefix}.{microseconds}Z" # Assume UTC as per Wireshark's frame.time_utc, 'Z' for Zulu time
+
+def convert_frame_timestamp(frame, stats=None):
+    """Event time from a frame layer (or extracted fields dict): `frame.time_epoch` when present (cheapest), else `frame.time_utc`."""
+    epoch_value = frame.get("frame.time_epoch")
+    if epoch_value is not None:
+        iso_timestamp = convert_epoch_timestamp(epoch_value, stats)
+        if iso_timestamp is not None:
+            return iso_timestamp
+    return convert_timestamp_robust(frame.get("frame.time_utc"), stats)
+
+# --- Compiled Field Accessors ---
+# Paths are tuples of keys (str) and list indexes (int), since TShark keys themselves contain dots ("frame.number"),
+# compiled once into a resolver function; the per-packet cost is a couple of dict lookups.
+def compile_field_path(path):
+    """
+    Compiles a path (tuple of dict keys and list indexes) into a function `resolve(data) -> value or None`.
+    Where a dict key is expected but a list is found (e.g. several `tls.record` entries in one segment),
+    the first element is used. Short paths get unrolled resolvers, the common case in the extraction spec.
+    """
+    keys = tuple(path)
+    if all(isinstance(key, str) for key in keys):
+        if len(keys) == 1:
+            key_0, = keys
+            def resolve(data):
+                return data.get(key_0) if type(data) is dict else None
+            return resolve
+        if len(keys) == 2:
+            key_0, key_1 = keys
+            def resolve(data):
+                if type(data) is not dict:
+                    return None
+                data = data.get(key_0)
+                if type(data) is list:
+                    data = data[0] if data else None
+                return data.get(key_1) if type(data) is dict else None
+            return resolve
+
+    def resolve(data):
         for key in keys:
-            if isinstance(val, dict):
-                val = val.get(key)
-            elif isinstance(val, list) and key.isdigit(): # Basic list index access
-                idx = int(key)
-                if 0 <= idx < len(val):
-                    val = val[idx]
-                else:
-                    return default
-            else:
-                return default
-            if val is None: # If any key in the path is not found or its value is None
-                return default
-        return val if val is not None else default
-    except (TypeError, AttributeError, ValueError): # Catch errors if structure is not as expected
-        return default
-
-def extract_values_from_tshark_section(section_data, field_key):
-    """
-    Extracts all occurrences of 'field_key' from TShark's structured sections (e.g., DNS Queries/Answers).
-    TShark often structures these as dicts of dicts.
-    This is more generic than the previous `print_dns` specific functions.
-    """
-    values = []
-    if isinstance(section_data, dict):
-        # TShark's DNS query/answer sections are dictionaries of items where each item is another dictionary containing the actual fields.
-        for item_details in section_data.values(): # Iterate through the inner dictionaries
-            if isinstance(item_details, dict):
-                value = item_details.get(field_key)
-                if value is not None:
-                    values.append(value)
-    return values if values else None # Return None if no values found, to avoid empty lists in UDM
+            if type(key) is int:
+                if type(data) is not list or not -len(data) <= key < len(data):
+                    return None
+                data = data[key]
+                continue
+            if type(data) is list:
+                data = data[0] if data else None
+            if type(data) is not dict:
+                return None
+            data = data.get(key)
+        return data
+    return resolve
+
+def _section_items(section):
+    """Sub-dictionaries of a TShark section, which is a dict of dicts (e.g. DNS "Queries") or occasionally a list."""
+    if type(section) is dict:
+        return section.values()
+    if type(section) is list:
+        return section
+    return ()
+
+def compile_extraction_spec(source_fields):
+    """
+    Groups `UDM_SOURCE_FIELDS`-style declarations by layer and compiles each path below the layer.
+    Returns a tuple of (layer_name, ((field_name, resolve, item_resolve), ...)); for "*" (one value per
+    section item) fields, `resolve` finds the section and `item_resolve` the value inside each item.
+    """
+    fields_by_layer = {}
+    for field_name, layer_path in source_fields:
+        layer_name, field_path = layer_path[0], layer_path[1:]
+        if "*" in field_path:
+            section_depth = field_path.index("*")
+            compiled = (field_name, compile_field_path(field_path[:section_depth]), compile_field_path(field_path[section_depth + 1:]))
+        else:
+            compiled = (field_name, compile_field_path(field_path), None)
+        fields_by_layer.setdefault(layer_name, []).append(compiled)
+    return tuple((layer_name, tuple(compiled_fields)) for layer_name, compiled_fields in fields_by_layer.items())
+
+_EXTRACTION_PLAN = compile_extraction_spec(UDM_SOURCE_FIELDS)
+_PACKET_LAYERS_PATH = compile_field_path(("_source", "layers"))
+_PACKET_NUMBER_PATH = compile_field_path(("_source", "layers", "frame", "frame.number"))
+_FRAME_EPOCH_PATH = compile_field_path(("_source", "layers", "frame", "frame.time_epoch"))
+_FRAME_LEN_PATH = compile_field_path(("_source", "layers", "frame", "frame.len"))
+_FRAME_PROTOCOLS_PATH = compile_field_path(("_source", "layers", "frame", "frame.protocols"))
+
+def extract_packet_fields(layers):
+    """
+    Resolves every declared source field of one packet in a single pass over the compiled spec.
+    Returns (present_layers, field_values): the set of non-empty mapped layers, and a dict of field name ->
+    value (a list of values for "*" fields). Layers that are absent cost one dict lookup for all their fields.
+    """
+    present_layers = set()
+    field_values = {}
+    for layer_name, compiled_fields in _EXTRACTION_PLAN:
+        layer = layers.get(layer_name)
+        if not layer:
+            continue
+        present_layers.add(layer_name)
+        for field_name, resolve, item_resolve in compiled_fields:
+            value = resolve(layer)
+            if value is None:
+                continue
+            if item_resolve is not None:
+                value = [item_value for item_value in map(item_resolve, _section_items(value)) if item_value is not None]
+                if not value:
+                    continue
+            field_values[field_name] = value
+    return present_layers, field_values
 
 # --- Main Packet Conversion Logic ---
-def convert_single_packet_to_udm(packet_data):
+def convert_single_packet_to_udm(packet_data, stats=None):
     """
     Converts a single packet (Python dictionary from ijson) to UDM format.
     A key design choice here is to ALWAYS produce a UDM event, even for malformed packets,
     to ensure no data is silently lost and to provide traceability.
     The UDM structure is more detailed and organized (principal, target, etc.) compared to the old script.
+    `stats`, when given, collects per-file counters (e.g. timestamp fallbacks) instead of per-packet log lines.
     """
     try:
         # The core data is nested under "_source" and "layers" in TShark's JSON output
-        layers = packet_data.get("_source", {}).get("layers", {})
-        packet_num_info = get_nested_value(packet_data, "_source.layers.frame.frame.number", "N/A")
+        layers = _PACKET_LAYERS_PATH(packet_data)
+        packet_num_info = _PACKET_NUMBER_PATH(packet_data) or "N/A"
 
         if not layers:
             # If the essential 'layers' key is missing, it's a severely malformed packet: create a minimal UDM event indicating this issue.
-            logging.warning(f"Packet (num: {packet_num_info}) missing '_source.layers'. Creating minimal UDM.")
+            packet_errors.record_packet_error(stats, "missing_layers", "missing '_source.layers'", packet_num_info, packet_data,
+                                              f"Packet (num: {packet_num_info}) missing '_source.layers'. Creating minimal UDM.", logging.WARNING)
             ts_fallback = datetime.now(timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
             return {"event": {"metadata": {"event_timestamp": ts_fallback,
                                           "product_name": "Wireshark TShark (Malformed)", # Specific product name for this case
@@ -110,21 +323,12 @@ def convert_single_packet_to_udm(packet_data):
                                           "event_type": "NETWORK_EVENT_UNKNOWN", # Generic, as we know little
                                           "description": f"Malformed packet data. Frame: {packet_num_info}"}}}
 
-        # Extract common layers. Using .get() for safety.
-        frame = layers.get("frame", {})
-        eth = layers.get("eth", {})
-        ip = layers.get("ip", {})
-        ipv6 = layers.get("ipv6", {}) # Added for completeness
-        tcp = layers.get("tcp", {})
-        udp = layers.get("udp", {})
-        icmp = layers.get("icmp", {})
-        dns = layers.get("dns", {})
-        http = layers.get("http", {})
-        tls_layer = layers.get("tls", {}) # Renamed from 'tls' to avoid conflict with the module
-        arp = layers.get("arp", {})
+        # All fields the mapper reads come from the compiled `UDM_SOURCE_FIELDS` spec in one pass.
+        # Adding a protocol means declaring its fields there and mapping them below.
+        present_layers, fields = extract_packet_fields(layers)
 
         # Use the robust timestamp conversion for the primary event time
-        event_timestamp = convert_timestamp_robust(frame.get("frame.time_utc"))
+        event_timestamp = convert_frame_timestamp(fields, stats)
 
         # Initialize UDM sections. This structured approach is cleaner than the previous script's flat network dict.
         udm_principal = {}
@@ -136,119 +340,101 @@ def convert_single_packet_to_udm(packet_data):
         event_type = "NETWORK_CONNECTION" # Default event type
 
         # --- IP Layer (Principal and Target) ---
-        if ip:
-            udm_principal["ip"] = ip.get("ip.src")
-            udm_target["ip"] = ip.get("ip.dst")
+        if "ip" in present_layers:
+            udm_principal["ip"] = fields.get("ip.src")
+            udm_target["ip"] = fields.get("ip.dst")
             udm_network["ip_protocol_version"] = 4
-            if ip.get("ip.ttl") is not None: udm_additional["ip_ttl"] = str(ip.get("ip.ttl")) # Store TTL in additional
-        elif ipv6: # Handle IPv6
-            udm_principal["ip"] = ipv6.get("ipv6.src")
-            udm_target["ip"] = ipv6.get("ipv6.dst")
+            if fields.get("ip.ttl") is not None: udm_additional["ip_ttl"] = str(fields["ip.ttl"]) # Store TTL in additional
+        elif "ipv6" in present_layers: # Handle IPv6
+            udm_principal["ip"] = fields.get("ipv6.src")
+            udm_target["ip"] = fields.get("ipv6.dst")
             udm_network["ip_protocol_version"] = 6
         
-        if eth: # MAC addresses
-            udm_principal["mac"] = eth.get("eth.src")
-            udm_target["mac"] = eth.get("eth.dst")
+        if "eth" in present_layers: # MAC addresses
+            udm_principal["mac"] = fields.get("eth.src")
+            udm_target["mac"] = fields.get("eth.dst")
 
         # --- Transport Layer ---
-        if tcp:
+        if "tcp" in present_layers:
             udm_network["transport_protocol"] = "TCP"
-            if tcp.get("tcp.srcport") is not None: udm_principal["port"] = int(tcp.get("tcp.srcport"))
-            if tcp.get("tcp.dstport") is not None: udm_target["port"] = int(tcp.get("tcp.dstport"))
-            if tcp.get("tcp.flags") is not None: udm_network["tcp_flags"] = tcp.get("tcp.flags")
-        elif udp:
+            if fields.get("tcp.srcport") is not None: udm_principal["port"] = int(fields["tcp.srcport"])
+            if fields.get("tcp.dstport") is not None: udm_target["port"] = int(fields["tcp.dstport"])
+            if fields.get("tcp.flags") is not None: udm_network["tcp_flags"] = fields["tcp.flags"]
+        elif "udp" in present_layers:
             udm_network["transport_protocol"] = "UDP"
-            if udp.get("udp.srcport") is not None: udm_principal["port"] = int(udp.get("udp.srcport"))
-            if udp.get("udp.dstport") is not None: udm_target["port"] = int(udp.get("udp.dstport"))
-        elif icmp:
+            if fields.get("udp.srcport") is not None: udm_principal["port"] = int(fields["udp.srcport"])
+            if fields.get("udp.dstport") is not None: udm_target["port"] = int(fields["udp.dstport"])
+        elif "icmp" in present_layers:
             udm_network["transport_protocol"] = "ICMP"
             event_type = "NETWORK_ICMP" # More specific event type
-            if icmp.get("icmp.type") is not None: udm_network["icmp_type"] = str(icmp.get("icmp.type"))
-            if icmp.get("icmp.code") is not None: udm_network["icmp_code"] = str(icmp.get("icmp.code"))
-        elif arp: # ARP is L2/L3 but distinct, good to capture
+            if fields.get("icmp.type") is not None: udm_network["icmp_type"] = str(fields["icmp.type"])
+            if fields.get("icmp.code") is not None: udm_network["icmp_code"] = str(fields["icmp.code"])
+        elif "arp" in present_layers: # ARP is L2/L3 but distinct, good to capture
             event_type = "NETWORK_ARP"
             # ARP specific details, mapping them to UDM principal/target where appropriate
-            udm_additional["arp_operation"] = arp.get("arp.opcode") # e.g., request (1), reply (2)
-            udm_principal["mac"] = arp.get("arp.src.hw_mac")
-            udm_principal["ip"] = arp.get("arp.src.proto_ipv4") # Sender IP
-            udm_target["mac"] = arp.get("arp.dst.hw_mac")
-            udm_target["ip"] = arp.get("arp.dst.proto_ipv4")   # Target IP
+            udm_additional["arp_operation"] = fields.get("arp.opcode") # e.g., request (1), reply (2)
+            udm_principal["mac"] = fields.get("arp.src.hw_mac")
+            udm_principal["ip"] = fields.get("arp.src.proto_ipv4") # Sender IP
+            udm_target["mac"] = fields.get("arp.dst.hw_mac")
+            udm_target["ip"] = fields.get("arp.dst.proto_ipv4")   # Target IP
         
         # --- Application Layer Protocols ---
         # This section is more structured for adding application data than the previous version.
-        if http:
+        if "http" in present_layers:
             event_type = "NETWORK_HTTP"
             http_info = {}
-            if http.get("http.host"): 
-                http_info["host"] = http.get("http.host")
-                udm_about.append({"hostname": http.get("http.host")})
-            if http.get("http.file_data"): http_info["file_data"] = http.get("http.file_data") # Potentially large, use with care
-            if http.get("http.request.method"): http_info["method"] = http.get("http.request.method")
-            if http.get("http.request.full_uri"): 
-                http_info["url"] = http.get("http.request.full_uri")
+            if fields.get("http.host"): 
+                http_info["host"] = fields["http.host"]
+                udm_about.append({"hostname": fields["http.host"]})
+            if fields.get("http.file_data"): http_info["file_data"] = fields["http.file_data"] # Potentially large, use with care
+            if fields.get("http.request.method"): http_info["method"] = fields["http.request.method"]
+            if fields.get("http.request.full_uri"): 
+                http_info["url"] = fields["http.request.full_uri"]
                 udm_about.append({"url": http_info["url"]})
-            if http.get("http.user_agent"): http_info["user_agent"] = http.get("http.user_agent")
-            if http.get("http.response.code"): http_info["status_code"] = int(http.get("http.response.code"))
+            if fields.get("http.user_agent"): http_info["user_agent"] = fields["http.user_agent"]
+            if fields.get("http.response.code"): http_info["status_code"] = int(fields["http.response.code"])
             if http_info: app_layer_data["http"] = http_info
         
-        # DNS processing, using the new helper `extract_values_from_tshark_section`, TShark's DNS JSON can be a bit nested.
-        dns_source_layer = dns # Could also be layers.get("mdns") if we were handling that separately.
-        if dns_source_layer:
+        # DNS processing: TShark's DNS JSON nests queries/answers in sections, flattened to value lists by the spec.
+        if "dns" in present_layers: # Could also cover "mdns" if we were handling that separately.
             event_type = "NETWORK_DNS"
             dns_info = {}
-            queries_section = dns_source_layer.get("Queries")
-            if queries_section:
-                q_names = extract_values_from_tshark_section(queries_section, "dns.qry.name")
-                q_types = extract_values_from_tshark_section(queries_section, "dns.qry.type") # e.g., A, AAAA, CNAME
-                if q_names:
-                    dns_info["queries"] = []
-                    for i, name in enumerate(q_names):
-                        query_item = {"name": name}
-                        if q_types and i < len(q_types): query_item["type"] = q_types[i]
-                        dns_info["queries"].append(query_item)
-                        udm_about.append({"hostname": name})
+            q_names = fields.get("dns.qry.name")
+            q_types = fields.get("dns.qry.type") # e.g., A, AAAA, CNAME
+            if q_names:
+                dns_info["queries"] = []
+                for i, name in enumerate(q_names):
+                    query_item = {"name": name}
+                    if q_types and i < len(q_types): query_item["type"] = q_types[i]
+                    dns_info["queries"].append(query_item)
+                    udm_about.append({"hostname": name})
 
             # Answers section, similar structure
-            answers_section = dns_source_layer.get("Answers")
-            if answers_section:
-                ans_ttls = extract_values_from_tshark_section(answers_section, "dns.resp.ttl")
-                if ans_ttls: dns_info["answer_ttls"] = [int(t) for t in ans_ttls if t is not None]
-                # For a full DNS UDM, would extract dns.a, dns.aaaa, dns.cname etc. here.
-
-            # DNS Flags
-            flags_tree = dns_source_layer.get("dns.flags_tree", {}) # TShark often puts flags in a sub-tree
-            if flags_tree.get("dns.flags.response") is not None:
-                dns_info["is_response"] = flags_tree.get("dns.flags.response") == '1' # '1' for response, '0' for query
+            ans_ttls = fields.get("dns.resp.ttl")
+            if ans_ttls: dns_info["answer_ttls"] = [int(t) for t in ans_ttls if t is not None]
+            # For a full DNS UDM, would extract dns.a, dns.aaaa, dns.cname etc. here.
+
+            # DNS Flags (TShark puts them in the dns.flags_tree sub-tree)
+            if fields.get("dns.flags.response") is not None:
+                dns_info["is_response"] = fields["dns.flags.response"] == '1' # '1' for response, '0' for query
             
             if dns_info: app_layer_data["dns"] = dns_info
 
         # TLS/SSL Information
-        if tls_layer:
+        # TShark can output tls.record as a single dict or a list of dicts (for multiple records in one TCP segment);
+        # the compiled paths take the first record for simplicity.
+        if "tls" in present_layers:
             event_type = "NETWORK_SSL" # UDM type for SSL/TLS events
             tls_info = {}
-            # TShark can output tls.record as a single dict or a list of dicts (for multiple records in one TCP segment)
-            tls_record_data = tls_layer.get("tls.record") 
-            
-            record_to_analyze = None
-            if isinstance(tls_record_data, dict):
-                record_to_analyze = tls_record_data
-            elif isinstance(tls_record_data, list) and len(tls_record_data) > 0:
-                record_to_analyze = tls_record_data[0] # Just take the first record for simplicity
-
-            if record_to_analyze:
-                if record_to_analyze.get("tls.record.version"): # e.g., "TLS 1.2" (0x0303)
-                    tls_info["record_version_protocol"] = record_to_analyze.get("tls.record.version") 
-                
-                # Handshake data is often nested
-                handshake_data = record_to_analyze.get("tls.handshake", {})
-                if handshake_data.get("tls.handshake.version"):
-                    tls_info["handshake_protocol_version"] = handshake_data.get("tls.handshake.version")
-                
-                # SNI (Server Name Indication) is a key field
-                sni = get_nested_value(handshake_data, "tls.handshake.extensions_server_name")
-                if sni:
-                    tls_info["server_name_indication"] = sni
-                    udm_about.append({"hostname": sni}) # SNI is a good candidate for 'about'
+            if fields.get("tls.record.version"): # e.g., "TLS 1.2" (0x0303)
+                tls_info["record_version_protocol"] = fields["tls.record.version"]
+            if fields.get("tls.handshake.version"):
+                tls_info["handshake_protocol_version"] = fields["tls.handshake.version"]
+            # SNI (Server Name Indication) is a key field
+            sni = fields.get("tls.handshake.extensions_server_name")
+            if sni:
+                tls_info["server_name_indication"] = sni
+                udm_about.append({"hostname": sni}) # SNI is a good candidate for 'about'
             
             if tls_info: app_layer_data["tls"] = tls_info
 
@@ -259,7 +445,7 @@ def convert_single_packet_to_udm(packet_data):
                 "product_name": "Wireshark TShark",
                 "vendor_name": "Wireshark",
                 "event_type": event_type, # Dynamically set based on protocols found
-                "description": f"Packet capture. Protocols: {frame.get('frame.protocols', 'N/A')}. Frame No: {packet_num_info}"
+                "description": f"Packet capture. Protocols: {fields.get('frame.protocols', 'N/A')}. Frame No: {packet_num_info}"
             }
         }
 
@@ -296,15 +482,20 @@ def convert_single_packet_to_udm(packet_data):
     except Exception as e_packet_processing:
         # This is a catch-all for unexpected errors during a single packet's processing.
         # The goal is to still create a UDM event describing the error.
-        packet_num_info = get_nested_value(packet_data, "_source.layers.frame.frame.number", "N/A (error state)")
+        try:
+            packet_num_info = _PACKET_NUMBER_PATH(packet_data) or "N/A (error state)"
+        except Exception:
+            packet_num_info = "N/A (error state)"
         ts_fallback = datetime.now(timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
-        logging.error(f"Critical error processing packet (num: {packet_num_info}): {e_packet_processing}. Creating minimal UDM event.", exc_info=True)
-        
-        # Try to get a snippet of the problematic packet for debugging, without crashing if serialization fails
+        # Counted per reason; only the first failures of a file are logged (see packet_errors.py)
+        packet_errors.record_packet_error(stats, packet_errors.error_reason(e_packet_processing), str(e_packet_processing),
+                                          packet_num_info, packet_data,
+                                          f"Critical error processing packet (num: {packet_num_info}): {e_packet_processing}. Creating minimal UDM event.",
+                                          exception=e_packet_processing)
+
+        # A snippet of the problematic packet for debugging: only the first 1000 characters are ever encoded
         try:
-            packet_snippet = json.dumps(packet_data) # This could be large
-            if len(packet_snippet) > 1000: # Limit snippet size
-                 packet_snippet = packet_snippet[:1000] + "..."
+            packet_snippet = packet_errors.bounded_json_snippet(packet_data)
         except Exception:
             packet_snippet = "Could not serialize packet data for snippet."
 
@@ -316,41 +507,300 @@ def convert_single_packet_to_udm(packet_data):
                          "additional": {"processing_error_message": str(e_packet_processing), # Store the error message
                                         "original_packet_data_snippet": packet_snippet}}} # And the snippet
 
+def new_conversion_stats():
+    """
+    Returns a fresh per-file counters dictionary shared by the conversion helpers below.
+    A plain dict keeps it cheap to update per packet and easy to log or pass between processes.
+    """
+    return {"packets_processed": 0, "packet_errors": 0}
+
+def merge_conversion_stats(total_stats, partial_stats):
+    """Adds the numeric counters of `partial_stats` (e.g. one chunk of a capture) into `total_stats`."""
+    packet_errors.merge_error_samples(total_stats, partial_stats) # Needs the counts before they are added up
+    for counter, value in partial_stats.items():
+        if counter == "error_sample":
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            total_stats.setdefault(counter, value)
+        else:
+            total_stats[counter] = total_stats.get(counter, 0) + value
+    return total_stats
+
+def is_error_udm_event(udm_event):
+    """True if the UDM event was produced by the catch-all error path of `convert_single_packet_to_udm`."""
+    return "PacketProcessingError" in udm_event.get("event", {}).get("metadata", {}).get("product_name", "")
+
+def iter_udm_events(packet_iterator, stats, event_filter=None):
+    """
+    Lazily converts an iterator of TShark packet dictionaries into UDM events, updating `stats` as it goes.
+    Being a generator, it lets callers stream packets straight from a parser (file or pipe) to a writer
+    without ever holding the whole capture in memory.
+    With an `event_filter` (packet_filter.PacketFilter), dropped and sampled-out packets are counted, not yielded.
+    """
+    flow_counts = event_filter.new_flow_table() if event_filter else None
+    for packet_data_dict in packet_iterator:
+        udm_event = convert_single_packet_to_udm(packet_data_dict, stats)
+        stats["packets_processed"] += 1
+        # Check if the generated UDM event was an error event
+        if is_error_udm_event(udm_event):
+            stats["packet_errors"] += 1
+        elif event_filter is not None:
+            udm_event = event_filter.decide(udm_event, _FRAME_PROTOCOLS_PATH(packet_data_dict), flow_counts, stats)
+            if udm_event is None:
+                continue
+        yield udm_event
+
+def iter_udm_flow_events(packet_iterator, stats, flow_settings=None, event_filter=None):
+    """
+    Like `iter_udm_events`, but folds the per-packet events into one event per flow (see flow_aggregator.py).
+    `flow_settings` holds the `FlowAggregator` options (idle_timeout_seconds, active_timeout_seconds, max_flows).
+    `packets_processed` / `packet_errors` still count packets; `flows_emitted` counts the flow events.
+    An `event_filter` only applies its drop / keep rules here: sampled packets would make the flow counters wrong.
+    """
+    aggregator = flow_aggregator.FlowAggregator(stats, **(flow_settings or {}))
+    for packet_data_dict in packet_iterator:
+        udm_event = convert_single_packet_to_udm(packet_data_dict, stats)
+        stats["packets_processed"] += 1
+        if is_error_udm_event(udm_event):
+            stats["packet_errors"] += 1
+            yield udm_event
+            continue
+        if event_filter is not None and event_filter.decide(udm_event, _FRAME_PROTOCOLS_PATH(packet_data_dict), None, stats,
+                                                            sample=False) is None:
+            continue
+        try:
+            packet_epoch = float(_FRAME_EPOCH_PATH(packet_data_dict))
+        except (TypeError, ValueError):
+            packet_epoch = None
+        yield from aggregator.add(udm_event, packet_epoch, _FRAME_LEN_PATH(packet_data_dict),
+                                  _PACKET_NUMBER_PATH(packet_data_dict), _FRAME_PROTOCOLS_PATH(packet_data_dict))
+    yield from aggregator.flush_all()
+
+def iter_output_events(packet_iterator, stats, flow_settings=None):
+    """
+    Per-packet UDM events, or per-flow events when `flow_settings` is given (the CLI's and pipelines' switch),
+    filtered by UDM_DROP_RULES / UDM_KEEP_RULES / FLOW_SAMPLING_* (see packet_filter.py) and enriched with
+    geo/ASN/asset context when ENRICH_* is configured (see ip_enrichment.py).
+    """
+    event_filter = packet_filter.filter_from_environment()
+    if event_filter is not None:
+        stats.setdefault("packets_dropped", 0) # Reported even when nothing matched
+    if flow_settings:
+        udm_events = iter_udm_flow_events(packet_iterator, stats, flow_settings, event_filter)
+    else:
+        udm_events = iter_udm_events(packet_iterator, stats, event_filter)
+    enricher = ip_enrichment.enricher_from_environment()
+    return enricher.enrich_events(udm_events, stats) if enricher else udm_events
+
+def log_conversion_summary(stats, source_name):
+    """Logs the per-file counters in the `UDM_PACKETS_PROCESSED` / `UDM_PACKET_ERRORS` format used by the log-based metrics."""
+    logging.info(f"Successfully converted {stats['packets_processed']} packets from JSON to UDM format for file {source_name}.")
+    logging.info(f"UDM_PACKETS_PROCESSED: {stats['packets_processed']} FILE: {source_name}")
+
+    if "packets_dropped" in stats:
+        logging.info(f"UDM_PACKETS_DROPPED: {stats['packets_dropped']} FILE: {source_name}")
+        for reason, dropped_count in sorted(packet_filter.dropped_by_reason(stats).items()):
+            logging.info(f"UDM_PACKETS_DROPPED_REASON: {dropped_count} REASON: {reason} FILE: {source_name}")
+
+    if "flows_emitted" in stats:
+        logging.info(f"UDM_FLOWS_EMITTED: {stats['flows_emitted']} FILE: {source_name}")
+        if stats.get("flows_evicted"):
+            logging.warning(f"{stats['flows_evicted']} flows were emitted early because the flow table was full for file {source_name}.")
+
+    if "enrichment_cache_misses" in stats:
+        logging.info(f"ENRICHMENT_CACHE_HITS: {stats['enrichment_cache_hits']} MISSES: {stats['enrichment_cache_misses']} "
+                     f"EVICTIONS: {stats['enrichment_cache_evictions']} FILE: {source_name}")
+
+    if stats["packet_errors"] > 0:
+        logging.warning(f"{stats['packet_errors']} packets encountered processing errors and were converted to minimal error UDM events for file {source_name}.")
+        logging.warning(f"UDM_PACKET_ERRORS: {stats['packet_errors']} FILE: {source_name}")
+    packet_errors.log_error_summary(stats, source_name)
+
+    if stats.get("timestamp_fallbacks"):
+        logging.warning(f"{stats['timestamp_fallbacks']} packets had a missing or unparseable timestamp and use the processing time instead "
+                        f"(last reason: {stats.get('last_timestamp_fallback_reason')}) for file {source_name}.")
+        logging.warning(f"TIMESTAMP_PARSE_FAILURES: {stats['timestamp_fallbacks']} FILE: {source_name}")
+
+def tshark_projection_arguments():
+    """TShark output arguments for the projected extraction: EK lines limited to `UDM_SOURCE_FIELDS`."""
+    arguments = ["-T", "ek"]
+    for field_name, _ in UDM_SOURCE_FIELDS:
+        arguments.extend(("-e", field_name))
+    return arguments
+
+def _normalize_projected_value(field_name, value):
+    """Projected values may come back as JSON numbers/booleans; the mapper expects the `-T json` string forms."""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if field_name == "tcp.flags" and isinstance(value, int):
+        return f"0x{value:04x}" # Same hex rendering as `-T json`
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+def packet_from_projected_fields(projected_layers):
+    """
+    Rebuilds the `-T json` packet shape (`{"_source": {"layers": ...}}`) from one projected EK record, placing
+    each field where `UDM_SOURCE_FIELDS` says the mapper looks for it. Only a few dozen keys are touched, so
+    this is far cheaper than parsing the full dissection, and the UDM mapping stays exactly the same code.
+    Single-valued fields take their first occurrence (the outermost header for tunnelled traffic).
+    """
+    layers = {}
+    for field_name, ek_key, layer_path in _PROJECTION_PLAN:
+        values = projected_layers.get(ek_key)
+        if values is None:
+            values = projected_layers.get(field_name)
+            if values is None:
+                continue
+        if not isinstance(values, list):
+            values = [values]
+        if not values:
+            continue
+
+        if "*" in layer_path:
+            section_depth = layer_path.index("*")
+            section = layers
+            for key in layer_path[:section_depth]:
+                section = section.setdefault(key, {})
+            for occurrence_index, value in enumerate(values):
+                item = section.setdefault(str(occurrence_index), {})
+                for key in layer_path[section_depth + 1:-1]:
+                    item = item.setdefault(key, {})
+                item[layer_path[-1]] = _normalize_projected_value(field_name, value)
+        else:
+            container = layers
+            for key in layer_path[:-1]:
+                container = container.setdefault(key, {})
+            container[layer_path[-1]] = _normalize_projected_value(field_name, values[0])
+
+    frame_protocols = layers.get("frame", {}).get("frame.protocols")
+    if frame_protocols:
+        for protocol in frame_protocols.split(":"):
+            if protocol in _MAPPED_LAYERS and not layers.get(protocol):
+                layers[protocol] = {PROJECTED_LAYER_MARKER: True}
+    return {"_source": {"layers": layers}}
+
+def iter_tshark_ek_packets(f_ek, stats):
+    """
+    Yields packet dictionaries from a projected `tshark -T ek -e ...` byte stream (one JSON document per line,
+    each packet preceded by an Elasticsearch bulk "index" line, which is skipped).
+    Like `iter_tshark_json_packets`, a malformed line ends the iteration and is recorded in `stats["parse_error"]`.
+    """
+    for line_number, line in enumerate(f_ek, start=1):
+        if not line.strip():
+            continue
+        try:
+            document = json_backends.loads(line)
+        except ValueError as e_line:
+            logging.error(f"Malformed EK line {line_number}: {e_line}. Stream may be truncated.")
+            stats["parse_error"] = f"line {line_number}: {e_line}"
+            return
+        projected_layers = document.get("layers")
+        if projected_layers is None:
+            continue # Bulk "index" header line
+        yield packet_from_projected_fields(projected_layers)
+
+def iter_tshark_packets(f_in, stats, input_format="json"):
+    """Dispatches to the packet iterator matching the TShark output format ("json" or "ek")."""
+    if input_format == "ek":
+        return iter_tshark_ek_packets(f_in, stats)
+    return iter_tshark_json_packets(f_in, stats)
+
+def udm_output_filename(base_name, output_format="json", compress=False):
+    """Builds the output object name for a capture, e.g. `capture.udm.json` or `capture.udm.ndjson.gz`."""
+    extension = ".udm.json" if output_format == "json" else ".udm.ndjson"
+    return base_name + extension + (".gz" if compress else "")
+
+def iter_tshark_json_packets(f_json, stats):
+    """
+    Yields packet dictionaries from a TShark `-T json` byte stream (a JSON array at the root).
+    A malformed or truncated stream ends the iteration instead of raising, so the events converted so far
+    are still written out; the parser error is logged and recorded in `stats["parse_error"]`.
+    """
+    try:
+        # The JSON is an array of objects at the root; each element is yielded (ijson backend from json_backends.py).
+        for packet_data_dict in json_backends.iter_array_items(f_json):
+            yield packet_data_dict
+    except ijson.JSONError as e_ijson:
+        logging.error(f"ijson.JSONError while parsing streaming JSON: {e_ijson}. Stream may be truncated or not a JSON array at the root.")
+        stats["parse_error"] = str(e_ijson)
+
+def write_udm_events(udm_events, f_out, output_format="json", compress=False, buffer_bytes=DEFAULT_WRITE_BUFFER_BYTES,
+                     preceding_events=0, close_array=True, lead_separator=True):
+    """
+    Writes UDM events to the binary file object `f_out` as they are produced and returns how many were written.
+    - "json" keeps the original output, byte-identical to `json.dump(list(udm_events), f, indent=4)`.
+    - "ndjson" writes one compact event per line, which is roughly half the size and can be split or appended.
+    Serialized events are joined into buffers of about `buffer_bytes` before each write, so peak memory
+    stays flat regardless of the capture size. With `compress`, the stream is gzip-compressed on the fly.
+    Events are serialized by the codec selected in json_backends.py (same bytes with any codec).
+    For "json" written in pieces (checkpointed parts concatenated later), `preceding_events` is the number of events
+    already written by earlier pieces and `close_array=False` leaves the closing bracket to the last piece.
+    `lead_separator=False` also leaves out the "[" or "," before the piece's first event, for pieces written before
+    the number of events preceding them is known (the assembler puts it between the pieces).
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown UDM output format '{output_format}'. Expected one of {OUTPUT_FORMATS}.")
+
+    # mtime=0 keeps the gzip header deterministic, so identical input gives identical objects.
+    out_stream = gzip.GzipFile(fileobj=f_out, mode="wb", mtime=0) if compress else f_out
+    pending_chunks = []
+    pending_bytes = 0
+    written_count = 0
+
+    for udm_event in udm_events:
+        if output_format == "ndjson":
+            chunk = json_backends.dumps_compact(udm_event) + b"\n"
+        else:
+            if written_count == 0 and not lead_separator:
+                separator = b"\n    "
+            else:
+                separator = b"[\n    " if written_count + preceding_events == 0 else b",\n    "
+            chunk = separator + json_backends.dumps_indented(udm_event)
+        pending_chunks.append(chunk)
+        pending_bytes += len(chunk)
+        written_count += 1
+        if pending_bytes >= buffer_bytes:
+            out_stream.write(b"".join(pending_chunks))
+            pending_chunks.clear()
+            pending_bytes = 0
+
+    if output_format == "json" and close_array:
+        pending_chunks.append(b"\n]" if written_count + preceding_events else b"[]")
+    out_stream.write(b"".join(pending_chunks))
+    if compress:
+        out_stream.close() # Writes the gzip trailer; the underlying f_out stays open for the caller
+    return written_count
+
+def iter_udm_output_events(f_udm, output_format="json", compress=False):
+    """
+    Reads back the UDM events of an output written by `write_udm_events` (binary file object, any format), one at a
+    time, e.g. to forward them to the Chronicle ingestion API (chronicle_sender.py) without loading the whole file.
+    """
+    in_stream = gzip.GzipFile(fileobj=f_udm, mode="rb") if compress else f_udm
+    if output_format == "ndjson":
+        for line in in_stream:
+            if line.strip():
+                yield json_backends.loads(line)
+    else:
+        yield from json_backends.iter_array_items(in_stream, use_float=True)
+
 def json_to_udm_streaming(json_file_path):
     """
     Processes a JSON file line by line (streaming objects from a JSON array) using ijson.
     This is the core change for memory efficiency compared to the old script's `json.loads()`
     which loaded the entire file into memory.
+    Returns the events as a list; use `iter_udm_events` + `write_udm_events` to keep memory flat.
     """
-    udm_events_list = [] # Will hold all converted UDM events for this run
-    processed_packet_count = 0
-    error_event_count = 0 # Count of packets that resulted in an error UDM
+    stats = new_conversion_stats()
 
     try:
         # 'rb' mode is important for ijson as it handles its own decoding
         with open(json_file_path, 'rb') as f_json: 
-            # `ijson.items(f_json, 'item')` assumes the JSON is an array of objects at the root.
-            # 'item' tells ijson to yield each element of that root array.
-            json_packet_iterator = ijson.items(f_json, 'item') 
-            for packet_data_dict in json_packet_iterator:
-                udm_event = convert_single_packet_to_udm(packet_data_dict)
-                udm_events_list.append(udm_event)
-                processed_packet_count += 1
-                # Check if the generated UDM event was an error event
-                if "PacketProcessingError" in udm_event.get("event", {}).get("metadata", {}).get("product_name", ""):
-                    error_event_count += 1
-        
-        logging.info(f"Successfully converted {processed_packet_count} packets from JSON to UDM format for file {os.path.basename(json_file_path)}.")
-        logging.info(f"UDM_PACKETS_PROCESSED: {processed_packet_count} FILE: {os.path.basename(json_file_path)}")
-
-        if error_event_count > 0:
-            logging.warning(f"{error_event_count} packets encountered processing errors and were converted to minimal error UDM events for file {os.path.basename(json_file_path)}.")
-            logging.warning(f"UDM_PACKET_ERRORS: {error_event_count} FILE: {os.path.basename(json_file_path)}")
-            
-    except ijson.JSONError as e_ijson:
-        # This catches errors during the streaming parse itself (e.g., malformed JSON structure)
-        logging.error(f"ijson.JSONError while parsing streaming JSON from {json_file_path}: {e_ijson}. File may be malformed or not a JSON array at the root.", exc_info=True)
-        return [] # Return empty list on parsing failure
+            udm_events_list = list(iter_udm_events(iter_tshark_json_packets(f_json, stats), stats))
+        if stats.get("parse_error"):
+            return [] # Return empty list on parsing failure
+        log_conversion_summary(stats, os.path.basename(json_file_path))
     except FileNotFoundError:
         logging.error(f"Input JSON file for streaming not found: {json_file_path}")
         return []
@@ -359,16 +809,56 @@ def json_to_udm_streaming(json_file_path):
         logging.error(f"Unexpected error during streaming conversion of {json_file_path}: {e_streaming_outer}", exc_info=True)
         return []
 
-    return udm_events_list # This list is then written to a single output file.
+    return udm_events_list
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Convert TShark JSON output into UDM events.")
+    parser.add_argument("input_file", help="TShark `-T json` (or projected `-T ek`) output file")
+    parser.add_argument("output_file", help="Destination UDM file")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="json",
+                        help="Output format: indented JSON array (default) or newline-delimited JSON")
+    parser.add_argument("--gzip", dest="compress", action="store_true", help="gzip-compress the output")
+    parser.add_argument("--input-format", dest="input_format", choices=INPUT_FORMATS, default="json",
+                        help="TShark output format: full `-T json` (default) or projected `-T ek -e ...`")
+    parser.add_argument("--flows", action="store_true", help="Emit one UDM event per flow instead of one per packet")
+    parser.add_argument("--flow-idle-timeout", type=float, default=flow_aggregator.DEFAULT_IDLE_TIMEOUT_SECONDS,
+                        help="Seconds without packets after which a flow is emitted")
+    parser.add_argument("--flow-active-timeout", type=float, default=flow_aggregator.DEFAULT_ACTIVE_TIMEOUT_SECONDS,
+                        help="Seconds after which a long-lived flow is emitted and a new one started")
+    parser.add_argument("--flow-max-entries", type=int, default=flow_aggregator.DEFAULT_MAX_FLOWS,
+                        help="Open flows kept in memory; the least recently active one is emitted when full")
+    return parser.parse_args(argv)
+
+def flow_settings_from_arguments(args):
+    """The `iter_udm_flow_events` settings selected on the command line, or None for per-packet events."""
+    if not args.flows:
+        return None
+    return {"idle_timeout_seconds": args.flow_idle_timeout, "active_timeout_seconds": args.flow_active_timeout,
+            "max_flows": args.flow_max_entries}
+
+def convert_tshark_output_file(input_file_path, output_file_path, output_format="json", compress=False,
+                               input_format="json", flow_settings=None):
+    """
+    Converts a tshark output file into a UDM output file and logs the metric lines, as the command line does.
+    A sample of the packets that failed is written next to the output (`<output>.errors.json`), if any did.
+    Returns (conversion stats, number of events written).
+    """
+    conversion_stats = new_conversion_stats()
+    with open(input_file_path, 'rb') as f_json, open(output_file_path, "wb") as f_out:
+        tshark_packets = iter_tshark_packets(f_json, conversion_stats, input_format)
+        udm_events = iter_output_events(tshark_packets, conversion_stats, flow_settings)
+        written_count = write_udm_events(udm_events, f_out, output_format, compress)
+    log_conversion_summary(conversion_stats, os.path.basename(input_file_path))
+    packet_errors.write_error_sample(conversion_stats, output_file_path + packet_errors.ERROR_SAMPLE_SUFFIX,
+                                     os.path.basename(input_file_path))
+    return conversion_stats, written_count
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        logging.error("Usage: python3 json2udm_cloud.py <input_json_file> <output_udm_file>")
-        sys.exit(1)
-    
-    input_file_path = sys.argv[1]
-    output_file_path = sys.argv[2]
+    args = parse_arguments(sys.argv[1:])
+    input_file_path = args.input_file
+    output_file_path = args.output_file
 
+    json_backends.log_selected_backends()
     if not os.path.isfile(input_file_path):
         logging.error(f"Error: Input JSON file '{input_file_path}' not found.")
         sys.exit(1)
@@ -379,9 +869,6 @@ if __name__ == "__main__":
     except Exception as e_stat: # Catch potential errors like permission denied
         logging.warning(f"Could not get size of input file {input_file_path}: {e_stat}")
 
-    # Core conversion logic using the streaming approach
-    udm_event_list_result = json_to_udm_streaming(input_file_path)
-
     # Outputting to a single file. The previous script had `write_to_multiple_files` which isn't needed here, 
     # as the next step in a GCP environment would likely be to upload this single file to GCS or send its contents via API to Chronicle.
     try:
@@ -390,19 +877,20 @@ if __name__ == "__main__":
         if output_directory and not os.path.exists(output_directory): # Check if dirname is not empty
             os.makedirs(output_directory, exist_ok=True)
             logging.info(f"Created output directory: {output_directory}")
-        
-        with open(output_file_path, "w") as f_out: # 'w' for text mode, as json.dump expects string data
-            json.dump(udm_event_list_result, f_out, indent=4) # Pretty print for readability
-        
-        if udm_event_list_result: # Only log success if events were actually written
-            logging.info(f"Successfully wrote {len(udm_event_list_result)} UDM events to {output_file_path}")
+
+        # Core conversion logic: parse, convert and write one event at a time
+        _, written_count = convert_tshark_output_file(input_file_path, output_file_path, args.output_format, args.compress,
+                                                      args.input_format, flow_settings_from_arguments(args))
+
+        if written_count: # Only log success if events were actually written
+            logging.info(f"Successfully wrote {written_count} UDM events to {output_file_path}")
         else:
             # This case covers ijson errors or if the input JSON was empty/invalid leading to no UDM events
-            logging.warning(f"No UDM events were generated (or stream parsing failed). Wrote an empty list to {output_file_path}.")
+            logging.warning(f"No UDM events were generated (or stream parsing failed). Wrote an empty output to {output_file_path}.")
             
     except Exception as e_write:
         # This is a critical error if we can't even write the output.
         logging.critical(f"CRITICAL ERROR: Failed to write UDM output to '{output_file_path}': {e_write}", exc_info=True)
         sys.exit(1) # Exit with error if output fails
 
-    sys.exit(0) # Successful execution
\ No newline at end of file
+    sys.exit(0) # Successful execution
@@ -0,0 +1,132 @@
+# processor/json_backends.py - Pluggable JSON parser / serializer backends for the converter.
+# Parsing and serializing JSON is most of the converter's cost outside the UDM mapping itself, and the fastest
+# implementations are compiled extensions that may be missing from an image:
+# - Streaming parser for the `tshark -T json` array: an ijson backend, fastest first (yajl2_c, yajl2_cffi, yajl2,
+#   python). A plain `ijson.items` silently drops to the pure-Python backend when the C one is not built.
+# - Codec for one JSON document at a time (projected EK lines, NDJSON parts re-read for a merge, serialized events):
+#   `orjson` when installed (optional, pip install orjson), else the stdlib `json` module.
+# The backends are chosen once per process, from JSON_PARSER_BACKEND and JSON_CODEC_BACKEND ("auto" or a name);
+# a requested backend that is not installed falls back to the next available one with a warning.
+# Output does not depend on the codec: orjson output is rewritten to the stdlib layout (4-space indentation for the
+# "json" format), and events it would render differently (non-ASCII text in the indented format, which the stdlib
+# escapes; integers beyond 64 bits) are serialized by the stdlib. The one remaining difference is the spelling of
+# floats below 1e-4 or from 1e16 on (`1e-05` vs `0.00001`), which parse back to the same value.
+
+import json
+import logging
+import os
+import re
+
+import ijson
+
+try:
+    import orjson # Optional: compiled JSON codec, several times faster than the stdlib in both directions
+except ImportError:
+    orjson = None
+
+PARSER_BACKENDS = ("yajl2_c", "yajl2_cffi", "yajl2", "python") # ijson backends, fastest first
+CODEC_BACKENDS = ("orjson", "stdlib")
+
+_ORJSON_INDENT = re.compile(rb"\n( *)")
+
+def _stdlib_loads(document):
+    return json.loads(document)
+
+def _stdlib_dumps_compact(udm_event):
+    return json.dumps(udm_event, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+def _stdlib_dumps_indented(udm_event):
+    return json.dumps(udm_event, indent=4).replace("\n", "\n    ").encode("utf-8")
+
+def _orjson_loads(document):
+    return orjson.loads(document)
+
+def _orjson_dumps_compact(udm_event):
+    try:
+        return orjson.dumps(udm_event)
+    except TypeError: # orjson.JSONEncodeError: e.g. an integer beyond 64 bits
+        return _stdlib_dumps_compact(udm_event)
+
+def _double_indent(match):
+    return b"\n    " + match.group(1) * 2
+
+def _orjson_dumps_indented(udm_event):
+    try:
+        serialized = orjson.dumps(udm_event, option=orjson.OPT_INDENT_2)
+    except TypeError:
+        return _stdlib_dumps_indented(udm_event)
+    if not serialized.isascii(): # The stdlib's indented output escapes non-ASCII text (ensure_ascii)
+        return _stdlib_dumps_indented(udm_event)
+    return _ORJSON_INDENT.sub(_double_indent, serialized)
+
+_CODECS = {"stdlib": (_stdlib_loads, _stdlib_dumps_compact, _stdlib_dumps_indented),
+           "orjson": (_orjson_loads, _orjson_dumps_compact, _orjson_dumps_indented)}
+
+def available_parser_backends():
+    """The ijson backends that can be loaded here, fastest first."""
+    available = []
+    for backend_name in PARSER_BACKENDS:
+        try:
+            ijson.get_backend(backend_name)
+        except ImportError:
+            continue
+        available.append(backend_name)
+    return available
+
+def _load_parser_backend(requested):
+    """
+    Returns (name, module) of the requested ijson backend, or of the fastest loadable one for "auto". Only a fallback
+    probes every backend: a missing compiled one costs tens of milliseconds to probe, paid again by each pool worker.
+    """
+    requested = (requested or "auto").strip().lower()
+    for backend_name in (PARSER_BACKENDS if requested == "auto" else (requested,)):
+        try:
+            return backend_name, ijson.get_backend(backend_name)
+        except ImportError:
+            continue
+    backend_name = _pick("parser", requested, available_parser_backends())
+    return backend_name, ijson.get_backend(backend_name)
+
+def available_codec_backends():
+    return [backend_name for backend_name in CODEC_BACKENDS if backend_name != "orjson" or orjson is not None]
+
+def _pick(kind, requested, available):
+    requested = (requested or "auto").strip().lower()
+    if requested == "auto" or requested in available:
+        return available[0] if requested == "auto" else requested
+    _fallback_notes.append(f"JSON {kind} backend '{requested}' is not available here; using '{available[0]}' (available: {', '.join(available)}).")
+    return available[0]
+
+# The active backends, set by `configure` (at import from the environment). Nothing is logged at import, which would
+# configure the root logger before the importing module's basicConfig; fallbacks are reported by `log_selected_backends`.
+parser_backend_name = None
+codec_backend_name = None
+_ijson_backend = None
+_fallback_notes = []
+loads = None
+dumps_compact = None
+dumps_indented = None
+
+def configure(parser_backend="auto", codec_backend="auto"):
+    """Selects the active backends ("auto" = fastest available) and returns their names."""
+    global parser_backend_name, codec_backend_name, _ijson_backend, loads, dumps_compact, dumps_indented
+    _fallback_notes.clear()
+    parser_backend_name, _ijson_backend = _load_parser_backend(parser_backend)
+    codec_backend_name = _pick("codec", codec_backend, available_codec_backends())
+    loads, dumps_compact, dumps_indented = _CODECS[codec_backend_name]
+    return parser_backend_name, codec_backend_name
+
+def iter_array_items(f_json, use_float=False):
+    """
+    Yields the elements of the JSON array at the root of the binary stream `f_json` (raises ijson.JSONError).
+    Numbers with a fraction come back as `Decimal` unless `use_float` (needed to serialize them again).
+    """
+    return _ijson_backend.items(f_json, "item", use_float=use_float)
+
+def log_selected_backends():
+    """Startup log line naming the active backends, e.g. `JSON_BACKENDS: parser=yajl2_c codec=orjson`."""
+    for fallback_note in _fallback_notes:
+        logging.warning(fallback_note)
+    logging.info(f"JSON_BACKENDS: parser={parser_backend_name} codec={codec_backend_name}")
+
+configure(os.environ.get("JSON_PARSER_BACKEND", "auto"), os.environ.get("JSON_CODEC_BACKEND", "auto"))
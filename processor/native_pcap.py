@@ -0,0 +1,370 @@
+# processor/native_pcap.py - Native pcap / pcapng decoder that takes plain L2-L4 frames off tshark's hands.
+# A full `tshark -T json` dissection costs far more than the handful of header fields most frames map to (MACs,
+# addresses, ports, TCP flags, TTL). With NATIVE_DECODER=true the capture is memory-mapped and read in place with
+# `struct.unpack_from` (no per-packet copies):
+# 1. `classify` decides per frame whether its UDM event only needs Ethernet (optionally one 802.1Q tag), IPv4 / IPv6,
+#    TCP, UDP, ICMP echo or ARP headers. Everything else goes to tshark: payload on a port it dissects deeper
+#    (DEEP_DISSECTION_PORTS: DNS, HTTP, TLS, ...), fragments, IPv6 extension headers, truncated frames, other
+#    EtherTypes and IP protocols.
+# 2. `write_deep_frames` writes the routed frames as a nanosecond pcap (tshark reads it from a pipe, `-r -`).
+# 3. `iter_packets` decodes the native frames into the same `-T json` packet shape tshark produces (`_source.layers`,
+#    string values) and puts tshark's packets back at their original frame numbers, so both go through the unchanged
+#    `convert_single_packet_to_udm`: every UDM field comes from the same mapping code.
+# Routing is per port, so whole streams on a deep port reach tshark and TCP reassembly (HTTP over several segments)
+# still works; segments without payload (handshakes, pure ACKs) are decoded natively whatever the port.
+# A frame carrying payload on another port gets `data` as its last protocol, as in tshark when no dissector claims
+# it; a tshark heuristic dissector could still name it differently, so run test/benchmarks/native_parity.py on
+# representative captures and add such ports to NATIVE_DEEP_PORTS.
+# Captures the decoder cannot read (not pcap / pcapng, non-Ethernet link types, damaged records) go to tshark whole.
+
+import logging
+import mmap
+import os
+import socket
+import struct
+
+LINKTYPE_ETHERNET = 1
+# Ports whose payload tshark dissects beyond `data`: all well-known ports plus common registered ones.
+DEEP_DISSECTION_PORTS = frozenset(range(1024)) | frozenset((
+    1194, 1433, 1521, 1701, 1723, 1812, 1813, 1883, 1900, 2049, 3128, 3306, 3389, 3478, 4500, 4789, 5004, 5060, 5061,
+    5222, 5353, 5355, 5432, 5671, 5672, 5683, 5900, 6081, 6379, 6443, 8000, 8008, 8080, 8443, 8883, 8888, 9092, 9200,
+    11211, 27017))
+ADDRESS_CACHE_MAX_ENTRIES = 65536 # Distinct MAC / IP texts remembered per process, as the timestamp prefix cache
+
+_PCAP_MAGICS = {b"\xd4\xc3\xb2\xa1": ("<", 1000), b"\xa1\xb2\xc3\xd4": (">", 1000), # microseconds (to ns)
+                b"\x4d\x3c\xb2\xa1": ("<", 1), b"\xa1\xb2\x3c\x4d": (">", 1)} # nanoseconds
+_PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+_PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+_PCAPNG_INTERFACE_DESCRIPTION = 1
+_PCAPNG_ENHANCED_PACKET = 6
+_PCAPNG_PACKET_BLOCKS = (2, 3) # Obsolete and simple packet blocks: no usable timestamp or interface
+_PCAPNG_IF_TSRESOL = 9
+_PCAPNG_IF_TSOFFSET = 14
+
+_ETHERNET = struct.Struct("!6s6sH") # dst, src, EtherType
+_VLAN_TAG = struct.Struct("!2xH")
+_IPV4 = struct.Struct("!BxH2xHBB2xII") # version/IHL, total length, flags/fragment offset, TTL, protocol, src, dst
+_IPV6 = struct.Struct("!4xHBx16s16s") # payload length, next header, src, dst
+_TCP = struct.Struct("!HH8xH") # ports, data offset + flags
+_UDP = struct.Struct("!HHH") # ports, length
+_ICMP = struct.Struct("!BB")
+_ARP = struct.Struct("!HHBBH6sI6sI") # htype, ptype, hlen, plen, opcode, sender MAC / IPv4, target MAC / IPv4
+_DEEP_PCAP_HEADER = struct.Struct("<IHHiIII")
+_DEEP_PCAP_RECORD = struct.Struct("<IIII")
+_DEEP_PCAP_SNAPLEN = 262144
+
+_mac_texts = {}
+_ipv4_texts = {}
+_ipv6_texts = {}
+
+class UnsupportedCapture(ValueError):
+    """The capture cannot be read natively; it is dissected by tshark as a whole."""
+
+# Address texts are looked up inline (`_mac_texts.get(key) or _new_mac_text(key)`); these only run on a cache miss.
+def _remember_address_text(cache, key, text):
+    if len(cache) >= ADDRESS_CACHE_MAX_ENTRIES:
+        cache.clear()
+    cache[key] = text
+    return text
+
+def _new_mac_text(mac):
+    return _remember_address_text(_mac_texts, mac, mac.hex(":"))
+
+def _new_ipv4_text(address):
+    return _remember_address_text(_ipv4_texts, address, socket.inet_ntoa(address.to_bytes(4, "big")))
+
+def _new_ipv6_text(address):
+    return _remember_address_text(_ipv6_texts, address, socket.inet_ntop(socket.AF_INET6, address)) # RFC 5952, as tshark
+
+def _pcapng_timestamp_divisor(options, byte_order):
+    """(units per second, offset seconds) of an interface from its if_tsresol / if_tsoffset options."""
+    units_per_second, offset_seconds = 10 ** 6, 0
+    position = 0
+    while position + 4 <= len(options):
+        code, length = struct.unpack_from(byte_order + "HH", options, position)
+        if code == 0:
+            break
+        value = options[position + 4:position + 4 + length]
+        if code == _PCAPNG_IF_TSRESOL and length >= 1:
+            units_per_second = 2 ** (value[0] & 0x7F) if value[0] & 0x80 else 10 ** value[0]
+        elif code == _PCAPNG_IF_TSOFFSET and length >= 8:
+            offset_seconds, = struct.unpack_from(byte_order + "q", value)
+        position += 4 + (length + 3) // 4 * 4
+    return units_per_second, offset_seconds
+
+class NativeCapture:
+    """
+    One memory-mapped pcap / pcapng file. Raises UnsupportedCapture from the constructor or `classify` if the file
+    cannot be read natively; nothing has been produced by then, so the caller can hand the file to tshark instead.
+    """
+    def __init__(self, pcap_path, deep_ports=DEEP_DISSECTION_PORTS):
+        self.deep_ports = deep_ports
+        self.routing = None # bytearray, one entry per frame: 1 = dissected by tshark
+        self.native_frames = 0
+        self.deep_frames = 0
+        with open(pcap_path, "rb") as f_pcap:
+            if os.fstat(f_pcap.fileno()).st_size < 24:
+                raise UnsupportedCapture("file too short for a capture header")
+            self._map = mmap.mmap(f_pcap.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        if self._map[:4] in _PCAP_MAGICS:
+            self._iter_records = self._iter_pcap_records
+            byte_order, _ = _PCAP_MAGICS[self._map[:4]]
+            link_type, = struct.unpack_from(byte_order + "I", self._map, 20)
+            if link_type & 0xFFFF != LINKTYPE_ETHERNET:
+                self.close()
+                raise UnsupportedCapture(f"link type {link_type & 0xFFFF} is not Ethernet")
+        elif struct.unpack_from("<I", self._map, 0)[0] == _PCAPNG_SECTION_HEADER:
+            self._iter_records = self._iter_pcapng_records
+        else:
+            self.close()
+            raise UnsupportedCapture("not a pcap or pcapng file")
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _iter_pcap_records(self):
+        """Yields (offset, captured length, original length, seconds, nanoseconds) per record."""
+        capture_map = self._map
+        byte_order, nanoseconds_per_unit = _PCAP_MAGICS[capture_map[:4]]
+        record_header = struct.Struct(byte_order + "IIII")
+        position, end = 24, len(capture_map)
+        while position < end:
+            if position + 16 > end:
+                raise UnsupportedCapture(f"record header cut short at byte {position}")
+            seconds, fraction, captured_length, original_length = record_header.unpack_from(capture_map, position)
+            position += 16
+            if position + captured_length > end:
+                raise UnsupportedCapture(f"record cut short at byte {position}")
+            yield position, captured_length, original_length, seconds, fraction * nanoseconds_per_unit
+            position += captured_length
+
+    def _iter_pcapng_records(self):
+        """Same as `_iter_pcap_records` for the enhanced packet blocks of every section of a pcapng file."""
+        capture_map = self._map
+        position, end = 0, len(capture_map)
+        byte_order, interfaces = "<", []
+        while position < end:
+            if position + 12 > end:
+                raise UnsupportedCapture(f"block header cut short at byte {position}")
+            block_type, = struct.unpack_from("<I", capture_map, position)
+            if block_type == _PCAPNG_SECTION_HEADER:
+                byte_order = "<" if struct.unpack_from("<I", capture_map, position + 8)[0] == _PCAPNG_BYTE_ORDER_MAGIC else ">"
+                interfaces = [] # Interface ids restart in every section
+            else:
+                block_type, = struct.unpack_from(byte_order + "I", capture_map, position)
+            block_length, = struct.unpack_from(byte_order + "I", capture_map, position + 4)
+            if block_length < 12 or block_length % 4 or position + block_length > end:
+                raise UnsupportedCapture(f"invalid block length {block_length} at byte {position}")
+            body = position + 8
+            if block_type == _PCAPNG_INTERFACE_DESCRIPTION:
+                link_type, = struct.unpack_from(byte_order + "H", capture_map, body)
+                if link_type != LINKTYPE_ETHERNET:
+                    raise UnsupportedCapture(f"interface {len(interfaces)} has link type {link_type}, not Ethernet")
+                interfaces.append(_pcapng_timestamp_divisor(capture_map[body + 8:position + block_length - 4], byte_order))
+            elif block_type == _PCAPNG_ENHANCED_PACKET:
+                interface_id, timestamp_high, timestamp_low, captured_length, original_length = struct.unpack_from(
+                    byte_order + "IIIII", capture_map, body)
+                if interface_id >= len(interfaces) or body + 20 + captured_length > position + block_length - 4:
+                    raise UnsupportedCapture(f"invalid enhanced packet block at byte {position}")
+                units_per_second, offset_seconds = interfaces[interface_id]
+                seconds, fraction = divmod((timestamp_high << 32) | timestamp_low, units_per_second)
+                yield (body + 20, captured_length, original_length, seconds + offset_seconds,
+                       fraction * 1000000000 // units_per_second)
+            elif block_type in _PCAPNG_PACKET_BLOCKS:
+                raise UnsupportedCapture(f"packet block type {block_type} (no timestamp) at byte {position}")
+            position += block_length
+
+    def _decode_layers(self, position, captured_length, original_length):
+        """
+        The `_source.layers` of one frame without its "frame" layer, plus its frame.protocols text, or None if the
+        frame has to be dissected by tshark. Only header fields are read; lengths come from the IP / UDP headers.
+        """
+        if captured_length != original_length or captured_length < 14:
+            return None
+        capture_map = self._map
+        mac_texts, ipv4_texts = _mac_texts, _ipv4_texts
+        dst_mac, src_mac, ether_type = _ETHERNET.unpack_from(capture_map, position)
+        layers = {"eth": {"eth.dst": mac_texts.get(dst_mac) or _new_mac_text(dst_mac),
+                          "eth.src": mac_texts.get(src_mac) or _new_mac_text(src_mac)}}
+        protocols = "eth:ethertype"
+        network_offset, end = position + 14, position + captured_length
+        if ether_type == 0x8100:
+            if network_offset + 4 > end:
+                return None
+            ether_type, = _VLAN_TAG.unpack_from(capture_map, network_offset)
+            protocols += ":vlan:ethertype"
+            network_offset += 4
+
+        if ether_type == 0x0806:
+            if network_offset + 28 > end:
+                return None
+            (hardware_type, protocol_type, hardware_size, protocol_size, opcode, sender_mac, sender_ip, target_mac,
+             target_ip) = _ARP.unpack_from(capture_map, network_offset)
+            if (hardware_type, protocol_type, hardware_size, protocol_size) != (1, 0x0800, 6, 4):
+                return None
+            layers["arp"] = {"arp.opcode": str(opcode), "arp.src.hw_mac": mac_texts.get(sender_mac) or _new_mac_text(sender_mac),
+                             "arp.src.proto_ipv4": ipv4_texts.get(sender_ip) or _new_ipv4_text(sender_ip),
+                             "arp.dst.hw_mac": mac_texts.get(target_mac) or _new_mac_text(target_mac),
+                             "arp.dst.proto_ipv4": ipv4_texts.get(target_ip) or _new_ipv4_text(target_ip)}
+            return layers, protocols + ":arp"
+
+        if ether_type == 0x0800:
+            if network_offset + 20 > end:
+                return None
+            version_header_length, total_length, flags_fragment, ttl, ip_protocol, src_ip, dst_ip = _IPV4.unpack_from(
+                capture_map, network_offset)
+            header_length = (version_header_length & 0x0F) * 4
+            if version_header_length >> 4 != 4 or header_length < 20 or flags_fragment & 0x3FFF \
+                    or total_length < header_length or network_offset + total_length > end:
+                return None # Fragments (MF flag or offset) need reassembly
+            layers["ip"] = {"ip.ttl": str(ttl), "ip.src": ipv4_texts.get(src_ip) or _new_ipv4_text(src_ip),
+                            "ip.dst": ipv4_texts.get(dst_ip) or _new_ipv4_text(dst_ip)}
+            protocols += ":ip"
+            transport_offset, transport_length = network_offset + header_length, total_length - header_length
+        elif ether_type == 0x86DD:
+            if network_offset + 40 > end:
+                return None
+            payload_length, ip_protocol, src_ip, dst_ip = _IPV6.unpack_from(capture_map, network_offset)
+            if not payload_length or network_offset + 40 + payload_length > end:
+                return None # Jumbograms (payload length 0) or inconsistent lengths
+            layers["ipv6"] = {"ipv6.src": _ipv6_texts.get(src_ip) or _new_ipv6_text(src_ip),
+                              "ipv6.dst": _ipv6_texts.get(dst_ip) or _new_ipv6_text(dst_ip)}
+            protocols += ":ipv6"
+            transport_offset, transport_length = network_offset + 40, payload_length
+        else:
+            return None
+
+        if ip_protocol == 6:
+            if transport_length < 20:
+                return None
+            src_port, dst_port, offset_flags = _TCP.unpack_from(capture_map, transport_offset)
+            header_length = (offset_flags >> 12) * 4
+            if header_length < 20 or header_length > transport_length:
+                return None
+            payload_length = transport_length - header_length
+            layers["tcp"] = {"tcp.srcport": str(src_port), "tcp.dstport": str(dst_port), "tcp.flags": f"0x{offset_flags & 0x0FFF:04x}"}
+            protocols += ":tcp"
+        elif ip_protocol == 17:
+            if transport_length < 8:
+                return None
+            src_port, dst_port, udp_length = _UDP.unpack_from(capture_map, transport_offset)
+            if udp_length != transport_length:
+                return None
+            payload_length = udp_length - 8
+            layers["udp"] = {"udp.srcport": str(src_port), "udp.dstport": str(dst_port)}
+            protocols += ":udp"
+        elif ip_protocol == 1 and "ip" in layers:
+            if transport_length < 8:
+                return None
+            icmp_type, icmp_code = _ICMP.unpack_from(capture_map, transport_offset)
+            if icmp_type not in (0, 8): # Error messages quote an inner IP packet, dissected by tshark
+                return None
+            layers["icmp"] = {"icmp.type": str(icmp_type), "icmp.code": str(icmp_code)}
+            return layers, protocols + (":icmp:data" if transport_length > 8 else ":icmp")
+        else:
+            return None
+
+        if payload_length:
+            if src_port in self.deep_ports or dst_port in self.deep_ports:
+                return None
+            protocols += ":data"
+        return layers, protocols
+
+    def classify(self):
+        """First pass: routes every frame natively or to tshark. Returns (native frames, tshark frames)."""
+        routing = bytearray()
+        decode_layers = self._decode_layers
+        for position, captured_length, original_length, _, _ in self._iter_records():
+            routing.append(decode_layers(position, captured_length, original_length) is None)
+        self.routing = routing
+        self.deep_frames = sum(routing)
+        self.native_frames = len(routing) - self.deep_frames
+        return self.native_frames, self.deep_frames
+
+    def write_deep_frames(self, f_out):
+        """Writes the frames routed to tshark as a nanosecond pcap to the binary stream `f_out` (e.g. tshark's stdin)."""
+        f_out.write(_DEEP_PCAP_HEADER.pack(0xA1B23C4D, 2, 4, 0, 0, _DEEP_PCAP_SNAPLEN, LINKTYPE_ETHERNET))
+        view = self._view
+        for is_deep, (position, captured_length, original_length, seconds, nanoseconds) in zip(self.routing, self._iter_records()):
+            if is_deep:
+                f_out.write(_DEEP_PCAP_RECORD.pack(seconds, nanoseconds, captured_length, original_length))
+                f_out.write(view[position:position + captured_length])
+
+    def iter_packets(self, deep_packets, stats):
+        """
+        Second pass: yields one `-T json`-shaped packet per frame in capture order, decoding native frames and taking
+        the others from `deep_packets` (tshark's packets for the routed frames, in order) with their frame numbers
+        restored. If tshark returns fewer packets than were routed, iteration stops and `stats["parse_error"]` is set.
+        """
+        decode_layers = self._decode_layers
+        deep_packets = iter(deep_packets)
+        for frame_number, (is_deep, (position, captured_length, original_length, seconds, nanoseconds)) in enumerate(
+                zip(self.routing, self._iter_records()), start=1):
+            if is_deep:
+                packet_data = next(deep_packets, None)
+                if packet_data is None:
+                    stats.setdefault("parse_error", f"tshark returned no packet for frame {frame_number}")
+                    return
+                frame_layer = packet_data.get("_source", {}).get("layers", {}).get("frame")
+                if isinstance(frame_layer, dict):
+                    frame_layer["frame.number"] = str(frame_number)
+                yield packet_data
+                continue
+            layers, protocols = decode_layers(position, captured_length, original_length)
+            layers["frame"] = {"frame.time_epoch": f"{seconds}.{nanoseconds:09d}", "frame.number": str(frame_number),
+                               "frame.len": str(original_length), "frame.protocols": protocols}
+            yield {"_source": {"layers": layers}}
+
+_environment_deep_ports = None
+_environment_deep_ports_loaded = False
+
+def deep_ports_from_environment():
+    """
+    The deep ports (DEEP_DISSECTION_PORTS plus NATIVE_DEEP_PORTS) if NATIVE_DECODER is on, else None.
+    Raises ValueError on an invalid NATIVE_DEEP_PORTS; services call it once at startup so a bad value fails the boot.
+    """
+    global _environment_deep_ports, _environment_deep_ports_loaded
+    if _environment_deep_ports_loaded:
+        return _environment_deep_ports
+
+    if os.environ.get("NATIVE_DECODER", "false").strip().lower() not in ("1", "true", "yes"):
+        _environment_deep_ports_loaded = True
+        return None
+    try:
+        extra_ports = frozenset(int(port) for port in os.environ.get("NATIVE_DEEP_PORTS", "").split(",") if port.strip())
+    except ValueError as e:
+        raise ValueError(f"Invalid NATIVE_DEEP_PORTS (comma-separated port numbers): {e}") from e
+    out_of_range = sorted(port for port in extra_ports if not 0 <= port <= 65535)
+    if out_of_range:
+        raise ValueError(f"Invalid NATIVE_DEEP_PORTS (comma-separated port numbers): {out_of_range} out of range")
+    _environment_deep_ports = DEEP_DISSECTION_PORTS | extra_ports
+    _environment_deep_ports_loaded = True # Only once valid: a later call must not silently turn the native decoder off
+    logging.info(f"Native decoder enabled: payload on {len(_environment_deep_ports)} ports is dissected by tshark"
+                 f"{' (extra: ' + ', '.join(map(str, sorted(extra_ports))) + ')' if extra_ports else ''}.")
+    return _environment_deep_ports
+
+def open_classified_capture(pcap_path, source_name, deep_ports):
+    """
+    Maps and classifies `pcap_path` (first pass). Returns the NativeCapture (to close after use) or None if the
+    capture has to be dissected by tshark as a whole, which is logged with the reason.
+    """
+    try:
+        native_capture = NativeCapture(pcap_path, deep_ports)
+    except UnsupportedCapture as e:
+        logging.info(f"Native decoder skipped for {source_name}: {e}. Using tshark for the whole capture.")
+        return None
+    try:
+        native_capture.classify()
+    except UnsupportedCapture as e:
+        native_capture.close()
+        logging.info(f"Native decoder skipped for {source_name}: {e}. Using tshark for the whole capture.")
+        return None
+    return native_capture
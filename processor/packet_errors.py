@@ -0,0 +1,183 @@
+# processor/packet_errors.py - Cheap, bounded error path for the per-packet converter (json2udm_cloud.py).
+# A malformed or truncated capture can make every packet fail. Logging a traceback and serializing the whole packet
+# for each of them made such a file slower to convert than a healthy one and flooded Cloud Logging. Instead:
+# - Snippets: `bounded_json_snippet` writes a packet as JSON only up to a character budget. It walks the structure
+#   lazily and cuts long strings first, so a 1 MB packet costs as much as a small one. ijson's Decimal numbers and
+#   other non-JSON values are written as they print, rather than making the snippet fail.
+# - Counters: every failure is counted per file as `packet_error_reason_<reason>` (the exception class in snake case,
+#   or e.g. `missing_layers`). Chunks add them up like the other counters, and `log_error_summary` reports them once
+#   per file as `UDM_PACKET_ERROR_REASON: <n> REASON: <reason> FILE: <name>`.
+# - Log lines: only the first PACKET_ERROR_LOG_LIMIT failures of each reason in a file are logged, and only the first
+#   one carries a traceback. The same reason and message is logged at most once per PACKET_ERROR_LOG_INTERVAL_SECONDS
+#   in a process, across files.
+# - Sample: up to PACKET_ERROR_SAMPLE_SIZE failing packets per file (reservoir sampling, deterministic for a given
+#   packet order), each cut to PACKET_ERROR_SAMPLE_BYTES of JSON. The sample is kept in the stats as plain JSON
+#   values, so it survives pool workers, checkpoint manifests and fan-out chunk stats; merged chunks keep a fair
+#   sample of the whole file. `write_error_sample` writes it as a side artifact (`<output>.errors.json`).
+# Configuration comes from the environment when the module is imported (script, pool workers and edge mode alike).
+
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+PACKET_ERROR_LOG_LIMIT = int(os.environ.get("PACKET_ERROR_LOG_LIMIT", "5")) # Logged failures per reason per file
+PACKET_ERROR_LOG_INTERVAL_SECONDS = float(os.environ.get("PACKET_ERROR_LOG_INTERVAL_SECONDS", "60"))
+PACKET_ERROR_SAMPLE_SIZE = int(os.environ.get("PACKET_ERROR_SAMPLE_SIZE", "5")) # 0: no sample
+PACKET_ERROR_SAMPLE_BYTES = int(os.environ.get("PACKET_ERROR_SAMPLE_BYTES", "16384")) # JSON characters per sampled packet
+SNIPPET_MAX_CHARS = 1000 # `original_packet_data_snippet` of an error event, as before
+SNIPPET_MAX_DEPTH = 32
+ERROR_SAMPLE_SUFFIX = ".errors.json"
+REASON_PREFIX = "packet_error_reason_"
+_RECENT_MESSAGES_MAX_ENTRIES = 1024
+_CAMEL_CASE_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])") # KeyError, JSONDecodeError
+
+_recent_messages = OrderedDict() # (reason, detail) -> monotonic time it was last logged in this process
+_recent_messages_lock = threading.Lock()
+
+def _iter_json_chunks(value, max_chars, depth):
+    if isinstance(value, str):
+        yield json.dumps(value[:max_chars])
+    elif isinstance(value, dict):
+        if depth >= SNIPPET_MAX_DEPTH:
+            yield '"..."'
+            return
+        yield "{"
+        for item_number, (key, item) in enumerate(value.items()):
+            yield ", " if item_number else ""
+            yield json.dumps(str(key)[:max_chars])
+            yield ": "
+            yield from _iter_json_chunks(item, max_chars, depth + 1)
+        yield "}"
+    elif isinstance(value, (list, tuple)):
+        if depth >= SNIPPET_MAX_DEPTH:
+            yield '"..."'
+            return
+        yield "["
+        for item_number, item in enumerate(value):
+            yield ", " if item_number else ""
+            yield from _iter_json_chunks(item, max_chars, depth + 1)
+        yield "]"
+    elif value is None or isinstance(value, (bool, int, float)):
+        yield json.dumps(value)
+    elif isinstance(value, Decimal): # ijson numbers
+        yield str(value)
+    else:
+        yield json.dumps(str(value)[:max_chars])
+
+def bounded_json_snippet(value, max_chars=SNIPPET_MAX_CHARS):
+    """
+    JSON text of `value`, cut after `max_chars` characters (then ending in "..."). Only the part that fits is
+    ever encoded; below the budget the text is what `json.dumps` writes.
+    """
+    parts = []
+    length = 0
+    for chunk in _iter_json_chunks(value, max_chars, 0):
+        parts.append(chunk)
+        length += len(chunk)
+        if length > max_chars:
+            return "".join(parts)[:max_chars] + "..."
+    return "".join(parts)
+
+def error_reason(exception):
+    """Counter name for an exception: its class name in snake case (KeyError -> key_error)."""
+    return _CAMEL_CASE_BOUNDARY.sub("_", type(exception).__name__).lower()
+
+def _first_in_interval(reason, detail):
+    """True if this reason and message was not logged in this process within PACKET_ERROR_LOG_INTERVAL_SECONDS."""
+    now = time.monotonic()
+    message_key = (reason, detail[:200])
+    with _recent_messages_lock:
+        logged_at = _recent_messages.get(message_key)
+        if logged_at is not None and now - logged_at < PACKET_ERROR_LOG_INTERVAL_SECONDS:
+            return False
+        _recent_messages[message_key] = now
+        _recent_messages.move_to_end(message_key)
+        if len(_recent_messages) > _RECENT_MESSAGES_MAX_ENTRIES:
+            _recent_messages.popitem(last=False)
+    return True
+
+def _sample_entry(reason, detail, frame_number, packet_data):
+    return {"reason": reason, "frame": str(frame_number), "error": detail[:SNIPPET_MAX_CHARS],
+            "packet": bounded_json_snippet(packet_data, PACKET_ERROR_SAMPLE_BYTES)}
+
+def _add_to_sample(stats, reason, detail, frame_number, packet_data):
+    """
+    Reservoir sampling: every failing packet of the file has the same chance to end up in the sample. The choice
+    for the n-th failure is seeded by n, so it is pseudo-random but the same on a retry of the capture.
+    """
+    seen = stats.get("error_sample_seen", 0) + 1
+    stats["error_sample_seen"] = seen
+    sample = stats.setdefault("error_sample", [])
+    if len(sample) < PACKET_ERROR_SAMPLE_SIZE:
+        sample.append(_sample_entry(reason, detail, frame_number, packet_data))
+        return
+    slot = random.Random(seen).randrange(seen)
+    if slot < PACKET_ERROR_SAMPLE_SIZE:
+        sample[slot] = _sample_entry(reason, detail, frame_number, packet_data)
+
+def record_packet_error(stats, reason, detail, frame_number, packet_data, log_message, level=logging.ERROR, exception=None):
+    """
+    Accounts one failed packet: per-reason counter, a log line within the limits above (`log_message`, with the
+    traceback of `exception` for the first one of its reason in the file) and a chance to enter the error sample.
+    Without `stats` (a direct caller) only the process-wide rate limit applies.
+    """
+    if stats is None:
+        if _first_in_interval(reason, detail):
+            logging.log(level, log_message)
+        return
+    reason_key = REASON_PREFIX + reason
+    occurrences = stats.get(reason_key, 0) + 1
+    stats[reason_key] = occurrences
+    if occurrences <= PACKET_ERROR_LOG_LIMIT and _first_in_interval(reason, detail):
+        logging.log(level, log_message, exc_info=exception if occurrences == 1 else None)
+        stats["packet_error_lines_logged"] = stats.get("packet_error_lines_logged", 0) + 1
+    if PACKET_ERROR_SAMPLE_SIZE > 0:
+        _add_to_sample(stats, reason, detail, frame_number, packet_data)
+
+def errors_by_reason(stats):
+    """{reason: count} from the flat `packet_error_reason_<reason>` counters of a conversion stats dict."""
+    return {key[len(REASON_PREFIX):]: value for key, value in stats.items() if key.startswith(REASON_PREFIX) and isinstance(value, int)}
+
+def merge_error_samples(total_stats, partial_stats):
+    """
+    Merges the error sample of `partial_stats` (one chunk) into `total_stats`, before their `error_sample_seen`
+    counters are added: every kept packet is weighted by how many failures its chunk's sample stands for.
+    """
+    partial_sample = partial_stats.get("error_sample") or []
+    total_sample = total_stats.get("error_sample") or []
+    if not partial_sample:
+        return
+    total_seen = total_stats.get("error_sample_seen", 0)
+    partial_seen = partial_stats.get("error_sample_seen", len(partial_sample))
+    candidates = [(entry, total_seen / len(total_sample)) for entry in total_sample]
+    candidates += [(entry, partial_seen / len(partial_sample)) for entry in partial_sample]
+    rng = random.Random(total_seen + partial_seen)
+    candidates.sort(key=lambda candidate: rng.random() ** (1 / candidate[1]), reverse=True) # Weighted, without replacement
+    total_stats["error_sample"] = [entry for entry, _ in candidates[:max(PACKET_ERROR_SAMPLE_SIZE, 1)]]
+
+def write_error_sample(stats, sample_path, source_name):
+    """Writes the file's error sample as a JSON document. Returns False (and writes nothing) if there is none."""
+    sample = stats.get("error_sample")
+    if not sample:
+        return False
+    error_sample = {"source": source_name, "packet_errors_by_reason": errors_by_reason(stats),
+                    "failures_seen": stats.get("error_sample_seen", len(sample)), "packets": sample}
+    with open(sample_path, "w") as f_sample:
+        json.dump(error_sample, f_sample, indent=2)
+    return True
+
+def log_error_summary(stats, source_name):
+    """One line per failure reason, plus how many failure log lines were held back, for the file."""
+    reasons = errors_by_reason(stats)
+    for reason, count in sorted(reasons.items()):
+        logging.warning(f"UDM_PACKET_ERROR_REASON: {count} REASON: {reason} FILE: {source_name}")
+    suppressed_lines = sum(reasons.values()) - stats.get("packet_error_lines_logged", 0)
+    if suppressed_lines > 0:
+        logging.warning(f"{suppressed_lines} packet failure log lines were suppressed for file {source_name} "
+                        f"(at most {PACKET_ERROR_LOG_LIMIT} per reason and file, repeated messages once per {PACKET_ERROR_LOG_INTERVAL_SECONDS:.0f}s).")
@@ -0,0 +1,170 @@
+# processor/packet_filter.py - Optional converter-side drop / keep rules and deterministic per-flow sampling.
+# The sniffer can already narrow the capture with a BPF filter and a snap length (CAPTURE_FILTER / SNAPLEN), but
+# packets dropped there leave no trace. Here every converted packet can be discarded with an accounted reason:
+# - Drop rules (UDM_DROP_RULES) and keep rules (UDM_KEEP_RULES): `;`-separated rules, each `name: key=value ...`.
+#   All conditions of a rule must match; a condition matches if any of its `|`-separated values does. Keys:
+#   `protocol` (a layer of frame.protocols, e.g. arp, tcp, dns, tls), `port` (source or destination) and
+#   `event_type` (the UDM metadata.event_type). A packet matching a keep rule is never dropped nor sampled.
+#   Example: UDM_DROP_RULES="arp: protocol=arp; bulk_tcp: event_type=NETWORK_CONNECTION protocol=tcp port=443|22"
+# - Per-flow sampling (FLOW_SAMPLING_THRESHOLD_PACKETS > 0): the first packets of a flow (same key as
+#   flow_aggregator.py, both directions) are kept, then only 1 in FLOW_SAMPLING_RATE. TCP SYN / FIN / RST segments
+#   are always kept, so connection boundaries stay visible; kept sampled events carry `additional.sample_rate`.
+#   The choice depends only on the packet order, so a retry of the same capture keeps the same packets.
+#   Sampling applies to per-packet output only: with flow aggregation the flow counters must see every packet.
+# Error events are never dropped. Counters go into the file's conversion stats: `packets_dropped` and one
+# `dropped_<reason>` per rule name or `sampled`, summed like the other counters when chunks are merged.
+# Configuration comes from the environment, as for ip_enrichment.py (script, pool workers and edge mode alike).
+
+import logging
+import os
+import re
+from collections import OrderedDict
+
+import flow_aggregator
+
+RULE_KEYS = ("protocol", "port", "event_type")
+SAMPLED_REASON = "sampled"
+_RULE_NAME_PATTERN = re.compile(r"^[a-z0-9_]+$")
+_TCP_CONTROL_FLAGS = 0x07 # FIN, SYN, RST
+
+def parse_rules(rules_text):
+    """
+    Parses `name: key=value|value key=value; ...` into a list of (name, {key: frozenset(values)}).
+    Raises ValueError on an unknown key, a bad name or a rule without conditions.
+    """
+    rules = []
+    for rule_number, rule_text in enumerate((part.strip() for part in (rules_text or "").split(";")), start=1):
+        if not rule_text:
+            continue
+        name, separator, conditions_text = rule_text.partition(":")
+        if not separator:
+            name, conditions_text = f"rule{rule_number}", rule_text
+        name = name.strip().lower()
+        if not _RULE_NAME_PATTERN.match(name) or name == SAMPLED_REASON:
+            raise ValueError(f"Invalid rule name '{name}' (lowercase letters, digits and '_'; '{SAMPLED_REASON}' is reserved)")
+        conditions = {}
+        for condition_text in conditions_text.split():
+            key, _, values_text = condition_text.partition("=")
+            if key not in RULE_KEYS or not values_text:
+                raise ValueError(f"Invalid condition '{condition_text}' in rule '{name}' (keys: {', '.join(RULE_KEYS)})")
+            values = frozenset(value.lower() if key == "protocol" else value for value in values_text.split("|"))
+            conditions[key] = frozenset(int(value) for value in values) if key == "port" else values
+        if not conditions:
+            raise ValueError(f"Rule '{name}' has no conditions")
+        rules.append((name, conditions))
+    return rules
+
+def _rule_matches(conditions, event_type, protocols, ports):
+    for key, values in conditions.items():
+        if key == "event_type":
+            if event_type not in values:
+                return False
+        elif key == "protocol":
+            if values.isdisjoint(protocols):
+                return False
+        elif values.isdisjoint(ports):
+            return False
+    return True
+
+class PacketFilter:
+    """Decides per converted packet whether its UDM event is written, counting every discarded one by reason."""
+    def __init__(self, drop_rules=(), keep_rules=(), sampling_threshold_packets=0, sampling_rate=1,
+                 max_flows=flow_aggregator.DEFAULT_MAX_FLOWS):
+        self.drop_rules = list(drop_rules)
+        self.keep_rules = list(keep_rules)
+        self.sampling_threshold_packets = max(0, sampling_threshold_packets)
+        self.sampling_rate = max(1, sampling_rate)
+        self.max_flows = max(1, max_flows)
+
+    @property
+    def samples(self):
+        return self.sampling_threshold_packets > 0 and self.sampling_rate > 1
+
+    def new_flow_table(self):
+        """Per-file packet counts per flow (least recently seen first); pass it to `decide` for every packet."""
+        return OrderedDict()
+
+    def _flow_packet_index(self, payload, flow_counts):
+        """Position of the packet in its flow (0 = first), or None if it is not sampled (no IP flow, TCP control)."""
+        network = payload.get("network", {})
+        if network.get("ip_protocol_version") is None:
+            return None
+        try:
+            if int(network.get("tcp_flags") or "0", 16) & _TCP_CONTROL_FLAGS:
+                return None
+        except ValueError:
+            pass
+        principal, target = payload.get("principal", {}), payload.get("target", {})
+        endpoints = sorted(((str(principal.get("ip")), principal.get("port") or 0), (str(target.get("ip")), target.get("port") or 0)))
+        flow_key = (network["ip_protocol_version"], network.get("transport_protocol"), *endpoints)
+        packet_index = flow_counts.pop(flow_key, 0)
+        flow_counts[flow_key] = packet_index + 1
+        if len(flow_counts) > self.max_flows:
+            flow_counts.popitem(last=False) # A forgotten flow starts counting again: more packets kept, never fewer
+        return packet_index
+
+    def decide(self, udm_event, protocols, flow_counts, stats, sample=True):
+        """
+        Returns the event to write (possibly marked as sampled) or None if it is dropped. `protocols` is the
+        packet's frame.protocols text; `sample=False` only applies the drop / keep rules.
+        """
+        payload = udm_event.get("event", {})
+        event_type = payload.get("metadata", {}).get("event_type")
+        if event_type == "NETWORK_EVENT_ERROR":
+            return udm_event
+        protocol_set = frozenset(protocols.split(":")) if protocols else frozenset()
+        ports = {port for port in (payload.get("principal", {}).get("port"), payload.get("target", {}).get("port")) if port is not None}
+        if any(_rule_matches(conditions, event_type, protocol_set, ports) for _, conditions in self.keep_rules):
+            return udm_event
+        for rule_name, conditions in self.drop_rules:
+            if _rule_matches(conditions, event_type, protocol_set, ports):
+                return self._drop(stats, rule_name)
+        if sample and self.samples:
+            packet_index = self._flow_packet_index(payload, flow_counts)
+            if packet_index is not None and packet_index >= self.sampling_threshold_packets:
+                if (packet_index - self.sampling_threshold_packets) % self.sampling_rate:
+                    return self._drop(stats, SAMPLED_REASON)
+                payload.setdefault("additional", {})["sample_rate"] = str(self.sampling_rate)
+        return udm_event
+
+    @staticmethod
+    def _drop(stats, reason):
+        stats["packets_dropped"] = stats.get("packets_dropped", 0) + 1
+        stats[f"dropped_{reason}"] = stats.get(f"dropped_{reason}", 0) + 1
+        return None
+
+def dropped_by_reason(stats):
+    """{reason: count} from the flat `dropped_<reason>` counters of a conversion stats dict."""
+    return {key[len("dropped_"):]: value for key, value in stats.items() if key.startswith("dropped_") and isinstance(value, int)}
+
+_environment_filter = None
+_environment_filter_loaded = False
+
+def filter_from_environment():
+    """
+    The process-wide `PacketFilter` configured by UDM_DROP_RULES / UDM_KEEP_RULES / FLOW_SAMPLING_*, or None.
+    Raises ValueError on an invalid setting; services call it once at startup so a bad value fails the boot instead
+    of every conversion.
+    """
+    global _environment_filter, _environment_filter_loaded
+    if _environment_filter_loaded:
+        return _environment_filter
+
+    try:
+        drop_rules = parse_rules(os.environ.get("UDM_DROP_RULES", ""))
+        keep_rules = parse_rules(os.environ.get("UDM_KEEP_RULES", ""))
+    except ValueError as e:
+        raise ValueError(f"Invalid UDM_DROP_RULES / UDM_KEEP_RULES: {e}") from e
+    try:
+        sampling_threshold_packets = int(os.environ.get("FLOW_SAMPLING_THRESHOLD_PACKETS", "0"))
+        sampling_rate = int(os.environ.get("FLOW_SAMPLING_RATE", "10"))
+    except ValueError as e:
+        raise ValueError(f"Invalid FLOW_SAMPLING_THRESHOLD_PACKETS / FLOW_SAMPLING_RATE: {e}") from e
+    packet_filter = PacketFilter(drop_rules, keep_rules, sampling_threshold_packets, sampling_rate)
+    _environment_filter_loaded = True # Only once valid: a later call must not silently convert without the rules
+    if drop_rules or packet_filter.samples:
+        _environment_filter = packet_filter
+        sampling_text = f"1 in {sampling_rate} after {sampling_threshold_packets} packets per flow" if packet_filter.samples else "off"
+        logging.info(f"Packet filtering enabled: drop rules {[name for name, _ in drop_rules]}, "
+                     f"keep rules {[name for name, _ in keep_rules]}, sampling {sampling_text}.")
+    return _environment_filter
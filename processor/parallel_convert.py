@@ -0,0 +1,182 @@
+# processor/parallel_convert.py - Multi-core conversion of a single large capture.
+# A single tshark + converter run keeps one core busy while the Cloud Run instance may have 2-8 vCPUs.
+# For large captures the work is split instead:
+# 1. `editcap -c N` cuts the pcap into frame-range chunks (cheap: no dissection, just record copies).
+# 2. Each chunk is dissected and converted in a process pool (tshark stdout -> json2udm_cloud, see pcap_pipeline.py),
+#    writing an NDJSON part file. Frame numbers are shifted back to the original capture's numbering.
+# 3. Parts are merged in chunk (= frame) order into the single output object, and the per-chunk counters are summed
+#    so `UDM_PACKETS_PROCESSED` / `UDM_PACKET_ERRORS` stay exact and are logged once per file.
+# Note: protocol state spanning a chunk boundary (TCP reassembly, DNS request/response matching) starts fresh in each chunk.
+# The same process pool also runs whole-file conversions (`pooled_pcap_to_udm`), so the CPU-bound mapping of
+# concurrent requests runs on separate cores instead of contending for the GIL of the gunicorn worker.
+# With flow aggregation, flows are aggregated per chunk: a flow crossing a chunk boundary is emitted once per chunk.
+# `prewarm_pool` starts the workers at boot (processor_app.py FAST_STARTUP), so the interpreter start and the
+# converter imports are not paid by the first request; `pooled_json_to_udm` runs the subprocess mode's
+# json2udm_cloud step in such a worker instead of a fresh `python3 json2udm_cloud.py`.
+
+import concurrent.futures
+import glob
+import gzip
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import json2udm_cloud
+import json_backends
+import pcap_pipeline
+
+_process_pool = None # Created on first use and reused across requests
+_process_pool_lock = threading.Lock()
+_pool_jobs_pending = 0 # Submitted and not finished (queued + running)
+
+def get_process_pool(max_workers):
+    """
+    Returns the shared conversion process pool, creating it on first use.
+    "spawn" is used because the Flask worker is multi-threaded and holds network clients; forking it is unsafe.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                                   mp_context=multiprocessing.get_context("spawn"))
+            logging.info(f"Conversion process pool started with {max_workers} workers.")
+        return _process_pool
+
+def _job_finished(_future):
+    global _pool_jobs_pending
+    with _process_pool_lock:
+        _pool_jobs_pending -= 1
+
+def submit_conversion_job(max_workers, job_function, *job_args):
+    """Submits a job to the shared pool and tracks it in the pool queue depth. Returns the future."""
+    global _pool_jobs_pending
+    process_pool = get_process_pool(max_workers)
+    with _process_pool_lock:
+        _pool_jobs_pending += 1 # Counted before submitting: the done callback may run before submit() returns
+    try:
+        job_future = process_pool.submit(job_function, *job_args)
+    except BaseException:
+        _job_finished(None)
+        raise
+    job_future.add_done_callback(_job_finished)
+    return job_future
+
+def pool_queue_depth():
+    """Conversion jobs submitted to the shared pool and not finished yet."""
+    with _process_pool_lock:
+        return _pool_jobs_pending
+
+def _warm_up_worker():
+    """Runs in a pool worker: by now the converter modules are imported and the JSON backends chosen."""
+    return os.getpid()
+
+def prewarm_pool(max_workers):
+    """
+    Starts the shared pool's workers without waiting for them. Workers are spawned on demand, so one job is submitted
+    per worker; each imports this module (and with it the converter) while unpickling the job.
+    """
+    started = time.monotonic()
+    warm_up_futures = [submit_conversion_job(max_workers, _warm_up_worker) for _ in range(max_workers)]
+    def log_when_warm():
+        concurrent.futures.wait(warm_up_futures)
+        worker_pids = {warm_up_future.result() for warm_up_future in warm_up_futures if not warm_up_future.exception()}
+        logging.info(f"Conversion pool warm: {len(worker_pids)} workers in {time.monotonic() - started:.3f}s.")
+    threading.Thread(target=log_when_warm, name="pool-warm-up", daemon=True).start()
+    return warm_up_futures
+
+def pooled_pcap_to_udm(pcap_path, udm_output_path, source_name, max_workers, output_format="json", compress=False,
+                       input_format="json", flow_settings=None):
+    """
+    Runs `pcap_pipeline.stream_pcap_to_udm` for a whole file in the shared process pool and waits for it.
+    The metric lines are logged by the worker process; returns its stats and raises what it raised.
+    """
+    return submit_conversion_job(max_workers, pcap_pipeline.stream_pcap_to_udm, pcap_path, udm_output_path, source_name,
+                                 output_format, compress, input_format, 0, True, flow_settings).result()
+
+def pooled_json_to_udm(json_path, udm_output_path, max_workers, output_format="json", compress=False,
+                       input_format="json", flow_settings=None):
+    """
+    Runs `json2udm_cloud.convert_tshark_output_file` on a tshark output file in the shared process pool and waits.
+    Returns the conversion stats (the metric lines are logged by the worker process).
+    """
+    conversion_stats, _ = submit_conversion_job(max_workers, json2udm_cloud.convert_tshark_output_file, json_path,
+                                                udm_output_path, output_format, compress, input_format,
+                                                flow_settings).result()
+    return conversion_stats
+
+def split_capture(pcap_path, chunk_dir, packets_per_chunk):
+    """Splits `pcap_path` into chunks of `packets_per_chunk` frames with editcap. Returns chunk paths in frame order."""
+    editcap_command = ["editcap", "-c", str(packets_per_chunk), pcap_path, os.path.join(chunk_dir, "chunk.pcap")]
+    subprocess.run(editcap_command, capture_output=True, text=True, check=True)
+    # editcap names chunks chunk_00000_<timestamp>.pcap, chunk_00001_..., so a lexical sort is frame order.
+    return sorted(glob.glob(os.path.join(chunk_dir, "chunk_*")))
+
+def convert_chunk(chunk_path, part_path, source_name, input_format, frame_offset, flow_settings=None):
+    """Process-pool task: dissects and converts one chunk into an NDJSON part file. Returns the chunk's stats."""
+    return pcap_pipeline.stream_pcap_to_udm(chunk_path, part_path, source_name, "ndjson", False, input_format,
+                                            frame_offset=frame_offset, log_summary=False, flow_settings=flow_settings)
+
+def merge_part_files(part_paths, udm_output_path, output_format="json", compress=False):
+    """
+    Concatenates NDJSON part files, in order, into the final output. NDJSON parts are copied as raw bytes;
+    the JSON array format re-reads each line and goes through the regular `write_udm_events` writer.
+    Returns the number of bytes written.
+    """
+    with open(udm_output_path, "wb") as f_out:
+        if output_format == "ndjson":
+            out_stream = gzip.GzipFile(fileobj=f_out, mode="wb", mtime=0) if compress else f_out
+            for part_path in part_paths:
+                with open(part_path, "rb") as f_part:
+                    shutil.copyfileobj(f_part, out_stream, json2udm_cloud.DEFAULT_WRITE_BUFFER_BYTES)
+            if compress:
+                out_stream.close()
+        else:
+            def iter_part_events():
+                for part_path in part_paths:
+                    with open(part_path, "rb") as f_part:
+                        for line in f_part:
+                            yield json_backends.loads(line)
+            json2udm_cloud.write_udm_events(iter_part_events(), f_out, output_format, compress)
+        return f_out.tell()
+
+def parallel_pcap_to_udm(pcap_path, udm_output_path, source_name, max_workers, packets_per_chunk,
+                         output_format="json", compress=False, input_format="json", flow_settings=None):
+    """
+    Converts one capture using `max_workers` processes and writes a single `udm_output_path`.
+    Returns the summed stats; raises like `pcap_pipeline.stream_pcap_to_udm` if any chunk fails.
+    """
+    stats = json2udm_cloud.new_conversion_stats()
+    stats.update({"tshark_output_bytes": 0, "udm_output_bytes": 0, "chunks": 0})
+
+    work_dir = tempfile.mkdtemp(prefix="chunks-", dir=os.path.dirname(udm_output_path) or None)
+    try:
+        chunk_paths = split_capture(pcap_path, work_dir, packets_per_chunk)
+        stats["chunks"] = len(chunk_paths)
+        logging.info(f"Split {source_name} into {len(chunk_paths)} chunks of up to {packets_per_chunk} packets.")
+
+        part_paths = [f"{chunk_path}.udm.ndjson" for chunk_path in chunk_paths]
+        chunk_futures = [submit_conversion_job(max_workers, convert_chunk, chunk_path, part_path, source_name, input_format,
+                                               chunk_index * packets_per_chunk, flow_settings)
+                         for chunk_index, (chunk_path, part_path) in enumerate(zip(chunk_paths, part_paths))]
+        try:
+            for chunk_future in chunk_futures: # In submission order; a failure aborts the whole file
+                chunk_stats = chunk_future.result()
+                chunk_stats.pop("udm_output_bytes", None) # Replaced by the merged object's size below
+                json2udm_cloud.merge_conversion_stats(stats, chunk_stats)
+        except BaseException:
+            for chunk_future in chunk_futures:
+                chunk_future.cancel()
+            raise
+
+        stats["udm_output_bytes"] = merge_part_files(part_paths, udm_output_path, output_format, compress)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    pcap_pipeline.log_stage_summary(stats, source_name)
+    logging.info(f"PARALLEL_CHUNKS: {stats['chunks']} WORKERS: {max_workers} FILE: {source_name}")
+    return stats
@@ -0,0 +1,299 @@
+# processor/pcap_pipeline.py - In-process PCAP -> TShark -> UDM pipeline helpers for the Cloud Run processor.
+# The original flow wrote tshark's JSON to a temp file and then started a second Python interpreter to convert it.
+# On Cloud Run the temp dir is RAM-backed, so the intermediate JSON (often 20-50x the pcap size) sat in memory.
+# Here tshark's stdout pipe feeds `ijson` directly and `json2udm_cloud` runs inside the calling worker:
+# - No intermediate JSON file and no extra interpreter start-up / `ijson` import per request.
+# - Bytes and packets are counted per stage so the logs show where volume is produced.
+# - With `input_format="ek"` tshark only emits the fields the mapper reads (see json2udm_cloud.UDM_SOURCE_FIELDS).
+# - `stream_blob_to_udm` also overlaps the GCS transfers: the pcap is read from GCS in chunks into tshark's stdin
+#   (`-r -`) and the UDM output goes out as a chunked resumable upload, so download, dissection, conversion and
+#   upload all run concurrently and neither copy touches the (RAM-backed) local disk.
+# - `flow_settings` switches from one UDM event per packet to one per flow (see flow_aggregator.py).
+# - With NATIVE_DECODER=true, `stream_pcap_to_udm` decodes plain L2-L4 frames itself (native_pcap.py) and pipes only
+#   the frames that need deep dissection into tshark; a capture made only of such plain frames never starts tshark.
+
+import logging
+import subprocess
+import tempfile
+import threading
+
+import ijson
+
+import json2udm_cloud
+import native_pcap
+
+TSHARK_PIPE_BUFFER_BYTES = 1024 * 1024 # Read-ahead on tshark's stdout pipe
+GCS_STREAM_CHUNK_BYTES = 8 * 1024 * 1024 # Ranged-read and resumable-upload chunk size (multiple of 256 KiB)
+
+class CountingReader:
+    """
+    Minimal read-only file wrapper that counts the bytes pulled through it.
+    Used to measure tshark's output volume without buffering it anywhere.
+    Supports both `read()` (ijson) and line iteration (EK input).
+    """
+    def __init__(self, raw_stream):
+        self.raw_stream = raw_stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self.raw_stream.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def __iter__(self):
+        for line in self.raw_stream:
+            self.bytes_read += len(line)
+            yield line
+
+def build_tshark_command(pcap_path, input_format="json"):
+    """
+    tshark command producing the full JSON dissection or, for "ek", only the fields the mapper reads.
+    `pcap_path` "-" makes tshark read the capture from stdin.
+    """
+    if input_format == "ek":
+        return ["tshark", "-r", pcap_path] + json2udm_cloud.tshark_projection_arguments()
+    return ["tshark", "-r", pcap_path, "-T", "json"]
+
+def offset_frame_numbers(packet_iterator, frame_offset):
+    """
+    Shifts `frame.number` by `frame_offset` for packets dissected from a chunk of a larger capture
+    (editcap restarts numbering at 1 in every chunk), so events keep the original capture's frame numbers.
+    """
+    for packet_data in packet_iterator:
+        frame_layer = packet_data.get("_source", {}).get("layers", {}).get("frame")
+        if isinstance(frame_layer, dict) and frame_layer.get("frame.number") is not None:
+            try:
+                frame_layer["frame.number"] = str(int(frame_layer["frame.number"]) + frame_offset)
+            except (TypeError, ValueError):
+                pass # Leave odd values alone; the mapper reports them as-is
+        yield packet_data
+
+def stream_pcap_to_udm(pcap_path, udm_output_path, source_name, output_format="json", compress=False, input_format="json",
+                       frame_offset=0, log_summary=True, flow_settings=None):
+    """
+    Runs tshark on `pcap_path` and converts its stdout to UDM on the fly, writing `udm_output_path`
+    in `output_format` ("json" or "ndjson", optionally gzip-compressed). `input_format` picks the full
+    `-T json` dissection or the projected "ek" extraction. `frame_offset` is added to frame numbers
+    when `pcap_path` is a chunk of a larger capture; `log_summary=False` leaves the per-file metric
+    lines to the caller (used when chunk results are merged). `flow_settings` enables flow aggregation.
+    With NATIVE_DECODER=true only the frames native_pcap.py cannot decode are dissected by tshark.
+    Returns the conversion stats dict (packets, errors, tshark output bytes, UDM output bytes).
+    Raises `subprocess.CalledProcessError` (with tshark's stderr) if tshark exits non-zero, mirroring
+    what `subprocess.run(..., check=True)` does in the file-based flow so callers can handle both alike.
+    """
+    stats = json2udm_cloud.new_conversion_stats()
+    deep_ports = native_pcap.deep_ports_from_environment()
+    native_capture = native_pcap.open_classified_capture(pcap_path, source_name, deep_ports) if deep_ports else None
+    if native_capture is not None:
+        with native_capture:
+            _convert_native_capture(native_capture, udm_output_path, source_name, output_format, compress, input_format,
+                                    frame_offset, flow_settings, stats)
+    else:
+        tshark_command = build_tshark_command(pcap_path, input_format)
+        # stderr goes to an unnamed temp file: a second pipe could fill up and deadlock tshark while we only drain stdout.
+        with tempfile.TemporaryFile() as tshark_stderr_file, open(udm_output_path, "wb") as f_out:
+            tshark_process = subprocess.Popen(tshark_command, stdout=subprocess.PIPE, stderr=tshark_stderr_file,
+                                              bufsize=TSHARK_PIPE_BUFFER_BYTES)
+            tshark_stdout = CountingReader(tshark_process.stdout)
+            try:
+                tshark_packets = json2udm_cloud.iter_tshark_packets(tshark_stdout, stats, input_format)
+                if frame_offset:
+                    tshark_packets = offset_frame_numbers(tshark_packets, frame_offset)
+                udm_events = json2udm_cloud.iter_output_events(tshark_packets, stats, flow_settings)
+                json2udm_cloud.write_udm_events(udm_events, f_out, output_format, compress)
+            except Exception:
+                tshark_process.kill()
+                raise
+            finally:
+                tshark_process.stdout.close()
+                return_code = tshark_process.wait()
+
+            check_tshark_result(return_code, tshark_command, tshark_stderr_file, stats, source_name)
+            stats["udm_output_bytes"] = f_out.tell()
+        stats["tshark_output_bytes"] = tshark_stdout.bytes_read
+
+    if log_summary:
+        log_stage_summary(stats, source_name)
+    return stats
+
+def _convert_native_capture(native_capture, udm_output_path, source_name, output_format, compress, input_format,
+                            frame_offset, flow_settings, stats):
+    """
+    The NATIVE_DECODER branch of `stream_pcap_to_udm` for a classified capture: a feeder thread writes the routed
+    frames into tshark's stdin (`-r -`) while this thread merges tshark's packets with the natively decoded ones.
+    """
+    stats["native_packets"] = native_capture.native_frames
+    stats["tshark_packets"] = native_capture.deep_frames
+    stats["tshark_output_bytes"] = 0
+    if not native_capture.deep_frames: # Nothing needs deep dissection: tshark is not started at all
+        with open(udm_output_path, "wb") as f_out:
+            packets = native_capture.iter_packets((), stats)
+            udm_events = json2udm_cloud.iter_output_events(
+                offset_frame_numbers(packets, frame_offset) if frame_offset else packets, stats, flow_settings)
+            json2udm_cloud.write_udm_events(udm_events, f_out, output_format, compress)
+            stats["udm_output_bytes"] = f_out.tell()
+        return
+
+    with tempfile.TemporaryFile() as tshark_stderr_file, open(udm_output_path, "wb") as f_out:
+        tshark_command = build_tshark_command("-", input_format)
+        tshark_process = subprocess.Popen(tshark_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=tshark_stderr_file, bufsize=TSHARK_PIPE_BUFFER_BYTES)
+        feeder_errors = []
+
+        def feed_tshark():
+            try:
+                native_capture.write_deep_frames(tshark_process.stdin)
+            except BrokenPipeError:
+                pass # tshark exited early; its exit code tells why
+            except Exception as e_feed:
+                feeder_errors.append(e_feed)
+            finally:
+                try:
+                    tshark_process.stdin.close()
+                except OSError:
+                    pass
+
+        feeder_thread = threading.Thread(target=feed_tshark, name=f"native-feeder-{source_name}", daemon=True)
+        feeder_thread.start()
+        tshark_stdout = CountingReader(tshark_process.stdout)
+        try:
+            packets = native_capture.iter_packets(json2udm_cloud.iter_tshark_packets(tshark_stdout, stats, input_format), stats)
+            udm_events = json2udm_cloud.iter_output_events(
+                offset_frame_numbers(packets, frame_offset) if frame_offset else packets, stats, flow_settings)
+            json2udm_cloud.write_udm_events(udm_events, f_out, output_format, compress)
+        except Exception:
+            tshark_process.kill()
+            raise
+        finally:
+            tshark_process.stdout.close()
+            return_code = tshark_process.wait()
+            feeder_thread.join() # The capture's mmap must not be closed while the feeder still reads it
+
+        if feeder_errors:
+            raise feeder_errors[0]
+        check_tshark_result(return_code, tshark_command, tshark_stderr_file, stats, source_name)
+        stats["udm_output_bytes"] = f_out.tell()
+    stats["tshark_output_bytes"] = tshark_stdout.bytes_read
+
+def check_tshark_result(return_code, tshark_command, tshark_stderr_file, stats, source_name):
+    """
+    Raises `subprocess.CalledProcessError` (with tshark's stderr) for a non-zero exit, or `ijson.JSONError` if the
+    output stream was malformed although tshark exited cleanly; logs tshark's stderr otherwise.
+    """
+    tshark_stderr_file.seek(0)
+    tshark_stderr = tshark_stderr_file.read().decode("utf-8", errors="replace").strip()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, tshark_command, output="", stderr=tshark_stderr)
+    if tshark_stderr:
+        logging.warning(f"tshark stderr: {tshark_stderr}")
+    if stats.get("parse_error"):
+        # Usually a truncated stream; tshark exited cleanly though, so the capture itself produced bad JSON.
+        raise ijson.JSONError(f"Malformed tshark JSON stream for {source_name}: {stats['parse_error']}")
+
+def log_stage_summary(stats, source_name):
+    """Logs the conversion counters plus the per-stage byte volumes of a streamed conversion."""
+    json2udm_cloud.log_conversion_summary(stats, source_name)
+    if "native_packets" in stats:
+        logging.info(f"NATIVE_DECODED_PACKETS: {stats['native_packets']} TSHARK_PACKETS: {stats['tshark_packets']} FILE: {source_name}")
+    logging.info(f"TSHARK_OUTPUT_BYTES: {stats['tshark_output_bytes']} FILE: {source_name}")
+    logging.info(f"UDM_OUTPUT_BYTES: {stats['udm_output_bytes']} FILE: {source_name}")
+
+def abort_blob_writer(blob_writer):
+    """
+    Cancels the resumable upload of a `blob.open("wb")` writer so the object is never finalized. google-cloud-storage
+    3.x does this in `BlobWriter.terminate()`; 2.x has no such method and finalizes the upload on `close()` (also on
+    a `with` block left by an exception), so there the session is deleted the same way and the buffer closed by hand.
+    """
+    if hasattr(blob_writer, "terminate"):
+        blob_writer.terminate()
+        return
+    upload_and_transport = getattr(blob_writer, "_upload_and_transport", None)
+    try:
+        if upload_and_transport:
+            upload, transport = upload_and_transport
+            transport.delete(upload.upload_url)
+    finally:
+        blob_writer._buffer.close() # `close()` now uploads nothing, so the partial object is never finalized
+
+def stream_blob_to_udm(source_blob, output_blob, source_name, output_format="json", compress=False, input_format="json",
+                       content_type=None, chunk_size=GCS_STREAM_CHUNK_BYTES, flow_settings=None, before_finalize=None):
+    """
+    Converts the capture in `source_blob` to UDM in `output_blob` with all stages overlapped:
+    a feeder thread copies ranged GCS reads into tshark's stdin, this thread converts tshark's stdout and
+    writes events into a resumable upload. Nothing is staged on local disk.
+    The upload is only finalized when tshark, the feeder and the parser all succeeded; on any failure it is
+    cancelled, so a half-written object never replaces or shadows a good one. `before_finalize` (optional) is called
+    right before the upload is finalized; raising there cancels it as well.
+    Raises `google.api_core.exceptions.NotFound` before starting tshark if the source object is missing.
+    Works against a local fake GCS server too (google-cloud-storage honors STORAGE_EMULATOR_HOST).
+    """
+    source_blob.reload() # Fetches size/generation; a missing object fails here, before tshark is started
+    tshark_command = build_tshark_command("-", input_format)
+    stats = json2udm_cloud.new_conversion_stats()
+    stats["pcap_input_bytes"] = 0
+    feeder_errors = []
+
+    with tempfile.TemporaryFile() as tshark_stderr_file:
+        tshark_process = subprocess.Popen(tshark_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=tshark_stderr_file, bufsize=TSHARK_PIPE_BUFFER_BYTES)
+
+        def feed_tshark():
+            try:
+                with source_blob.open("rb", chunk_size=chunk_size) as blob_reader:
+                    while True:
+                        chunk = blob_reader.read(chunk_size)
+                        if not chunk:
+                            break
+                        tshark_process.stdin.write(chunk)
+                        stats["pcap_input_bytes"] += len(chunk)
+            except BrokenPipeError:
+                pass # tshark exited early; its exit code tells why
+            except Exception as e_feed:
+                feeder_errors.append(e_feed)
+            finally:
+                try:
+                    tshark_process.stdin.close()
+                except OSError:
+                    pass
+
+        feeder_thread = threading.Thread(target=feed_tshark, name=f"gcs-feeder-{source_name}", daemon=True)
+        feeder_thread.start()
+        tshark_stdout = CountingReader(tshark_process.stdout)
+        try:
+            # Not a `with` block: on google-cloud-storage 2.x leaving it with an exception finalizes the upload.
+            f_out = output_blob.open("wb", chunk_size=chunk_size, content_type=content_type, ignore_flush=True)
+            try:
+                tshark_packets = json2udm_cloud.iter_tshark_packets(tshark_stdout, stats, input_format)
+                udm_events = json2udm_cloud.iter_output_events(tshark_packets, stats, flow_settings)
+                json2udm_cloud.write_udm_events(udm_events, f_out, output_format, compress)
+                stats["udm_output_bytes"] = f_out.tell()
+
+                # The parser stops early on malformed JSON (stats["parse_error"]): tshark, still writing, must not block
+                # on the unread pipe and stop reading its stdin, or the feeder below would never finish.
+                tshark_process.stdout.close()
+                feeder_thread.join()
+                return_code = tshark_process.wait()
+                if feeder_errors:
+                    raise feeder_errors[0]
+                check_tshark_result(return_code, tshark_command, tshark_stderr_file, stats, source_name)
+                if before_finalize is not None:
+                    before_finalize()
+            except BaseException:
+                try:
+                    abort_blob_writer(f_out)
+                except Exception as e_abort:
+                    logging.warning(f"Could not cancel the resumable upload of {source_name}: {e_abort}")
+                raise
+            f_out.close() # Finalizes the upload
+        except Exception:
+            tshark_process.kill()
+            raise
+        finally:
+            tshark_process.stdout.close()
+            tshark_process.wait()
+            feeder_thread.join(timeout=5)
+
+    stats["tshark_output_bytes"] = tshark_stdout.bytes_read
+    logging.info(f"PCAP_INPUT_BYTES: {stats['pcap_input_bytes']} FILE: {source_name}")
+    log_stage_summary(stats, source_name)
+    return stats
@@ -0,0 +1,228 @@
+# processor/pipeline_metrics.py - Per-file stage timing and throughput instrumentation for the processor.
+# The text metric lines (PROCESSING_DURATION_SECONDS, UDM_PACKETS_PROCESSED, ...) only give one number per file.
+# A `FileMetrics` object follows one Pub/Sub notification through the handler and records:
+# - queue lag: handler start minus the Pub/Sub `publishTime` of the message,
+# - wall-clock seconds per stage (download, tshark, udm_convert / convert, upload, overlapped),
+# - bytes per stage, packets (and packets dropped by the converter's filter, by reason), derived bytes/s and packets/s,
+# - packets that failed conversion, by reason (packet_errors.py),
+# - Chronicle delivery (chronicle_sender.py): events sent / spooled, retries, events/s and batch latency percentiles,
+# - peak RSS of the worker and of its largest finished child (tshark / converter script),
+# - errors by type.
+# `emit()` writes it as ONE structured JSON line on stdout (Cloud Run turns it into `jsonPayload`, message
+# "FILE_METRICS FILE: <name>") and folds it into in-process aggregates that `render_prometheus()` exposes
+# in the Prometheus text format (served on /metrics when METRICS_ENDPOINT=true).
+# Aggregates are per instance and reset when the instance is recycled; the JSON log is the durable record.
+
+import contextlib
+import json
+import re
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+STAGE_DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600) # Seconds; also used for queue lag
+_BYTE_COUNTERS = ("pcap_input_bytes", "tshark_output_bytes", "udm_output_bytes")
+_CHRONICLE_COUNTERS = ("chronicle_events_sent", "chronicle_batches_sent", "chronicle_events_spooled", "chronicle_batches_spooled",
+                       "chronicle_batches_rejected", "chronicle_retries", "chronicle_request_bytes", "chronicle_spool_replayed")
+_CHRONICLE_RATES = ("chronicle_events_per_second", "chronicle_batch_latency_p50_seconds", "chronicle_batch_latency_p95_seconds",
+                    "chronicle_batch_latency_max_seconds")
+_LOGGED_COUNTER_PATTERN = re.compile(r"(UDM_PACKETS_PROCESSED|UDM_PACKET_ERRORS|TIMESTAMP_PARSE_FAILURES|UDM_FLOWS_EMITTED|UDM_PACKETS_DROPPED): ([0-9]+)")
+_LOGGED_COUNTER_KEYS = {"UDM_PACKETS_PROCESSED": "packets_processed", "UDM_PACKET_ERRORS": "packet_errors",
+                        "TIMESTAMP_PARSE_FAILURES": "timestamp_fallbacks", "UDM_FLOWS_EMITTED": "flows_emitted",
+                        "UDM_PACKETS_DROPPED": "packets_dropped"}
+_LOGGED_DROP_REASON_PATTERN = re.compile(r"UDM_PACKETS_DROPPED_REASON: ([0-9]+) REASON: ([a-z0-9_]+)")
+_LOGGED_ERROR_REASON_PATTERN = re.compile(r"UDM_PACKET_ERROR_REASON: ([0-9]+) REASON: ([a-z0-9_]+)")
+
+_registry_lock = threading.Lock()
+_registry = {"files": {}, "errors": {}, "stage_seconds": {}, "queue_lag_seconds": None,
+             "bytes": {}, "packets": 0, "packet_errors": 0, "packets_dropped": {},
+             "chronicle_events": {}}
+
+def parse_publish_time(publish_time):
+    """
+    Parses a Pub/Sub `publishTime` ("2024-05-01T12:00:00.123456789Z", fraction optional) into an aware datetime.
+    Returns None if missing or unparseable; the queue lag is then simply not reported.
+    """
+    if not isinstance(publish_time, str) or not publish_time.endswith("Z"):
+        return None
+    second_text, _, fraction_text = publish_time[:-1].partition(".")
+    try:
+        published_at = datetime.strptime(second_text, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+        return published_at.replace(microsecond=int((fraction_text + "000000")[:6])) if fraction_text else published_at
+    except ValueError:
+        return None
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    """Peak RSS (process-wide high-water mark) of this process or of its largest waited-for child, in bytes."""
+    peak_rss = resource.getrusage(who).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+def counters_from_log_text(log_text):
+    """Extracts the converter's `UDM_PACKETS_PROCESSED` / ... metric lines from a script's captured log output."""
+    counters = {_LOGGED_COUNTER_KEYS[name]: int(value) for name, value in _LOGGED_COUNTER_PATTERN.findall(log_text or "")}
+    counters.update((f"dropped_{reason}", int(value)) for value, reason in _LOGGED_DROP_REASON_PATTERN.findall(log_text or ""))
+    counters.update((f"packet_error_reason_{reason}", int(value)) for value, reason in _LOGGED_ERROR_REASON_PATTERN.findall(log_text or ""))
+    return counters
+
+class FileMetrics:
+    """
+    Collects the measurements for one processed file; `emit()` logs and aggregates them once.
+    Stage timers accumulate, so a stage entered twice (or nested inside another) is summed.
+    """
+    def __init__(self, source_name, publish_time=None, mode=None):
+        self.source_name = source_name
+        self.mode = mode
+        self.started_at = datetime.now(timezone.utc)
+        self.started_monotonic = time.monotonic()
+        published_at = parse_publish_time(publish_time)
+        self.queue_lag_seconds = max(0.0, (self.started_at - published_at).total_seconds()) if published_at else None
+        self.stage_seconds = {}
+        self.counters = {}
+        self.errors = {}
+        self.outcome = "error" # Until the handler says otherwise
+
+    @contextlib.contextmanager
+    def stage(self, stage_name):
+        stage_started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage_name] = self.stage_seconds.get(stage_name, 0.0) + time.monotonic() - stage_started
+
+    def add_stats(self, stats):
+        """Takes the byte/packet counters out of a conversion stats dict (json2udm_cloud / pcap_pipeline)."""
+        for key in ("packets_processed", "packet_errors", "timestamp_fallbacks", "flows_emitted", "chunks", "enrichment_cache_hits",
+                    "enrichment_cache_misses", "enrichment_cache_evictions", "packets_dropped", "native_packets", "tshark_packets") + _BYTE_COUNTERS + _CHRONICLE_COUNTERS:
+            if isinstance(stats.get(key), int):
+                self.counters[key] = stats[key]
+        for key in _CHRONICLE_RATES:
+            if isinstance(stats.get(key), (int, float)):
+                self.counters[key] = stats[key]
+        dropped_by_reason = {key[len("dropped_"):]: value for key, value in stats.items()
+                             if key.startswith("dropped_") and isinstance(value, int)}
+        if dropped_by_reason: # packet_filter.py reasons: drop rule names and "sampled"
+            self.counters["packets_dropped_by_reason"] = dropped_by_reason
+        errors_by_reason = {key[len("packet_error_reason_"):]: value for key, value in stats.items()
+                            if key.startswith("packet_error_reason_") and isinstance(value, int)}
+        if errors_by_reason: # packet_errors.py reasons: exception classes in snake case, missing_layers
+            self.counters["packet_errors_by_reason"] = errors_by_reason
+
+    def record_error(self, error_type):
+        self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def to_record(self):
+        total_seconds = time.monotonic() - self.started_monotonic
+        convert_seconds = self.stage_seconds.get("convert") or self.stage_seconds.get("overlapped")
+        pcap_input_bytes = self.counters.get("pcap_input_bytes")
+        throughput = {}
+        if convert_seconds and self.counters.get("packets_processed") is not None:
+            throughput["packets_per_second"] = round(self.counters["packets_processed"] / convert_seconds, 1)
+        if convert_seconds and pcap_input_bytes is not None:
+            throughput["convert_bytes_per_second"] = round(pcap_input_bytes / convert_seconds, 1)
+        if self.stage_seconds.get("download") and pcap_input_bytes is not None:
+            throughput["download_bytes_per_second"] = round(pcap_input_bytes / self.stage_seconds["download"], 1)
+        if self.stage_seconds.get("upload") and self.counters.get("udm_output_bytes") is not None:
+            throughput["upload_bytes_per_second"] = round(self.counters["udm_output_bytes"] / self.stage_seconds["upload"], 1)
+        return {"file": self.source_name, "mode": self.mode, "outcome": self.outcome,
+                "started_at": self.started_at.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+                "queue_lag_seconds": round(self.queue_lag_seconds, 3) if self.queue_lag_seconds is not None else None,
+                "total_seconds": round(total_seconds, 3),
+                "stage_seconds": {name: round(seconds, 3) for name, seconds in self.stage_seconds.items()},
+                **self.counters, **throughput,
+                "peak_rss_bytes": peak_rss_bytes(), "peak_child_rss_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN),
+                "errors": dict(self.errors)}
+
+    def emit(self):
+        """Writes the structured per-file record and adds it to the /metrics aggregates. Returns the record."""
+        record = self.to_record()
+        severity = {"success": "INFO", "not_found": "INFO", "duplicate": "INFO",
+                    "rejected": "WARNING", "in_progress": "WARNING", "lease_lost": "WARNING"}.get(self.outcome, "ERROR")
+        print(json.dumps({"severity": severity, "message": f"FILE_METRICS FILE: {self.source_name}",
+                          "file_metrics": record}), file=sys.stdout, flush=True)
+        _aggregate(record)
+        return record
+
+def count_error(error_type):
+    """Counts an error that happened before a file could be identified (bad Pub/Sub message, GCS client)."""
+    with _registry_lock:
+        _registry["errors"][error_type] = _registry["errors"].get(error_type, 0) + 1
+
+def _new_histogram():
+    return {"buckets": [0] * len(STAGE_DURATION_BUCKETS), "count": 0, "sum": 0.0}
+
+def _observe(histogram, value):
+    histogram["count"] += 1
+    histogram["sum"] += value
+    for bucket_index, upper_bound in enumerate(STAGE_DURATION_BUCKETS):
+        if value <= upper_bound:
+            histogram["buckets"][bucket_index] += 1
+
+def _aggregate(record):
+    with _registry_lock:
+        _registry["files"][record["outcome"]] = _registry["files"].get(record["outcome"], 0) + 1
+        for error_type, error_count in record["errors"].items():
+            _registry["errors"][error_type] = _registry["errors"].get(error_type, 0) + error_count
+        for stage_name, seconds in record["stage_seconds"].items():
+            _observe(_registry["stage_seconds"].setdefault(stage_name, _new_histogram()), seconds)
+        if record["queue_lag_seconds"] is not None:
+            if _registry["queue_lag_seconds"] is None:
+                _registry["queue_lag_seconds"] = _new_histogram()
+            _observe(_registry["queue_lag_seconds"], record["queue_lag_seconds"])
+        for byte_counter in _BYTE_COUNTERS:
+            if record.get(byte_counter) is not None:
+                stage_name = byte_counter[:-len("_bytes")]
+                _registry["bytes"][stage_name] = _registry["bytes"].get(stage_name, 0) + record[byte_counter]
+        _registry["packets"] += record.get("packets_processed") or 0
+        _registry["packet_errors"] += record.get("packet_errors") or 0
+        for reason, dropped_count in (record.get("packets_dropped_by_reason") or {}).items():
+            _registry["packets_dropped"][reason] = _registry["packets_dropped"].get(reason, 0) + dropped_count
+        for outcome in ("sent", "spooled"):
+            if record.get(f"chronicle_events_{outcome}") is not None:
+                _registry["chronicle_events"][outcome] = _registry["chronicle_events"].get(outcome, 0) + record[f"chronicle_events_{outcome}"]
+
+def _histogram_lines(metric_name, histogram, labels=""):
+    label_prefix = labels + "," if labels else ""
+    lines = [f'{metric_name}_bucket{{{label_prefix}le="{upper_bound}"}} {bucket_count}'
+             for upper_bound, bucket_count in zip(STAGE_DURATION_BUCKETS, histogram["buckets"])]
+    lines.append(f'{metric_name}_bucket{{{label_prefix}le="+Inf"}} {histogram["count"]}')
+    label_block = f"{{{labels}}}" if labels else ""
+    lines.append(f"{metric_name}_sum{label_block} {histogram['sum']:.6f}")
+    lines.append(f"{metric_name}_count{label_block} {histogram['count']}")
+    return lines
+
+def render_prometheus(extra_lines=()):
+    """The aggregates, plus `extra_lines` from other components, in Prometheus text exposition format (version 0.0.4)."""
+    with _registry_lock:
+        lines = ["# HELP pcap_processor_files_total Files handled, by outcome.", "# TYPE pcap_processor_files_total counter"]
+        lines += [f'pcap_processor_files_total{{outcome="{outcome}"}} {count}' for outcome, count in sorted(_registry["files"].items())]
+        lines += ["# HELP pcap_processor_errors_total Errors, by type.", "# TYPE pcap_processor_errors_total counter"]
+        lines += [f'pcap_processor_errors_total{{type="{error_type}"}} {count}' for error_type, count in sorted(_registry["errors"].items())]
+        lines += ["# HELP pcap_processor_stage_duration_seconds Wall-clock time per processing stage.",
+                  "# TYPE pcap_processor_stage_duration_seconds histogram"]
+        for stage_name, histogram in sorted(_registry["stage_seconds"].items()):
+            lines += _histogram_lines("pcap_processor_stage_duration_seconds", histogram, f'stage="{stage_name}"')
+        lines += ["# HELP pcap_processor_queue_lag_seconds Pub/Sub publishTime to handler start.",
+                  "# TYPE pcap_processor_queue_lag_seconds histogram"]
+        if _registry["queue_lag_seconds"] is not None:
+            lines += _histogram_lines("pcap_processor_queue_lag_seconds", _registry["queue_lag_seconds"])
+        lines += ["# HELP pcap_processor_bytes_total Bytes per stage (pcap_input, tshark_output, udm_output).",
+                  "# TYPE pcap_processor_bytes_total counter"]
+        lines += [f'pcap_processor_bytes_total{{stage="{stage_name}"}} {count}' for stage_name, count in sorted(_registry["bytes"].items())]
+        lines += ["# HELP pcap_processor_packets_total Packets converted to UDM events.", "# TYPE pcap_processor_packets_total counter",
+                  f"pcap_processor_packets_total {_registry['packets']}",
+                  "# HELP pcap_processor_packet_errors_total Packets that produced an error event.",
+                  "# TYPE pcap_processor_packet_errors_total counter",
+                  f"pcap_processor_packet_errors_total {_registry['packet_errors']}"]
+        lines += ["# HELP pcap_processor_packets_dropped_total Packets discarded by the converter's filter, by reason.",
+                  "# TYPE pcap_processor_packets_dropped_total counter"]
+        lines += [f'pcap_processor_packets_dropped_total{{reason="{reason}"}} {count}' for reason, count in sorted(_registry["packets_dropped"].items())]
+        lines += ["# HELP pcap_processor_chronicle_events_total UDM events sent to the Chronicle ingestion API or spooled, by outcome.",
+                  "# TYPE pcap_processor_chronicle_events_total counter"]
+        lines += [f'pcap_processor_chronicle_events_total{{outcome="{outcome}"}} {count}' for outcome, count in sorted(_registry["chronicle_events"].items())]
+    lines += ["# HELP pcap_processor_peak_rss_bytes Peak resident set size.", "# TYPE pcap_processor_peak_rss_bytes gauge",
+              f'pcap_processor_peak_rss_bytes{{process="worker"}} {peak_rss_bytes()}',
+              f'pcap_processor_peak_rss_bytes{{process="children"}} {peak_rss_bytes(resource.RUSAGE_CHILDREN)}']
+    lines += extra_lines
+    return "\n".join(lines) + "\n"
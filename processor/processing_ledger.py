@@ -0,0 +1,225 @@
+# processor/processing_ledger.py - Idempotency ledger: skip Pub/Sub redeliveries of files that are done or in progress.
+# Pub/Sub push delivers at least once: a lost ack, a 500 after a successful upload or a request outliving the ack
+# deadline all lead to the same pcap being pushed again, possibly while the first delivery is still converting.
+# Every job is keyed on the source object name plus its GCS generation (a re-uploaded file is a new job), and the
+# ledger keeps two small objects per job under a prefix:
+# - `<key>.done`: completion marker, created once (create-only) after the UDM output was uploaded,
+# - `<key>.lease`: processing lease {holder, expires_at}, created create-only, renewed in the background with a
+#   generation-matched write and deleted when the request ends. An expired lease (crashed or killed worker) is taken
+#   over with the same compare-and-swap, so exactly one delivery wins. A renewal failing on a transient error is
+#   retried on the next tick; the lease only counts as lost once it was taken over or has actually expired.
+# The UDM output object also carries `source_object` / `source_generation` metadata, which covers a crash between
+# the upload and the marker write.
+# The store is pluggable: `GcsLedgerStore` (objects in a bucket, preconditions via if_generation_match) and
+# `LocalLedgerStore` (a directory, flock + generation counters) as a stand-in for local runs and tests.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from google.api_core import exceptions as google_api_exceptions
+
+DEFAULT_LEASE_SECONDS = 120 # Renewed every third of this while the request runs
+
+class GcsLedgerStore:
+    """Ledger records as small JSON objects in a GCS bucket; object generations implement compare-and-swap."""
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def create(self, name, record):
+        """Creates `name` if it does not exist. Returns its generation, or None if it already exists."""
+        blob = self.bucket.blob(self.prefix + name)
+        try:
+            blob.upload_from_string(json.dumps(record), content_type="application/json", if_generation_match=0)
+            return blob.generation
+        except google_api_exceptions.PreconditionFailed:
+            return None
+
+    def read(self, name):
+        """Returns (record, generation), or (None, None) if `name` does not exist."""
+        blob = self.bucket.get_blob(self.prefix + name)
+        if blob is None:
+            return None, None
+        try:
+            return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+        except (google_api_exceptions.NotFound, google_api_exceptions.PreconditionFailed):
+            return None, None # Replaced or deleted in between; the caller treats it as absent and retries its write
+
+    def replace(self, name, record, generation):
+        """Overwrites `name` only if it is still at `generation`. Returns the new generation, or None if it changed."""
+        blob = self.bucket.blob(self.prefix + name)
+        try:
+            blob.upload_from_string(json.dumps(record), content_type="application/json", if_generation_match=generation)
+            return blob.generation
+        except (google_api_exceptions.PreconditionFailed, google_api_exceptions.NotFound):
+            return None
+
+    def delete(self, name, generation):
+        try:
+            self.bucket.blob(self.prefix + name).delete(if_generation_match=generation)
+        except (google_api_exceptions.PreconditionFailed, google_api_exceptions.NotFound):
+            pass # Taken over or already gone
+
+class LocalLedgerStore:
+    """
+    Same interface on a local directory (local development, tests). One JSON file per record holding a generation
+    counter; every operation runs under an exclusive flock, so several worker processes can share the directory.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._thread_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._thread_lock, open(os.path.join(self.directory, ".lock"), "a") as f_lock:
+            fcntl.flock(f_lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name.replace("/", "%2F"))
+
+    def _read_unlocked(self, name):
+        try:
+            with open(self._path(name)) as f_record:
+                stored = json.load(f_record)
+            return stored["record"], stored["generation"]
+        except FileNotFoundError:
+            return None, None
+
+    def _write_unlocked(self, name, record, generation):
+        temp_path = self._path(name) + ".tmp"
+        with open(temp_path, "w") as f_record:
+            json.dump({"record": record, "generation": generation}, f_record)
+        os.replace(temp_path, self._path(name))
+
+    def create(self, name, record):
+        with self._locked():
+            if self._read_unlocked(name)[0] is not None:
+                return None
+            self._write_unlocked(name, record, 1)
+            return 1
+
+    def read(self, name):
+        with self._locked():
+            return self._read_unlocked(name)
+
+    def replace(self, name, record, generation):
+        with self._locked():
+            if self._read_unlocked(name)[1] != generation:
+                return None
+            self._write_unlocked(name, record, generation + 1)
+            return generation + 1
+
+    def delete(self, name, generation):
+        with self._locked():
+            if self._read_unlocked(name)[1] == generation:
+                os.remove(self._path(name))
+
+class LeaseLostError(Exception):
+    """This delivery's lease was taken over or expired: another delivery may be writing the same output."""
+
+class Lease:
+    """A held processing lease; renewed by a daemon thread until `ProcessingLedger.release` / `complete`."""
+    def __init__(self, job_key, generation, expires_at):
+        self.job_key = job_key
+        self.generation = generation
+        self.expires_at = expires_at # Of the last lease record written
+        self.lost = False # Set if the renewal found the lease taken over (we were considered dead) or let it expire
+        self.stop_renewal = threading.Event()
+        self.renewal_thread = None
+
+class ProcessingLedger:
+    """Completion markers and leases per job (source object name + generation) on a ledger store."""
+    def __init__(self, store, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.store = store
+        self.lease_seconds = lease_seconds
+
+    @staticmethod
+    def job_key(object_name, generation):
+        return f"{object_name}@{generation}"
+
+    def completed_record(self, job_key):
+        """The completion marker's record if the job is done, else None."""
+        return self.store.read(job_key + ".done")[0]
+
+    def mark_completed(self, job_key, record):
+        """Writes the completion marker (a no-op if another delivery already wrote it)."""
+        self.store.create(job_key + ".done", dict(record, completed_at=time.time()))
+
+    def _lease_record(self, holder):
+        return {"holder": holder, "expires_at": time.time() + self.lease_seconds}
+
+    def acquire(self, job_key):
+        """
+        Returns a renewed `Lease` if this delivery may process the job, or None if another live delivery holds it.
+        An expired lease is taken over with a generation-matched write, so concurrent takeovers cannot both win.
+        """
+        holder = f"{os.environ.get('K_REVISION', socket.gethostname())}/{os.getpid()}/{uuid.uuid4().hex[:8]}"
+        lease_name = job_key + ".lease"
+        for _ in range(2): # Second round only if the lease vanished between our create and read
+            lease_record = self._lease_record(holder)
+            lease_generation = self.store.create(lease_name, lease_record)
+            if lease_generation is not None:
+                return self._start_renewal(Lease(job_key, lease_generation, lease_record["expires_at"]), holder)
+            current_lease, current_generation = self.store.read(lease_name)
+            if current_lease is None:
+                continue
+            if current_lease.get("expires_at", 0) > time.time():
+                return None
+            lease_record = self._lease_record(holder)
+            new_generation = self.store.replace(lease_name, lease_record, current_generation)
+            if new_generation is None:
+                return None # Someone else took it over first
+            logging.warning(f"Took over expired processing lease of {current_lease.get('holder')} for {job_key}.")
+            return self._start_renewal(Lease(job_key, new_generation, lease_record["expires_at"]), holder)
+        return None
+
+    def _start_renewal(self, lease, holder):
+        def renew():
+            lease_name = lease.job_key + ".lease"
+            while not lease.stop_renewal.wait(self.lease_seconds / 3):
+                lease_record = self._lease_record(holder)
+                try:
+                    new_generation = self.store.replace(lease_name, lease_record, lease.generation)
+                    if new_generation is None:
+                        # A renewal that failed on the client side may still have been written: still ours then
+                        current_lease, current_generation = self.store.read(lease_name)
+                        if current_lease is not None and current_lease.get("holder") == holder:
+                            lease.generation, lease.expires_at = current_generation, current_lease.get("expires_at", 0)
+                            continue
+                        lease.lost = True
+                        logging.warning(f"Processing lease for {lease.job_key} was lost; another delivery may be processing it.")
+                        return
+                except Exception as e_renew: # Transient (503, timeout, connection reset): retry on the next tick
+                    if time.time() < lease.expires_at:
+                        logging.warning(f"Could not renew the processing lease for {lease.job_key} (retrying): {e_renew}")
+                        continue
+                    lease.lost = True
+                    logging.error(f"Processing lease for {lease.job_key} expired while it could not be renewed: {e_renew}")
+                    return
+                lease.generation, lease.expires_at = new_generation, lease_record["expires_at"]
+        lease.renewal_thread = threading.Thread(target=renew, name=f"lease-{lease.job_key}", daemon=True)
+        lease.renewal_thread.start()
+        return lease
+
+    def release(self, lease):
+        """Stops renewing and deletes the lease (unless it was taken over), so a redelivery can start right away."""
+        lease.stop_renewal.set()
+        lease.renewal_thread.join()
+        if not lease.lost:
+            self.store.delete(lease.job_key + ".lease", lease.generation)
+
+    def complete(self, lease, record):
+        self.mark_completed(lease.job_key, record)
+        self.release(lease)
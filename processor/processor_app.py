@@ -1,100 +1,338 @@
 # processor/processor_app.py - Cloud Run Flask App for PCAP to UDM processing.
 # Listens to Pub/Sub, downloads PCAP from GCS, converts via tshark & json2udm_cloud.py, uploads UDM to GCS.
+# PROCESSING_MODE selects how the conversion runs:
+# - "subprocess" (default): tshark writes a JSON file, then json2udm_cloud.py runs as a separate script on it.
+# - "streaming": tshark's stdout is parsed and converted in-process (see pcap_pipeline.py), no intermediate JSON file.
+# OVERLAPPED_IO=true streams the pcap from GCS into tshark and the UDM output back to GCS while converting,
+# instead of download -> convert -> upload through local files (see pcap_pipeline.stream_blob_to_udm).
+# With PARALLEL_WORKERS > 1, captures above PARALLEL_MIN_PCAP_BYTES are split and converted on several cores (parallel_convert.py).
+# Every notification also produces one structured FILE_METRICS log record with per-stage timings (pipeline_metrics.py).
+# Requests are admitted against in-flight file and temp byte budgets first (admission_control.py); over budget the
+# handler answers 429 so Pub/Sub redelivers later. In streaming mode the conversion runs in a CPU-sized process pool.
+# Notifications with the attribute `content=udm` come from a sniffer in edge mode (sniffer/uploader.py, EDGE_CONVERSION):
+# the object is already gzip NDJSON UDM produced by the same json2udm_cloud mapper and is only copied server-side.
+# Redeliveries are made idempotent by a ledger keyed on object name + generation (processing_ledger.py): a finished
+# file is acknowledged without work, one still being processed by another delivery is answered 409 for a later retry.
+# With CHECKPOINTED_CONVERSION=true, captures above CHECKPOINT_MIN_PCAP_BYTES are converted in committed parts with a
+# manifest in the output bucket (checkpointed_convert.py): a retried delivery resumes after the last committed frame
+# and the parts are composed into the final UDM object at the end.
+# With FANOUT_TOPIC set, captures above FANOUT_MIN_PCAP_BYTES are split into chunks that are published back to the
+# topic as separate notifications (content=pcap_chunk), converted by any instance and composed in order by the chunk
+# that completes the set (fanout.py), so large files scale with the number of instances.
+# With CHRONICLE_INGESTION=true the finished UDM output is also sent to the Chronicle ingestion API in batches, in a
+# `send` stage after the upload (chronicle_sender.py); batches that cannot be delivered are spooled to GCS.
+# FAST_STARTUP=true shortens a cold start: the module only builds the Flask app, while a boot thread imports the GCS
+# library, creates the clients and verifies both buckets concurrently; the first notification waits for it (the
+# health check does not). The conversion pool is started at boot, and the subprocess mode's json2udm_cloud step runs
+# in one of its pre-warmed workers (in-process with CONVERSION_POOL=false) instead of a fresh interpreter.
+# test/benchmarks/bench_startup.py measures time-to-first-request and time-to-first-processed-file.
+# Packets that fail conversion are counted per reason; a small sample of them (packet_errors.py) is uploaded to
+# ERROR_SAMPLE_PREFIX in the output bucket as `<pcap>.errors.json`, for debugging a malformed capture.
 
 import base64
+import concurrent.futures
 import json
 import os
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 import logging
 from flask import Flask, request, Response, jsonify
 from datetime import datetime, timezone # Added for latency measurement
 from google.api_core import exceptions as google_api_exceptions
 
-from google.cloud import storage
+import admission_control
+import checkpointed_convert
+import chronicle_sender
+import fanout
+import json2udm_cloud
+import json_backends
+import native_pcap
+import packet_errors
+import packet_filter
+import parallel_convert
+import pcap_pipeline
+import pipeline_metrics
+import processing_ledger
 
 # --- Configuration ---
 INCOMING_BUCKET_NAME = os.environ.get("INCOMING_BUCKET")
 OUTPUT_BUCKET_NAME = os.environ.get("OUTPUT_BUCKET")
 GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID") # For GCS client context
+PROCESSING_MODE = os.environ.get("PROCESSING_MODE", "subprocess").strip().lower() # "subprocess" or "streaming"
+UDM_OUTPUT_FORMAT = os.environ.get("UDM_OUTPUT_FORMAT", "json").strip().lower() # "json" (indented array) or "ndjson"
+UDM_OUTPUT_GZIP = os.environ.get("UDM_OUTPUT_GZIP", "false").strip().lower() in ("1", "true", "yes")
+TSHARK_PROJECTION = os.environ.get("TSHARK_PROJECTION", "false").strip().lower() in ("1", "true", "yes") # Only extract mapped fields
+TSHARK_INPUT_FORMAT = "ek" if TSHARK_PROJECTION else "json"
+OVERLAPPED_IO = os.environ.get("OVERLAPPED_IO", "false").strip().lower() in ("1", "true", "yes")
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", "1")) # >1 enables multi-core conversion of large captures
+PARALLEL_MIN_PCAP_BYTES = int(os.environ.get("PARALLEL_MIN_PCAP_BYTES", str(100 * 1024 * 1024)))
+PARALLEL_CHUNK_PACKETS = int(os.environ.get("PARALLEL_CHUNK_PACKETS", "50000"))
+CONVERSION_POOL = os.environ.get("CONVERSION_POOL", "true").strip().lower() in ("1", "true", "yes") # Streaming mode: convert in the process pool
+CONVERSION_WORKERS = int(os.environ.get("CONVERSION_WORKERS", "0")) or admission_control.available_cpu_count() # Process pool size
+MAX_IN_FLIGHT_FILES = int(os.environ.get("MAX_IN_FLIGHT_FILES", "0")) or 2 * CONVERSION_WORKERS
+MAX_TEMP_BYTES = int(os.environ.get("MAX_TEMP_BYTES", "0")) or (admission_control.detect_memory_limit_bytes() or 2 * 1024**3) // 2
+TEMP_BYTES_PER_PCAP_BYTE = float(os.environ.get("TEMP_BYTES_PER_PCAP_BYTE", "0")) # 0: per-mode estimate below
+FLOW_AGGREGATION = os.environ.get("FLOW_AGGREGATION", "false").strip().lower() in ("1", "true", "yes") # One UDM event per flow
+FLOW_SETTINGS = {"idle_timeout_seconds": float(os.environ.get("FLOW_IDLE_TIMEOUT_SECONDS", "60")),
+                 "active_timeout_seconds": float(os.environ.get("FLOW_ACTIVE_TIMEOUT_SECONDS", "300")),
+                 "max_flows": int(os.environ.get("FLOW_MAX_ENTRIES", "20000"))} if FLOW_AGGREGATION else None
+IDEMPOTENCY_LEDGER = os.environ.get("IDEMPOTENCY_LEDGER", "gcs").strip().lower() # "gcs", "local" (stand-in) or "off"
+LEDGER_BUCKET_NAME = os.environ.get("LEDGER_BUCKET") or INCOMING_BUCKET_NAME # Markers and leases, under LEDGER_PREFIX
+LEDGER_PREFIX = os.environ.get("LEDGER_PREFIX", "_ledger/")
+LEDGER_LOCAL_DIR = os.environ.get("LEDGER_LOCAL_DIR", os.path.join(tempfile.gettempdir(), "pcap-processor-ledger"))
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", str(processing_ledger.DEFAULT_LEASE_SECONDS)))
+CHECKPOINTED_CONVERSION = os.environ.get("CHECKPOINTED_CONVERSION", "false").strip().lower() in ("1", "true", "yes") # Resumable parts
+CHECKPOINT_MIN_PCAP_BYTES = int(os.environ.get("CHECKPOINT_MIN_PCAP_BYTES", str(500 * 1024 * 1024)))
+CHECKPOINT_PART_PACKETS = int(os.environ.get("CHECKPOINT_PART_PACKETS", "200000")) # Frames per committed part
+CHECKPOINT_PREFIX = os.environ.get("CHECKPOINT_PREFIX", "_checkpoints/") # Parts and manifests, in the output bucket
+FANOUT_TOPIC = os.environ.get("FANOUT_TOPIC", "") # projects/<p>/topics/<t> the processor listens on; empty disables fan-out
+FANOUT_MIN_PCAP_BYTES = int(os.environ.get("FANOUT_MIN_PCAP_BYTES", str(1024 * 1024 * 1024)))
+FANOUT_CHUNK_PACKETS = int(os.environ.get("FANOUT_CHUNK_PACKETS", "500000")) # Frames per chunk (one notification each)
+FANOUT_PREFIX = os.environ.get("FANOUT_PREFIX", "_fanout/") # Chunks in INCOMING_BUCKET, parts and markers in OUTPUT_BUCKET
+METRICS_ENDPOINT = os.environ.get("METRICS_ENDPOINT", "false").strip().lower() in ("1", "true", "yes") # Serve GET /metrics
+CHRONICLE_SPOOL_BUCKET_NAME = os.environ.get("CHRONICLE_SPOOL_BUCKET") or OUTPUT_BUCKET_NAME # Undeliverable batches
+CHRONICLE_SPOOL_REPLAY_BATCHES = int(os.environ.get("CHRONICLE_SPOOL_REPLAY_BATCHES", "20")) # Re-sent after each clean file
+FAST_STARTUP = os.environ.get("FAST_STARTUP", "false").strip().lower() in ("1", "true", "yes") # Boot in the background
+STARTUP_WAIT_SECONDS = float(os.environ.get("STARTUP_WAIT_SECONDS", "120")) # A notification's wait for the boot thread
+ERROR_SAMPLE_PREFIX = os.environ.get("ERROR_SAMPLE_PREFIX", "_errors/") # Samples of failing packets, in the output bucket; empty: off
 
 if not INCOMING_BUCKET_NAME:
     logging.critical("CRITICAL: INCOMING_BUCKET env var not set.")
 if not OUTPUT_BUCKET_NAME:
     logging.critical("CRITICAL: OUTPUT_BUCKET env var not set.")
+if PROCESSING_MODE not in ("subprocess", "streaming"):
+    logging.critical(f"CRITICAL: Unknown PROCESSING_MODE '{PROCESSING_MODE}', falling back to 'subprocess'.")
+    PROCESSING_MODE = "subprocess"
+if UDM_OUTPUT_FORMAT not in json2udm_cloud.OUTPUT_FORMATS:
+    logging.critical(f"CRITICAL: Unknown UDM_OUTPUT_FORMAT '{UDM_OUTPUT_FORMAT}', falling back to 'json'.")
+    UDM_OUTPUT_FORMAT = "json"
+try: # Parsed once here: invalid settings would otherwise fail (and redeliver) every file
+    packet_filter.filter_from_environment()
+    native_pcap.deep_ports_from_environment()
+except ValueError as e:
+    logging.critical(f"CRITICAL: {e}")
+    sys.exit(1)
+# Rough temp-dir bytes per pcap byte: the pcap itself, tshark's JSON (20-50x, subprocess mode only), the UDM output,
+# and for the parallel / checkpointed modes the chunk copies and part files as well.
+TEMP_BYTES_FACTORS = {"subprocess": 50, "streaming": 11, "parallel": 22, "checkpointed": 22, "fanout": 2, "chunk": 11,
+                      "overlapped": 0, "edge": 0}
+EDGE_UDM_SUFFIX = json2udm_cloud.udm_output_filename("", "ndjson", True) # Object suffix of edge-converted notifications
+EDGE_STATS_ATTRIBUTES = ("packets_processed", "packet_errors", "timestamp_fallbacks", "pcap_input_bytes", "udm_output_bytes",
+                         "packets_dropped") # Plus one dropped_<reason> per filter reason
+UDM_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "json2udm_cloud.py") # /app/ in the image
+UDM_CONTENT_TYPES = {("json", False): "application/json", ("ndjson", False): "application/x-ndjson",
+                     ("json", True): "application/gzip", ("ndjson", True): "application/gzip"}
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 
+admission_controller = admission_control.AdmissionController(MAX_IN_FLIGHT_FILES, MAX_TEMP_BYTES)
+process_pool_workers = CONVERSION_WORKERS if CONVERSION_POOL else PARALLEL_WORKERS # Shared by pooled and parallel conversions
+logging.info(f"Admission limits: {MAX_IN_FLIGHT_FILES} in-flight files, {MAX_TEMP_BYTES} temp bytes. "
+             f"Conversion pool: {'on' if CONVERSION_POOL else 'off'} ({process_pool_workers} workers).")
+json_backends.log_selected_backends()
+
 # --- Google Cloud Storage Client Initialization ---
 storage_client_instance = None # Global GCS client
-try:
-    storage_client_instance = storage.Client()
-    logging.info("GCS client created.")
-except Exception as e:
-    logging.critical(f"CRITICAL: Failed to create GCS client: {e}", exc_info=True)
+ledger = None # Idempotency ledger (None when disabled)
+chronicle = None # Chronicle ingestion sender (None when CHRONICLE_INGESTION is off)
+
+def create_clients():
+    """Creates the GCS client, the idempotency ledger and the Chronicle sender (at import, or on the boot thread)."""
+    global storage_client_instance, ledger, chronicle
+    try:
+        from google.cloud import storage # Imported here: with its auth dependencies, one of the slowest imports
+        storage_client_instance = storage.Client()
+        logging.info("GCS client created.")
+    except Exception as e:
+        logging.critical(f"CRITICAL: Failed to create GCS client: {e}", exc_info=True)
+
+    if IDEMPOTENCY_LEDGER == "local":
+        ledger = processing_ledger.ProcessingLedger(processing_ledger.LocalLedgerStore(LEDGER_LOCAL_DIR), LEASE_SECONDS)
+        logging.info(f"Idempotency ledger: local directory {LEDGER_LOCAL_DIR}.")
+    elif IDEMPOTENCY_LEDGER == "gcs" and storage_client_instance and LEDGER_BUCKET_NAME:
+        ledger = processing_ledger.ProcessingLedger(
+            processing_ledger.GcsLedgerStore(storage_client_instance.bucket(LEDGER_BUCKET_NAME), LEDGER_PREFIX), LEASE_SECONDS)
+        logging.info(f"Idempotency ledger: gs://{LEDGER_BUCKET_NAME}/{LEDGER_PREFIX} (lease {LEASE_SECONDS}s).")
+    else:
+        logging.warning(f"Idempotency ledger disabled (IDEMPOTENCY_LEDGER={IDEMPOTENCY_LEDGER}); redeliveries are processed again.")
+
+    chronicle = chronicle_sender.sender_from_environment(
+        storage_client_instance.bucket(CHRONICLE_SPOOL_BUCKET_NAME) if storage_client_instance and CHRONICLE_SPOOL_BUCKET_NAME else None)
 
 _incoming_bucket_verified = False # Worker-instance flags for bucket verification
 _output_bucket_verified = False
+_startup_done = threading.Event() # Set once the clients exist (immediately without FAST_STARTUP)
+
+def verify_bucket(bucket_name, bucket_label):
+    """Looks up one bucket; True if it is accessible. Errors are logged, not raised."""
+    try:
+        if storage_client_instance.lookup_bucket(bucket_name):
+            logging.info(f"{bucket_label.capitalize()} bucket '{bucket_name}' verified.")
+            return True
+        logging.error(f"Failed to verify {bucket_label} bucket '{bucket_name}'.")
+    except Exception as e:
+        logging.error(f"Exception verifying {bucket_label} bucket '{bucket_name}': {e}", exc_info=True)
+    return False
+
+def verify_buckets():
+    """Verifies the buckets not verified yet, concurrently (each lookup is a network round trip). True if both are."""
+    global _incoming_bucket_verified, _output_bucket_verified
+    pending = []
+    if not _incoming_bucket_verified:
+        pending.append((INCOMING_BUCKET_NAME, "incoming"))
+    if not _output_bucket_verified:
+        pending.append((OUTPUT_BUCKET_NAME, "output"))
+    for bucket_name, bucket_label in pending:
+        if not bucket_name:
+            logging.error(f"{bucket_label.upper()}_BUCKET_NAME not set; cannot verify.")
+            return False
+    if pending:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(pending)) as lookup_executor:
+            verified = dict(zip((bucket_label for _, bucket_label in pending),
+                                lookup_executor.map(lambda bucket: verify_bucket(*bucket), pending)))
+        _incoming_bucket_verified = _incoming_bucket_verified or verified.get("incoming", False)
+        _output_bucket_verified = _output_bucket_verified or verified.get("output", False)
+    return _incoming_bucket_verified and _output_bucket_verified
 
 def get_verified_storage_client():
     """
     Returns GCS client if buckets are verified. Verifies lazily on first call per worker.
     Lazy verification helps if IAM policies (e.g., via Terraform) need time to propagate
     post-deployment, avoiding a separate re-deploy just for permissions.
+    With FAST_STARTUP, waits for the boot thread first (which already verified the buckets once).
     Returns None on client creation failure or if buckets aren't accessible.
     """
-    global _incoming_bucket_verified, _output_bucket_verified
+    if not _startup_done.wait(STARTUP_WAIT_SECONDS):
+        logging.error(f"Startup has not finished after {STARTUP_WAIT_SECONDS}s; no client provided.")
+        return None
 
     if not storage_client_instance:
         logging.error("Storage client object was not created at application startup.")
         return None
 
-    client_to_use = storage_client_instance
-
-    if not _incoming_bucket_verified:
-        if not INCOMING_BUCKET_NAME:
-            logging.error("INCOMING_BUCKET_NAME not set; cannot verify.")
-            return None
-        try:
-            if client_to_use.lookup_bucket(INCOMING_BUCKET_NAME):
-                logging.info(f"Incoming bucket '{INCOMING_BUCKET_NAME}' verified.")
-                _incoming_bucket_verified = True
-            else:
-                logging.error(f"Failed to verify incoming bucket '{INCOMING_BUCKET_NAME}'.")
-                return None
-        except Exception as e:
-            logging.error(f"Exception verifying incoming bucket '{INCOMING_BUCKET_NAME}': {e}", exc_info=True)
-            return None
-
-    if not _output_bucket_verified:
-        if not OUTPUT_BUCKET_NAME:
-            logging.error("OUTPUT_BUCKET_NAME not set; cannot verify.")
-            return None
-        try:
-            if client_to_use.lookup_bucket(OUTPUT_BUCKET_NAME):
-                logging.info(f"Output bucket '{OUTPUT_BUCKET_NAME}' verified.")
-                _output_bucket_verified = True
-            else:
-                logging.error(f"Failed to verify output bucket '{OUTPUT_BUCKET_NAME}'.")
-                return None
-        except Exception as e:
-            logging.error(f"Exception verifying output bucket '{OUTPUT_BUCKET_NAME}': {e}", exc_info=True)
-            return None
-            
-    if _incoming_bucket_verified and _output_bucket_verified:
-        return client_to_use
+    if verify_buckets():
+        return storage_client_instance
     else:
         logging.error("Bucket verification failed. No client provided.")
         return None
 
+def boot_in_background():
+    """FAST_STARTUP boot thread: conversion pool, clients and bucket verification, while requests are served."""
+    boot_started = time.monotonic()
+    try:
+        if CONVERSION_POOL: # First: the workers start while the clients are created
+            parallel_convert.prewarm_pool(process_pool_workers)
+        create_clients()
+        if storage_client_instance:
+            verify_buckets() # Failures are retried lazily by get_verified_storage_client
+    finally:
+        _startup_done.set()
+    logging.info(f"STARTUP_BOOT_SECONDS: {time.monotonic() - boot_started:.3f}")
+
+if FAST_STARTUP:
+    threading.Thread(target=boot_in_background, name="startup", daemon=True).start()
+else:
+    create_clients()
+    _startup_done.set()
+
 # --- Health Check Route ---
 @app.route('/', methods=['GET'])
 def health_check():
     """Basic health check for Cloud Run liveness probes."""
     return jsonify(status="ok"), 200
 
+def select_processing_mode(pcap_size_bytes):
+    """The mode a capture of this size is processed in (also names its FILE_METRICS record and temp estimate)."""
+    if FANOUT_TOPIC and pcap_size_bytes >= FANOUT_MIN_PCAP_BYTES:
+        return "fanout"
+    if CHECKPOINTED_CONVERSION and pcap_size_bytes >= CHECKPOINT_MIN_PCAP_BYTES:
+        return "checkpointed"
+    if OVERLAPPED_IO:
+        return "overlapped"
+    if PARALLEL_WORKERS > 1 and pcap_size_bytes >= PARALLEL_MIN_PCAP_BYTES:
+        return "parallel"
+    return PROCESSING_MODE
+
+def estimate_temp_bytes(pcap_size_bytes, processing_mode):
+    """Temp bytes reserved for one file by admission control; overlapped mode only holds the transfer buffers."""
+    if processing_mode == "overlapped":
+        return 2 * pcap_pipeline.GCS_STREAM_CHUNK_BYTES
+    if processing_mode == "edge":
+        return 0 # Server-side copy, nothing local
+    return int(pcap_size_bytes * (TEMP_BYTES_PER_PCAP_BYTE or TEMP_BYTES_FACTORS[processing_mode]))
+
+def check_lease(processing_lease, pcap_filename):
+    """Raises LeaseLostError before an output is written if this delivery's lease was lost (no-op without a ledger)."""
+    if processing_lease is not None and processing_lease.lost:
+        raise processing_ledger.LeaseLostError(f"Processing lease for {pcap_filename} was lost")
+
+def is_job_completed(storage_client, job_key, output_object_name, source_generation):
+    """
+    True if this object generation was already processed: its completion marker exists, or the output object carries
+    its generation in the `source_generation` metadata (the worker died between the upload and the marker write).
+    """
+    if ledger.completed_record(job_key) is not None:
+        return True
+    output_blob = storage_client.bucket(OUTPUT_BUCKET_NAME).get_blob(output_object_name)
+    if output_blob is not None and (output_blob.metadata or {}).get("source_generation") == str(source_generation):
+        ledger.mark_completed(job_key, {"output": output_object_name, "recovered_from": "output_metadata"})
+        return True
+    return False
+
+def send_udm_output_to_chronicle(storage_client, local_udm_path, output_object_name, source_name, source_generation, is_edge_udm):
+    """
+    Streams the finished UDM output to Chronicle: the local file when the mode kept one, else the output object.
+    Edge outputs are gzip NDJSON whatever this processor's output settings. Returns the send counters.
+    """
+    output_format, compress = ("ndjson", True) if is_edge_udm else (UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)
+    if os.path.exists(local_udm_path):
+        f_udm = open(local_udm_path, "rb")
+    else:
+        f_udm = storage_client.bucket(OUTPUT_BUCKET_NAME).blob(output_object_name).open("rb", chunk_size=pcap_pipeline.GCS_STREAM_CHUNK_BYTES)
+    with f_udm:
+        send_stats = chronicle.send_events(json2udm_cloud.iter_udm_output_events(f_udm, output_format, compress), source_name,
+                                           processing_ledger.ProcessingLedger.job_key(source_name, source_generation))
+    if not send_stats["chronicle_batches_spooled"]: # The endpoint takes batches again: catch up on earlier spooled ones
+        send_stats["chronicle_spool_replayed"] = chronicle.replay_spool(CHRONICLE_SPOOL_REPLAY_BATCHES)
+    chronicle_sender.log_send_summary(send_stats, source_name)
+    return send_stats
+
+def store_error_sample(storage_client, source_name, local_udm_path, conversion_stats=None):
+    """
+    Uploads the sample of packets that failed conversion to ERROR_SAMPLE_PREFIX in the output bucket, if the file had any.
+    It comes from the conversion stats, or from the `<output>.errors.json` the json2udm_cloud.py script left next to its
+    output. A debugging aid only: a failed upload is logged, never retried.
+    """
+    if not ERROR_SAMPLE_PREFIX:
+        return
+    sample_path = local_udm_path + packet_errors.ERROR_SAMPLE_SUFFIX
+    if conversion_stats is not None:
+        packet_errors.write_error_sample(conversion_stats, sample_path, source_name)
+    if not os.path.exists(sample_path):
+        return
+    sample_object_name = f"{ERROR_SAMPLE_PREFIX}{source_name}{packet_errors.ERROR_SAMPLE_SUFFIX}"
+    try:
+        storage_client.bucket(OUTPUT_BUCKET_NAME).blob(sample_object_name).upload_from_filename(sample_path, content_type="application/json")
+        logging.info(f"ERROR_SAMPLE: gs://{OUTPUT_BUCKET_NAME}/{sample_object_name} FILE: {source_name}")
+    except Exception as e:
+        logging.warning(f"Could not upload the error sample of {source_name}: {e}")
+
+_pubsub_session = None # Authorized session for publishing fan-out chunk notifications, created on first use
+
+def get_pubsub_session():
+    global _pubsub_session
+    if _pubsub_session is None:
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/pubsub"])
+        _pubsub_session = AuthorizedSession(credentials)
+    return _pubsub_session
+
 # --- Route for Pub/Sub Push ---
 @app.route('/', methods=['POST'])
 def process_pcap_notification():
@@ -103,94 +341,404 @@ def process_pcap_notification():
 
     active_storage_client = get_verified_storage_client()
     if not active_storage_client:
+        pipeline_metrics.count_error("gcs_client")
         return "Internal Server Error: GCS client/bucket issue.", 500
 
     envelope = request.get_json(silent=True)
     if not envelope:
         logging.error("Bad Request: No JSON payload.")
+        pipeline_metrics.count_error("bad_request")
         return "Bad Request: No JSON payload", 400 # No retry
 
     if not isinstance(envelope, dict) or "message" not in envelope:
         logging.error(f"Bad Request: Invalid Pub/Sub format: {envelope}")
+        pipeline_metrics.count_error("bad_request")
         return "Bad Request: Invalid Pub/Sub format", 400
 
     pubsub_message = envelope["message"]
     pcap_filename = ""
+    is_edge_udm = False
+    fanout_chunk = None # {"index", "count", "packets", "source_generation"} for a fan-out chunk notification
 
     if isinstance(pubsub_message, dict) and "data" in pubsub_message:
         try:
             pcap_filename = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
-            logging.info(f"Notification for pcap: {pcap_filename}")
+            pubsub_attributes = pubsub_message.get("attributes") or {}
+            is_edge_udm = pubsub_attributes.get("content") == "udm"
+            if pubsub_attributes.get("content") == "pcap_chunk":
+                fanout_chunk = {key: int(pubsub_attributes[attribute]) for key, attribute in
+                                (("index", "chunk_index"), ("count", "chunk_count"), ("packets", "chunk_packets"),
+                                 ("source_generation", "source_generation"))}
+                logging.info(f"Notification for pcap: {pcap_filename} (chunk {fanout_chunk['index'] + 1}/{fanout_chunk['count']})")
+            elif is_edge_udm:
+                logging.info(f"Notification for edge-converted UDM: {pcap_filename} (from {pubsub_attributes.get('sniffer_id', 'unknown sniffer')})")
+            else:
+                logging.info(f"Notification for pcap: {pcap_filename}")
         except Exception as e:
             logging.error(f"Error decoding Pub/Sub data: {e}", exc_info=True)
+            pipeline_metrics.count_error("bad_request")
             return "Bad Request: Cannot decode message data", 400
     else:
          logging.error(f"Bad Request: Invalid Pub/Sub structure: {pubsub_message}")
+         pipeline_metrics.count_error("bad_request")
          return "Bad Request: Invalid Pub/Sub structure", 400
 
     if not pcap_filename or '/' in pcap_filename: # Basic filename validation
         logging.error(f"Bad Request: Invalid pcap filename: '{pcap_filename}'")
+        pipeline_metrics.count_error("bad_request")
         return "Bad Request: Invalid pcap filename", 400
+    if is_edge_udm and not pcap_filename.endswith(EDGE_UDM_SUFFIX):
+        logging.error(f"Bad Request: Edge UDM notification for '{pcap_filename}', expected a *{EDGE_UDM_SUFFIX} object")
+        pipeline_metrics.count_error("bad_request")
+        return "Bad Request: Invalid UDM filename", 400
+
+    file_metrics = pipeline_metrics.FileMetrics(pcap_filename, publish_time=pubsub_message.get("publishTime"))
+    admission_ticket = None
+    processing_lease = None
 
     # --- Processing Steps ---
     with tempfile.TemporaryDirectory() as temp_dir:
         local_pcap_path = os.path.join(temp_dir, pcap_filename)
         local_json_path = os.path.join(temp_dir, pcap_filename + ".json") # tshark JSON output
         base_output_name = os.path.splitext(pcap_filename)[0]
-        udm_output_filename = f"{base_output_name}.udm.json" # Final UDM output name
+        udm_output_filename = json2udm_cloud.udm_output_filename(base_output_name, UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP) # Final UDM output name
         local_udm_path = os.path.join(temp_dir, udm_output_filename)
 
         try:
-            # 1. Download pcap from GCS
-            logging.info(f"Downloading gs://{INCOMING_BUCKET_NAME}/{pcap_filename} to {local_pcap_path}")
-            active_storage_client.bucket(INCOMING_BUCKET_NAME).blob(pcap_filename).download_to_filename(local_pcap_path)
-            logging.info(f"Download complete for {pcap_filename}.") # Confirmation for success metric
-
-            # 2. Convert pcap to JSON (tshark)
-            logging.info(f"Converting {local_pcap_path} to JSON...")
-            tshark_command = ["tshark", "-r", local_pcap_path, "-T", "json"]
-            with open(local_json_path, "w") as json_file:
-                process = subprocess.run(tshark_command, stdout=json_file, stderr=subprocess.PIPE, text=True, check=True)
-            logging.info(f"tshark conversion successful: {local_json_path}")
-            if process.stderr: logging.warning(f"tshark stderr: {process.stderr.strip()}")
-
-            # 3. Convert JSON to UDM (json2udm_cloud.py)
-            logging.info(f"Converting {local_json_path} to UDM: {local_udm_path}")
-            udm_script_command = ["python3", "/app/json2udm_cloud.py", local_json_path, local_udm_path]
-            process = subprocess.run(udm_script_command, capture_output=True, text=True, check=True)
-            logging.info(f"UDM conversion script done for {pcap_filename}.") # Confirmation
-            if process.stdout: logging.info(f"json2udm_cloud.py stdout: {process.stdout.strip()}")
-            if process.stderr: logging.warning(f"json2udm_cloud.py stderr: {process.stderr.strip()}")
+            # 0. Admission: the object size (metadata only) decides the mode and the temp bytes to reserve
+            if fanout_chunk: # The chunk object of a fanned-out capture; gone once the capture was merged
+                fanout_job_key = processing_ledger.ProcessingLedger.job_key(pcap_filename, fanout_chunk["source_generation"])
+                source_object_name = fanout.chunk_object_name(FANOUT_PREFIX, fanout_job_key, fanout_chunk["index"])
+            else:
+                source_object_name = pcap_filename
+            source_blob = active_storage_client.bucket(INCOMING_BUCKET_NAME).get_blob(source_object_name)
+            if source_blob is None:
+                raise google_api_exceptions.NotFound(f"gs://{INCOMING_BUCKET_NAME}/{source_object_name}")
+            source_generation = fanout_chunk["source_generation"] if fanout_chunk else source_blob.generation
+            output_object_name = pcap_filename if is_edge_udm else udm_output_filename
+            output_metadata = {"source_object": pcap_filename, "source_generation": str(source_generation)}
+            if ledger:
+                # Idempotency: skip redeliveries of finished files, leave files in progress to the delivery holding the lease
+                job_key = ledger.job_key(source_object_name, source_blob.generation)
+                if is_job_completed(active_storage_client, job_key, output_object_name, source_generation):
+                    logging.info(f"DUPLICATE_SKIPPED: completed FILE: {pcap_filename} (generation {source_blob.generation})")
+                    file_metrics.outcome = "duplicate"
+                    return Response(status=204) # Already done: ACK
+                processing_lease = ledger.acquire(job_key)
+                if processing_lease is None:
+                    logging.warning(f"DUPLICATE_SKIPPED: in_progress FILE: {pcap_filename} (generation {source_blob.generation})")
+                    file_metrics.outcome = "in_progress"
+                    return "Conflict: file is being processed by another delivery, retry later.", 409 # Redelivered with backoff
+                if ledger.completed_record(job_key) is not None: # Completed (and its lease deleted) since the check above
+                    logging.info(f"DUPLICATE_SKIPPED: completed FILE: {pcap_filename} (generation {source_blob.generation})")
+                    file_metrics.outcome = "duplicate"
+                    return Response(status=204) # Already done: ACK; the lease is released below
+            file_metrics.mode = "edge" if is_edge_udm else "chunk" if fanout_chunk else select_processing_mode(source_blob.size or 0)
+            admission_ticket = admission_controller.try_admit(estimate_temp_bytes(source_blob.size or 0, file_metrics.mode),
+                                                              pcap_filename)
+            if admission_ticket is None:
+                file_metrics.outcome = "rejected"
+                return "Too Many Requests: processor at capacity, retry later.", 429 # Pub/Sub redelivers with backoff
+
+            udm_output_ready = True # False when this notification did not produce the final UDM output (fan-out steps)
+            error_sample_stats = None # Conversion stats holding the file's sample of failing packets, if the mode returns them
+            if file_metrics.mode == "edge":
+                # 1-4. Converted on the sniffer: server-side copy (rewrite) into the output bucket, no tshark here
+                logging.info(f"Copying edge-converted gs://{INCOMING_BUCKET_NAME}/{pcap_filename} to gs://{OUTPUT_BUCKET_NAME}/{pcap_filename}")
+                check_lease(processing_lease, pcap_filename)
+                with file_metrics.stage("copy"):
+                    output_blob = active_storage_client.bucket(OUTPUT_BUCKET_NAME).blob(pcap_filename)
+                    output_blob.metadata = output_metadata # Sent as the destination's metadata, so set the content type too
+                    output_blob.content_type = source_blob.content_type
+                    rewrite_token = None
+                    while True: # Large or cross-location copies take several rewrite calls
+                        rewrite_token, _, _ = output_blob.rewrite(source_blob, token=rewrite_token)
+                        if rewrite_token is None:
+                            break
+                edge_stats = {key: int(value) for key, value in pubsub_attributes.items()
+                              if (key in EDGE_STATS_ATTRIBUTES or key.startswith(("dropped_", packet_errors.REASON_PREFIX)))
+                              and str(value).isdigit()}
+                edge_stats.setdefault("udm_output_bytes", source_blob.size or 0)
+                file_metrics.add_stats(edge_stats)
+                if "packets_processed" in edge_stats:
+                    json2udm_cloud.log_conversion_summary({**json2udm_cloud.new_conversion_stats(), **edge_stats}, pcap_filename)
+                logging.info(f"Upload complete for {pcap_filename}.") # Confirmation
+            elif file_metrics.mode == "fanout":
+                # 1. Download pcap from GCS
+                logging.info(f"Downloading gs://{INCOMING_BUCKET_NAME}/{pcap_filename} to {local_pcap_path}")
+                with file_metrics.stage("download"):
+                    source_blob.download_to_filename(local_pcap_path)
+                logging.info(f"Download complete for {pcap_filename}.") # Confirmation for success metric
+                pcap_size_bytes = os.path.getsize(local_pcap_path)
+                file_metrics.add_stats({"pcap_input_bytes": pcap_size_bytes})
+                logging.info(f"PCAP_INPUT_BYTES: {pcap_size_bytes} FILE: {pcap_filename}")
+
+                # 2. Split into chunks under FANOUT_PREFIX and publish one notification per chunk; the merge happens later
+                fanout_job_key = processing_ledger.ProcessingLedger.job_key(pcap_filename, source_blob.generation)
+                with file_metrics.stage("split"):
+                    chunk_count = fanout.split_and_upload(local_pcap_path, active_storage_client.bucket(INCOMING_BUCKET_NAME),
+                                                          FANOUT_PREFIX, fanout_job_key, FANOUT_CHUNK_PACKETS, temp_dir)
+                if chunk_count == 0: # No frames at all: nothing to fan out, write the empty output right here
+                    logging.warning(f"No frames in {pcap_filename}; writing an empty UDM output.")
+                    with open(local_udm_path, "wb") as f_udm:
+                        json2udm_cloud.write_udm_events((), f_udm, UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)
+                    check_lease(processing_lease, pcap_filename)
+                    output_blob = active_storage_client.bucket(OUTPUT_BUCKET_NAME).blob(udm_output_filename)
+                    output_blob.metadata = output_metadata
+                    output_blob.upload_from_filename(local_udm_path, content_type=UDM_CONTENT_TYPES[(UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)])
+                    logging.info(f"Upload complete for {udm_output_filename}.") # Confirmation
+                else:
+                    check_lease(processing_lease, pcap_filename)
+                    with file_metrics.stage("publish"):
+                        fanout.publish_chunk_messages(get_pubsub_session(), FANOUT_TOPIC, pcap_filename, source_blob.generation,
+                                                      chunk_count, FANOUT_CHUNK_PACKETS)
+                    file_metrics.add_stats({"chunks": chunk_count})
+                    logging.info(f"FANOUT_CHUNKS: {chunk_count} FILE: {pcap_filename}")
+                    udm_output_ready = False
+            elif file_metrics.mode == "chunk":
+                # 1. Download this chunk of a fanned-out capture
+                local_chunk_path = os.path.join(temp_dir, f"chunk-{fanout_chunk['index']:05d}.pcap")
+                logging.info(f"Downloading gs://{INCOMING_BUCKET_NAME}/{source_object_name} to {local_chunk_path}")
+                with file_metrics.stage("download"):
+                    source_blob.download_to_filename(local_chunk_path)
+                logging.info(f"Download complete for {pcap_filename}.") # Confirmation for success metric
+
+                # 2+3. Convert it (frame numbers of the original capture) and commit its part and done marker
+                output_bucket = active_storage_client.bucket(OUTPUT_BUCKET_NAME)
+                with file_metrics.stage("convert"):
+                    chunk_stats = fanout.convert_and_commit_chunk(
+                        local_chunk_path, output_bucket, FANOUT_PREFIX, fanout_job_key, fanout_chunk["index"],
+                        fanout_chunk["packets"], pcap_filename, process_pool_workers, UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP,
+                        TSHARK_INPUT_FORMAT, FLOW_SETTINGS)
+                file_metrics.add_stats(chunk_stats)
+                logging.info(f"UDM conversion done for {pcap_filename} chunk {fanout_chunk['index']}.") # Confirmation
+
+                # 4. The chunk that completes the set composes all parts into the UDM object
+                check_lease(processing_lease, pcap_filename)
+                with file_metrics.stage("upload"):
+                    output_blob = output_bucket.blob(udm_output_filename)
+                    output_blob.metadata = output_metadata
+                    output_blob.content_type = UDM_CONTENT_TYPES[(UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)]
+                    merged_stats = fanout.try_merge(active_storage_client.bucket(INCOMING_BUCKET_NAME), output_bucket,
+                                                    FANOUT_PREFIX, fanout_job_key, fanout_chunk["count"], output_blob,
+                                                    UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP, pcap_filename)
+                if merged_stats is not None: # Whole-capture counters were logged by the merge; FILE_METRICS keeps this chunk's
+                    logging.info(f"Upload complete for {udm_output_filename}.") # Confirmation
+                    error_sample_stats = merged_stats
+                udm_output_ready = merged_stats is not None
+            elif file_metrics.mode == "checkpointed":
+                # 1. Download pcap from GCS (a retry downloads it again, but only converts the frames not yet committed)
+                logging.info(f"Downloading gs://{INCOMING_BUCKET_NAME}/{pcap_filename} to {local_pcap_path}")
+                with file_metrics.stage("download"):
+                    source_blob.download_to_filename(local_pcap_path)
+                logging.info(f"Download complete for {pcap_filename}.") # Confirmation for success metric
+                pcap_size_bytes = os.path.getsize(local_pcap_path)
+                file_metrics.add_stats({"pcap_input_bytes": pcap_size_bytes})
+                logging.info(f"PCAP_INPUT_BYTES: {pcap_size_bytes} FILE: {pcap_filename}")
+
+                # 2+3. Convert frame ranges and commit each as a part under CHECKPOINT_PREFIX, resuming an earlier attempt
+                output_bucket = active_storage_client.bucket(OUTPUT_BUCKET_NAME)
+                checkpoint_job_key = processing_ledger.ProcessingLedger.job_key(pcap_filename, source_blob.generation)
+                logging.info(f"Converting {local_pcap_path} to UDM in checkpointed mode (parts of {CHECKPOINT_PART_PACKETS} packets): "
+                             f"gs://{OUTPUT_BUCKET_NAME}/{CHECKPOINT_PREFIX}{checkpoint_job_key}/")
+                with file_metrics.stage("convert"):
+                    checkpoint_manifest = checkpointed_convert.convert_with_checkpoints(
+                        local_pcap_path, output_bucket, CHECKPOINT_PREFIX, checkpoint_job_key, pcap_filename,
+                        process_pool_workers, CHECKPOINT_PART_PACKETS, UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP,
+                        TSHARK_INPUT_FORMAT, FLOW_SETTINGS)
+                logging.info(f"tshark conversion successful: {local_pcap_path} (checkpointed)")
+                logging.info(f"UDM conversion done for {pcap_filename}.") # Confirmation
+
+                # 4. Compose the parts into the UDM object (server-side, no upload of the whole output)
+                logging.info(f"Composing {len(checkpoint_manifest['parts'])} parts into gs://{OUTPUT_BUCKET_NAME}/{udm_output_filename}")
+                check_lease(processing_lease, pcap_filename)
+                with file_metrics.stage("upload"):
+                    output_blob = output_bucket.blob(udm_output_filename)
+                    output_blob.metadata = output_metadata
+                    output_blob.content_type = UDM_CONTENT_TYPES[(UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)]
+                    udm_output_bytes = checkpointed_convert.finalize_parts(output_bucket, checkpoint_manifest, CHECKPOINT_PREFIX,
+                                                                           checkpoint_job_key, output_blob)
+                file_metrics.add_stats({**checkpoint_manifest["stats"], "pcap_input_bytes": pcap_size_bytes,
+                                        "udm_output_bytes": udm_output_bytes})
+                error_sample_stats = checkpoint_manifest["stats"]
+                logging.info(f"Upload complete for {udm_output_filename}.") # Confirmation
+            elif file_metrics.mode == "overlapped":
+                # 1-4. GCS ranged reads -> tshark stdin -> UDM conversion -> resumable upload, all concurrently
+                logging.info(f"Streaming gs://{INCOMING_BUCKET_NAME}/{pcap_filename} through tshark to gs://{OUTPUT_BUCKET_NAME}/{udm_output_filename}")
+                output_blob = active_storage_client.bucket(OUTPUT_BUCKET_NAME).blob(udm_output_filename)
+                output_blob.metadata = output_metadata # Sent when the resumable upload is initiated
+                with file_metrics.stage("overlapped"):
+                    conversion_stats = pcap_pipeline.stream_blob_to_udm(
+                        source_blob, output_blob,
+                        pcap_filename, UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP, TSHARK_INPUT_FORMAT,
+                        content_type=UDM_CONTENT_TYPES[(UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)], flow_settings=FLOW_SETTINGS,
+                        before_finalize=lambda: check_lease(processing_lease, pcap_filename))
+                file_metrics.add_stats(conversion_stats)
+                error_sample_stats = conversion_stats
+                logging.info(f"Download complete for {pcap_filename}.") # Confirmation for success metric
+                logging.info(f"tshark conversion successful: gs://{INCOMING_BUCKET_NAME}/{pcap_filename} (overlapped)")
+                logging.info(f"Upload complete for {udm_output_filename}.") # Confirmation
+            else:
+                # 1. Download pcap from GCS
+                logging.info(f"Downloading gs://{INCOMING_BUCKET_NAME}/{pcap_filename} to {local_pcap_path}")
+                with file_metrics.stage("download"):
+                    source_blob.download_to_filename(local_pcap_path)
+                logging.info(f"Download complete for {pcap_filename}.") # Confirmation for success metric
+
+                pcap_size_bytes = os.path.getsize(local_pcap_path)
+                file_metrics.add_stats({"pcap_input_bytes": pcap_size_bytes})
+                if file_metrics.mode == "parallel":
+                    # 2+3. Split into frame-range chunks, convert them on PARALLEL_WORKERS cores, merge in frame order
+                    logging.info(f"Converting {local_pcap_path} to UDM in parallel mode ({PARALLEL_WORKERS} workers): {local_udm_path}")
+                    logging.info(f"PCAP_INPUT_BYTES: {pcap_size_bytes} FILE: {pcap_filename}")
+                    with file_metrics.stage("convert"):
+                        conversion_stats = parallel_convert.parallel_pcap_to_udm(
+                            local_pcap_path, local_udm_path, pcap_filename, process_pool_workers, PARALLEL_CHUNK_PACKETS,
+                            UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP, TSHARK_INPUT_FORMAT, FLOW_SETTINGS)
+                    file_metrics.add_stats(conversion_stats)
+                    error_sample_stats = conversion_stats
+                    logging.info(f"tshark conversion successful: {local_pcap_path} (parallel)")
+                    logging.info(f"UDM conversion done for {pcap_filename}.") # Confirmation
+                elif PROCESSING_MODE == "streaming":
+                    # 2+3. tshark stdout -> ijson -> UDM in a pool process (or this worker), no intermediate JSON file
+                    logging.info(f"Converting {local_pcap_path} to UDM in streaming mode: {local_udm_path}")
+                    logging.info(f"PCAP_INPUT_BYTES: {pcap_size_bytes} FILE: {pcap_filename}")
+                    with file_metrics.stage("convert"):
+                        if CONVERSION_POOL:
+                            conversion_stats = parallel_convert.pooled_pcap_to_udm(
+                                local_pcap_path, local_udm_path, pcap_filename, process_pool_workers,
+                                UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP, TSHARK_INPUT_FORMAT, FLOW_SETTINGS)
+                        else:
+                            conversion_stats = pcap_pipeline.stream_pcap_to_udm(local_pcap_path, local_udm_path, pcap_filename,
+                                                                                UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP, TSHARK_INPUT_FORMAT,
+                                                                                flow_settings=FLOW_SETTINGS)
+                    file_metrics.add_stats(conversion_stats)
+                    error_sample_stats = conversion_stats
+                    logging.info(f"tshark conversion successful: {local_pcap_path} (streamed)")
+                    logging.info(f"UDM conversion done for {pcap_filename}.") # Confirmation
+                else:
+                    with file_metrics.stage("convert"):
+                        # 2. Convert pcap to JSON (tshark)
+                        logging.info(f"Converting {local_pcap_path} to JSON...")
+                        tshark_command = pcap_pipeline.build_tshark_command(local_pcap_path, TSHARK_INPUT_FORMAT)
+                        with file_metrics.stage("tshark"), open(local_json_path, "w") as json_file:
+                            process = subprocess.run(tshark_command, stdout=json_file, stderr=subprocess.PIPE, text=True, check=True)
+                        logging.info(f"tshark conversion successful: {local_json_path}")
+                        if process.stderr: logging.warning(f"tshark stderr: {process.stderr.strip()}")
+                        file_metrics.add_stats({"tshark_output_bytes": os.path.getsize(local_json_path)})
+
+                        # 3. Convert JSON to UDM (json2udm_cloud.py)
+                        logging.info(f"Converting {local_json_path} to UDM: {local_udm_path}")
+                        if FAST_STARTUP: # Same conversion with the converter already loaded, not in a fresh interpreter
+                            with file_metrics.stage("udm_convert"):
+                                if CONVERSION_POOL: # In a pre-warmed pool worker
+                                    conversion_stats = parallel_convert.pooled_json_to_udm(
+                                        local_json_path, local_udm_path, process_pool_workers, UDM_OUTPUT_FORMAT,
+                                        UDM_OUTPUT_GZIP, TSHARK_INPUT_FORMAT, FLOW_SETTINGS)
+                                else: # In this process
+                                    conversion_stats, _ = json2udm_cloud.convert_tshark_output_file(
+                                        local_json_path, local_udm_path, UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP,
+                                        TSHARK_INPUT_FORMAT, FLOW_SETTINGS)
+                            logging.info(f"UDM conversion done for {pcap_filename} (preloaded converter).") # Confirmation
+                            file_metrics.add_stats(conversion_stats)
+                            error_sample_stats = conversion_stats
+                        else:
+                            udm_script_command = ["python3", UDM_SCRIPT_PATH, local_json_path, local_udm_path,
+                                                  "--format", UDM_OUTPUT_FORMAT, "--input-format", TSHARK_INPUT_FORMAT]
+                            if UDM_OUTPUT_GZIP: udm_script_command.append("--gzip")
+                            if FLOW_SETTINGS:
+                                udm_script_command += ["--flows", "--flow-idle-timeout", str(FLOW_SETTINGS["idle_timeout_seconds"]),
+                                                       "--flow-active-timeout", str(FLOW_SETTINGS["active_timeout_seconds"]),
+                                                       "--flow-max-entries", str(FLOW_SETTINGS["max_flows"])]
+                            with file_metrics.stage("udm_convert"):
+                                process = subprocess.run(udm_script_command, capture_output=True, text=True, check=True)
+                            logging.info(f"UDM conversion script done for {pcap_filename}.") # Confirmation
+                            if process.stdout: logging.info(f"json2udm_cloud.py stdout: {process.stdout.strip()}")
+                            if process.stderr: logging.warning(f"json2udm_cloud.py stderr: {process.stderr.strip()}")
+                            file_metrics.add_stats(pipeline_metrics.counters_from_log_text(process.stderr))
             
-            if not os.path.exists(local_udm_path) or os.path.getsize(local_udm_path) == 0:
-                logging.error(f"UDM file {local_udm_path} missing or empty post-conversion for {pcap_filename}.")
-                return "Internal Server Error: UDM generation failed.", 500 # Retry
+                # An empty capture legitimately yields an empty NDJSON file; a JSON array is never empty ("[]").
+                if not os.path.exists(local_udm_path) or (UDM_OUTPUT_FORMAT == "json" and not UDM_OUTPUT_GZIP and os.path.getsize(local_udm_path) == 0):
+                    logging.error(f"UDM file {local_udm_path} missing or empty post-conversion for {pcap_filename}.")
+                    file_metrics.record_error("empty_output")
+                    return "Internal Server Error: UDM generation failed.", 500 # Retry
 
-            # 4. Upload UDM JSON to GCS
-            logging.info(f"Uploading {local_udm_path} to gs://{OUTPUT_BUCKET_NAME}/{udm_output_filename}")
-            active_storage_client.bucket(OUTPUT_BUCKET_NAME).blob(udm_output_filename).upload_from_filename(local_udm_path)
-            logging.info(f"Upload complete for {udm_output_filename}.") # Confirmation
+                # 4. Upload UDM JSON to GCS
+                logging.info(f"Uploading {local_udm_path} to gs://{OUTPUT_BUCKET_NAME}/{udm_output_filename}")
+                file_metrics.add_stats({"udm_output_bytes": os.path.getsize(local_udm_path)})
+                check_lease(processing_lease, pcap_filename)
+                with file_metrics.stage("upload"):
+                    output_blob = active_storage_client.bucket(OUTPUT_BUCKET_NAME).blob(udm_output_filename)
+                    output_blob.metadata = output_metadata
+                    output_blob.upload_from_filename(local_udm_path, content_type=UDM_CONTENT_TYPES[(UDM_OUTPUT_FORMAT, UDM_OUTPUT_GZIP)])
+                logging.info(f"Upload complete for {udm_output_filename}.") # Confirmation
+
+            if file_metrics.mode != "edge" and udm_output_ready: # Edge files were converted (and sampled) on the sniffer
+                store_error_sample(active_storage_client, pcap_filename, local_udm_path, error_sample_stats)
+
+            # 5. Send the events to the Chronicle ingestion API (the output object stays the durable copy)
+            if chronicle is not None and udm_output_ready:
+                check_lease(processing_lease, pcap_filename)
+                with file_metrics.stage("send"):
+                    send_stats = send_udm_output_to_chronicle(active_storage_client, local_udm_path, output_object_name,
+                                                              pcap_filename, source_generation, is_edge_udm)
+                file_metrics.add_stats(send_stats)
 
             processing_end_time = datetime.now(timezone.utc)
             processing_duration_seconds = (processing_end_time - processing_start_time).total_seconds()
             logging.info(f"PROCESSING_DURATION_SECONDS: {processing_duration_seconds:.3f} FILE: {pcap_filename}")
 
+            check_lease(processing_lease, pcap_filename) # No completion marker from a delivery that lost its lease
             logging.info(f"Successfully processed {pcap_filename}")
+            file_metrics.outcome = "success"
             return Response(status=204) # OK, No Content for Pub/Sub ACK
 
+        except processing_ledger.LeaseLostError as e:
+            logging.warning(f"{e}; another delivery may be processing it. Not writing its output or completion marker.")
+            file_metrics.outcome = "lease_lost"
+            return "Conflict: processing lease lost to another delivery.", 409 # Redelivered; the completed job is then skipped
         except google_api_exceptions.NotFound:
              logging.error(f"Error: pcap gs://{INCOMING_BUCKET_NAME}/{pcap_filename} not found.", exc_info=False)
+             file_metrics.outcome = "not_found"
+             file_metrics.record_error("not_found")
              return Response(status=204) # ACK Pub/Sub (don't retry for non-existent file)
         except subprocess.CalledProcessError as e:
-            error_message = e.stderr.strip() if e.stderr else e.stdout.strip()
+            error_message = e.stderr.strip() if e.stderr else (e.stdout or "").strip()
             if "tshark" in ' '.join(e.cmd):
                  logging.error(f"Subprocess error (tshark): CMD: {' '.join(e.cmd)} ERR: {error_message}", exc_info=False)
+                 file_metrics.record_error("tshark")
             else: # Assumed UDM script error
                  logging.error(f"Subprocess error (json2udm): CMD: {' '.join(e.cmd)} ERR: {error_message}", exc_info=False)
+                 file_metrics.record_error("json2udm")
             return "Internal Server Error during processing step.", 500 # Retry
         except Exception as e:
             logging.error(f"Unexpected error processing {pcap_filename}: {e}", exc_info=True)
+            file_metrics.record_error(type(e).__name__)
             return "Internal Server Error", 500 # Retry
+        finally:
+            if admission_ticket is not None:
+                admission_controller.release(admission_ticket)
+            if processing_lease is not None:
+                try:
+                    if file_metrics.outcome == "success" and not processing_lease.lost:
+                        ledger.complete(processing_lease, {"output": output_object_name, "mode": file_metrics.mode})
+                    else:
+                        ledger.release(processing_lease) # Let the redelivery start right away
+                except Exception as e:
+                    logging.error(f"Failed to update the idempotency ledger for {pcap_filename}: {e}", exc_info=True)
+            file_metrics.emit() # One structured FILE_METRICS record per notification, whatever the outcome
+
+# --- Metrics Route (Prometheus text format) ---
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Per-instance stage/throughput aggregates for a Prometheus scraper; 404 unless METRICS_ENDPOINT is enabled."""
+    if not METRICS_ENDPOINT:
+        return "Not Found", 404
+    pool_lines = ["# HELP pcap_processor_pool_queue_depth Conversion jobs submitted to the process pool and not finished.",
+                  "# TYPE pcap_processor_pool_queue_depth gauge",
+                  f"pcap_processor_pool_queue_depth {parallel_convert.pool_queue_depth()}"]
+    return Response(pipeline_metrics.render_prometheus(admission_controller.prometheus_lines() + pool_lines),
+                    mimetype="text/plain; version=0.0.4")
 
 # --- Main Execution (for local development) ---
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+# sniffer/rotation_controller.py - Adaptive tshark rotation, driven by the observed traffic rate (ADAPTIVE_ROTATION).
+# A fixed ROTATE gives tiny files on a quiet link (one upload, publish, Cloud Run invocation and tshark start each)
+# and a flood of files on a busy one. With ADAPTIVE_ROTATION=true the uploader measures every closed rotation file
+# (packets, bytes, seconds it covered) and the time from its close to its notification, and keeps moving averages.
+# From them it derives the `-b duration:` / `-b filesize:` thresholds that hit ROTATION_TARGET_PACKETS per file:
+# - duration = target / packet rate, at least ROTATION_MIN_SECONDS and at most ROTATION_MAX_LATENCY_SECONDS minus
+#   the observed ship time, so a packet is notified within the latency budget even on a quiet link;
+# - filesize = target x bytes per packet (+10%, so it only fires first on a burst), within
+#   ROTATION_MIN_FILESIZE_KB..ROTATION_MAX_FILESIZE_KB;
+# - while more than ROTATION_BACKLOG_FILES files wait for upload, the target grows (up to 4x): fewer, larger files
+#   cut the per-file overhead that the uploads cannot keep up with.
+# A new setting is only applied when a threshold moves by more than ROTATION_CHANGE_THRESHOLD and the last change is
+# ROTATION_MIN_CHANGE_INTERVAL_SECONDS old. It is written to ROTATION_FILE as `-b filesize:<kb> -b duration:<s>`;
+# sniffer_entrypoint.sh restarts tshark with it (tshark cannot change its rotation while running).
+# Log lines: `ROTATION_OBSERVED: packets=... seconds=... packets_per_second=... FILE: <name>` per file and
+# `ROTATION_DECISION: duration=... filesize_kb=... reason=...` per applied change.
+
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+DEFAULT_ROTATE = "-b filesize:10240 -b duration:60" # As in sniffer_entrypoint.sh
+MAX_BACKLOG_SCALE = 4 # Largest growth of the per-file target while uploads lag behind
+FILESIZE_HEADROOM = 1.1 # The size threshold sits above the target, so duration decides unless traffic bursts
+RATE_SMOOTHING = 0.3 # Weight of the newest file in the moving averages
+ROTATE_PATTERN = re.compile(r"^-b filesize:(\d+) -b duration:(\d+)$")
+
+_PCAP_MAGICS = {b"\xd4\xc3\xb2\xa1": "<", b"\xa1\xb2\xc3\xd4": ">", b"\x4d\x3c\xb2\xa1": "<", b"\xa1\xb2\x3c\x4d": ">"}
+_PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+_PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+_PCAPNG_PACKET_BLOCKS = (2, 3, 6) # Obsolete, simple and enhanced packet blocks
+
+def count_capture_packets(capture_path):
+    """
+    Packets in a pcap / pcapng file, walking the record headers only. A damaged tail ends the count;
+    anything else than a capture counts 0.
+    """
+    with open(capture_path, "rb") as f_capture:
+        if os.fstat(f_capture.fileno()).st_size < 24:
+            return 0
+        with mmap.mmap(f_capture.fileno(), 0, access=mmap.ACCESS_READ) as capture_map:
+            end = len(capture_map)
+            packets = 0
+            if capture_map[:4] in _PCAP_MAGICS:
+                record_length = struct.Struct(_PCAP_MAGICS[capture_map[:4]] + "8xI4x")
+                position = 24
+                while position + 16 <= end:
+                    position += 16 + record_length.unpack_from(capture_map, position)[0]
+                    packets += position <= end
+                return packets
+            if struct.unpack_from("<I", capture_map, 0)[0] != _PCAPNG_SECTION_HEADER:
+                return 0
+            position, byte_order = 0, "<"
+            while position + 12 <= end:
+                block_type, = struct.unpack_from(byte_order + "I", capture_map, position)
+                if block_type == _PCAPNG_SECTION_HEADER:
+                    byte_order = "<" if struct.unpack_from("<I", capture_map, position + 8)[0] == _PCAPNG_BYTE_ORDER_MAGIC else ">"
+                block_length, = struct.unpack_from(byte_order + "I", capture_map, position + 4)
+                if block_length < 12 or position + block_length > end:
+                    break
+                packets += block_type in _PCAPNG_PACKET_BLOCKS
+                position += block_length
+            return packets
+
+def capture_started_at(capture_name):
+    """Epoch seconds tshark opened a ring file, from its name (`<base>_00001_20240101120000.pcap`, local time)."""
+    match = re.search(r"_(\d{14})\.pcap(ng)?$", capture_name)
+    if not match:
+        return None
+    return time.mktime(time.strptime(match.group(1), "%Y%m%d%H%M%S"))
+
+def parse_rotate(rotate):
+    """(filesize KB, duration seconds) of a ROTATE value; a missing threshold is None."""
+    filesize = re.search(r"filesize:(\d+)", rotate or "")
+    duration = re.search(r"duration:(\d+)", rotate or "")
+    return (int(filesize.group(1)) if filesize else None, int(duration.group(1)) if duration else None)
+
+def format_rotate(filesize_kb, duration_seconds):
+    return f"-b filesize:{filesize_kb} -b duration:{duration_seconds}"
+
+class RotationController:
+    """Moving averages of the observed rates and the rotation currently applied. Thread-safe."""
+    def __init__(self, rotation_file, current_rotate, target_packets=100000, max_latency_seconds=300.0, min_seconds=15,
+                 min_filesize_kb=1024, max_filesize_kb=102400, backlog_files=4, change_threshold=0.25,
+                 min_change_interval_seconds=300.0, clock=time.monotonic):
+        self.rotation_file = rotation_file
+        self.target_packets = target_packets
+        self.max_latency_seconds = max_latency_seconds
+        self.min_seconds = min_seconds
+        self.min_filesize_kb = min_filesize_kb
+        self.max_filesize_kb = max_filesize_kb
+        self.backlog_files = backlog_files
+        self.change_threshold = change_threshold
+        self.min_change_interval_seconds = min_change_interval_seconds
+        self.clock = clock
+        self.filesize_kb, self.duration_seconds = parse_rotate(current_rotate)
+        self.packets_per_second = None # Moving averages, None until the first file
+        self.bytes_per_second = None
+        self.ship_seconds = 0.0 # Close of a file to its published notification
+        self.last_change_at = None
+        self._lock = threading.Lock()
+
+    def _smooth(self, average, value):
+        return value if average is None else (1 - RATE_SMOOTHING) * average + RATE_SMOOTHING * value
+
+    def record_file(self, packets, capture_bytes, seconds):
+        """Adds one closed file to the rate averages."""
+        seconds = max(seconds, 1.0) # File names have a one-second resolution
+        with self._lock:
+            self.packets_per_second = self._smooth(self.packets_per_second, packets / seconds)
+            self.bytes_per_second = self._smooth(self.bytes_per_second, capture_bytes / seconds)
+
+    def record_shipped(self, seconds):
+        """Adds the time one file took from its close to its published notification."""
+        with self._lock:
+            self.ship_seconds = self._smooth(self.ship_seconds or None, seconds)
+
+    def observe_capture(self, capture_name, capture_path, closed_at):
+        """Measures a closed rotation file (`closed_at`: epoch seconds) and logs ROTATION_OBSERVED. False if unreadable."""
+        started_at = capture_started_at(capture_name)
+        try:
+            capture_bytes = os.path.getsize(capture_path)
+            packets = count_capture_packets(capture_path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Warning: Could not measure {capture_name} for the rotation controller: {e}")
+            return False
+        if started_at is None:
+            return False
+        seconds = max(closed_at - started_at, 1.0)
+        self.record_file(packets, capture_bytes, seconds)
+        logging.info(f"ROTATION_OBSERVED: packets={packets} bytes={capture_bytes} seconds={seconds:.0f} "
+                     f"packets_per_second={packets / seconds:.1f} bytes_per_second={capture_bytes / seconds:.0f} FILE: {capture_name}")
+        return True
+
+    def recommend(self, backlog_files):
+        """(filesize KB, duration seconds, reason) for the current averages, or None before the first file."""
+        with self._lock:
+            packets_per_second, bytes_per_second, ship_seconds = self.packets_per_second, self.bytes_per_second, self.ship_seconds
+        if not packets_per_second:
+            return None
+        scale = min(MAX_BACKLOG_SCALE, max(1.0, backlog_files / self.backlog_files)) if self.backlog_files else 1.0
+        target_packets = self.target_packets * scale
+        latency_budget = max(self.min_seconds, self.max_latency_seconds - ship_seconds)
+        wanted_seconds = target_packets / packets_per_second
+        duration_seconds = int(min(max(wanted_seconds, self.min_seconds), latency_budget))
+        wanted_kb = target_packets * bytes_per_second / packets_per_second * FILESIZE_HEADROOM / 1024
+        filesize_kb = int(min(max(math.ceil(wanted_kb), self.min_filesize_kb), self.max_filesize_kb))
+        if wanted_seconds > latency_budget:
+            reason = "latency" # Quiet link: files close on the latency budget, below the target
+        elif wanted_kb > self.max_filesize_kb:
+            reason = "filesize_cap"
+        elif wanted_seconds < self.min_seconds:
+            reason = "min_duration" # Busy link: the size threshold keeps files near the target
+        elif scale > 1:
+            reason = "backlog"
+        else:
+            reason = "rate"
+        return filesize_kb, duration_seconds, reason
+
+    def _moved_enough(self, current, proposed):
+        return current is None or abs(proposed - current) > self.change_threshold * current
+
+    def evaluate(self, backlog_files):
+        """Applies the recommended rotation if it differs enough from the current one. Returns the new ROTATE or None."""
+        recommendation = self.recommend(backlog_files)
+        if recommendation is None:
+            return None
+        filesize_kb, duration_seconds, reason = recommendation
+        now = self.clock()
+        with self._lock:
+            if self.last_change_at is not None and now - self.last_change_at < self.min_change_interval_seconds:
+                return None
+            if not (self._moved_enough(self.filesize_kb, filesize_kb) or self._moved_enough(self.duration_seconds, duration_seconds)):
+                return None
+            previous = format_rotate(self.filesize_kb, self.duration_seconds)
+            self.filesize_kb, self.duration_seconds, self.last_change_at = filesize_kb, duration_seconds, now
+            packets_per_second, bytes_per_second, ship_seconds = self.packets_per_second, self.bytes_per_second, self.ship_seconds
+        rotate = format_rotate(filesize_kb, duration_seconds)
+        if self.rotation_file:
+            with open(self.rotation_file + ".tmp", "w") as f_rotation:
+                f_rotation.write(rotate + "\n")
+            os.replace(self.rotation_file + ".tmp", self.rotation_file)
+        logging.info(f"ROTATION_DECISION: duration={duration_seconds} filesize_kb={filesize_kb} reason={reason} "
+                     f"packets_per_second={packets_per_second:.1f} bytes_per_second={bytes_per_second:.0f} "
+                     f"ship_seconds={ship_seconds:.1f} backlog={backlog_files} "
+                     f"expected_packets={min(duration_seconds * packets_per_second, filesize_kb * 1024 * packets_per_second / bytes_per_second):.0f} "
+                     f"(was: {previous})")
+        return rotate
+
+def controller_from_environment(capture_dir, rotate):
+    """The controller configured by ADAPTIVE_ROTATION / ROTATION_*, or None when adaptive rotation is off."""
+    if os.environ.get("ADAPTIVE_ROTATION", "false").strip().lower() not in ("1", "true", "yes"):
+        return None
+    rotation_file = os.environ.get("ROTATION_FILE", os.path.join(capture_dir, ".rotation"))
+    try: # The entrypoint starts tshark with an earlier decision if there is one
+        with open(rotation_file) as f_rotation:
+            applied_rotate = f_rotation.read().strip()
+        if ROTATE_PATTERN.match(applied_rotate):
+            rotate = applied_rotate
+    except OSError:
+        pass
+    controller = RotationController(
+        rotation_file, rotate or DEFAULT_ROTATE,
+        target_packets=int(os.environ.get("ROTATION_TARGET_PACKETS", "100000")),
+        max_latency_seconds=float(os.environ.get("ROTATION_MAX_LATENCY_SECONDS", "300")),
+        min_seconds=int(os.environ.get("ROTATION_MIN_SECONDS", "15")),
+        min_filesize_kb=int(os.environ.get("ROTATION_MIN_FILESIZE_KB", "1024")),
+        max_filesize_kb=int(os.environ.get("ROTATION_MAX_FILESIZE_KB", "102400")),
+        backlog_files=int(os.environ.get("ROTATION_BACKLOG_FILES", "4")),
+        change_threshold=float(os.environ.get("ROTATION_CHANGE_THRESHOLD", "0.25")),
+        min_change_interval_seconds=float(os.environ.get("ROTATION_MIN_CHANGE_INTERVAL_SECONDS", "300")))
+    logging.info(f"Adaptive rotation enabled: target {controller.target_packets} packets per file, latency budget "
+                 f"{controller.max_latency_seconds:.0f}s, starting from '{format_rotate(controller.filesize_kb, controller.duration_seconds)}'.")
+    return controller
@@ -1,6 +1,9 @@
 #!/bin/bash
 # sniffer/sniffer_entrypoint.sh - Captures network traffic, uploads to GCS, and notifies Pub/Sub.
 # This script runs inside a Docker container, typically on premises or an edge device.
+# Uploads and notifications are handled by uploader.py (inotify-driven, concurrent uploads, batched publishes).
+# With ADAPTIVE_ROTATION=true the uploader picks the rotation thresholds from the observed traffic and writes them to
+# ROTATION_FILE; the supervision loop restarts tshark with them (tshark cannot change its rotation while running).
 
 # --- Configuration (from Environment Variables) ---
 GCP_PROJECT_ID="${GCP_PROJECT_ID}"                # GCP Project ID
@@ -14,8 +17,14 @@ INTERFACE=""                                      # Network interface for captur
 INTERFACE_NAME_ONLY="unknown-interface"           # To store just the name of the interface
 ROTATE="${ROTATE:-"-b filesize:10240 -b duration:60"}" # tshark rotation params (e.g., 10MB or 60s)
 LIMITS="${LIMITS:-}"                              # Other tshark limits (e.g., -c packet_count)
-CAPTURE_DIR="/app/captures"                       # Local directory for storing .pcap files
-FILENAME_BASE="capture"                           # Base for .pcap filenames (e.g., capture_00001_timestamp.pcap)
+CAPTURE_FILTER="${CAPTURE_FILTER:-}"              # BPF capture filter (e.g., "not arp and not port 22"); empty captures everything
+SNAPLEN="${SNAPLEN:-}"                            # Bytes kept per packet (e.g., 256 keeps headers only); empty = tshark default
+CAPTURE_DIR="${CAPTURE_DIR:-/app/captures}"       # Local directory for storing .pcap files
+FILENAME_BASE="${FILENAME_BASE:-capture}"         # Base for .pcap filenames (e.g., capture_00001_timestamp.pcap)
+ADAPTIVE_ROTATION="${ADAPTIVE_ROTATION:-false}"   # true: rotation thresholds follow the traffic rate (ROTATE is the start value)
+ROTATION_FILE="${ROTATION_FILE:-$CAPTURE_DIR/.rotation}" # Rotation chosen by the uploader's controller
+TSHARK_PID_FILE="/tmp/tshark.pid"                 # Current tshark PID, for the heartbeat (tshark may be restarted)
+UPLOADER_READY_FILE="/tmp/uploader.ready"         # Written by uploader.py once its startup scan is done
 
 # --- Validate Configuration & Setup ---
 echo "--- Sniffer Container Starting (ID: $SNIFFER_ID) ---"
@@ -32,18 +41,11 @@ if [ ! -f "$GCP_KEY_FILE" ]; then
 fi
 # Verify required tools are installed.
 if ! command -v tshark &> /dev/null; then echo "Error: tshark not found."; exit 1; fi
-if ! command -v gcloud &> /dev/null; then echo "Error: gcloud not found."; exit 1; fi
-if ! command -v stat &> /dev/null; then echo "Error: stat not found."; exit 1; fi
-if ! command -v lsof &> /dev/null; then echo "Error: lsof not found (required from procps package)."; exit 1; fi
+if ! command -v python3 &> /dev/null; then echo "Error: python3 not found (required by uploader.py)."; exit 1; fi
+if ! python3 -c "import google.cloud.storage" &> /dev/null; then echo "Error: google-cloud-storage Python package not found."; exit 1; fi
+export GCP_KEY_FILE CAPTURE_DIR FILENAME_BASE ROTATE ADAPTIVE_ROTATION ROTATION_FILE UPLOADER_READY_FILE # Shared with uploader.py
 
 
-# Activate Service Account using the provided key file for gcloud operations.
-echo "(ID: $SNIFFER_ID) Activating Service Account using key $GCP_KEY_FILE..."
-gcloud auth activate-service-account --key-file="$GCP_KEY_FILE" --project="$GCP_PROJECT_ID"
-if [ $? -ne 0 ]; then echo "Error (ID: $SNIFFER_ID): Failed to activate service account."; exit 1; fi
-echo "(ID: $SNIFFER_ID) Service Account activated."
-gcloud auth list # Display active gcloud account for verification.
-
 # Auto-detect active network interface if not explicitly set.
 # This loop tries to find a suitable non-loopback, non-docker, etc., interface that is 'up'.
 if [ -z "$INTERFACE" ]; then # Only auto-detect if INTERFACE is not already set by env var
@@ -81,10 +83,46 @@ else
 fi
 
 
+# Capture filter and snap length, as an array so a multi-word BPF expression stays one argument.
+# Packets rejected by the BPF filter never reach the capture file: they are not counted anywhere downstream.
+CAPTURE_OPTIONS=()
+if [ -n "$CAPTURE_FILTER" ]; then
+    # Fail fast on a filter the kernel cannot compile, instead of a tshark that exits on every restart.
+    if command -v dumpcap &> /dev/null && ! dumpcap $INTERFACE -f "$CAPTURE_FILTER" -d > /dev/null 2>&1; then
+        echo "Error (ID: $SNIFFER_ID): CAPTURE_FILTER '$CAPTURE_FILTER' is not a valid capture filter for $INTERFACE_NAME_ONLY."
+        exit 1
+    fi
+    CAPTURE_OPTIONS+=(-f "$CAPTURE_FILTER")
+fi
+if [ -n "$SNAPLEN" ]; then
+    if ! [[ "$SNAPLEN" =~ ^[0-9]+$ ]]; then
+        echo "Error (ID: $SNIFFER_ID): SNAPLEN must be a number of bytes, got '$SNAPLEN'."
+        exit 1
+    fi
+    CAPTURE_OPTIONS+=(-s "$SNAPLEN")
+fi
+
+
+# Rotation chosen by the adaptive controller, if adaptive rotation is on and a valid one was written (also by an
+# earlier run: the container starts with the thresholds that fit the traffic last seen).
+adaptive_rotation() {
+    local rotation
+    [[ "$ADAPTIVE_ROTATION" =~ ^(1|true|yes)$ ]] || return 1
+    rotation=$(head -n 1 "$ROTATION_FILE" 2>/dev/null) || return 1
+    [[ "$rotation" =~ ^-b\ filesize:[0-9]+\ -b\ duration:[0-9]+$ ]] || return 1
+    echo "$rotation"
+}
+if applied_rotation=$(adaptive_rotation); then
+    ROTATE="$applied_rotation"
+fi
+
+
 # --- Capture and Process Loop ---
 echo "(ID: $SNIFFER_ID) Starting tshark capture..."
 echo "(ID: $SNIFFER_ID)   Interface: $INTERFACE_NAME_ONLY ($INTERFACE)"
 echo "(ID: $SNIFFER_ID)   Rotation: $ROTATE"
+echo "(ID: $SNIFFER_ID)   Capture filter: ${CAPTURE_FILTER:-none}"
+echo "(ID: $SNIFFER_ID)   Snap length: ${SNAPLEN:-default}"
 echo "(ID: $SNIFFER_ID)   Output Dir: $CAPTURE_DIR"
 echo "(ID: $SNIFFER_ID)   GCS Bucket: gs://${INCOMING_BUCKET}"
 echo "(ID: $SNIFFER_ID)   Pub/Sub Topic: ${PUBSUB_TOPIC_ID}"
@@ -94,7 +132,9 @@ send_heartbeat() {
     while true; do
         # Log current tshark status along with heartbeat
         local tshark_status="stopped"
-        if kill -0 $TSHARK_PID 2>/dev/null; then # Check if tshark process exists
+        local TSHARK_PID
+        TSHARK_PID=$(cat "$TSHARK_PID_FILE" 2>/dev/null)
+        if [ -n "$TSHARK_PID" ] && kill -0 $TSHARK_PID 2>/dev/null; then # Check if tshark process exists
             tshark_status="running"
         fi
         echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) (IFACE: $INTERFACE_NAME_ONLY) Heartbeat. tshark PID: $TSHARK_PID (Status: $tshark_status)"
@@ -103,34 +143,39 @@ send_heartbeat() {
     done
 }
 
+# Start the uploader first: it uploads files left over from a previous run, then watches for rotations.
+# tshark must not start before the uploader's startup scan is done: the scan ships every capture file it finds,
+# and a file tshark had already begun writing would be uploaded half-written and then deleted under it.
+rm -f "$UPLOADER_READY_FILE"
+python3 /app/uploader.py &
+UPLOADER_PID=$!
+echo "(ID: $SNIFFER_ID) Uploader started with PID $UPLOADER_PID, waiting for its startup scan..."
+while [ ! -f "$UPLOADER_READY_FILE" ]; do
+    if ! kill -0 $UPLOADER_PID 2>/dev/null; then
+        echo "Error (ID: $SNIFFER_ID): uploader (PID: $UPLOADER_PID) exited during startup."
+        exit 1
+    fi
+    sleep 0.2
+done
+
 # Start tshark in the background to capture packets.
-# It will rotate files based on $ROTATE parameters.
-tshark $INTERFACE $ROTATE $LIMITS -w "$CAPTURE_DIR/$FILENAME_BASE.pcap" &
-TSHARK_PID=$! # Store tshark's Process ID.
-echo "(ID: $SNIFFER_ID) tshark started with PID $TSHARK_PID"
-sleep 5 # Give tshark a moment to start and potentially create its first file.
+# It will rotate files based on $ROTATE parameters; each file it closes is picked up by the uploader.
+start_tshark() {
+    tshark $INTERFACE "${CAPTURE_OPTIONS[@]}" $ROTATE $LIMITS -w "$CAPTURE_DIR/$FILENAME_BASE.pcap" &
+    TSHARK_PID=$! # Store tshark's Process ID.
+    echo "$TSHARK_PID" > "$TSHARK_PID_FILE"
+    echo "(ID: $SNIFFER_ID) tshark started with PID $TSHARK_PID (rotation: $ROTATE)"
+}
+start_tshark
 
 # Start heartbeat in background
 send_heartbeat &
 HEARTBEAT_PID=$!
 
-processed_files=() # Array to keep track of files already uploaded/notified.
-
-# Helper function to check if a file is already in the processed_files array.
-is_processed() {
-  local file_to_check="$1"
-  for item in "${processed_files[@]}"; do
-    if [[ "$item" == "$file_to_check" ]]; then
-      return 0 # 0 for true (found)
-    fi
-  done
-  return 1 # 1 for false (not found)
-}
-
 # Graceful shutdown function
 graceful_shutdown() {
-  echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Received termination signal. Shutting down tshark and heartbeat..."
-  # Terminate tshark process
+  echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Received termination signal. Shutting down tshark, uploader and heartbeat..."
+  # Terminate tshark first, so the file it is writing gets closed and is still uploaded.
   if kill -0 $TSHARK_PID 2>/dev/null; then
     echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Sending SIGTERM to tshark (PID: $TSHARK_PID)..."
     kill -TERM $TSHARK_PID
@@ -139,6 +184,12 @@ graceful_shutdown() {
   else
     echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) tshark (PID: $TSHARK_PID) already stopped."
   fi
+  # The uploader drains pending uploads and notifications (bounded by UPLOAD_DRAIN_TIMEOUT_SECONDS) before exiting.
+  if kill -0 $UPLOADER_PID 2>/dev/null; then
+    echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Sending SIGTERM to uploader (PID: $UPLOADER_PID)..."
+    kill -TERM $UPLOADER_PID
+    wait $UPLOADER_PID
+  fi
   # Terminate heartbeat process
   if kill -0 $HEARTBEAT_PID 2>/dev/null; then
     echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Sending SIGTERM to heartbeat (PID: $HEARTBEAT_PID)..."
@@ -151,63 +202,25 @@ graceful_shutdown() {
 # Trap SIGINT (Ctrl+C) and SIGTERM (docker stop) to call graceful_shutdown
 trap graceful_shutdown SIGINT SIGTERM
 
-# Main loop: monitors tshark and processes completed capture files.
-# Loop continues as long as the tshark process is running.
+# Main loop: only supervises. The uploader reacts to closed rotation files itself.
 while kill -0 $TSHARK_PID 2>/dev/null; do
-    # Attempt to identify the file tshark is currently writing to.
-    # This helps avoid processing the active capture file prematurely.
-    # Filter by process ID and ensure the file is within our CAPTURE_DIR and ends with .pcap or .pcapng
-    active_file_path=$(lsof -p $TSHARK_PID -Fn 2>/dev/null | grep '^n' | cut -c2- | grep "^${CAPTURE_DIR}/.*\.pcap*" | head -n 1)
-    active_file=$(basename "$active_file_path" 2>/dev/null) # Extract just the filename.
-
-    # Find all .pcap or .pcapng files in the capture directory matching the base name.
-    # The ".pcap*" wildcard covers both .pcap and .pcapng extensions.
-    find "$CAPTURE_DIR" -maxdepth 1 -name "${FILENAME_BASE}_*.pcap*" -type f | while read -r pcap_file_path; do
-        current_pcap_file_basename=$(basename "$pcap_file_path")
-
-        # Skip if this is the file tshark is currently writing to.
-        if [[ -n "$active_file" && "$current_pcap_file_basename" == "$active_file" ]]; then
-            # echo "[DEBUG] Skipping active file: $current_pcap_file_basename" # Optional debug
-            continue
-        fi
-        # Skip if this file has already been processed.
-        if is_processed "$current_pcap_file_basename" "${processed_files[@]}"; then
-            # echo "[DEBUG] Skipping already processed file: $current_pcap_file_basename" # Optional debug
-            continue
-        fi
-
-        echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Detected completed file: $current_pcap_file_basename"
-        
-        # Get file size
-        file_size_bytes=$(stat -c%s "$pcap_file_path")
-        echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) PCAP_SIZE_BYTES: $file_size_bytes FILE: $current_pcap_file_basename"
-
-        # 1. Upload the completed .pcap file to Google Cloud Storage.
-        echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Uploading $current_pcap_file_basename to gs://${INCOMING_BUCKET}/..."
-        if gcloud storage cp "$pcap_file_path" "gs://${INCOMING_BUCKET}/" --project "$GCP_PROJECT_ID"; then
-            echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Upload successful for $current_pcap_file_basename."
-
-            # 2. Publish a notification to Pub/Sub with the filename.
-            echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Publishing notification for $current_pcap_file_basename to ${PUBSUB_TOPIC_ID}..."
-            if gcloud pubsub topics publish "$PUBSUB_TOPIC_ID" --message "$current_pcap_file_basename" --project "$GCP_PROJECT_ID"; then
-                echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Notification published successfully for $current_pcap_file_basename."
-                processed_files+=("$current_pcap_file_basename") # Add to processed list.
-                # 3. Remove the local .pcap file after successful upload and notification.
-                rm "$pcap_file_path"
-                echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Removed local file: $pcap_file_path"
-            else
-                echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Error: Failed to publish notification for $current_pcap_file_basename. Will retry." # Log for Pub/Sub publish error metric
-                # File is not removed or added to processed_files, will retry on next loop iteration.
-            fi
-        else
-            echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Error: Failed to upload $current_pcap_file_basename to GCS. Will retry."
-            # Upload failed; will retry on next loop iteration.
-        fi
-    done
-    sleep 10 # Wait before checking for new completed files again.
+    if ! kill -0 $UPLOADER_PID 2>/dev/null; then
+        echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) Error: uploader (PID: $UPLOADER_PID) exited. Initiating shutdown..."
+        break
+    fi
+    # New rotation from the adaptive controller: stop tshark (it closes its current file, which the uploader ships)
+    # and start it again with the new thresholds. Packets arriving during the restart (about a second) are not captured.
+    if applied_rotation=$(adaptive_rotation) && [ "$applied_rotation" != "$ROTATE" ]; then
+        echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) ROTATION_RESTART: '$ROTATE' -> '$applied_rotation'. Restarting tshark (PID: $TSHARK_PID)..."
+        kill -TERM $TSHARK_PID
+        wait $TSHARK_PID
+        ROTATE="$applied_rotation"
+        start_tshark
+    fi
+    sleep 5 & wait $! # Interruptible by the trap
 done
 
-echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) tshark process (PID: $TSHARK_PID) appears to have ended. Initiating shutdown..."
-graceful_shutdown # Call graceful shutdown if tshark loop exits
+echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] (ID: $SNIFFER_ID) tshark or uploader process appears to have ended. Initiating shutdown..."
+graceful_shutdown # Call graceful shutdown if the supervision loop exits
 
 echo "[$(date +'%Y-%m-%dT%H:%M:%SZ')] --- Sniffer Container (ID: $SNIFFER_ID) Finished ---"
\ No newline at end of file
@@ -0,0 +1,541 @@
+# sniffer/uploader.py - Uploads closed tshark rotation files to GCS and notifies Pub/Sub (replaces the polling loop).
+# Started in the background by sniffer_entrypoint.sh, which starts tshark only once UPLOADER_READY_FILE exists. Instead of polling the capture dir with lsof/find
+# and spawning `gcloud storage cp` / `gcloud pubsub topics publish` per file:
+# - rotation files are detected through inotify IN_CLOSE_WRITE (tshark closes a file when it rotates), so the file
+#   tshark is still writing is never picked up; IN_MOVED_TO covers files moved into the directory,
+# - uploads run on a thread pool that shares ONE authorized HTTP session (connection pool sized to the workers),
+# - notifications (message data = the filename, as before) are batched into one Pub/Sub REST publish call,
+# - a ledger file in the capture dir records uploaded / notified files, so a restart neither re-uploads nor
+#   forgets a file whose notification had not gone out yet. Membership checks are O(1) set lookups.
+# Failed uploads / publishes are retried with exponential backoff. Log lines keep the format of the former bash loop
+# ("[ts] (ID: x) Upload successful for ...", "Error: Failed to upload ...", ...) that the log-based metrics match.
+# EDGE_CONVERSION=true converts each closed rotation file on the sniffer with the processor's own modules
+# (pcap_pipeline.stream_pcap_to_udm -> json2udm_cloud, copied into the image), uploads the gzip NDJSON UDM instead
+# of the pcap and flags the notification with the attribute `content=udm`; the processor then only copies the object
+# into the output bucket. Raw pcaps are uploaded as well (under raw/, without notification) only if KEEP_RAW_PCAPS.
+# ADAPTIVE_ROTATION=true measures every closed rotation file and the time it takes to ship, and lets
+# rotation_controller.py choose tshark's rotation thresholds (applied by sniffer_entrypoint.sh, see the readme).
+
+import base64
+import ctypes
+import ctypes.util
+import heapq
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import google.auth
+from google.api_core import exceptions as google_api_exceptions
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+
+import rotation_controller
+
+# The shared converter modules sit next to this file in the image and in ../processor in a source checkout.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "processor"))
+
+# --- Configuration (from Environment Variables, same names as sniffer_entrypoint.sh) ---
+GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
+INCOMING_BUCKET = os.environ.get("INCOMING_BUCKET")
+PUBSUB_TOPIC_ID = os.environ.get("PUBSUB_TOPIC_ID")
+GCP_KEY_FILE = os.environ.get("GCP_KEY_FILE", "/app/gcp-key/key.json")
+SNIFFER_ID = os.environ.get("SNIFFER_ID", "unknown-sniffer")
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "/app/captures")
+FILENAME_BASE = os.environ.get("FILENAME_BASE", "capture")
+ROTATE = os.environ.get("ROTATE", rotation_controller.DEFAULT_ROTATE) # Exported by sniffer_entrypoint.sh
+UPLOADER_READY_FILE = os.environ.get("UPLOADER_READY_FILE") # Written after the startup scan (exported by the entrypoint)
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4")) # Concurrent uploads
+UPLOAD_LEDGER = os.environ.get("UPLOAD_LEDGER", os.path.join(CAPTURE_DIR, ".uploaded"))
+PUBLISH_BATCH_MAX_MESSAGES = int(os.environ.get("PUBLISH_BATCH_MAX_MESSAGES", "100"))
+PUBLISH_BATCH_MAX_LATENCY_SECONDS = float(os.environ.get("PUBLISH_BATCH_MAX_LATENCY_SECONDS", "1"))
+RETRY_MAX_BACKOFF_SECONDS = float(os.environ.get("RETRY_MAX_BACKOFF_SECONDS", "300"))
+STATUS_INTERVAL_SECONDS = float(os.environ.get("UPLOAD_STATUS_INTERVAL_SECONDS", "60"))
+DRAIN_TIMEOUT_SECONDS = float(os.environ.get("UPLOAD_DRAIN_TIMEOUT_SECONDS", "120")) # On SIGTERM
+EDGE_CONVERSION = os.environ.get("EDGE_CONVERSION", "false").strip().lower() in ("1", "true", "yes") # Ship UDM, not pcaps
+EDGE_CONVERT_WORKERS = int(os.environ.get("EDGE_CONVERT_WORKERS", "1")) # Conversion processes (each also runs a tshark)
+EDGE_CONVERT_MAX_ATTEMPTS = int(os.environ.get("EDGE_CONVERT_MAX_ATTEMPTS", "3")) # Then the raw pcap is shipped instead
+TSHARK_PROJECTION = os.environ.get("TSHARK_PROJECTION", "false").strip().lower() in ("1", "true", "yes") # As in the processor
+KEEP_RAW_PCAPS = os.environ.get("KEEP_RAW_PCAPS", "false").strip().lower() in ("1", "true", "yes") # Debug: also upload raw/<pcap>
+UDM_DIR = os.path.join(CAPTURE_DIR, "udm") # Converted files waiting for upload (not watched)
+RAW_PCAP_PREFIX = "raw/"
+EDGE_STATS_ATTRIBUTES = ("packets_processed", "packet_errors", "timestamp_fallbacks", "pcap_input_bytes", "udm_output_bytes",
+                         "packets_dropped") # Forwarded as notification attributes (as the processor reads them)
+
+PUBSUB_API_ROOT = "https://pubsub.googleapis.com/v1"
+CAPTURE_FILE_PATTERN = re.compile(rf"^{re.escape(FILENAME_BASE)}_.*\.pcap(ng)?$")
+
+# inotify(7) constants and `struct inotify_event` header (int wd; uint32 mask, cookie, len; char name[len])
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                    format=f"[%(asctime)s] (ID: {SNIFFER_ID}) %(message)s", datefmt="%Y-%m-%dT%H:%M:%SZ")
+logging.Formatter.converter = time.gmtime
+
+def open_inotify(directory, mask):
+    """inotify fd watching `directory` (through libc via ctypes, no third-party watcher). None if unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        inotify_fd = libc.inotify_init1(IN_CLOEXEC)
+        if inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(directory), mask) < 0:
+            os.close(inotify_fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        return inotify_fd
+    except (AttributeError, OSError) as e:
+        logging.warning(f"Warning: inotify unavailable ({e}); falling back to directory scans.")
+        return None
+
+def read_inotify_events(inotify_fd):
+    """Reads the pending events. Returns (file names, overflowed)."""
+    buffer = os.read(inotify_fd, 64 * 1024)
+    names, overflowed, offset = [], False, 0
+    while offset < len(buffer):
+        _, mask, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+        offset += INOTIFY_EVENT_HEADER.size
+        if mask & IN_Q_OVERFLOW:
+            overflowed = True
+        elif name_length:
+            names.append(os.fsdecode(buffer[offset:offset + name_length].rstrip(b"\0")))
+        offset += name_length
+    return names, overflowed
+
+def udm_object_name(capture_name):
+    """Object name of a capture's edge-converted UDM (the processor's naming, NDJSON + gzip)."""
+    return os.path.splitext(capture_name)[0] + ".udm.ndjson.gz"
+
+def convert_capture(pcap_path, udm_path, capture_name):
+    """
+    Runs in a conversion pool process: tshark + the shared json2udm_cloud mapper, exactly as the processor's
+    streaming mode does. Returns the conversion stats (plain ints, picklable).
+    """
+    import pcap_pipeline # Only needed in edge mode
+    stats = pcap_pipeline.stream_pcap_to_udm(pcap_path, udm_path, capture_name, "ndjson", True,
+                                             "ek" if TSHARK_PROJECTION else "json")
+    stats["pcap_input_bytes"] = os.path.getsize(pcap_path)
+    return {key: value for key, value in stats.items() if isinstance(value, int)}
+
+def list_capture_files(skip_newest):
+    """
+    Capture files in CAPTURE_DIR, oldest first, so with `skip_newest` the last one - the file tshark may still be
+    writing - is left out. Ordered by modification time: tshark numbers its ring files (capture_00001_<ts>.pcap, ...)
+    from 1 again whenever it is restarted (e.g. with a new rotation), so the names alone do not give the order.
+    """
+    modified = {}
+    for name in os.listdir(CAPTURE_DIR):
+        if CAPTURE_FILE_PATTERN.match(name):
+            try:
+                modified[name] = os.path.getmtime(os.path.join(CAPTURE_DIR, name))
+            except OSError:
+                pass # Uploaded and removed meanwhile
+    capture_files = sorted(modified, key=lambda name: (modified[name], name))
+    return capture_files[:-1] if skip_newest and capture_files else capture_files
+
+class UploadLedger:
+    """
+    Persistent record of files already uploaded (`U <name>`) and notified (`N <name>`), one line per transition.
+    Rewritten compactly at startup with only the entries whose local file still exists.
+    """
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        self.uploaded = set()
+        self.notified = set()
+        self._lock = threading.Lock()
+        if os.path.exists(ledger_path):
+            with open(ledger_path) as f_ledger:
+                for line in f_ledger:
+                    state, _, name = line.rstrip("\n").partition(" ")
+                    (self.notified if state == "N" else self.uploaded).add(name)
+        self.uploaded -= self.notified
+        existing_files = set(os.listdir(CAPTURE_DIR))
+        self.uploaded &= existing_files
+        self.notified &= existing_files
+        with open(ledger_path + ".tmp", "w") as f_compact:
+            f_compact.writelines([f"U {name}\n" for name in sorted(self.uploaded)] + [f"N {name}\n" for name in sorted(self.notified)])
+        os.replace(ledger_path + ".tmp", ledger_path)
+        self._f_ledger = open(ledger_path, "a")
+
+    def _append(self, state, name):
+        self._f_ledger.write(f"{state} {name}\n")
+        self._f_ledger.flush()
+
+    def mark_uploaded(self, name):
+        with self._lock:
+            self.uploaded.add(name)
+            self._append("U", name)
+
+    def mark_notified(self, name):
+        with self._lock:
+            self.uploaded.discard(name)
+            self.notified.add(name)
+            self._append("N", name)
+
+    def forget(self, name):
+        """The local file is gone; its name cannot be detected again."""
+        with self._lock:
+            self.notified.discard(name)
+
+class NotificationBatcher:
+    """
+    Collects filenames and publishes them in batches (up to PUBLISH_BATCH_MAX_MESSAGES per call, at most
+    PUBLISH_BATCH_MAX_LATENCY_SECONDS after the first one) through the Pub/Sub REST API on the shared session.
+    """
+    def __init__(self, session, topic_path, build_message, on_published, on_failed):
+        self.session = session
+        self.build_message = build_message
+        self.publish_url = f"{PUBSUB_API_ROOT}/{topic_path}:publish"
+        self.on_published = on_published
+        self.on_failed = on_failed
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="pubsub-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, name):
+        self.pending.put(name)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join(DRAIN_TIMEOUT_SECONDS)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            first_name = self.pending.get()
+            if first_name is None:
+                break
+            batch, deadline = [first_name], time.monotonic() + PUBLISH_BATCH_MAX_LATENCY_SECONDS
+            while len(batch) < PUBLISH_BATCH_MAX_MESSAGES:
+                try:
+                    name = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if name is None:
+                    closing = True
+                    break
+                batch.append(name)
+            self._publish(batch)
+
+    def _publish(self, batch):
+        for name in batch:
+            logging.info(f"Publishing notification for {name} to {PUBSUB_TOPIC_ID}...")
+        messages = [self.build_message(name) for name in batch]
+        try:
+            response = self.session.post(self.publish_url, json={"messages": messages}, timeout=60)
+            response.raise_for_status()
+        except Exception as e:
+            for name in batch:
+                logging.error(f"Error: Failed to publish notification for {name}. Will retry. ({e})")
+                self.on_failed(name)
+            return
+        logging.info(f"PUBSUB_BATCH_PUBLISHED: {len(batch)} messages")
+        for name in batch:
+            self.on_published(name)
+
+class CaptureUploader:
+    """Owns the upload pool, the notification batcher, the ledger and the retry schedule."""
+    def __init__(self, session, bucket, topic_path, ledger, rotation=None):
+        self.bucket = bucket
+        self.ledger = ledger
+        self.rotation = rotation # rotation_controller.RotationController, or None
+        self.upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+        self.notifier = NotificationBatcher(session, topic_path, self._notification_message,
+                                            self._notification_published, self._notification_failed)
+        self.convert_pool = None
+        if EDGE_CONVERSION:
+            os.makedirs(UDM_DIR, exist_ok=True)
+            # spawn: this process already runs threads, which fork() would copy in an undefined state
+            self.convert_pool = ProcessPoolExecutor(max_workers=EDGE_CONVERT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        self.in_progress = set() # Names queued for conversion, upload or notification
+        self.conversion_stats = {} # name -> stats of the edge conversion, forwarded as notification attributes
+        self.shipped_raw = set() # Edge mode: names whose conversion kept failing and that go out as pcaps
+        self.attempts = {} # name -> failed attempts so far
+        self.retries = [] # heap of (due monotonic time, name, "upload" | "notify")
+        self.closed_at = {} # Adaptive rotation: name -> monotonic time tshark closed it (for the ship time)
+        self.to_measure = {} # Adaptive rotation: name -> epoch time tshark closed it, until the controller measured it
+        self._lock = threading.Lock()
+
+    def handle_closed_file(self, name, just_closed=False):
+        """
+        Entry point for a file tshark has finished writing (or one found at startup). `just_closed`: reported by inotify
+        as it was closed, so its close time is known and the rotation controller can measure it.
+        """
+        with self._lock:
+            if name in self.in_progress:
+                return
+            self.in_progress.add(name)
+            if just_closed and self.rotation is not None:
+                self.closed_at[name] = time.monotonic()
+                self.to_measure[name] = time.time()
+        file_path = os.path.join(CAPTURE_DIR, name)
+        if name in self.ledger.notified:
+            self._remove_local_file(name) # Notified before a restart, local delete did not happen
+        elif name in self.ledger.uploaded:
+            self.notifier.submit(name)
+        else:
+            logging.info(f"Detected completed file: {name}")
+            try:
+                logging.info(f"PCAP_SIZE_BYTES: {os.path.getsize(file_path)} FILE: {name}")
+            except OSError:
+                with self._lock:
+                    self.in_progress.discard(name)
+                return
+            if EDGE_CONVERSION:
+                self._start_conversion(name)
+            else:
+                self.upload_pool.submit(self._upload, name)
+
+    def _start_conversion(self, name):
+        logging.info(f"Converting {name} to UDM on the edge...")
+        conversion = self.convert_pool.submit(convert_capture, os.path.join(CAPTURE_DIR, name),
+                                              os.path.join(UDM_DIR, udm_object_name(name)), name)
+        conversion.add_done_callback(lambda finished: self._conversion_done(name, finished))
+
+    def _conversion_done(self, name, conversion):
+        try:
+            stats = conversion.result()
+        except Exception as e:
+            with self._lock:
+                failed_attempts = self.attempts.get(name, 0) + 1
+            if failed_attempts < EDGE_CONVERT_MAX_ATTEMPTS:
+                logging.error(f"Error: Failed to convert {name} to UDM. Will retry. ({e})")
+                self._schedule_retry(name, "convert")
+            else:
+                logging.error(f"Error: Failed to convert {name} to UDM after {failed_attempts} attempts; uploading the raw pcap instead. ({e})")
+                with self._lock:
+                    self.attempts.pop(name, None)
+                    self.shipped_raw.add(name)
+                self.upload_pool.submit(self._upload, name)
+            return
+        logging.info(f"UDM conversion done for {name}.")
+        with self._lock:
+            self.conversion_stats[name] = stats
+            self.attempts.pop(name, None)
+        self.upload_pool.submit(self._upload, name)
+
+    def _ships_udm(self, name):
+        return EDGE_CONVERSION and name not in self.shipped_raw
+
+    def _upload_object(self, local_path, object_name, content_type=None):
+        """
+        if_generation_match=0: create only. A retry after an upload whose response was lost finds the
+        object already there (412) instead of overwriting it, which objectCreator would not allow anyway.
+        """
+        try:
+            self.bucket.blob(object_name).upload_from_filename(local_path, content_type=content_type, if_generation_match=0)
+        except google_api_exceptions.PreconditionFailed:
+            logging.info(f"{object_name} already exists in gs://{INCOMING_BUCKET}/ (earlier attempt).")
+
+    def _observe_rotation(self, name):
+        """Feeds a just-closed file to the rotation controller, once (before its first upload attempt)."""
+        with self._lock:
+            closed_at = self.to_measure.pop(name, None)
+        if closed_at is not None:
+            self.rotation.observe_capture(name, os.path.join(CAPTURE_DIR, name), closed_at)
+
+    def _upload(self, name):
+        file_path = os.path.join(CAPTURE_DIR, name)
+        if self.rotation is not None:
+            self._observe_rotation(name)
+        object_name = udm_object_name(name) if self._ships_udm(name) else name
+        logging.info(f"Uploading {object_name} to gs://{INCOMING_BUCKET}/...")
+        try:
+            if self._ships_udm(name):
+                self._upload_object(os.path.join(UDM_DIR, object_name), object_name, "application/gzip")
+                if KEEP_RAW_PCAPS:
+                    self._upload_object(file_path, RAW_PCAP_PREFIX + name)
+            else:
+                self._upload_object(file_path, name)
+        except Exception as e:
+            logging.error(f"Error: Failed to upload {object_name} to GCS. Will retry. ({e})")
+            self._schedule_retry(name, "upload")
+            return
+        logging.info(f"Upload successful for {object_name}.")
+        self.ledger.mark_uploaded(name)
+        self.notifier.submit(name)
+
+    def _notification_message(self, name):
+        """Pub/Sub message for a file: data is the object name, edge-converted UDM is flagged with `content=udm`."""
+        attributes = {"sniffer_id": SNIFFER_ID}
+        object_name = name
+        if self._ships_udm(name):
+            object_name = udm_object_name(name)
+            attributes.update(content="udm", source_pcap=name)
+            with self._lock:
+                stats = self.conversion_stats.get(name, {})
+            for key, value in stats.items(): # Counters, including dropped_<reason> of the filter and packet_error_reason_<reason>
+                if key in EDGE_STATS_ATTRIBUTES or key.startswith(("dropped_", "packet_error_reason_")):
+                    attributes[key] = str(value)
+        return {"data": base64.b64encode(object_name.encode("utf-8")).decode("ascii"), "attributes": attributes}
+
+    def _notification_published(self, name):
+        logging.info(f"Notification published successfully for {name}.")
+        with self._lock:
+            closed_at = self.closed_at.pop(name, None)
+        if closed_at is not None:
+            self.rotation.record_shipped(time.monotonic() - closed_at)
+        self.ledger.mark_notified(name)
+        self._remove_local_file(name)
+
+    def _notification_failed(self, name):
+        self._schedule_retry(name, "notify")
+
+    def _remove_local_file(self, name):
+        file_path = os.path.join(CAPTURE_DIR, name)
+        try:
+            os.remove(file_path)
+            logging.info(f"Removed local file: {file_path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error: Failed to remove local file {file_path}: {e}")
+            return # Stays in the ledger as notified, so it is skipped after a restart
+        if EDGE_CONVERSION:
+            try:
+                os.remove(os.path.join(UDM_DIR, udm_object_name(name)))
+            except OSError:
+                pass
+        self.ledger.forget(name)
+        with self._lock:
+            self.in_progress.discard(name)
+            self.attempts.pop(name, None)
+            self.conversion_stats.pop(name, None)
+            self.shipped_raw.discard(name)
+            self.closed_at.pop(name, None)
+            self.to_measure.pop(name, None)
+
+    def _schedule_retry(self, name, step):
+        with self._lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            backoff_seconds = min(RETRY_MAX_BACKOFF_SECONDS, 5 * 2 ** (self.attempts[name] - 1))
+            heapq.heappush(self.retries, (time.monotonic() + backoff_seconds, name, step))
+
+    def run_due_retries(self):
+        while True:
+            with self._lock:
+                if not self.retries or self.retries[0][0] > time.monotonic():
+                    return
+                _, name, step = heapq.heappop(self.retries)
+            if step == "convert":
+                self._start_conversion(name)
+            elif step == "upload":
+                self.upload_pool.submit(self._upload, name)
+            else:
+                self.notifier.submit(name)
+
+    def backlog(self):
+        with self._lock:
+            return len(self.in_progress), len(self.retries)
+
+    def drain(self):
+        """Finishes queued conversions and uploads and flushes the last notification batch (on shutdown)."""
+        if self.convert_pool is not None:
+            self.convert_pool.shutdown(wait=True)
+        self.upload_pool.shutdown(wait=True)
+        self.notifier.close()
+
+def build_session():
+    """One authorized session for GCS and Pub/Sub, with a connection pool large enough for all upload workers."""
+    scopes = ["https://www.googleapis.com/auth/cloud-platform"]
+    if os.path.isfile(GCP_KEY_FILE):
+        credentials = service_account.Credentials.from_service_account_file(GCP_KEY_FILE, scopes=scopes)
+    else:
+        credentials, _ = google.auth.default(scopes=scopes)
+    session = AuthorizedSession(credentials)
+    pooled_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_WORKERS + 2)
+    session.mount("https://", pooled_adapter)
+    return credentials, session
+
+def main():
+    if not (GCP_PROJECT_ID and INCOMING_BUCKET and PUBSUB_TOPIC_ID):
+        logging.error("Error: GCP_PROJECT_ID, INCOMING_BUCKET and PUBSUB_TOPIC_ID must be set.")
+        sys.exit(1)
+    if EDGE_CONVERSION:
+        import native_pcap # Validated once here, so invalid settings stop the sniffer instead of failing every file
+        import packet_filter
+        try:
+            packet_filter.filter_from_environment()
+            native_pcap.deep_ports_from_environment()
+        except ValueError as e:
+            logging.error(f"Error: {e}")
+            sys.exit(1)
+    topic_path = PUBSUB_TOPIC_ID if PUBSUB_TOPIC_ID.startswith("projects/") else f"projects/{GCP_PROJECT_ID}/topics/{PUBSUB_TOPIC_ID}"
+    credentials, session = build_session()
+    storage_client = storage.Client(project=GCP_PROJECT_ID, credentials=credentials, _http=session)
+    bucket = storage_client.bucket(INCOMING_BUCKET)
+    ledger = UploadLedger(UPLOAD_LEDGER)
+    rotation = rotation_controller.controller_from_environment(CAPTURE_DIR, ROTATE)
+    uploader = CaptureUploader(session, bucket, topic_path, ledger, rotation)
+
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+
+    inotify_fd = open_inotify(CAPTURE_DIR, IN_CLOSE_WRITE | IN_MOVED_TO)
+    logging.info(f"Uploader started: {UPLOAD_WORKERS} upload workers, Pub/Sub batches of up to {PUBLISH_BATCH_MAX_MESSAGES}, "
+                 f"watching {CAPTURE_DIR} ({'inotify' if inotify_fd is not None else 'directory scans'}).")
+    if EDGE_CONVERSION:
+        logging.info(f"Edge conversion enabled: {EDGE_CONVERT_WORKERS} conversion workers, "
+                     f"{'projected EK' if TSHARK_PROJECTION else 'full JSON'} dissection, raw pcaps {'kept' if KEEP_RAW_PCAPS else 'not uploaded'}.")
+    # Files left over from a previous run: the entrypoint starts tshark only after the ready file below is written,
+    # so none of them is being written. The inotify watch is already open, so no file tshark closes later is missed.
+    for name in list_capture_files(skip_newest=False):
+        uploader.handle_closed_file(name)
+    if UPLOADER_READY_FILE:
+        with open(UPLOADER_READY_FILE, "w") as f_ready:
+            f_ready.write(f"{os.getpid()}\n")
+
+    next_status_at = time.monotonic() + STATUS_INTERVAL_SECONDS
+    while not stop_requested.is_set():
+        if inotify_fd is not None:
+            try:
+                readable, _, _ = select.select([inotify_fd], [], [], 1.0)
+            except InterruptedError:
+                continue
+            if readable:
+                closed_names, overflowed = read_inotify_events(inotify_fd)
+                if overflowed: # Kernel queue overflowed: events were lost, rescan
+                    closed_names = list_capture_files(skip_newest=True)
+                for name in closed_names:
+                    if CAPTURE_FILE_PATTERN.match(name):
+                        uploader.handle_closed_file(name, just_closed=not overflowed)
+        else:
+            stop_requested.wait(5.0)
+            for name in list_capture_files(skip_newest=True):
+                uploader.handle_closed_file(name)
+        uploader.run_due_retries()
+        if time.monotonic() >= next_status_at:
+            pending_files, scheduled_retries = uploader.backlog()
+            logging.info(f"UPLOAD_BACKLOG: {pending_files} files ({scheduled_retries} awaiting retry)")
+            if rotation is not None:
+                rotation.evaluate(pending_files)
+            next_status_at = time.monotonic() + STATUS_INTERVAL_SECONDS
+
+    # tshark is stopped first by the entrypoint; pick up the file it closed last, then drain.
+    logging.info("Uploader received termination signal. Draining pending uploads and notifications...")
+    if inotify_fd is not None:
+        while select.select([inotify_fd], [], [], 0)[0]:
+            for name in read_inotify_events(inotify_fd)[0]:
+                if CAPTURE_FILE_PATTERN.match(name):
+                    uploader.handle_closed_file(name)
+    drain_thread = threading.Thread(target=uploader.drain, daemon=True)
+    drain_thread.start()
+    drain_thread.join(DRAIN_TIMEOUT_SECONDS)
+    logging.info("Uploader stopped.")
+
+if __name__ == "__main__":
+    main()
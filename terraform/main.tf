@@ -79,6 +79,8 @@ module "cloudrun_processor" {
     INCOMING_BUCKET = module.gcs_buckets.incoming_pcap_bucket_id
     OUTPUT_BUCKET   = module.gcs_buckets.processed_udm_bucket_id
     GCP_PROJECT_ID  = var.gcp_project_id
+    FANOUT_TOPIC    = module.pubsub_topic.topic_id // Oversized captures are split and their chunks published back here
+    FAST_STARTUP    = "true" // Clients, bucket checks and the conversion pool start in the background
   }
   max_concurrency = var.cloud_run_max_concurrency
   cpu_limit       = var.cloud_run_cpu
@@ -124,6 +126,14 @@ resource "google_pubsub_topic_iam_member" "sniffer_sa_pubsub_publisher" {
   member  = "serviceAccount:${google_service_account.sniffer_sa.email}"
 }
 
+// The processor publishes the chunk notifications of fanned-out captures to its own topic.
+resource "google_pubsub_topic_iam_member" "runner_pubsub_publisher" {
+  project = var.gcp_project_id
+  topic   = module.pubsub_topic.topic_id
+  role    = "roles/pubsub.publisher"
+  member  = "serviceAccount:${google_service_account.cloud_run_sa.email}"
+}
+
 resource "google_storage_bucket_iam_member" "sniffer_sa_gcs_writer" {
   bucket = module.gcs_buckets.incoming_pcap_bucket_id
   role   = "roles/storage.objectCreator" // Allows creating objects in the bucket
@@ -135,6 +145,8 @@ resource "google_storage_bucket_iam_member" "sniffer_sa_gcs_writer" {
 // - Read metadata for both buckets (for startup verification).
 // - Read objects from the incoming GCS bucket (to download .pcap files).
 // - Create objects in the processed UDM GCS bucket (to upload .udm.json files).
+// - Manage the idempotency ledger (completion markers and leases under _ledger/ in the incoming bucket), which needs
+//   create-only writes, generation-matched overwrites and deletes; and read output object metadata on redelivery.
 
 resource "google_storage_bucket_iam_member" "runner_incoming_bucket_metadata_reader" {
   bucket = module.gcs_buckets.incoming_pcap_bucket_id
@@ -150,13 +162,13 @@ resource "google_storage_bucket_iam_member" "runner_output_bucket_metadata_reade
 
 resource "google_storage_bucket_iam_member" "runner_gcs_writer" {
   bucket = module.gcs_buckets.processed_udm_bucket_id
-  role   = "roles/storage.objectCreator" // Allows writing UDM files
+  role   = "roles/storage.objectUser" // Allows writing UDM files, reading their metadata (idempotency check) and composing/deleting _checkpoints/ parts
   member = "serviceAccount:${google_service_account.cloud_run_sa.email}"
 }
 
 resource "google_storage_bucket_iam_member" "runner_gcs_reader" {
   bucket = module.gcs_buckets.incoming_pcap_bucket_id
-  role   = "roles/storage.objectViewer" // Allows reading PCAP files
+  role   = "roles/storage.objectUser" // Allows reading PCAP files and managing the _ledger/ markers and leases
   member = "serviceAccount:${google_service_account.cloud_run_sa.email}"
 }
 
@@ -216,9 +228,15 @@ resource "google_pubsub_subscription" "processor_subscription" {
     }
   }
 
+  // The processor answers 429 when an instance is at its admission limits; back off instead of redelivering at once.
+  retry_policy {
+    minimum_backoff = "10s"
+    maximum_backoff = "600s"
+  }
+
   dead_letter_policy {
     dead_letter_topic     = module.pubsub_topic.dlq_topic_id // DLQ topic for failed messages
-    max_delivery_attempts = 5                                // Max retries before sending to DLQ
+    max_delivery_attempts = 10                               // Max retries before sending to DLQ (429 rejections count too)
   }
 
   depends_on = [
@@ -513,7 +531,7 @@ resource "google_logging_metric" "tshark_conversion_error_processor" {
 resource "google_logging_metric" "udm_upload_success_processor" {
   project     = var.gcp_project_id
   name        = "processor_udm_upload_success_count"
-  filter      = "resource.type=\"cloud_run_revision\" AND textPayload=~\"INFO - Upload complete for .*udm.json\""
+  filter      = "resource.type=\"cloud_run_revision\" AND textPayload=~\"INFO - Upload complete for .*udm\\\\.(nd)?json\""
   description = "Counts successful UDM uploads by the processor."
 
   metric_descriptor {
@@ -524,6 +542,68 @@ resource "google_logging_metric" "udm_upload_success_processor" {
   }
 }
 
+// Sniffer Rotation Decisions Metric: Counts rotation changes of the adaptive controller (ADAPTIVE_ROTATION=true),
+// by reason (rate, latency, min_duration, backlog, filesize_cap). Each one restarts tshark on that sniffer.
+resource "google_logging_metric" "sniffer_rotation_decisions" {
+  project     = var.gcp_project_id
+  name        = "sniffer_rotation_decisions_count"
+  filter      = "resource.type=(\"gce_instance\" OR \"k8s_container\" OR \"global\") AND textPayload:\"ROTATION_DECISION:\" AND textPayload:\"(ID: \""
+  description = "Counts rotation changes applied by the sniffers' adaptive rotation controller."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "INT64"
+    unit         = "1"
+    display_name = "Sniffer Rotation Decisions"
+    labels {
+      key         = "sniffer_id"
+      value_type  = "STRING"
+      description = "Unique identifier of the sniffer instance"
+    }
+    labels {
+      key         = "reason"
+      value_type  = "STRING"
+      description = "What bounded the new rotation"
+    }
+  }
+  label_extractors = {
+    "sniffer_id" = "REGEXP_EXTRACT(textPayload, \"\\\\(ID: ([^)]+)\\\\)\")"
+    "reason"     = "REGEXP_EXTRACT(textPayload, \" reason=([a-z_]+) \")"
+  }
+}
+
+// Sniffer Packets per Rotation File Metric: Distribution of the packets in each closed rotation file, as measured by
+// the adaptive rotation controller. Shows whether files land near ROTATION_TARGET_PACKETS.
+resource "google_logging_metric" "sniffer_rotation_file_packets" {
+  project     = var.gcp_project_id
+  name        = "sniffer_rotation_file_packets"
+  filter      = "resource.type=(\"gce_instance\" OR \"k8s_container\" OR \"global\") AND textPayload:\"ROTATION_OBSERVED:\" AND textPayload:\"(ID: \""
+  description = "Distribution of packets per closed sniffer rotation file (adaptive rotation)."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "DISTRIBUTION"
+    unit         = "1"
+    display_name = "Sniffer Packets per Rotation File"
+    labels {
+      key         = "sniffer_id"
+      value_type  = "STRING"
+      description = "Unique identifier of the sniffer instance"
+    }
+  }
+  bucket_options {
+    exponential_buckets {
+      num_finite_buckets = 20
+      growth_factor      = 2
+      scale              = 100
+    }
+  }
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"ROTATION_OBSERVED: packets=([0-9]+) \")"
+  label_extractors = {
+    "sniffer_id" = "REGEXP_EXTRACT(textPayload, \"\\\\(ID: ([^)]+)\\\\)\")"
+  }
+}
+
 // Processor PCAP Processing Latency Metric: Distribution of end-to-end processing time per PCAP file.
 resource "google_logging_metric" "processor_pcap_latency" {
   project     = var.gcp_project_id
@@ -547,6 +627,162 @@ resource "google_logging_metric" "processor_pcap_latency" {
   value_extractor = "REGEXP_EXTRACT(textPayload, \"PROCESSING_DURATION_SECONDS: ([0-9]+\\\\.?[0-9]*)\")"
 }
 
+// Processor Admission Rejections Metric: Counts pushes answered with 429 because an instance was at capacity.
+resource "google_logging_metric" "processor_admission_rejected" {
+  project     = var.gcp_project_id
+  name        = "processor_admission_rejected_count"
+  filter      = "resource.type=\"cloud_run_revision\" AND textPayload=~\"WARNING - ADMISSION_REJECTED:\""
+  description = "Counts Pub/Sub pushes rejected by the processor's admission control (retried later by Pub/Sub)."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "INT64"
+    unit         = "1"
+    display_name = "Processor Admission Rejections"
+    labels {
+      key         = "reason"
+      value_type  = "STRING"
+      description = "Exhausted budget (in_flight_files or temp_bytes)"
+    }
+  }
+  label_extractors = {
+    "reason" = "REGEXP_EXTRACT(textPayload, \"ADMISSION_REJECTED: ([a-z_]+)\")"
+  }
+}
+
+// Processor Duplicate Deliveries Metric: Counts Pub/Sub redeliveries skipped by the idempotency ledger.
+resource "google_logging_metric" "processor_duplicate_skipped" {
+  project     = var.gcp_project_id
+  name        = "processor_duplicate_skipped_count"
+  filter      = "resource.type=\"cloud_run_revision\" AND textPayload=~\"DUPLICATE_SKIPPED:\""
+  description = "Counts Pub/Sub deliveries of files already processed (ACKed) or being processed by another delivery (409)."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "INT64"
+    unit         = "1"
+    display_name = "Processor Duplicate Deliveries Skipped"
+    labels {
+      key         = "state"
+      value_type  = "STRING"
+      description = "completed or in_progress"
+    }
+  }
+  label_extractors = {
+    "state" = "REGEXP_EXTRACT(textPayload, \"DUPLICATE_SKIPPED: ([a-z_]+)\")"
+  }
+}
+
+// Processor Dropped Packets Metric: Packets discarded by the converter's drop rules or per-flow sampling, by reason.
+resource "google_logging_metric" "processor_packets_dropped" {
+  project     = var.gcp_project_id
+  name        = "processor_packets_dropped"
+  filter      = "resource.type=\"cloud_run_revision\" AND textPayload=~\"UDM_PACKETS_DROPPED_REASON:\""
+  description = "Distribution of converted packets dropped per PCAP file by UDM_DROP_RULES or flow sampling, by reason."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "DISTRIBUTION"
+    unit         = "1"
+    display_name = "Processor Packets Dropped"
+    labels {
+      key         = "reason"
+      value_type  = "STRING"
+      description = "Drop rule name or sampled"
+    }
+  }
+  bucket_options {
+    exponential_buckets {
+      num_finite_buckets = 20
+      growth_factor      = 2
+      scale              = 1
+    }
+  }
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"UDM_PACKETS_DROPPED_REASON: ([0-9]+)\")"
+  label_extractors = {
+    "reason" = "REGEXP_EXTRACT(textPayload, \" REASON: ([a-z0-9_]+) FILE:\")"
+  }
+}
+
+// Processor Packet Error Reasons Metric: Distribution of packets that failed conversion per PCAP file, by reason
+// (exception class in snake case, or missing_layers), from the once-per-file UDM_PACKET_ERROR_REASON lines.
+resource "google_logging_metric" "processor_packet_error_reasons" {
+  project     = var.gcp_project_id
+  name        = "processor_packet_error_reasons"
+  filter      = "resource.type=\"cloud_run_revision\" AND textPayload=~\"UDM_PACKET_ERROR_REASON:\""
+  description = "Distribution of packets that failed UDM conversion per PCAP file, by reason."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "DISTRIBUTION"
+    unit         = "1"
+    display_name = "Processor Packet Errors by Reason"
+    labels {
+      key         = "reason"
+      value_type  = "STRING"
+      description = "Exception class in snake case, or missing_layers"
+    }
+  }
+  bucket_options {
+    exponential_buckets {
+      num_finite_buckets = 20
+      growth_factor      = 2
+      scale              = 1
+    }
+  }
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"UDM_PACKET_ERROR_REASON: ([0-9]+)\")"
+  label_extractors = {
+    "reason" = "REGEXP_EXTRACT(textPayload, \" REASON: ([a-z0-9_]+) FILE:\")"
+  }
+}
+
+// Processor Stage Duration Metrics: Distributions built from the structured FILE_METRICS record (jsonPayload)
+// the processor writes once per file, so the dashboard can show where the time goes (queue, download, convert, upload).
+locals {
+  processor_file_metrics_fields = {
+    "queue_lag"           = { field = "queue_lag_seconds", display_name = "Processor Pub/Sub Queue Lag" }
+    "download"            = { field = "stage_seconds.download", display_name = "Processor Download Stage Duration" }
+    "convert"             = { field = "stage_seconds.convert", display_name = "Processor Convert Stage Duration" }
+    "upload"              = { field = "stage_seconds.upload", display_name = "Processor Upload Stage Duration" }
+    "overlapped"          = { field = "stage_seconds.overlapped", display_name = "Processor Overlapped Stream Duration" }
+    "copy"                = { field = "stage_seconds.copy", display_name = "Processor Edge UDM Copy Duration" }
+    "split"               = { field = "stage_seconds.split", display_name = "Processor Fan-out Split Duration" }
+    "send"                = { field = "stage_seconds.send", display_name = "Processor Chronicle Send Duration" }
+    "chronicle_batch_p95" = { field = "chronicle_batch_latency_p95_seconds", display_name = "Processor Chronicle Batch Latency (p95)" }
+  }
+}
+
+resource "google_logging_metric" "processor_stage_seconds" {
+  for_each    = local.processor_file_metrics_fields
+  project     = var.gcp_project_id
+  name        = "processor_${each.key}_seconds"
+  filter      = "resource.type=\"cloud_run_revision\" AND jsonPayload.message=~\"^FILE_METRICS FILE:\" AND jsonPayload.file_metrics.${each.value.field}:*"
+  description = "Distribution of ${lower(each.value.display_name)} per PCAP file in seconds."
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "DISTRIBUTION"
+    unit         = "s"
+    display_name = each.value.display_name
+    labels {
+      key         = "mode"
+      value_type  = "STRING"
+      description = "Processing mode (subprocess, streaming, parallel, checkpointed, fanout, chunk, overlapped, edge)"
+    }
+  }
+  bucket_options {
+    exponential_buckets {
+      num_finite_buckets = 20
+      growth_factor      = 1.5
+      scale              = 0.1
+    }
+  }
+  value_extractor = "EXTRACT(jsonPayload.file_metrics.${each.value.field})"
+  label_extractors = {
+    "mode" = "EXTRACT(jsonPayload.file_metrics.mode)"
+  }
+}
+
 // --- Cloud Monitoring Dashboard ---
 // Defines the operational dashboard using a JSON template file.
 // This dashboard visualizes the custom metrics and standard GCP service metrics.
@@ -572,7 +808,9 @@ resource "google_monitoring_dashboard" "main_operational_dashboard" {
     google_logging_metric.tshark_conversion_error_processor,
     // google_logging_metric.udm_packet_processing_errors,           // RIMOSSO
     google_logging_metric.udm_upload_success_processor,
-    google_logging_metric.processor_pcap_latency
+    google_logging_metric.processor_pcap_latency,
+    google_logging_metric.processor_stage_seconds,
+    google_logging_metric.processor_admission_rejected
   ]
 }
 
@@ -30,6 +30,7 @@ resource "google_cloud_run_v2_service" "processor" {
           cpu    = var.cpu_limit
           memory = var.memory_limit
         }
+        startup_cpu_boost = true # CPU extra durante l'avvio: i worker di conversione partono in parallelo al server
       }
 
       # Probe di Startup (per verificare che l'app sia partita correttamente)
@@ -23,6 +23,15 @@ resource "google_storage_bucket" "incoming_pcaps" {
     action { type = "Delete" }
     condition { age = 30 }
   }
+
+  // Chunk di catture suddivise (fan-out) rimaste da job mai completati
+  lifecycle_rule {
+    action { type = "Delete" }
+    condition {
+      age            = 7
+      matches_prefix = ["_fanout/"]
+    }
+  }
 }
 
 resource "google_storage_bucket" "processed_udm" {
@@ -45,4 +54,13 @@ resource "google_storage_bucket" "processed_udm" {
       default_kms_key_name = var.cmek_key_name
     }
   }
-}
\ No newline at end of file
+
+  // Parti e manifest di conversioni checkpointed / fan-out abbandonate (file finiti in dead letter)
+  lifecycle_rule {
+    action { type = "Delete" }
+    condition {
+      age            = 7
+      matches_prefix = ["_checkpoints/", "_fanout/"]
+    }
+  }
+}
@@ -0,0 +1,156 @@
+# test/benchmarks/bench_converter.py - Offline throughput / memory benchmark for the TShark JSON -> UDM converter.
+# Generates a synthetic corpus (see synthetic_corpus.py), then runs each case in a fresh interpreter so the
+# peak RSS of one case does not leak into the next:
+# - streaming:      json_to_udm_streaming(path) - the file-based entry point (events collected into a list)
+# - single_packet:  convert_single_packet_to_udm over packets already in memory - the pure mapping cost
+# - pipeline_json:  iter_tshark_packets -> iter_udm_events -> write_udm_events, `-T json` input (production path)
+# - pipeline_ek:    the same with the projected `-T ek` input
+# Each case reports packets/s, peak RSS and output bytes. Results are saved as JSON so two versions can be compared:
+#   python3 test/benchmarks/bench_converter.py --packets 50000 --save test/benchmarks/results/before.json
+#   python3 test/benchmarks/bench_converter.py --packets 50000 --compare test/benchmarks/results/before.json
+# `--compare` exits non-zero if any case is slower than `--max-regression` (default 10%).
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "..", "processor"))
+sys.path.insert(0, BENCHMARK_DIR)
+import json2udm_cloud  # noqa: E402
+import synthetic_corpus  # noqa: E402
+
+CASES = ("streaming", "single_packet", "pipeline_json", "pipeline_ek")
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+def run_case(case_name, corpus_path, packet_count, malformed_ratio, seed, output_format):
+    """Runs one case in the current process and returns its measurements."""
+    json2udm_cloud.logging.disable(json2udm_cloud.logging.CRITICAL) # Per-file metric lines are not part of the cost being measured
+    stats = json2udm_cloud.new_conversion_stats()
+    with tempfile.TemporaryFile() as f_out:
+        if case_name == "single_packet":
+            packets = list(synthetic_corpus.iter_packets(packet_count, malformed_ratio=malformed_ratio, seed=seed))
+            rss_before = peak_rss_bytes()
+            started = time.perf_counter()
+            udm_events = [json2udm_cloud.convert_single_packet_to_udm(packet, stats) for packet in packets]
+            elapsed = time.perf_counter() - started
+            json2udm_cloud.write_udm_events(udm_events, f_out, output_format)
+        elif case_name == "streaming":
+            rss_before = peak_rss_bytes()
+            started = time.perf_counter()
+            udm_events = json2udm_cloud.json_to_udm_streaming(corpus_path)
+            elapsed = time.perf_counter() - started
+            json2udm_cloud.write_udm_events(udm_events, f_out, output_format)
+        else:
+            input_format = "ek" if case_name == "pipeline_ek" else "json"
+            rss_before = peak_rss_bytes()
+            started = time.perf_counter()
+            with open(corpus_path, "rb") as f_in:
+                tshark_packets = json2udm_cloud.iter_tshark_packets(f_in, stats, input_format)
+                udm_count = json2udm_cloud.write_udm_events(json2udm_cloud.iter_udm_events(tshark_packets, stats),
+                                                            f_out, output_format)
+            elapsed = time.perf_counter() - started
+            udm_events = range(udm_count)
+        output_bytes = f_out.tell()
+    if case_name in ("single_packet", "streaming"): # These entry points do not count errors in `stats`
+        stats["packet_errors"] = sum(1 for udm_event in udm_events if json2udm_cloud.is_error_udm_event(udm_event))
+    return {"case": case_name, "packets": len(udm_events), "seconds": round(elapsed, 4),
+            "packets_per_second": round(len(udm_events) / elapsed, 1) if elapsed else None,
+            "input_bytes": os.path.getsize(corpus_path) if case_name != "single_packet" else None,
+            "output_bytes": output_bytes, "peak_rss_bytes": peak_rss_bytes(),
+            "peak_rss_growth_bytes": peak_rss_bytes() - rss_before,
+            "packet_errors": stats.get("packet_errors", 0)}
+
+def run_case_isolated(case_name, corpus_path, args):
+    """Runs one case in a child interpreter so its peak RSS is measured on its own."""
+    child_command = [sys.executable, os.path.abspath(__file__), "--run-case", case_name, "--corpus", corpus_path,
+                     "--packets", str(args.packets), "--malformed", str(args.malformed), "--seed", str(args.seed),
+                     "--output-format", args.output_format]
+    child_result = subprocess.run(child_command, capture_output=True, text=True, check=True)
+    return json.loads(child_result.stdout.strip().splitlines()[-1])
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(current, previous, max_regression):
+    """Prints per-case deltas against a previous results file. Returns False if a case regressed too much."""
+    previous_cases = {case["case"]: case for case in previous["cases"]}
+    within_budget = True
+    print(f"Compared with {previous.get('revision') or 'unknown revision'} ({previous.get('created_at')}):")
+    for case in current["cases"]:
+        before = previous_cases.get(case["case"])
+        if not before or not before.get("packets_per_second"):
+            print(f"  {case['case']:<14} no previous result")
+            continue
+        speed_change = case["packets_per_second"] / before["packets_per_second"] - 1
+        rss_change = case["peak_rss_bytes"] / before["peak_rss_bytes"] - 1
+        regressed = speed_change < -max_regression
+        within_budget = within_budget and not regressed
+        print(f"  {case['case']:<14} throughput {speed_change:+7.1%}  peak RSS {rss_change:+7.1%}  "
+              f"output bytes {case['output_bytes'] - before['output_bytes']:+d}{'  REGRESSION' if regressed else ''}")
+    return within_budget
+
+def main():
+    parser = argparse.ArgumentParser(description="Converter throughput / memory benchmark on a synthetic corpus.")
+    parser.add_argument("--packets", type=int, default=50000)
+    parser.add_argument("--malformed", type=float, default=0.01, help="Fraction of malformed packets in the corpus")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output-format", choices=json2udm_cloud.OUTPUT_FORMATS, default="ndjson")
+    parser.add_argument("--cases", default=",".join(CASES), help=f"Comma-separated subset of {CASES}")
+    parser.add_argument("--save", help="Write the results JSON to this path")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="Allowed throughput drop for --compare")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS) # Child mode used by run_case_isolated
+    parser.add_argument("--corpus", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.corpus, args.packets, args.malformed, args.seed, args.output_format)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="bench-corpus-") as corpus_dir:
+        corpus_paths = {"json": os.path.join(corpus_dir, "corpus.json"), "ek": os.path.join(corpus_dir, "corpus.ek")}
+        for corpus_format, corpus_path in corpus_paths.items():
+            synthetic_corpus.write_corpus(corpus_path, args.packets, None, args.malformed, args.seed, corpus_format)
+        results = {"revision": git_revision(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                   "python": platform.python_version(), "machine": platform.machine(),
+                   "corpus": {"packets": args.packets, "malformed": args.malformed, "seed": args.seed,
+                              "json_bytes": os.path.getsize(corpus_paths["json"]),
+                              "ek_bytes": os.path.getsize(corpus_paths["ek"])},
+                   "output_format": args.output_format, "cases": []}
+        for case_name in args.cases.split(","):
+            corpus_path = corpus_paths["ek" if case_name == "pipeline_ek" else "json"]
+            results["cases"].append(run_case_isolated(case_name, corpus_path, args))
+
+    print(f"{args.packets} packets ({args.malformed:.1%} malformed), "
+          f"corpus {results['corpus']['json_bytes'] / 2**20:.1f} MB json / {results['corpus']['ek_bytes'] / 2**20:.1f} MB ek")
+    for case in results["cases"]:
+        print(f"  {case['case']:<14} {case['packets_per_second']:>10,.0f} packets/s  peak RSS {case['peak_rss_bytes'] / 2**20:7.1f} MB  "
+              f"output {case['output_bytes'] / 2**20:7.1f} MB  errors {case['packet_errors']}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f_results:
+            json.dump(results, f_results, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f_previous:
+            if not compare_results(results, json.load(f_previous), args.max_regression):
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# test/benchmarks/bench_enrichment.py - Microbenchmark for the cached IP / hostname enrichment stage.
+# Converts a synthetic corpus once, maps its addresses onto a pool of `--endpoints` distinct IPs (a capture has
+# thousands of packets but few endpoints), then times the enrichment of every event against a synthetic
+# CIDR -> asset table of `--cidrs` networks (plus MMDB files if given), with the LRU cache and without it.
+# Usage: python3 test/benchmarks/bench_enrichment.py [--packets 100000] [--endpoints 50] [--cidrs 20000] [--mmdb GeoLite2-City.mmdb,...]
+
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "processor"))
+import ip_enrichment  # noqa: E402
+import json2udm_cloud  # noqa: E402
+import synthetic_corpus  # noqa: E402
+
+def build_asset_index(cidr_count, endpoints, rng):
+    """Random /16../28 networks, plus a /24 around every endpoint so each one resolves to an asset."""
+    index = ip_enrichment.CidrAssetIndex()
+    for network_number in range(cidr_count):
+        prefix_length = rng.choice((16, 20, 24, 28))
+        index.add(f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}/{prefix_length}",
+                  {"hostname": f"asset-{network_number}", "asset_id": f"A{network_number:06d}", "category": "server"})
+    for endpoint_number, endpoint_ip in enumerate(endpoints):
+        index.add(f"{endpoint_ip}/24", {"hostname": f"host-{endpoint_number}", "asset_id": f"E{endpoint_number:06d}"})
+    return index
+
+def time_enrichment(enricher, udm_events):
+    stats = {}
+    events = copy.deepcopy(udm_events) # Enrichment adds fields in place
+    started = time.perf_counter()
+    for _ in enricher.enrich_events(events, stats):
+        pass
+    return time.perf_counter() - started, stats
+
+def main():
+    parser = argparse.ArgumentParser(description="IP enrichment microbenchmark.")
+    parser.add_argument("--packets", type=int, default=100000)
+    parser.add_argument("--endpoints", type=int, default=50, help="Distinct IP addresses in the capture")
+    parser.add_argument("--cidrs", type=int, default=20000, help="Networks in the synthetic asset table")
+    parser.add_argument("--mmdb", default="", help="Comma-separated MaxMind DB files to include in the lookups")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    endpoints = [f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}" for _ in range(args.endpoints)]
+    conversion_stats = json2udm_cloud.new_conversion_stats()
+    udm_events = list(json2udm_cloud.iter_udm_events(synthetic_corpus.iter_packets(args.packets, seed=args.seed), conversion_stats))
+    for udm_event in udm_events:
+        for section in ("principal", "target"):
+            noun = udm_event.get("event", {}).get(section)
+            if noun and noun.get("ip"):
+                noun["ip"] = rng.choice(endpoints)
+
+    asset_index = build_asset_index(args.cidrs, endpoints, rng)
+    mmdb_readers = []
+    if args.mmdb:
+        if ip_enrichment.maxminddb is None:
+            sys.exit("--mmdb needs the `maxminddb` package")
+        mmdb_readers = [ip_enrichment.maxminddb.open_database(path) for path in args.mmdb.split(",")]
+
+    results = [("uncached (1-entry cache)", *time_enrichment(ip_enrichment.IpEnricher(mmdb_readers, asset_index, 1), udm_events)),
+               ("LRU cache", *time_enrichment(ip_enrichment.IpEnricher(mmdb_readers, asset_index), udm_events))]
+    uncached_seconds = results[0][1]
+    print(f"{len(udm_events)} events, {args.endpoints} endpoints, {args.cidrs} CIDRs, {len(mmdb_readers)} MMDB file(s)")
+    for label, elapsed, stats in results:
+        lookups = stats["enrichment_cache_hits"] + stats["enrichment_cache_misses"]
+        print(f"  {label:<26} {len(udm_events) / elapsed:>12,.0f} events/s  {elapsed * 1e6 / len(udm_events):6.2f} us/event  "
+              f"hit ratio {stats['enrichment_cache_hits'] / max(1, lookups):.3f}  evictions {stats['enrichment_cache_evictions']}  "
+              f"speedup x{uncached_seconds / elapsed:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# test/benchmarks/bench_json_backends.py - Compares the JSON parser / codec backends of json_backends.py on one corpus.
+# For every available combination of ijson backend (yajl2_c, yajl2_cffi, yajl2, python) and codec (orjson, stdlib),
+# times on the same synthetic corpus (see synthetic_corpus.py):
+# - parse_json:       iterating the `tshark -T json` array (ijson backend)
+# - parse_ek:         decoding the projected `-T ek` lines (codec)
+# - write_json / write_ndjson: serializing the converted events with write_udm_events (codec)
+# - pipeline:         `-T json` input -> UDM -> `--output-format` output, the production path end to end
+# and checks that every combination parses to the same packets and writes byte-identical output (exits non-zero if not).
+# Usage: python3 test/benchmarks/bench_json_backends.py [--packets 50000] [--output-format ndjson] [--gzip]
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "..", "processor"))
+sys.path.insert(0, BENCHMARK_DIR)
+import json2udm_cloud  # noqa: E402
+import json_backends  # noqa: E402
+import synthetic_corpus  # noqa: E402
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return time.perf_counter() - started, result
+
+def packets_digest(packets):
+    return hashlib.sha256(json.dumps(packets, sort_keys=True).encode("utf-8")).hexdigest()
+
+def write_digest(udm_events, output_format, compress):
+    with tempfile.TemporaryFile() as f_out:
+        json2udm_cloud.write_udm_events(udm_events, f_out, output_format, compress)
+        f_out.seek(0)
+        return hashlib.sha256(f_out.read()).hexdigest()
+
+def run_combination(corpus_paths, udm_events, args):
+    """Timings (seconds) and output digests of the active backends."""
+    stats = json2udm_cloud.new_conversion_stats()
+    timings, digests = {}, {}
+    for input_format in json2udm_cloud.INPUT_FORMATS:
+        with open(corpus_paths[input_format], "rb") as f_in:
+            timings[f"parse_{input_format}"], packets = timed(lambda: list(json2udm_cloud.iter_tshark_packets(f_in, stats, input_format)))
+        digests[f"parse_{input_format}"] = packets_digest(packets)
+    for output_format in json2udm_cloud.OUTPUT_FORMATS:
+        timings[f"write_{output_format}"], digests[f"write_{output_format}"] = timed(
+            lambda: write_digest(udm_events, output_format, args.compress))
+
+    def run_pipeline():
+        pipeline_stats = json2udm_cloud.new_conversion_stats()
+        with open(corpus_paths["json"], "rb") as f_json:
+            tshark_packets = json2udm_cloud.iter_tshark_packets(f_json, pipeline_stats, "json")
+            with tempfile.TemporaryFile() as f_out:
+                json2udm_cloud.write_udm_events(json2udm_cloud.iter_udm_events(tshark_packets, pipeline_stats), f_out,
+                                                args.output_format, args.compress)
+    # Not compared: malformed packets get the wall-clock time; the parse_* and write_* outputs cover both halves
+    timings["pipeline"], _ = timed(run_pipeline)
+    return timings, digests
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON parser / codec backend comparison.")
+    parser.add_argument("--packets", type=int, default=50000)
+    parser.add_argument("--malformed", type=float, default=0.01, help="Fraction of malformed packets in the corpus")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output-format", choices=json2udm_cloud.OUTPUT_FORMATS, default="ndjson", help="Output of the pipeline case")
+    parser.add_argument("--gzip", dest="compress", action="store_true", help="gzip-compress the outputs")
+    args = parser.parse_args()
+    json2udm_cloud.logging.disable(json2udm_cloud.logging.CRITICAL) # Malformed-packet errors are not part of the cost being measured
+
+    with tempfile.TemporaryDirectory(prefix="bench-corpus-") as corpus_dir:
+        corpus_paths = {corpus_format: os.path.join(corpus_dir, f"corpus.{corpus_format}") for corpus_format in ("json", "ek")}
+        for corpus_format, corpus_path in corpus_paths.items():
+            synthetic_corpus.write_corpus(corpus_path, args.packets, None, args.malformed, args.seed, corpus_format)
+        conversion_stats = json2udm_cloud.new_conversion_stats()
+        udm_events = list(json2udm_cloud.iter_udm_events(
+            synthetic_corpus.iter_packets(args.packets, malformed_ratio=args.malformed, seed=args.seed), conversion_stats))
+
+        results = []
+        for parser_backend in json_backends.available_parser_backends():
+            for codec_backend in json_backends.available_codec_backends():
+                json_backends.configure(parser_backend, codec_backend)
+                results.append((parser_backend, codec_backend, *run_combination(corpus_paths, udm_events, args)))
+
+    case_names = list(results[0][2])
+    print(f"{args.packets} packets ({args.malformed:.1%} malformed), pipeline output {args.output_format}{'.gz' if args.compress else ''}; packets/s:")
+    print(f"  {'parser':<11} {'codec':<7} " + " ".join(f"{case_name:>13}" for case_name in case_names))
+    for parser_backend, codec_backend, timings, _ in results:
+        print(f"  {parser_backend:<11} {codec_backend:<7} " + " ".join(f"{args.packets / timings[case_name]:>13,.0f}" for case_name in case_names))
+
+    reference_digests = results[0][3]
+    mismatches = [(parser_backend, codec_backend, output_name) for parser_backend, codec_backend, _, digests in results
+                  for output_name, digest in digests.items() if digest != reference_digests[output_name]]
+    for parser_backend, codec_backend, output_name in mismatches:
+        print(f"  OUTPUT DIFFERS: {output_name} with parser={parser_backend} codec={codec_backend}")
+    if mismatches:
+        sys.exit(1)
+    print("  Outputs are byte-identical across backends.")
+
+if __name__ == "__main__":
+    main()
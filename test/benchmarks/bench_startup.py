@@ -0,0 +1,326 @@
+# test/benchmarks/bench_startup.py - Cold start benchmark for the processor service (processor_app.py).
+# Each run starts the service the way the container does (gunicorn with the Dockerfile's settings, or werkzeug when
+# gunicorn is not installed) in a fresh process and measures, from the moment the process is launched:
+# - time-to-first-request: the first `GET /` (the startup probe) answered with 200;
+# - time-to-first-processed-file: a Pub/Sub push for `--pcap` (default: a synthetic capture of `--packets` frames,
+#   see native_parity.py), sent right after, answered with 204.
+# GCS is a local in-memory stand-in of the JSON API (STORAGE_EMULATOR_HOST), so the numbers leave out network and
+# credential discovery; the conversion needs TShark on PATH like the service (or NATIVE_DECODER=true via --env).
+# Modes alternate run by run: "default" (FAST_STARTUP=false) and "fast" (FAST_STARTUP=true); --env adds settings
+# to both, e.g. --env PROCESSING_MODE=streaming. Medians are saved as JSON so two versions can be compared:
+#   python3 test/benchmarks/bench_startup.py --runs 5 --save test/benchmarks/results/startup_before.json
+#   python3 test/benchmarks/bench_startup.py --runs 5 --compare test/benchmarks/results/startup_before.json
+# `--compare` exits non-zero if a median is slower than `--max-regression` (default 20%); a run that does not
+# produce the UDM output exits non-zero as well.
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROCESSOR_DIR = os.path.join(BENCHMARK_DIR, "..", "..", "processor")
+INCOMING_BUCKET = "bench-incoming"
+OUTPUT_BUCKET = "bench-output"
+MODES = {"default": {"FAST_STARTUP": "false"}, "fast": {"FAST_STARTUP": "true"}}
+METRICS = ("first_request_seconds", "first_file_seconds")
+sys.path.insert(0, BENCHMARK_DIR)
+import native_parity  # noqa: E402
+
+class GcsStandIn:
+    """In-memory buckets and objects, enough of the JSON API for the processor's client calls."""
+    def __init__(self, bucket_names):
+        self.lock = threading.Lock()
+        self.objects = {bucket_name: {} for bucket_name in bucket_names} # bucket -> name -> (resource, data)
+        self.uploads = {} # resumable upload id -> (bucket, resource)
+        self.generation = 1000
+        self.unexpected = [] # Requests the stand-in does not implement
+
+    def put(self, bucket_name, resource, data):
+        with self.lock:
+            self.generation += 1
+            resource = dict(resource, bucket=bucket_name, kind="storage#object", size=str(len(data)),
+                            generation=str(self.generation), metageneration="1",
+                            updated=time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()))
+            resource.setdefault("contentType", "application/octet-stream")
+            self.objects[bucket_name][resource["name"]] = (resource, data)
+            return resource
+
+def make_handler(gcs):
+    class GcsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _answer(self, status, payload=None, data=None, headers=None):
+            body = data if data is not None else json.dumps(payload if payload is not None else {}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream" if data is not None else "application/json")
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self):
+            url = urllib.parse.urlsplit(self.path)
+            parts = [urllib.parse.unquote(part) for part in url.path.strip("/").split("/")]
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if parts[:1] in (["download"], ["upload"]):
+                parts = parts[1:]
+            if parts[:3] != ["storage", "v1", "b"] or len(parts) < 4 or parts[3] not in gcs.objects:
+                return None, None, query
+            object_name = "/".join(parts[5:]) if len(parts) > 5 and parts[4] == "o" else None
+            return parts[3], object_name, query
+
+        def _unexpected(self):
+            gcs.unexpected.append(f"{self.command} {self.path}")
+            self._answer(501, {"error": {"code": 501, "message": "not implemented by the stand-in"}})
+
+        def _store(self, bucket_name, resource, data, query):
+            with gcs.lock:
+                exists = resource["name"] in gcs.objects[bucket_name]
+            if query.get("ifGenerationMatch") == "0" and exists:
+                return self._answer(412, {"error": {"code": 412, "message": "conditionNotMet"}})
+            self._answer(200, gcs.put(bucket_name, resource, data))
+
+        def do_GET(self):
+            bucket_name, object_name, query = self._route()
+            if bucket_name is None:
+                return self._answer(404, {"error": {"code": 404, "message": "Not Found"}})
+            if object_name is None:
+                if self.path.rstrip("/").endswith("/o"): # List
+                    with gcs.lock:
+                        items = [resource for name, (resource, _) in sorted(gcs.objects[bucket_name].items())
+                                 if name.startswith(query.get("prefix", ""))]
+                    return self._answer(200, {"kind": "storage#objects", "items": items})
+                return self._answer(200, {"kind": "storage#bucket", "name": bucket_name, "id": bucket_name})
+            with gcs.lock:
+                stored = gcs.objects[bucket_name].get(object_name)
+            if stored is None:
+                return self._answer(404, {"error": {"code": 404, "message": "No such object"}})
+            if query.get("alt") == "media":
+                return self._answer(200, data=stored[1])
+            self._answer(200, stored[0])
+
+        def do_POST(self):
+            bucket_name, _, query = self._route()
+            body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            if bucket_name is None:
+                return self._unexpected()
+            if query.get("uploadType") == "multipart":
+                boundary = self.headers["Content-Type"].split("boundary=")[1].strip('"').encode()
+                metadata_part, media_part = body.split(b"--" + boundary)[1:3]
+                resource = json.loads(metadata_part.split(b"\r\n\r\n", 1)[1])
+                _, data = media_part.split(b"\r\n\r\n", 1)
+                resource.setdefault("name", query.get("name"))
+                return self._store(bucket_name, resource, data[:-2], query) # Part data ends with CRLF
+            if query.get("uploadType") == "resumable":
+                resource = json.loads(body or b"{}")
+                resource.setdefault("name", query.get("name"))
+                with gcs.lock:
+                    upload_id = str(len(gcs.uploads) + 1)
+                    gcs.uploads[upload_id] = (bucket_name, resource, query)
+                location = f"http://{self.headers['Host']}/upload/storage/v1/b/{bucket_name}/o?uploadType=resumable&upload_id={upload_id}"
+                return self._answer(200, {}, headers={"Location": location})
+            self._unexpected()
+
+        def do_PUT(self):
+            _, _, query = self._route()
+            body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            with gcs.lock:
+                upload = gcs.uploads.pop(query.get("upload_id"), None)
+            if upload is None:
+                return self._unexpected()
+            bucket_name, resource, upload_query = upload
+            self._store(bucket_name, resource, body, upload_query) # Whole body in one request (small files)
+
+        def do_PATCH(self):
+            bucket_name, object_name, _ = self._route()
+            patch = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+            with gcs.lock:
+                stored = gcs.objects.get(bucket_name, {}).get(object_name)
+                if stored is not None:
+                    stored[0].setdefault("metadata", {}).update(patch.get("metadata") or {})
+            if stored is None:
+                return self._answer(404, {"error": {"code": 404, "message": "No such object"}})
+            self._answer(200, stored[0])
+
+        def do_DELETE(self):
+            bucket_name, object_name, _ = self._route()
+            with gcs.lock:
+                stored = gcs.objects.get(bucket_name, {}).pop(object_name, None)
+            self._answer(204 if stored is not None else 404, {})
+    return GcsHandler
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def server_command(server, port):
+    """The service's command line: the Dockerfile's gunicorn CMD, or werkzeug's threaded server."""
+    if server == "gunicorn":
+        return ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", "1", "--threads", "8", "--timeout", "600",
+                "processor_app:app"]
+    return [sys.executable, "-c", "import processor_app, werkzeug.serving; "
+            f"werkzeug.serving.run_simple('127.0.0.1', {port}, processor_app.app, threaded=True)"]
+
+def http_status(url, body=None, timeout=600):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"} if body else {})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def run_once(mode, args, gcs_url, pcap_name, log_path):
+    """Launches the service, waits for the first 200 and the first processed file, stops it. Returns the timings."""
+    port = free_port()
+    env = dict(os.environ, INCOMING_BUCKET=INCOMING_BUCKET, OUTPUT_BUCKET=OUTPUT_BUCKET, STORAGE_EMULATOR_HOST=gcs_url,
+               GOOGLE_CLOUD_PROJECT="bench", IDEMPOTENCY_LEDGER="off", PORT=str(port), **MODES[mode])
+    env.update(setting.split("=", 1) for setting in args.env)
+    base_url = f"http://127.0.0.1:{port}/"
+    push_body = json.dumps({"message": {"data": base64.b64encode(pcap_name.encode()).decode(),
+                                        "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}}).encode()
+    with open(log_path, "ab") as f_log:
+        started = time.perf_counter()
+        service = subprocess.Popen(server_command(args.server, port), cwd=PROCESSOR_DIR, env=env,
+                                   stdout=f_log, stderr=subprocess.STDOUT)
+        try:
+            while True:
+                if service.poll() is not None:
+                    raise RuntimeError(f"service exited with {service.returncode} (see {log_path})")
+                try:
+                    if http_status(base_url, timeout=1) == 200:
+                        break
+                except (urllib.error.URLError, ConnectionError, socket.timeout):
+                    pass
+                if time.perf_counter() - started > args.timeout:
+                    raise RuntimeError(f"no answer to GET / after {args.timeout}s (see {log_path})")
+                time.sleep(0.005)
+            first_request_seconds = time.perf_counter() - started
+            push_status = http_status(base_url, push_body, timeout=args.timeout)
+            first_file_seconds = time.perf_counter() - started
+        finally:
+            service.terminate()
+            try:
+                service.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                service.kill()
+                service.wait()
+    return {"mode": mode, "push_status": push_status, "first_request_seconds": round(first_request_seconds, 4),
+            "first_file_seconds": round(first_file_seconds, 4)}
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(current, previous, max_regression):
+    """Prints per-mode median deltas against a previous results file. Returns False if a median regressed too much."""
+    within_budget = True
+    print(f"Compared with {previous.get('revision') or 'unknown revision'} ({previous.get('created_at')}):")
+    for mode, medians in current["medians"].items():
+        before = previous.get("medians", {}).get(mode)
+        if not before:
+            print(f"  {mode:<8} no previous result")
+            continue
+        deltas = []
+        for metric in METRICS:
+            change = medians[metric] / before[metric] - 1 if before.get(metric) else 0.0
+            regressed = change > max_regression
+            within_budget = within_budget and not regressed
+            deltas.append(f"{metric} {change:+7.1%}{' REGRESSION' if regressed else ''}")
+        print(f"  {mode:<8} " + "  ".join(deltas))
+    return within_budget
+
+def main():
+    parser = argparse.ArgumentParser(description="Processor cold start benchmark: time to first request / processed file.")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per mode")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated subset of {tuple(MODES)}")
+    parser.add_argument("--pcap", help="Capture sent as the first notification (default: synthetic)")
+    parser.add_argument("--packets", type=int, default=2000, help="Frames of the synthetic capture")
+    parser.add_argument("--server", choices=("gunicorn", "werkzeug"),
+                        default="gunicorn" if shutil.which("gunicorn") else "werkzeug")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Extra service setting (repeatable)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds allowed for each step of a run")
+    parser.add_argument("--save", help="Write the results JSON to this path")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.20, help="Allowed slowdown of a median for --compare")
+    args = parser.parse_args()
+
+    gcs = GcsStandIn((INCOMING_BUCKET, OUTPUT_BUCKET))
+    gcs_server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(gcs))
+    threading.Thread(target=gcs_server.serve_forever, daemon=True).start()
+    gcs_url = f"http://127.0.0.1:{gcs_server.server_address[1]}"
+    if not args.pcap:
+        args.pcap = os.path.join(tempfile.mkdtemp(prefix="bench-startup-"), "startup_bench.pcap")
+        native_parity.write_synthetic_capture(args.pcap, args.packets)
+    pcap_name = os.path.basename(args.pcap)
+    with open(args.pcap, "rb") as f_pcap:
+        gcs.put(INCOMING_BUCKET, {"name": pcap_name, "contentType": "application/vnd.tcpdump.pcap"}, f_pcap.read())
+
+    modes = args.modes.split(",")
+    runs = []
+    failures = []
+    log_path = os.path.join(tempfile.gettempdir(), "bench_startup_service.log")
+    open(log_path, "wb").close()
+    for run_number in range(args.runs):
+        for mode in modes: # Alternating, so a slow phase of the machine does not land on one mode only
+            with gcs.lock:
+                gcs.objects[OUTPUT_BUCKET].clear()
+            run = run_once(mode, args, gcs_url, pcap_name, log_path)
+            with gcs.lock:
+                run["output_objects"] = sorted(gcs.objects[OUTPUT_BUCKET])
+            runs.append(run)
+            print(f"  run {run_number + 1} {mode:<8} first request {run['first_request_seconds']:7.3f}s  "
+                  f"first file {run['first_file_seconds']:7.3f}s  push {run['push_status']}")
+            if run["push_status"] != 204 or not run["output_objects"]:
+                failures.append(f"{mode} run {run_number + 1}: push answered {run['push_status']}, "
+                                f"{len(run['output_objects'])} output objects (see {log_path})")
+    gcs_server.shutdown()
+
+    results = {"revision": git_revision(), "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+               "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+               "server": args.server, "pcap": pcap_name, "pcap_bytes": os.path.getsize(args.pcap), "env": args.env,
+               "medians": {mode: {metric: round(statistics.median(run[metric] for run in runs if run["mode"] == mode), 4)
+                                  for metric in METRICS} for mode in modes},
+               "runs": runs}
+    print(f"{args.runs} runs per mode, {args.server}, {pcap_name} ({results['pcap_bytes']} bytes), medians:")
+    for mode, medians in results["medians"].items():
+        print(f"  {mode:<8} time-to-first-request {medians['first_request_seconds']:7.3f}s  "
+              f"time-to-first-processed-file {medians['first_file_seconds']:7.3f}s")
+    if gcs.unexpected:
+        print(f"GCS stand-in: {len(gcs.unexpected)} unimplemented requests, e.g. {gcs.unexpected[0]}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f_results:
+            json.dump(results, f_results, indent=2)
+        print(f"Results saved to {args.save}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    if args.compare:
+        with open(args.compare) as f_previous:
+            if not compare_results(results, json.load(f_previous), args.max_regression):
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# test/benchmarks/bench_timestamps.py - Microbenchmark for the per-packet timestamp conversion.
+# Compares the original strptime-based conversion with the cached engine in json2udm_cloud
+# (text `frame.time_utc` form and `frame.time_epoch` form) on a synthetic, capture-like sequence:
+# many packets per second, monotonically increasing time.
+# Usage: python3 test/benchmarks/bench_timestamps.py [--packets 200000] [--packets-per-second 500]
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "processor"))
+import json2udm_cloud  # noqa: E402
+
+def legacy_convert_timestamp(timestamp_str):
+    """The strptime-based conversion used before the cached engine (kept here as the baseline)."""
+    try:
+        dt_naive = datetime.strptime(timestamp_str[:26], "%b %d, %Y %H:%M:%S.%f")
+    except ValueError:
+        cleaned_ts = timestamp_str.split(" UTC")[0].strip()
+        dt_naive = datetime.strptime(cleaned_ts, "%b %d, %Y %H:%M:%S")
+    return dt_naive.replace(tzinfo=timezone.utc).isoformat(timespec='microseconds').replace('+00:00', 'Z')
+
+def build_samples(packet_count, packets_per_second, start_epoch=1700000000):
+    """Returns parallel lists of `frame.time_utc` strings and `frame.time_epoch` strings."""
+    text_samples, epoch_samples = [], []
+    for index in range(packet_count):
+        seconds = start_epoch + index // packets_per_second
+        nanoseconds = (index % packets_per_second) * (10**9 // packets_per_second)
+        text_samples.append(time.strftime("%b %d, %Y %H:%M:%S", time.gmtime(seconds)) + f".{nanoseconds:09d} UTC")
+        epoch_samples.append(f"{seconds}.{nanoseconds:09d}")
+    return text_samples, epoch_samples
+
+def time_conversion(convert, samples):
+    started = time.perf_counter()
+    for sample in samples:
+        convert(sample)
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="Timestamp conversion microbenchmark.")
+    parser.add_argument("--packets", type=int, default=200000)
+    parser.add_argument("--packets-per-second", type=int, default=500)
+    args = parser.parse_args()
+
+    text_samples, epoch_samples = build_samples(args.packets, args.packets_per_second)
+    # The engine keeps microseconds the legacy path truncated (it cut the string at 26 chars), so compare
+    # on the second prefix only; the full value is checked against the epoch form instead.
+    for text_sample, epoch_sample in zip(text_samples[:1000], epoch_samples[:1000]):
+        assert json2udm_cloud.convert_timestamp_robust(text_sample) == json2udm_cloud.convert_epoch_timestamp(epoch_sample)
+        assert json2udm_cloud.convert_timestamp_robust(text_sample)[:19] == legacy_convert_timestamp(text_sample)[:19]
+
+    results = [("legacy strptime (frame.time_utc)", time_conversion(legacy_convert_timestamp, text_samples)),
+               ("cached text (frame.time_utc)", time_conversion(json2udm_cloud.convert_timestamp_robust, text_samples)),
+               ("cached epoch (frame.time_epoch)", time_conversion(json2udm_cloud.convert_epoch_timestamp, epoch_samples))]
+    baseline_seconds = results[0][1]
+    print(f"{args.packets} timestamps, {args.packets_per_second} packets/second")
+    for label, elapsed in results:
+        print(f"  {label:<34} {args.packets / elapsed:>12,.0f} conversions/s  speedup x{baseline_seconds / elapsed:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# test/benchmarks/chronicle_sender_check.py - Runs chronicle_sender.py against a local stand-in of the ingestion API.
+# A threaded HTTP server on 127.0.0.1 plays `udmevents:batchCreate`: it checks every request body (customer id,
+# event list, 1 MB limit), adds `--latency-ms` per request and answers every `--throttle-every`-th request with 429
+# plus `Retry-After`, every `--fail-every`-th with 503, or every request with `--reject-status`. It records when a
+# throttled batch may come back, so a retry that ignores `Retry-After` is counted.
+# The check converts a synthetic corpus (see synthetic_corpus.py), writes it as a UDM output, reads it back with
+# json2udm_cloud.iter_udm_output_events and sends it with spooling to a temporary directory. Then it replays the spool
+# against a healthy stand-in. Prints events/s and batch latency, and exits non-zero if an event is lost (neither
+# delivered nor kept in the spool's rejected folder) or duplicated, or if a retry came early.
+# Usage: python3 test/benchmarks/chronicle_sender_check.py [--packets 50000] [--workers 4] [--throttle-every 7] [--reject-status 400]
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "..", "processor"))
+sys.path.insert(0, BENCHMARK_DIR)
+import chronicle_sender  # noqa: E402
+import json2udm_cloud  # noqa: E402
+import synthetic_corpus  # noqa: E402
+
+CUSTOMER_ID = "00000000-0000-0000-0000-000000000000"
+REQUEST_LIMIT_BYTES = 1024 * 1024
+
+class StandInState:
+    def __init__(self, latency_seconds, throttle_every, fail_every, reject_status, retry_after_seconds):
+        self.lock = threading.Lock()
+        self.latency_seconds = latency_seconds
+        self.throttle_every = throttle_every
+        self.fail_every = fail_every
+        self.reject_status = reject_status
+        self.retry_after_seconds = retry_after_seconds
+        self.requests = 0
+        self.received = {} # event marker -> times accepted
+        self.not_before = {} # body digest -> monotonic time a throttled batch may be retried
+        self.early_retries = 0
+        self.bad_requests = 0
+
+def make_handler(state):
+    class IngestionHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _answer(self, status, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            time.sleep(state.latency_seconds)
+            digest = hashlib.sha1(body).hexdigest()
+            with state.lock:
+                state.requests += 1
+                request_number = state.requests
+                allowed_at = state.not_before.pop(digest, None)
+                if allowed_at is not None and time.monotonic() < allowed_at - 0.05:
+                    state.early_retries += 1
+            if self.path != chronicle_sender.INGESTION_PATH or len(body) > REQUEST_LIMIT_BYTES:
+                with state.lock:
+                    state.bad_requests += 1
+                return self._answer(400)
+            try:
+                payload = json.loads(body)
+                events = payload["events"]
+                assert payload["customer_id"] == CUSTOMER_ID and isinstance(events, list) and events
+            except (ValueError, KeyError, AssertionError):
+                with state.lock:
+                    state.bad_requests += 1
+                return self._answer(400)
+            if state.reject_status:
+                return self._answer(state.reject_status)
+            if state.throttle_every and request_number % state.throttle_every == 0:
+                with state.lock:
+                    state.not_before[digest] = time.monotonic() + state.retry_after_seconds
+                return self._answer(429, {"Retry-After": str(state.retry_after_seconds)})
+            if state.fail_every and request_number % state.fail_every == 0:
+                return self._answer(503)
+            with state.lock:
+                for udm_event in events:
+                    marker = udm_event.get("metadata", {}).get("product_event_type")
+                    state.received[marker] = state.received.get(marker, 0) + 1
+            self._answer(200)
+    return IngestionHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Chronicle sender check against a local ingestion stand-in.")
+    parser.add_argument("--packets", type=int, default=50000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output-format", choices=json2udm_cloud.OUTPUT_FORMATS, default="ndjson")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--batch-max-bytes", type=int, default=chronicle_sender.DEFAULT_BATCH_MAX_BYTES)
+    parser.add_argument("--batch-max-events", type=int, default=chronicle_sender.DEFAULT_BATCH_MAX_EVENTS)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Stand-in latency per request")
+    parser.add_argument("--throttle-every", type=int, default=7, help="Every Nth request gets 429 + Retry-After (0: never)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--fail-every", type=int, default=11, help="Every Nth request gets 503 (0: never)")
+    parser.add_argument("--reject-status", type=int, default=0, help="Answer every request with this status (e.g. 400, 503)")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    state = StandInState(args.latency_ms / 1000, args.throttle_every, args.fail_every, args.reject_status, args.retry_after)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}{chronicle_sender.INGESTION_PATH}"
+
+    # Every event is marked with its index in product_event_type, so losses and duplicates show up at the stand-in
+    conversion_stats = json2udm_cloud.new_conversion_stats()
+    udm_events = list(json2udm_cloud.iter_udm_events(synthetic_corpus.iter_packets(args.packets, seed=args.seed), conversion_stats))
+    for event_number, udm_event in enumerate(udm_events):
+        udm_event["event"]["metadata"]["product_event_type"] = f"check-{event_number}"
+    expected = {udm_event["event"]["metadata"]["product_event_type"] for udm_event in udm_events}
+
+    failures = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        udm_path = os.path.join(work_dir, json2udm_cloud.udm_output_filename("check", args.output_format, args.gzip))
+        with open(udm_path, "wb") as f_out:
+            json2udm_cloud.write_udm_events(iter(udm_events), f_out, args.output_format, args.gzip)
+        spool_store = chronicle_sender.LocalSpoolStore(os.path.join(work_dir, "spool"))
+        sender = chronicle_sender.ChronicleSender(
+            url, CUSTOMER_ID, chronicle_sender.build_session("none", pool_size=args.workers), spool_store, args.workers,
+            args.batch_max_bytes, args.batch_max_events, max_attempts=4, max_backoff_seconds=5.0)
+
+        with open(udm_path, "rb") as f_udm:
+            send_stats = sender.send_events(json2udm_cloud.iter_udm_output_events(f_udm, args.output_format, args.gzip),
+                                            "check.pcap", "check.pcap@1")
+        chronicle_sender.log_send_summary(send_stats, "check.pcap")
+        print(json.dumps(send_stats, indent=2))
+
+        with state.lock: # Healthy stand-in for the replay, which resends spooled batches on purpose
+            state.reject_status = state.throttle_every = state.fail_every = 0
+            state.not_before.clear()
+        spooled_batches = len(spool_store.list_names("retry/", args.packets))
+        replayed = sender.replay_spool(spooled_batches)
+        print(f"Replayed {replayed}/{spooled_batches} spooled batches; {len(spool_store.list_names('retry/', args.packets))} left.")
+        if replayed != spooled_batches:
+            failures.append(f"{spooled_batches - replayed} spooled batches were not replayed")
+        rejected = set() # Events of batches kept in the rejected folder (never replayed)
+        for name in spool_store.list_names("rejected/", args.packets):
+            rejected.update(udm_event["metadata"]["product_event_type"] for udm_event in json.loads(spool_store.get(name))["events"])
+        print(f"Rejected: {len(rejected)} events kept in the spool's rejected folder.")
+
+    server.shutdown()
+    print(f"Stand-in: {state.requests} requests, {state.early_retries} early retries, {state.bad_requests} bad requests.")
+    received = set(state.received)
+    if state.early_retries:
+        failures.append(f"{state.early_retries} retries came before Retry-After")
+    if state.bad_requests:
+        failures.append(f"{state.bad_requests} requests were malformed or above the size limit")
+    if received | rejected != expected or received & rejected:
+        failures.append(f"{len(expected - received - rejected)} events missing, {len(received - expected)} unexpected, "
+                        f"{len(received & rejected)} both delivered and rejected")
+    duplicated = sum(1 for count in state.received.values() if count > 1)
+    if duplicated:
+        failures.append(f"{duplicated} events delivered more than once")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"OK: {len(received)} events delivered exactly once, {len(rejected)} rejected.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# test/benchmarks/ledger_check.py - Checks the idempotency ledger (processor/processing_ledger.py) on its local stand-in.
+# Runs ProcessingLedger on a LocalLedgerStore in a temporary directory, with a short lease so renewals happen within
+# the check, and plays the sequences processor_app.py relies on:
+# - create-only acquire: a second delivery gets no lease while the first holds a live one;
+# - takeover: an expired lease (crashed holder, no renewal) is taken over by exactly one of several deliveries;
+# - lost lease: the renewal marks the lease `lost` when another delivery took it over, and when it could not be
+#   renewed (store failing) until it expired; a transient failure alone does not lose it;
+# - completion: after `complete` the marker is readable, the lease is gone and a redelivery is skipped;
+# - acquire versus complete: a delivery that passed the completion check, then acquires right after the holder
+#   completed and deleted its lease, gets a fresh lease - the handler's second completion check must see the marker.
+# Prints one line per case and exits non-zero if any of them fails.
+# Usage: python3 test/benchmarks/ledger_check.py [--lease-seconds 0.6]
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "..", "processor"))
+import processing_ledger  # noqa: E402
+
+class FlakyStore:
+    """LocalLedgerStore whose lease renewals (`replace`) raise ConnectionError while `failing_renewals` > 0."""
+    def __init__(self, store):
+        self.store = store
+        self.failing_renewals = 0
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def replace(self, name, record, generation):
+        if self.failing_renewals > 0:
+            self.failing_renewals -= 1
+            raise ConnectionError("503 Service Unavailable (injected)")
+        return self.store.replace(name, record, generation)
+
+def check(failures, case, condition, detail=""):
+    print(f"{'ok  ' if condition else 'FAIL'} {case}{': ' + detail if detail and not condition else ''}")
+    if not condition:
+        failures.append(case)
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the processor's idempotency ledger on its local stand-in.")
+    parser.add_argument("--lease-seconds", type=float, default=0.6, help="Lease duration; renewed every third of it")
+    parser.add_argument("--deliveries", type=int, default=8, help="Concurrent deliveries racing for an expired lease")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL, format="%(levelname)s %(message)s") # The expected lease warnings stay quiet
+    lease_seconds = args.lease_seconds
+    failures = []
+
+    with tempfile.TemporaryDirectory() as ledger_dir:
+        store = FlakyStore(processing_ledger.LocalLedgerStore(ledger_dir))
+        ledger = processing_ledger.ProcessingLedger(store, lease_seconds)
+
+        # Create-only acquire
+        first_lease = ledger.acquire("create.pcap@1")
+        second_lease = ledger.acquire("create.pcap@1")
+        check(failures, "create-only acquire", first_lease is not None and second_lease is None)
+        time.sleep(lease_seconds * 1.5) # Renewed meanwhile: still held
+        check(failures, "renewed lease stays held", ledger.acquire("create.pcap@1") is None and not first_lease.lost)
+        ledger.release(first_lease)
+        released_lease = ledger.acquire("create.pcap@1")
+        check(failures, "released lease can be acquired at once", released_lease is not None)
+        ledger.release(released_lease)
+
+        # Takeover of an expired lease: the holder crashed (renewal stopped, lease left behind)
+        crashed_lease = ledger.acquire("takeover.pcap@1")
+        crashed_lease.stop_renewal.set()
+        crashed_lease.renewal_thread.join()
+        time.sleep(lease_seconds * 1.2)
+        winners = []
+        barrier = threading.Barrier(args.deliveries)
+        def deliver():
+            barrier.wait()
+            lease = ledger.acquire("takeover.pcap@1")
+            if lease is not None:
+                winners.append(lease)
+        threads = [threading.Thread(target=deliver) for _ in range(args.deliveries)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check(failures, "expired lease taken over by exactly one delivery", len(winners) == 1, f"{len(winners)} winners")
+        for lease in winners:
+            ledger.release(lease)
+
+        # Renewal finds the lease taken over: lost
+        slow_lease = ledger.acquire("lost.pcap@1")
+        current_record, current_generation = store.read("lost.pcap@1.lease")
+        store.replace("lost.pcap@1.lease", dict(current_record, holder="other-delivery"), current_generation)
+        time.sleep(lease_seconds * 0.6)
+        check(failures, "renewal marks a taken-over lease lost", slow_lease.lost)
+        ledger.release(slow_lease)
+        check(failures, "a lost lease is not deleted on release", store.read("lost.pcap@1.lease")[0]["holder"] == "other-delivery")
+
+        # Renewal failing transiently keeps the lease; failing until expiry loses it
+        store.failing_renewals = 1
+        flaky_lease = ledger.acquire("transient.pcap@1")
+        time.sleep(lease_seconds * 0.9)
+        check(failures, "one failed renewal does not lose the lease", not flaky_lease.lost and flaky_lease.renewal_thread.is_alive())
+        ledger.release(flaky_lease)
+        store.failing_renewals = 10**6
+        failing_lease = ledger.acquire("expired.pcap@1")
+        time.sleep(lease_seconds * 1.6)
+        check(failures, "renewal failing until expiry marks the lease lost", failing_lease.lost and not failing_lease.renewal_thread.is_alive())
+        ledger.release(failing_lease)
+        store.failing_renewals = 0
+
+        # Completion marker: readable, lease deleted, redelivery skipped
+        done_lease = ledger.acquire("done.pcap@1")
+        ledger.complete(done_lease, {"output": "done.udm.json"})
+        check(failures, "completed job has its marker and no lease",
+              (ledger.completed_record("done.pcap@1") or {}).get("output") == "done.udm.json"
+              and store.read("done.pcap@1.lease")[0] is None)
+
+        # Acquire versus complete: B passes the completion check, A completes, then B acquires
+        holder_lease = ledger.acquire("race.pcap@1")
+        completed_before = ledger.completed_record("race.pcap@1") # B's first check
+        ledger.complete(holder_lease, {"output": "race.udm.json"}) # A finishes in between
+        racing_lease = ledger.acquire("race.pcap@1") # B: the lease is free again
+        completed_after = ledger.completed_record("race.pcap@1") # B's second check, right after acquiring
+        check(failures, "completion seen by the check after acquire",
+              completed_before is None and racing_lease is not None and completed_after is not None)
+        if racing_lease is not None:
+            ledger.release(racing_lease)
+
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
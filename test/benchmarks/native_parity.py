@@ -0,0 +1,243 @@
+# test/benchmarks/native_parity.py - Field-for-field parity check of the native pcap decoder (native_pcap.py) against tshark.
+# For one capture (a given pcap / pcapng, or a synthetic one covering every decoder branch) it builds the UDM events
+# twice, both through `convert_single_packet_to_udm`:
+# - reference: every frame dissected by `tshark -T json` (or the projected `-T ek` with --input-format ek),
+# - native:    plain frames decoded by native_pcap.py, the routed ones dissected by tshark from the sub-capture,
+# then compares them frame by frame on every UDM field path, and prints the mismatches per field with examples,
+# the native / routed split and the time of both paths. Exits non-zero on any mismatch.
+# Needs tshark on PATH, except with --decode-only (classification and native decoding speed only).
+# Usage: python3 test/benchmarks/native_parity.py [capture.pcap] [--synthetic 20000 [--pcapng]] [--input-format ek] [--decode-only]
+
+import argparse
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "processor"))
+import json2udm_cloud  # noqa: E402
+import native_pcap  # noqa: E402
+import pcap_pipeline  # noqa: E402
+
+MAX_EXAMPLES = 3
+
+# --- Synthetic capture ---
+# Endpoints come from small pools, as in real traffic (a capture has thousands of frames but tens of hosts).
+_POOL = random.Random(99)
+MACS = [bytes((_POOL.randrange(256) & 0xFE,)) + _POOL.randbytes(5) for _ in range(40)] # Unicast
+IPV4_ADDRESSES = [_POOL.randbytes(4) for _ in range(200)]
+IPV6_ADDRESSES = [b"\x20\x01\x0d\xb8" + bytes(10) + _POOL.randbytes(2) for _ in range(20)] + \
+                 [b"\xfe\x80" + bytes(6) + _POOL.randbytes(8) for _ in range(20)]
+
+def _ethernet(rng, ether_type, vlan=False):
+    header = rng.choice(MACS) + rng.choice(MACS)
+    if vlan:
+        header += struct.pack("!HH", 0x8100, rng.randrange(1, 4095))
+    return header + struct.pack("!H", ether_type)
+
+def _ipv4(rng, protocol, payload, fragment=False):
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), rng.randrange(65536),
+                         0x2000 if fragment else 0x4000, rng.choice((64, 128, 255)), protocol, 0,
+                         rng.choice(IPV4_ADDRESSES), rng.choice(IPV4_ADDRESSES))
+    return header + payload
+
+def _ipv6(rng, next_header, payload):
+    return struct.pack("!IHBB16s16s", 0x60000000, len(payload), next_header, 64,
+                       rng.choice(IPV6_ADDRESSES), rng.choice(IPV6_ADDRESSES)) + payload
+
+def _tcp(rng, src_port, dst_port, flags, payload=b""):
+    return struct.pack("!HHIIHHHH", src_port, dst_port, rng.randrange(1 << 32), rng.randrange(1 << 32),
+                       (5 << 12) | flags, 65535, 0, 0) + payload
+
+def _udp(src_port, dst_port, payload):
+    return struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0) + payload
+
+def _dns_query(rng):
+    name = b"".join(bytes((len(label),)) + label for label in (b"www", rng.choice((b"example", b"vendor")), b"com")) + b"\x00"
+    return struct.pack("!HHHHHH", rng.randrange(65536), 0x0100, 1, 0, 0, 0) + name + struct.pack("!HH", 1, 1)
+
+def _http_request(rng):
+    return f"GET /item/{rng.randrange(1000)} HTTP/1.1\r\nHost: shop.example.com\r\nUser-Agent: bench\r\n\r\n".encode()
+
+def _arp(rng):
+    return struct.pack("!HHBBH6s4s6s4s", 1, 0x0800, 6, 4, rng.choice((1, 2)), rng.choice(MACS), rng.choice(IPV4_ADDRESSES),
+                       bytes(6), rng.choice(IPV4_ADDRESSES))
+
+def build_synthetic_frame(rng):
+    """One Ethernet frame of a weighted mix: mostly plain TCP / UDP, plus every case the decoder routes to tshark."""
+    ephemeral_port, server_port = rng.randrange(32768, 61000), rng.choice((8081, 9000, 27500, 44321))
+    kind = rng.choices(("tcp_ack", "tcp_data", "tcp_syn", "udp_data", "ipv6_tcp", "ipv6_udp", "vlan_tcp", "icmp_echo",
+                        "arp", "dns", "http", "tls", "icmp_unreachable", "fragment"),
+                       weights=(25, 20, 5, 10, 5, 3, 3, 4, 3, 8, 4, 6, 1, 1))[0]
+    if kind == "tcp_ack":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 6, _tcp(rng, ephemeral_port, server_port, 0x010))
+    if kind == "tcp_data":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 6, _tcp(rng, server_port, ephemeral_port, 0x018, rng.randbytes(rng.randrange(1, 1400))))
+    if kind == "tcp_syn":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 6, _tcp(rng, ephemeral_port, rng.choice((22, 443, server_port)), 0x002))
+    if kind == "udp_data":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 17, _udp(ephemeral_port, server_port, rng.randbytes(rng.randrange(0, 512))))
+    if kind == "ipv6_tcp":
+        return _ethernet(rng, 0x86DD) + _ipv6(rng, 6, _tcp(rng, ephemeral_port, server_port, 0x010))
+    if kind == "ipv6_udp":
+        return _ethernet(rng, 0x86DD) + _ipv6(rng, 17, _udp(ephemeral_port, server_port, rng.randbytes(64)))
+    if kind == "vlan_tcp":
+        return _ethernet(rng, 0x0800, vlan=True) + _ipv4(rng, 6, _tcp(rng, ephemeral_port, server_port, 0x011))
+    if kind == "icmp_echo":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 1, struct.pack("!BBHHH", rng.choice((0, 8)), 0, 0, 1, rng.randrange(65536)) + rng.randbytes(32))
+    if kind == "arp":
+        return _ethernet(rng, 0x0806) + _arp(rng)
+    if kind == "dns":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 17, _udp(ephemeral_port, 53, _dns_query(rng)))
+    if kind == "http":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 6, _tcp(rng, ephemeral_port, 80, 0x018, _http_request(rng)))
+    if kind == "tls":
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 6, _tcp(rng, 443, ephemeral_port, 0x018, b"\x17\x03\x03" + struct.pack("!H", 48) + rng.randbytes(48)))
+    if kind == "icmp_unreachable":
+        inner = _ipv4(rng, 17, _udp(ephemeral_port, server_port, b""))
+        return _ethernet(rng, 0x0800) + _ipv4(rng, 1, struct.pack("!BBHI", 3, 3, 0, 0) + inner)
+    return _ethernet(rng, 0x0800) + _ipv4(rng, 17, _udp(ephemeral_port, server_port, rng.randbytes(64)), fragment=True)
+
+def write_synthetic_capture(path, packet_count, seed=1234, pcapng=False, start_epoch=1700000000):
+    """Writes `packet_count` synthetic frames as a microsecond pcap, or a pcapng with nanosecond timestamps."""
+    rng = random.Random(seed)
+    with open(path, "wb") as f_out:
+        if pcapng:
+            f_out.write(struct.pack("<IIIHHqI", 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+            options = struct.pack("<HHB3x", 9, 1, 9) + struct.pack("<HH", 0, 0)
+            f_out.write(struct.pack("<IIHHI", 1, 20 + len(options), 1, 0, 0) + options + struct.pack("<I", 20 + len(options)))
+        else:
+            f_out.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 262144, 1))
+        for frame_index in range(packet_count):
+            frame = build_synthetic_frame(rng)
+            frame += bytes(max(0, 60 - len(frame))) # Ethernet minimum size: padding after the IP packet
+            timestamp_ns = (start_epoch + frame_index // 500) * 10 ** 9 + frame_index * 1999 % 10 ** 9
+            if pcapng:
+                padded = frame + bytes(-len(frame) % 4)
+                block_length = 32 + len(padded)
+                f_out.write(struct.pack("<IIIIIII", 6, block_length, 0, timestamp_ns >> 32, timestamp_ns & 0xFFFFFFFF,
+                                        len(frame), len(frame)) + padded + struct.pack("<I", block_length))
+            else:
+                seconds, nanoseconds = divmod(timestamp_ns, 10 ** 9)
+                f_out.write(struct.pack("<IIII", seconds, nanoseconds // 1000, len(frame), len(frame)) + frame)
+
+# --- Both paths ---
+def tshark_packets(pcap_path, input_format):
+    tshark_command = pcap_pipeline.build_tshark_command(pcap_path, input_format)
+    with tempfile.TemporaryFile() as f_tshark:
+        subprocess.run(tshark_command, stdout=f_tshark, check=True)
+        f_tshark.seek(0)
+        stats = json2udm_cloud.new_conversion_stats()
+        packets = list(json2udm_cloud.iter_tshark_packets(f_tshark, stats, input_format))
+    if stats.get("parse_error"):
+        raise RuntimeError(f"Malformed tshark output for {pcap_path}: {stats['parse_error']}")
+    return packets
+
+def reference_events(pcap_path, input_format):
+    return [json2udm_cloud.convert_single_packet_to_udm(packet_data) for packet_data in tshark_packets(pcap_path, input_format)]
+
+def native_events(pcap_path, input_format, deep_ports):
+    stats = {}
+    with native_pcap.NativeCapture(pcap_path, deep_ports) as native_capture:
+        native_capture.classify()
+        deep_packets = []
+        if native_capture.deep_frames:
+            with tempfile.NamedTemporaryFile(suffix=".pcap") as f_deep:
+                native_capture.write_deep_frames(f_deep)
+                f_deep.flush()
+                deep_packets = tshark_packets(f_deep.name, input_format)
+        events = [json2udm_cloud.convert_single_packet_to_udm(packet_data)
+                  for packet_data in native_capture.iter_packets(deep_packets, stats)]
+        routing = bytes(native_capture.routing)
+    if stats.get("parse_error"):
+        raise RuntimeError(stats["parse_error"])
+    return events, routing
+
+def flatten(value, prefix=""):
+    """{"event.network.tcp_flags": "0x0018", "event.about.0.hostname": ...} for one UDM event."""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = ((str(index), item) for index, item in enumerate(value))
+    else:
+        return {prefix: value}
+    flat = {}
+    for key, item in items:
+        flat.update(flatten(item, f"{prefix}.{key}" if prefix else key))
+    return flat
+
+def compare(reference, native, routing):
+    """{field path: [count, [(frame number, routed, reference value, native value), ...]]} of the differing fields."""
+    mismatches = {}
+    if len(reference) != len(native):
+        mismatches["<event count>"] = [1, [(None, None, len(reference), len(native))]]
+    for frame_number, (reference_event, native_event) in enumerate(zip(reference, native), start=1):
+        reference_fields, native_fields = flatten(reference_event), flatten(native_event)
+        for field_path in reference_fields.keys() | native_fields.keys():
+            reference_value, native_value = reference_fields.get(field_path), native_fields.get(field_path)
+            if reference_value != native_value:
+                field_mismatches = mismatches.setdefault(field_path, [0, []])
+                field_mismatches[0] += 1
+                if len(field_mismatches[1]) < MAX_EXAMPLES:
+                    field_mismatches[1].append((frame_number, bool(routing[frame_number - 1]), reference_value, native_value))
+    return mismatches
+
+def decode_only(pcap_path, deep_ports):
+    """Times the two native passes without tshark: classification, then decoding of the native frames."""
+    with native_pcap.NativeCapture(pcap_path, deep_ports) as native_capture:
+        started = time.perf_counter()
+        native_frames, deep_frames = native_capture.classify()
+        classify_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        decoded = sum(1 for _ in native_capture.iter_packets(iter(lambda: {}, None), {}))
+        decode_seconds = time.perf_counter() - started
+    total_frames = native_frames + deep_frames
+    print(f"{total_frames} frames: {native_frames} native ({native_frames / max(total_frames, 1):.1%}), {deep_frames} routed to tshark")
+    print(f"  classify: {total_frames / classify_seconds:>12,.0f} frames/s")
+    print(f"  decode:   {decoded / decode_seconds:>12,.0f} frames/s (routed frames are placeholders here)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Native pcap decoder vs tshark parity check.")
+    parser.add_argument("capture", nargs="?", help="pcap / pcapng file (default: a synthetic capture)")
+    parser.add_argument("--synthetic", type=int, default=20000, help="Frames of the synthetic capture")
+    parser.add_argument("--pcapng", action="store_true", help="Write the synthetic capture as pcapng")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--input-format", choices=json2udm_cloud.INPUT_FORMATS, default="json", help="tshark output format of both paths")
+    parser.add_argument("--deep-ports", default="", help="Extra ports routed to tshark (as NATIVE_DEEP_PORTS)")
+    parser.add_argument("--decode-only", action="store_true", help="Only time the native passes (no tshark needed)")
+    args = parser.parse_args()
+    json2udm_cloud.logging.disable(json2udm_cloud.logging.WARNING)
+    deep_ports = native_pcap.DEEP_DISSECTION_PORTS | {int(port) for port in args.deep_ports.split(",") if port.strip()}
+
+    with tempfile.TemporaryDirectory(prefix="native-parity-") as work_dir:
+        pcap_path = args.capture
+        if pcap_path is None:
+            pcap_path = os.path.join(work_dir, "synthetic.pcapng" if args.pcapng else "synthetic.pcap")
+            write_synthetic_capture(pcap_path, args.synthetic, args.seed, args.pcapng)
+        if args.decode_only:
+            decode_only(pcap_path, deep_ports)
+            return
+
+        started = time.perf_counter()
+        reference = reference_events(pcap_path, args.input_format)
+        reference_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        native, routing = native_events(pcap_path, args.input_format, deep_ports)
+        native_seconds = time.perf_counter() - started
+
+    print(f"{len(reference)} frames: {routing.count(0)} native, {routing.count(1)} routed to tshark")
+    print(f"  tshark only: {reference_seconds:8.2f} s   native + routed: {native_seconds:8.2f} s   ({reference_seconds / native_seconds:.1f}x)")
+    mismatches = compare(reference, native, routing)
+    for field_path, (count, examples) in sorted(mismatches.items()):
+        print(f"  MISMATCH {field_path}: {count} frames")
+        for frame_number, routed, reference_value, native_value in examples:
+            print(f"    frame {frame_number} ({'routed' if routed else 'native'}): tshark={reference_value!r} native={native_value!r}")
+    if mismatches:
+        sys.exit(1)
+    print("  All UDM fields agree.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# test/benchmarks/rotation_check.py - Checks the sniffer's adaptive rotation (sniffer/rotation_controller.py) offline.
+# 1. The packet counter the controller uses is compared with the packet count of synthetic pcap and pcapng files
+#    (see native_parity.py), complete and with a truncated tail.
+# 2. A simulated sniffer runs a traffic profile (`--profile`: phases of seconds x packets/s) on a simulated clock:
+#    tshark closes a file on its size or duration threshold, one upload line ships it at `--upload-mbps` plus
+#    `--per-file-seconds` of fixed cost (upload, publish, Cloud Run invocation). The fixed ROTATE and the adaptive
+#    controller run the same profile. A rotation change restarts tshark, which loses `--restart-gap` seconds of traffic.
+# Prints files, packets per file, worst end-to-end latency (first packet of a file captured -> notification published)
+# and the controller's decisions per phase. Exits non-zero if the counter is wrong or the adaptive run's worst latency
+# (after its first decision) exceeds ROTATION_MAX_LATENCY_SECONDS by more than the slack of one status interval.
+# Usage: python3 test/benchmarks/rotation_check.py [--profile 900x20,900x2000,600x20000,900x200] [--target-packets 100000]
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "..", "sniffer"))
+sys.path.insert(0, BENCHMARK_DIR)
+import native_parity  # noqa: E402
+import rotation_controller  # noqa: E402
+
+STATUS_INTERVAL_SECONDS = 60 # As UPLOAD_STATUS_INTERVAL_SECONDS: the uploader evaluates the controller this often
+
+def check_packet_counter(failures):
+    with tempfile.TemporaryDirectory() as work_dir:
+        for pcapng in (False, True):
+            capture_path = os.path.join(work_dir, "check.pcapng" if pcapng else "check.pcap")
+            native_parity.write_synthetic_capture(capture_path, 5000, pcapng=pcapng)
+            counted = rotation_controller.count_capture_packets(capture_path)
+            with open(capture_path, "r+b") as f_capture: # Cut into the last record, as a killed writer would
+                f_capture.truncate(os.path.getsize(capture_path) - 10)
+            counted_truncated = rotation_controller.count_capture_packets(capture_path)
+            print(f"Packet counter ({'pcapng' if pcapng else 'pcap'}): {counted} of 5000, {counted_truncated} of 4999 after truncation.")
+            if (counted, counted_truncated) != (5000, 4999):
+                failures.append(f"packet counter wrong for {'pcapng' if pcapng else 'pcap'}")
+
+def parse_profile(profile):
+    return [(int(seconds), float(rate)) for seconds, rate in (phase.split("x") for phase in profile.split(","))]
+
+def simulate(profile, rotate, controller, args):
+    """One run on a simulated clock. Returns per-phase rows and the worst latency after the first decision."""
+    clock = [0.0]
+    if controller is not None:
+        controller.clock = lambda: clock[0]
+    filesize_kb, duration_seconds = rotation_controller.parse_rotate(rotate)
+    upload_bytes_per_second = args.upload_mbps * 125000
+    upload_free_at = 0.0 # Single upload line: time the last queued file is shipped
+    shipping = [] # (shipped at, closed at, ship seconds) of files not yet notified
+    file_started_at, file_packets, file_bytes = 0.0, 0, 0
+    first_decision_at, worst_latency, lost_packets = None, 0.0, 0
+    rows = []
+
+    def close_file(now):
+        nonlocal upload_free_at, file_started_at, file_packets, file_bytes, worst_latency
+        if file_packets:
+            upload_free_at = max(upload_free_at, now) + args.per_file_seconds + file_bytes / upload_bytes_per_second
+            shipping.append((upload_free_at, now, upload_free_at - now))
+            if controller is not None:
+                controller.record_file(file_packets, file_bytes, now - file_started_at)
+            if first_decision_at is not None or controller is None:
+                worst_latency = max(worst_latency, upload_free_at - file_started_at)
+            phase_row["files"] += 1
+            phase_row["packets"] += file_packets
+        file_started_at, file_packets, file_bytes = now, 0, 0
+
+    second = 0
+    for phase_seconds, packets_per_second in profile:
+        phase_row = {"rate": packets_per_second, "files": 0, "packets": 0, "decisions": []}
+        rows.append(phase_row)
+        for _ in range(phase_seconds):
+            second += 1
+            clock[0] = float(second)
+            file_packets += int(packets_per_second)
+            file_bytes += int(packets_per_second * args.bytes_per_packet)
+            if file_bytes >= filesize_kb * 1024 or second - file_started_at >= duration_seconds:
+                close_file(clock[0])
+            while shipping and shipping[0][0] <= clock[0]:
+                _, _, ship_seconds = shipping.pop(0)
+                if controller is not None:
+                    controller.record_shipped(ship_seconds)
+            if controller is not None and second % STATUS_INTERVAL_SECONDS == 0:
+                new_rotate = controller.evaluate(len(shipping))
+                if new_rotate:
+                    first_decision_at = first_decision_at or clock[0]
+                    phase_row["decisions"].append(new_rotate)
+                    close_file(clock[0]) # tshark is restarted: the current file closes, the gap is not captured
+                    lost_packets += int(packets_per_second * args.restart_gap)
+                    filesize_kb, duration_seconds = rotation_controller.parse_rotate(new_rotate)
+    close_file(clock[0])
+    return rows, worst_latency, lost_packets
+
+def print_run(label, rows, worst_latency, lost_packets):
+    total_files = sum(row["files"] for row in rows)
+    print(f"{label}: {total_files} files, worst latency {worst_latency:.0f}s, {lost_packets} packets lost to restarts")
+    for row in rows:
+        per_file = row["packets"] / row["files"] if row["files"] else 0
+        print(f"    {row['rate']:>9.0f} pkt/s: {row['files']:>4} files, {per_file:>9.0f} packets/file"
+              + (f", decisions: {' | '.join(row['decisions'])}" if row["decisions"] else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline check of the sniffer's adaptive rotation controller.")
+    parser.add_argument("--profile", default="900x20,900x2000,600x20000,900x200", help="Phases: <seconds>x<packets/s>,...")
+    parser.add_argument("--rotate", default=rotation_controller.DEFAULT_ROTATE, help="Fixed rotation, and the adaptive start value")
+    parser.add_argument("--bytes-per-packet", type=float, default=400.0)
+    parser.add_argument("--upload-mbps", type=float, default=50.0)
+    parser.add_argument("--per-file-seconds", type=float, default=2.0, help="Fixed cost per shipped file")
+    parser.add_argument("--restart-gap", type=float, default=1.0, help="Seconds not captured while tshark restarts")
+    parser.add_argument("--target-packets", type=int, default=100000)
+    parser.add_argument("--max-latency", type=float, default=300.0)
+    parser.add_argument("--min-change-interval", type=float, default=300.0)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING) # Decisions are printed per phase below
+
+    failures = []
+    check_packet_counter(failures)
+    profile = parse_profile(args.profile)
+    print_run(f"Fixed '{args.rotate}'", *simulate(profile, args.rotate, None, args))
+    controller = rotation_controller.RotationController(
+        None, args.rotate, target_packets=args.target_packets, max_latency_seconds=args.max_latency,
+        min_change_interval_seconds=args.min_change_interval)
+    rows, worst_latency, lost_packets = simulate(profile, args.rotate, controller, args)
+    print_run("Adaptive", rows, worst_latency, lost_packets)
+    if worst_latency > args.max_latency + STATUS_INTERVAL_SECONDS:
+        failures.append(f"adaptive worst latency {worst_latency:.0f}s above the {args.max_latency:.0f}s budget")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# test/benchmarks/synthetic_corpus.py - Synthetic TShark output generator for offline converter benchmarks.
+# Produces `tshark -T json`-shaped packet arrays (and the projected `-T ek -e ...` form) with a configurable
+# protocol mix, realistic layer nesting (DNS query/answer sections, TLS record lists, HTTP headers) and
+# the unmapped filler fields real dissections carry, plus optional malformed packets.
+# No tshark or network access is needed; output is deterministic for a given seed.
+# Usage: python3 test/benchmarks/synthetic_corpus.py out.json --packets 100000 --mix tcp=40,udp=10,dns=20,tls=20,http=5,icmp=3,arp=2 --malformed 0.01
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "processor"))
+import json2udm_cloud  # noqa: E402
+
+DEFAULT_MIX = {"tcp": 40, "udp": 10, "dns": 20, "tls": 20, "http": 5, "icmp": 3, "arp": 2}
+PROTOCOLS = tuple(DEFAULT_MIX)
+DOMAINS = ("example.com", "api.example.net", "cdn.example.org", "mail.example.com", "updates.vendor.io")
+
+def parse_mix(mix_text):
+    """Parses "tcp=40,dns=20" into a weights dict; unknown protocols are rejected."""
+    mix = {}
+    for item in mix_text.split(","):
+        protocol, _, weight = item.partition("=")
+        if protocol.strip() not in PROTOCOLS:
+            raise ValueError(f"Unknown protocol '{protocol}' in mix; expected one of {PROTOCOLS}")
+        mix[protocol.strip()] = float(weight)
+    return mix
+
+def _mac(rng):
+    return ":".join(f"{rng.randrange(256):02x}" for _ in range(6))
+
+def _ipv4(rng, private=True):
+    return f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}" if private else \
+        f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+
+def _frame_layer(frame_number, epoch_seconds, protocols, frame_length):
+    fraction = f"{frame_number * 7919 % 1000000000:09d}"
+    return {
+        "frame.encap_type": "1",
+        "frame.time": time.strftime("%b %d, %Y %H:%M:%S", time.gmtime(epoch_seconds)) + f".{fraction} UTC",
+        "frame.time_utc": time.strftime("%b %d, %Y %H:%M:%S", time.gmtime(epoch_seconds)) + f".{fraction} UTC",
+        "frame.time_epoch": f"{epoch_seconds}.{fraction}",
+        "frame.offset_shift": "0.000000000",
+        "frame.time_delta": "0.000120000",
+        "frame.time_relative": f"{frame_number / 1000:.9f}",
+        "frame.number": str(frame_number),
+        "frame.len": str(frame_length),
+        "frame.cap_len": str(frame_length),
+        "frame.marked": "0",
+        "frame.ignored": "0",
+        "frame.protocols": protocols,
+    }
+
+def _ip_layer(rng, src, dst, protocol_number):
+    return {"ip.version": "4", "ip.hdr_len": "20", "ip.dsfield": "0x00", "ip.len": str(rng.randrange(40, 1500)),
+            "ip.id": f"0x{rng.randrange(65536):04x}", "ip.flags": "0x02", "ip.ttl": str(rng.choice((64, 128, 255))),
+            "ip.proto": str(protocol_number), "ip.checksum": f"0x{rng.randrange(65536):04x}",
+            "ip.checksum.status": "2", "ip.src": src, "ip.addr": src, "ip.src_host": src,
+            "ip.dst": dst, "ip.dst_host": dst}
+
+def _tcp_layer(rng, src_port, dst_port, flags):
+    return {"tcp.srcport": str(src_port), "tcp.dstport": str(dst_port), "tcp.port": str(src_port),
+            "tcp.stream": str(rng.randrange(1000)), "tcp.len": str(rng.randrange(0, 1400)),
+            "tcp.seq": str(rng.randrange(1, 10**6)), "tcp.ack": str(rng.randrange(1, 10**6)),
+            "tcp.hdr_len": "20", "tcp.flags": f"0x{flags:04x}",
+            "tcp.flags_tree": {"tcp.flags.syn": str(flags >> 1 & 1), "tcp.flags.ack": str(flags >> 4 & 1),
+                               "tcp.flags.push": str(flags >> 3 & 1), "tcp.flags.fin": str(flags & 1)},
+            "tcp.window_size_value": "502", "tcp.checksum": f"0x{rng.randrange(65536):04x}",
+            "tcp.checksum.status": "2", "tcp.urgent_pointer": "0"}
+
+def _udp_layer(rng, src_port, dst_port):
+    return {"udp.srcport": str(src_port), "udp.dstport": str(dst_port), "udp.port": str(src_port),
+            "udp.length": str(rng.randrange(8, 512)), "udp.checksum": f"0x{rng.randrange(65536):04x}",
+            "udp.checksum.status": "2", "udp.stream": str(rng.randrange(1000))}
+
+def _dns_layer(rng):
+    is_response = rng.random() < 0.5
+    query_count = rng.choice((1, 1, 1, 2))
+    queries = {}
+    answers = {}
+    for query_index in range(query_count):
+        name = rng.choice(DOMAINS)
+        query_type = rng.choice(("1", "28", "5"))
+        queries[f"{name}: type {query_type}, class IN #{query_index}"] = {
+            "dns.qry.name": name, "dns.qry.name.len": str(len(name)), "dns.count.labels": str(name.count(".") + 1),
+            "dns.qry.type": query_type, "dns.qry.class": "0x0001"}
+        if is_response:
+            for answer_index in range(rng.randrange(1, 4)):
+                answers[f"{name}: type A, class IN, addr #{query_index}.{answer_index}"] = {
+                    "dns.resp.name": name, "dns.resp.type": "1", "dns.resp.class": "0x0001",
+                    "dns.resp.ttl": str(rng.choice((30, 60, 300, 3600))), "dns.resp.len": "4", "dns.a": _ipv4(rng, False)}
+    layer = {"dns.id": f"0x{rng.randrange(65536):04x}", "dns.flags": "0x8180" if is_response else "0x0100",
+             "dns.flags_tree": {"dns.flags.response": "1" if is_response else "0", "dns.flags.opcode": "0",
+                                "dns.flags.recdesired": "1"},
+             "dns.count.queries": str(query_count), "dns.count.answers": str(len(answers)),
+             "Queries": queries}
+    if answers:
+        layer["Answers"] = answers
+    return layer
+
+def _tls_layer(rng):
+    record_count = rng.choice((1, 1, 2, 3))
+    records = []
+    for record_index in range(record_count):
+        record = {"tls.record.content_type": "22" if record_index == 0 else "23",
+                  "tls.record.version": rng.choice(("0x0301", "0x0303")), "tls.record.length": str(rng.randrange(40, 16384))}
+        if record_index == 0:
+            record["tls.handshake"] = {"tls.handshake.type": "1", "tls.handshake.length": "508",
+                                       "tls.handshake.version": "0x0303",
+                                       "tls.handshake.random": "".join(f"{rng.randrange(256):02x}" for _ in range(32)),
+                                       "tls.handshake.extensions_server_name": rng.choice(DOMAINS)}
+        records.append(record)
+    return {"tls.record": records[0] if record_count == 1 else records}
+
+def _http_layer(rng):
+    host = rng.choice(DOMAINS)
+    if rng.random() < 0.6:
+        path = rng.choice(("/", "/index.html", "/api/v1/items?page=2", "/static/app.js"))
+        return {"GET " + path + " HTTP/1.1\\r\\n": {"http.request.method": "GET", "http.request.uri": path,
+                                                    "http.request.version": "HTTP/1.1"},
+                "http.host": host, "http.request.method": "GET", "http.user_agent": "Mozilla/5.0 (X11; Linux x86_64)",
+                "http.request.full_uri": f"http://{host}{path}", "http.request": "1", "http.request_number": "1"}
+    return {"HTTP/1.1 200 OK\\r\\n": {"http.response.version": "HTTP/1.1", "http.response.code": "200"},
+            "http.response.code": "200", "http.content_type": "text/html", "http.response": "1",
+            "http.file_data": "<html><body>ok</body></html>"}
+
+def build_packet(rng, protocol, frame_number, epoch_seconds):
+    """One packet in `tshark -T json` shape for the given protocol."""
+    eth = {"eth.dst": _mac(rng), "eth.src": _mac(rng), "eth.type": "0x0800"}
+    layers = {"eth": eth}
+    client, server = _ipv4(rng), _ipv4(rng, private=False)
+    if protocol == "arp":
+        eth["eth.type"] = "0x0806"
+        layers["arp"] = {"arp.hw.type": "1", "arp.proto.type": "0x0800", "arp.opcode": rng.choice(("1", "2")),
+                         "arp.src.hw_mac": eth["eth.src"], "arp.src.proto_ipv4": client,
+                         "arp.dst.hw_mac": "00:00:00:00:00:00", "arp.dst.proto_ipv4": _ipv4(rng)}
+        protocols = "eth:ethertype:arp"
+    elif protocol == "icmp":
+        layers["ip"] = _ip_layer(rng, client, server, 1)
+        layers["icmp"] = {"icmp.type": rng.choice(("8", "0", "3")), "icmp.code": "0",
+                          "icmp.checksum": f"0x{rng.randrange(65536):04x}", "icmp.ident": str(rng.randrange(65536))}
+        protocols = "eth:ethertype:ip:icmp:data"
+    elif protocol in ("udp", "dns"):
+        layers["ip"] = _ip_layer(rng, client, server, 17)
+        layers["udp"] = _udp_layer(rng, rng.randrange(1024, 65535), 53 if protocol == "dns" else rng.choice((123, 514, 5353)))
+        if protocol == "dns":
+            layers["dns"] = _dns_layer(rng)
+            protocols = "eth:ethertype:ip:udp:dns"
+        else:
+            protocols = "eth:ethertype:ip:udp:data"
+    else:
+        layers["ip"] = _ip_layer(rng, client, server, 6)
+        dst_port = {"tls": 443, "http": 80}.get(protocol, rng.choice((22, 3389, 8080, 5432)))
+        layers["tcp"] = _tcp_layer(rng, rng.randrange(1024, 65535), dst_port, rng.choice((0x002, 0x012, 0x010, 0x018, 0x011)))
+        protocols = "eth:ethertype:ip:tcp"
+        if protocol == "tls":
+            layers["tls"] = _tls_layer(rng)
+            protocols += ":tls"
+        elif protocol == "http":
+            layers["http"] = _http_layer(rng)
+            protocols += ":http"
+    layers = {"frame": _frame_layer(frame_number, epoch_seconds, protocols, rng.randrange(60, 1514)), **layers}
+    return {"_index": "packets-2023-11-14", "_type": "doc", "_score": None, "_source": {"layers": layers}}
+
+def build_malformed_packet(rng, frame_number, epoch_seconds):
+    """Malformed shapes the converter must survive: no layers, bad integers, bad timestamps, wrong types."""
+    kind = rng.randrange(4)
+    if kind == 0:
+        return {"_index": "packets-2023-11-14", "_source": {}}
+    packet = build_packet(rng, "tcp", frame_number, epoch_seconds)
+    layers = packet["_source"]["layers"]
+    if kind == 1:
+        layers["tcp"]["tcp.srcport"] = "not-a-port"
+    elif kind == 2:
+        layers["frame"]["frame.time_utc"] = "garbled timestamp"
+        layers["frame"].pop("frame.time_epoch")
+    else:
+        layers["ip"] = ["unexpected", "list"]
+    return packet
+
+def iter_packets(packet_count, mix=None, malformed_ratio=0.0, seed=1234, start_epoch=1700000000, packets_per_second=500):
+    """Yields `packet_count` synthetic packets; deterministic for a given seed."""
+    rng = random.Random(seed)
+    weights = mix or DEFAULT_MIX
+    protocols = list(weights)
+    cumulative = list(weights.values())
+    for frame_number in range(1, packet_count + 1):
+        epoch_seconds = start_epoch + frame_number // packets_per_second
+        if malformed_ratio and rng.random() < malformed_ratio:
+            yield build_malformed_packet(rng, frame_number, epoch_seconds)
+        else:
+            yield build_packet(rng, rng.choices(protocols, cumulative)[0], frame_number, epoch_seconds)
+
+def _projected_values(layers, layer_path):
+    """Values of one `UDM_SOURCE_FIELDS` path in a full packet, as EK would list them."""
+    nodes = [layers]
+    for key in layer_path:
+        next_nodes = []
+        for node in nodes:
+            if isinstance(node, list):
+                node = node[0] if node else None # Mirrors the mapper's "first record" rule
+            if not isinstance(node, dict):
+                continue
+            if key == "*":
+                next_nodes.extend(node.values())
+            elif key in node:
+                next_nodes.append(node[key])
+        nodes = next_nodes
+    return [value for value in nodes if isinstance(value, str)]
+
+def to_ek_lines(packet):
+    """Renders a synthetic packet as the two lines `tshark -T ek -e <UDM_SOURCE_FIELDS>` would print."""
+    layers = packet.get("_source", {}).get("layers") or {}
+    projected = {}
+    if isinstance(layers, dict):
+        for field_name, layer_path in json2udm_cloud.UDM_SOURCE_FIELDS:
+            values = _projected_values(layers, layer_path)
+            if values:
+                projected[field_name.replace(".", "_")] = values
+    return (json.dumps({"index": {"_index": "packets-2023-11-14", "_type": "doc"}}) + "\n" +
+            json.dumps({"timestamp": "1700000000000", "layers": projected}) + "\n")
+
+def write_corpus(path, packet_count, mix=None, malformed_ratio=0.0, seed=1234, output_format="json"):
+    """Writes a corpus file ("json": `-T json` array, "ek": projected EK lines). Returns bytes written."""
+    with open(path, "w") as f_out:
+        if output_format == "ek":
+            for packet in iter_packets(packet_count, mix, malformed_ratio, seed):
+                f_out.write(to_ek_lines(packet))
+        else:
+            f_out.write("[\n")
+            for index, packet in enumerate(iter_packets(packet_count, mix, malformed_ratio, seed)):
+                f_out.write(("  " if index == 0 else ",\n  ") + json.dumps(packet, indent=2).replace("\n", "\n  "))
+            f_out.write("\n]\n")
+        return f_out.tell()
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic TShark JSON corpus.")
+    parser.add_argument("output_file")
+    parser.add_argument("--packets", type=int, default=10000)
+    parser.add_argument("--mix", type=parse_mix, default=None, help="Protocol weights, e.g. tcp=40,dns=20,tls=20")
+    parser.add_argument("--malformed", type=float, default=0.0, help="Fraction of malformed packets (0-1)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--format", dest="output_format", choices=("json", "ek"), default="json")
+    args = parser.parse_args()
+    size_bytes = write_corpus(args.output_file, args.packets, args.mix, args.malformed, args.seed, args.output_format)
+    print(f"Wrote {args.packets} packets ({size_bytes / (1024 * 1024):.1f} MB) to {args.output_file}")
+
+if __name__ == "__main__":
+    main()